@@ -14,3 +14,12 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "ImageExtraction.settings")
 
 application = get_asgi_application()
+
+# Initialize Vertex AI in the background so the first upload doesn't pay for it.
+# Only server processes load this module, not migrations or other commands.
+from django.conf import settings  # noqa: E402
+
+if settings.VERTEX_WARM_UP_ON_START:
+    from apps.image_app.vertex_model import warm_up  # noqa: E402
+
+    warm_up(background=True)
@@ -241,6 +241,150 @@ EMAIL_USE_TLS = os.getenv("EMAIL_USE_TLS", "False").lower() in ["true", "1"]
 DEFAULT_FROM_EMAIL = os.getenv("DEFAULT_FROM_EMAIL", "no-reply@example.com")
 FRONTEND_URL = os.getenv("FRONTEND_URL")
 
+# Extraction result cache (SQLite file shared by all workers on the host)
+EXTRACTION_CACHE_ENABLED = os.getenv("EXTRACTION_CACHE_ENABLED", "True").lower() in ["true", "1"]
+EXTRACTION_CACHE_PATH = os.getenv(
+    "EXTRACTION_CACHE_PATH",
+    os.path.join(BASE_DIR, "cache", "extraction_cache.sqlite3"),
+)
+EXTRACTION_CACHE_TTL = int(os.getenv("EXTRACTION_CACHE_TTL", str(7 * 24 * 3600)))
+EXTRACTION_CACHE_MAX_ENTRIES = int(os.getenv("EXTRACTION_CACHE_MAX_ENTRIES", "5000"))
+
+# Lock files used to coalesce identical extractions across worker processes
+EXTRACTION_LOCK_DIR = os.getenv("EXTRACTION_LOCK_DIR", os.path.join(BASE_DIR, "cache", "locks"))
+
+# Full-document PDFs are split into page windows extracted in parallel. The
+# window size and fan-out adapt to observed latency within these bounds.
+PAGE_WINDOW_SIZE = int(os.getenv("PAGE_WINDOW_SIZE", "10"))
+PAGE_WINDOW_MIN_SIZE = int(os.getenv("PAGE_WINDOW_MIN_SIZE", "2"))
+PAGE_WINDOW_MAX_SIZE = int(os.getenv("PAGE_WINDOW_MAX_SIZE", "25"))
+PAGE_WINDOW_MAX_WORKERS = int(os.getenv("PAGE_WINDOW_MAX_WORKERS", "4"))
+PAGE_WINDOW_TARGET_SECONDS = float(os.getenv("PAGE_WINDOW_TARGET_SECONDS", "30"))
+
+# Shared Vertex AI rate limiter. Budgets are per project quota and are shared by
+# every worker using the same RATE_LIMIT_STATE_PATH.
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "True").lower() in ["true", "1"]
+RATE_LIMIT_STATE_PATH = os.getenv(
+    "RATE_LIMIT_STATE_PATH",
+    os.path.join(BASE_DIR, "cache", "rate_limiter.sqlite3"),
+)
+VERTEX_REQUESTS_PER_MINUTE = int(os.getenv("VERTEX_REQUESTS_PER_MINUTE", "60"))
+VERTEX_TOKENS_PER_MINUTE = int(os.getenv("VERTEX_TOKENS_PER_MINUTE", "4000000"))
+VERTEX_MAX_CONCURRENCY = int(os.getenv("VERTEX_MAX_CONCURRENCY", "16"))
+VERTEX_MIN_CONCURRENCY = int(os.getenv("VERTEX_MIN_CONCURRENCY", "1"))
+RATE_LIMIT_QUOTA_COOLDOWN_SECONDS = float(os.getenv("RATE_LIMIT_QUOTA_COOLDOWN_SECONDS", "10"))
+RATE_LIMIT_MAX_WAIT_SECONDS = float(os.getenv("RATE_LIMIT_MAX_WAIT_SECONDS", "300"))
+# Fair share of the limiter per user tier (JSON object of tier -> weight,
+# max_concurrency, max_per_user); empty uses rate_limiter.DEFAULT_TIER_CONCURRENCY
+TIER_CONCURRENCY = os.getenv("TIER_CONCURRENCY", "")
+
+# Retry budget for Vertex calls: an overall deadline across attempts, a timeout
+# per attempt, and a circuit breaker that fails fast while Vertex is unhealthy.
+VERTEX_REQUEST_DEADLINE_SECONDS = float(os.getenv("VERTEX_REQUEST_DEADLINE_SECONDS", "300"))
+VERTEX_ATTEMPT_TIMEOUT_SECONDS = float(os.getenv("VERTEX_ATTEMPT_TIMEOUT_SECONDS", "120"))
+CIRCUIT_BREAKER_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_BREAKER_FAILURE_THRESHOLD", "5"))
+CIRCUIT_BREAKER_RESET_SECONDS = float(os.getenv("CIRCUIT_BREAKER_RESET_SECONDS", "30"))
+
+# Vertex AI is initialized on first use. Set VERTEX_WARM_UP_ON_START to initialize
+# it in the background as soon as a WSGI/ASGI worker starts instead.
+VERTEX_WARM_UP_ON_START = os.getenv("VERTEX_WARM_UP_ON_START", "False").lower() in ["true", "1"]
+# Clients (gRPC channels) per endpoint and model, keep-alive pings on idle ones,
+# access token refresh ahead of expiry, and a count_tokens call per client on warm-up
+VERTEX_CHANNELS = int(os.getenv("VERTEX_CHANNELS", "4"))
+VERTEX_KEEPALIVE_SECONDS = float(os.getenv("VERTEX_KEEPALIVE_SECONDS", "60"))
+VERTEX_CREDENTIAL_REFRESH_MARGIN_SECONDS = float(os.getenv("VERTEX_CREDENTIAL_REFRESH_MARGIN_SECONDS", "300"))
+VERTEX_WARM_UP_CALL = os.getenv("VERTEX_WARM_UP_CALL", "True").lower() in ["true", "1"]
+# Budget for importing the app in a fresh process, enforced by `manage.py check_import_time`
+IMPORT_TIME_BUDGET_SECONDS = float(os.getenv("IMPORT_TIME_BUDGET_SECONDS", "1.5"))
+
+# Extraction backend: "vertex" (default), "record" (Vertex, saving responses to
+# EXTRACTION_RECORDINGS_DIR), "replay" (recorded responses, offline) or "fake".
+EXTRACTION_BACKEND = os.getenv("EXTRACTION_BACKEND", "vertex")
+EXTRACTION_RECORDINGS_DIR = os.getenv(
+    "EXTRACTION_RECORDINGS_DIR",
+    os.path.join(BASE_DIR, "cache", "recordings"),
+)
+# Simulated behaviour of the replay/fake backends
+FAKE_BACKEND_LATENCY = os.getenv("FAKE_BACKEND_LATENCY", "lognormal:5:0.5")
+FAKE_BACKEND_LATENCY_PER_PAGE = float(os.getenv("FAKE_BACKEND_LATENCY_PER_PAGE", "0.5"))
+FAKE_BACKEND_ERROR_RATE = float(os.getenv("FAKE_BACKEND_ERROR_RATE", "0"))
+FAKE_BACKEND_QUOTA_ERROR_RATE = float(os.getenv("FAKE_BACKEND_QUOTA_ERROR_RATE", "0"))
+FAKE_BACKEND_PROMPT_TOKENS_PER_PAGE = int(os.getenv("FAKE_BACKEND_PROMPT_TOKENS_PER_PAGE", "258"))
+FAKE_BACKEND_OUTPUT_TOKENS_PER_PAGE = int(os.getenv("FAKE_BACKEND_OUTPUT_TOKENS_PER_PAGE", "350"))
+FAKE_BACKEND_SEED = os.getenv("FAKE_BACKEND_SEED", "0")
+
+# Image normalization before extraction (rotate, downsize, grayscale, recompress)
+IMAGE_NORMALIZATION_ENABLED = os.getenv("IMAGE_NORMALIZATION_ENABLED", "True").lower() in ["true", "1"]
+IMAGE_MAX_LONG_EDGE = int(os.getenv("IMAGE_MAX_LONG_EDGE", "1536"))
+IMAGE_GRAYSCALE_ENABLED = os.getenv("IMAGE_GRAYSCALE_ENABLED", "True").lower() in ["true", "1"]
+IMAGE_GRAYSCALE_THRESHOLD = float(os.getenv("IMAGE_GRAYSCALE_THRESHOLD", "8"))
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "85"))
+
+# Send PDF pages with a usable text layer as text instead of page images
+PDF_TEXT_LAYER_ENABLED = os.getenv("PDF_TEXT_LAYER_ENABLED", "True").lower() in ["true", "1"]
+PDF_TEXT_LAYER_MIN_CHARS = int(os.getenv("PDF_TEXT_LAYER_MIN_CHARS", "200"))
+PDF_TEXT_LAYER_MIN_QUALITY = float(os.getenv("PDF_TEXT_LAYER_MIN_QUALITY", "0.9"))
+
+# Drop blank and duplicate PDF pages before they are sent
+PAGE_FILTER_ENABLED = os.getenv("PAGE_FILTER_ENABLED", "True").lower() in ["true", "1"]
+PAGE_BLANK_INK_RATIO = float(os.getenv("PAGE_BLANK_INK_RATIO", "0.002"))
+PAGE_DUPLICATE_MAX_DISTANCE = int(os.getenv("PAGE_DUPLICATE_MAX_DISTANCE", "4"))
+
+# Prepare PDFs and images of at least PREPROCESSING_POOL_MIN_KB in a pool of
+# processes instead of the request thread (0 workers disables the pool)
+PREPROCESSING_POOL_WORKERS = int(os.getenv("PREPROCESSING_POOL_WORKERS", "2"))
+PREPROCESSING_POOL_MIN_KB = int(os.getenv("PREPROCESSING_POOL_MIN_KB", "256"))
+
+# Memory a worker process may hold for documents being extracted (0 = no
+# limit). Requests wait up to MEMORY_ADMISSION_TIMEOUT_SECONDS for room;
+# documents estimated above the whole budget are rejected.
+MEMORY_BUDGET_MB = float(os.getenv("MEMORY_BUDGET_MB", "1024"))
+MEMORY_ADMISSION_TIMEOUT_SECONDS = float(os.getenv("MEMORY_ADMISSION_TIMEOUT_SECONDS", "60"))
+
+# Pre-flight token estimates and per-user input token budgets (0 = unlimited)
+USER_INPUT_TOKEN_BUDGET = int(os.getenv("USER_INPUT_TOKEN_BUDGET", "0"))
+USER_TOKEN_BUDGET_PERIOD_DAYS = int(os.getenv("USER_TOKEN_BUDGET_PERIOD_DAYS", "30"))
+ESTIMATE_METHOD = os.getenv("ESTIMATE_METHOD", "local")
+ESTIMATE_SAMPLE_PAGES = int(os.getenv("ESTIMATE_SAMPLE_PAGES", "10"))
+ESTIMATE_HISTORY_SIZE = int(os.getenv("ESTIMATE_HISTORY_SIZE", "200"))
+ESTIMATE_CALIBRATION_MIN_DOCUMENTS = int(os.getenv("ESTIMATE_CALIBRATION_MIN_DOCUMENTS", "5"))
+ESTIMATE_SECONDS_PER_PAGE = float(os.getenv("ESTIMATE_SECONDS_PER_PAGE", "4.0"))
+
+# Per-request model routing (JSON list of routes) and the fallback chain after MODEL_ID
+MODEL_ROUTES = os.getenv("MODEL_ROUTES", "[]")
+MODEL_FALLBACK_IDS = [model.strip() for model in os.getenv("MODEL_FALLBACK_IDS", "").split(",") if model.strip()]
+MODEL_QUOTA_COOLDOWN_SECONDS = float(os.getenv("MODEL_QUOTA_COOLDOWN_SECONDS", "60"))
+
+# Batch uploads of reimbursement receipts, packed into few model calls
+RECEIPT_BATCH_MAX_FILES = int(os.getenv("RECEIPT_BATCH_MAX_FILES", "50"))
+RECEIPT_BATCH_MAX_DOCUMENTS = int(os.getenv("RECEIPT_BATCH_MAX_DOCUMENTS", "10"))
+RECEIPT_BATCH_MAX_REQUEST_MB = float(os.getenv("RECEIPT_BATCH_MAX_REQUEST_MB", "15"))
+RECEIPT_BATCH_MAX_OUTPUT_TOKENS = int(os.getenv("RECEIPT_BATCH_MAX_OUTPUT_TOKENS", "8192"))
+RECEIPT_BATCH_MAX_WORKERS = int(os.getenv("RECEIPT_BATCH_MAX_WORKERS", "4"))
+# Ask the model for reimbursement expenses only and compute the totals locally
+REIMBURSEMENT_LOCAL_AGGREGATES = os.getenv("REIMBURSEMENT_LOCAL_AGGREGATES", "True").lower() in ["true", "1"]
+
+# Send the output schema a prompt declares in prompts.yaml as response_schema
+STRUCTURED_OUTPUT_ENABLED = os.getenv("STRUCTURED_OUTPUT_ENABLED", "True").lower() in ["true", "1"]
+
+# Recover truncated or malformed model output instead of re-running the document
+OUTPUT_SALVAGE_ENABLED = os.getenv("OUTPUT_SALVAGE_ENABLED", "True").lower() in ["true", "1"]
+OUTPUT_CONTINUATION_MAX_ROUNDS = int(os.getenv("OUTPUT_CONTINUATION_MAX_ROUNDS", "2"))
+
+# Hedged requests: a second identical call when one is slower than recent ones
+HEDGING_ENABLED = os.getenv("HEDGING_ENABLED", "False").lower() in ["true", "1"]
+HEDGE_LATENCY_PERCENTILE = float(os.getenv("HEDGE_LATENCY_PERCENTILE", "95"))
+HEDGE_MIN_DELAY_SECONDS = float(os.getenv("HEDGE_MIN_DELAY_SECONDS", "2"))
+HEDGE_MIN_OBSERVATIONS = int(os.getenv("HEDGE_MIN_OBSERVATIONS", "20"))
+HEDGE_MAX_EXTRA_LOAD = float(os.getenv("HEDGE_MAX_EXTRA_LOAD", "0.05"))
+
+# Vertex AI endpoints (JSON list of project/location/credentials) calls are balanced across
+VERTEX_ENDPOINTS = os.getenv("VERTEX_ENDPOINTS", "[]")
+ENDPOINT_QUOTA_COOLDOWN_SECONDS = float(os.getenv("ENDPOINT_QUOTA_COOLDOWN_SECONDS", "60"))
+
+# How often a running request checks whether its client disconnected (0 disables the check)
+CLIENT_DISCONNECT_POLL_SECONDS = float(os.getenv("CLIENT_DISCONNECT_POLL_SECONDS", "1"))
+
 # SIMPLE_JWT = {
 #     'ACCESS_TOKEN_LIFETIME': timedelta(minutes=30),   # 🔐 30-minute access token
 #     'REFRESH_TOKEN_LIFETIME': timedelta(days=1),      # Optional: 1-day refresh token
@@ -1,15 +1,5 @@
 from .settings import *
-import types
-import sys
-
-# Provide a lightweight stub for vertex_model to avoid external dependencies in tests
-sys.modules.setdefault(
-    "apps.image_app.vertex_model",
-    types.SimpleNamespace(
-        call_gemini_api_with_streaming=lambda *args, **kwargs: None,
-        MODEL_ID="test-model",
-    ),
-)
+import tempfile
 
 DATABASES = {
     "default": {
@@ -17,3 +7,20 @@ DATABASES = {
         "NAME": ":memory:",
     }
 }
+
+_TEST_CACHE_DIR = tempfile.mkdtemp(prefix="adp-test-cache-")
+EXTRACTION_CACHE_PATH = os.path.join(_TEST_CACHE_DIR, "extraction_cache.sqlite3")
+EXTRACTION_LOCK_DIR = os.path.join(_TEST_CACHE_DIR, "locks")
+RATE_LIMIT_STATE_PATH = os.path.join(_TEST_CACHE_DIR, "rate_limiter.sqlite3")
+EXTRACTION_RECORDINGS_DIR = os.path.join(_TEST_CACHE_DIR, "recordings")
+
+# Run the pipeline against the offline fake backend instead of Vertex AI
+EXTRACTION_BACKEND = "fake"
+FAKE_BACKEND_LATENCY = "fixed:0"
+FAKE_BACKEND_LATENCY_PER_PAGE = 0
+
+# No keep-alive thread pinging Vertex from tests
+VERTEX_KEEPALIVE_SECONDS = 0
+
+# Prepare documents in the test process; the pool has its own tests
+PREPROCESSING_POOL_WORKERS = 0
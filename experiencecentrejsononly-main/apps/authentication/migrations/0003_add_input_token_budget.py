@@ -0,0 +1,17 @@
+# Create this file: apps/authentication/migrations/0003_add_input_token_budget.py
+
+from django.db import migrations, models
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authentication', '0002_add_user_types_and_usage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customuser',
+            name='input_token_budget',
+            field=models.IntegerField(default=0),
+        ),
+    ]
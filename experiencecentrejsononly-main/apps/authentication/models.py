@@ -14,11 +14,13 @@ class CustomUser(AbstractUser):
     documents_processed = models.IntegerField(default=0)
     total_pages_processed = models.IntegerField(default=0)
     max_documents_allowed = models.IntegerField(default=20)
+    # Input tokens per USER_TOKEN_BUDGET_PERIOD_DAYS; 0 uses USER_INPUT_TOKEN_BUDGET
+    input_token_budget = models.IntegerField(default=0)
     registration_datetime = models.DateTimeField(default=timezone.now)
     last_document_processed = models.DateTimeField(null=True, blank=True)
     
-    def can_process_document(self):
-        """Check if user can process another document"""
+    def can_process_document(self, count=1):
+        """Check if user can process ``count`` more documents"""
         if self.user_type in ['power', 'admin']:
             return True, None
 
@@ -26,7 +28,10 @@ class CustomUser(AbstractUser):
         if max_allowed <= 0:
             max_allowed = self._meta.get_field('max_documents_allowed').default
 
-        if self.documents_processed >= max_allowed:
+        if self.documents_processed + count > max_allowed:
+            if count > 1:
+                remaining = max(0, max_allowed - self.documents_processed)
+                return False, f"Document limit exceeded: {count} documents requested, {remaining} of {max_allowed} remaining. Please contact plg@valuedx.com or plg@automationedge.com for upgrade."
             return False, f"Document limit reached ({self.documents_processed}/{max_allowed}). Please contact plg@valuedx.com or plg@automationedge.com for upgrade."
 
         return True, None
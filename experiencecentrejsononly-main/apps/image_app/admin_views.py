@@ -10,6 +10,11 @@ from django.utils import timezone
 from datetime import timedelta
 import logging
 
+from . import (
+    client_pool, endpoint_pool, extraction_cache, hedging, memory_budget, metrics, output_schema, preprocessing_pool,
+    rate_limiter, reimbursement, resilience,
+)
+
 logger = logging.getLogger(__name__)
 CustomUser = get_user_model()
 
@@ -149,7 +154,7 @@ class AdminUserManagementView(APIView):
         
         try:
             user_id = request.data.get('user_id')
-            action = request.data.get('action')  # 'change_type', 'update_limit', 'reset_usage'
+            action = request.data.get('action')  # 'change_type', 'update_limit', 'update_token_budget', 'reset_usage'
             
             if not user_id or not action:
                 return Response(
@@ -216,6 +221,30 @@ class AdminUserManagementView(APIView):
                     }
                 }, status=status.HTTP_200_OK)
             
+            elif action == 'update_token_budget':
+                new_budget = request.data.get('new_budget')
+                if not isinstance(new_budget, int) or new_budget < 0:
+                    return Response(
+                        {"error": "new_budget must be a positive integer (0 for the default budget)"},
+                        status=status.HTTP_400_BAD_REQUEST
+                    )
+
+                old_budget = target_user.input_token_budget
+                target_user.input_token_budget = new_budget
+                target_user.save()
+
+                logger.info(f"Admin {user.username} changed user {target_user.username} input token budget from {old_budget} to {new_budget}")
+
+                return Response({
+                    "status": "success",
+                    "message": f"Input token budget updated from {old_budget} to {new_budget}",
+                    "user_info": {
+                        "id": target_user.id,
+                        "username": target_user.username,
+                        "input_token_budget": target_user.input_token_budget
+                    }
+                }, status=status.HTTP_200_OK)
+
             elif action == 'reset_usage':
                 old_docs = target_user.documents_processed
                 old_pages = target_user.total_pages_processed
@@ -240,7 +269,7 @@ class AdminUserManagementView(APIView):
             
             else:
                 return Response(
-                    {"error": "Invalid action. Must be 'change_type', 'update_limit', or 'reset_usage'"},
+                    {"error": "Invalid action. Must be 'change_type', 'update_limit', 'update_token_budget', or 'reset_usage'"},
                     status=status.HTTP_400_BAD_REQUEST
                 )
                 
@@ -256,6 +285,44 @@ class AdminUserManagementView(APIView):
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
 
+class AdminPipelineMetricsView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        """Get extraction pipeline counters and timings for admins"""
+        user = request.user
+
+        # Check if user is admin
+        if user.user_type != 'admin':
+            return Response(
+                {"error": "Admin access required"},
+                status=status.HTTP_403_FORBIDDEN
+            )
+
+        try:
+            return Response({
+                "status": "success",
+                "extraction_cache": extraction_cache.stats(),
+                "rate_limiter": rate_limiter.status(),
+                "circuits": resilience.circuit_states(),
+                "parsing": output_schema.failure_rates(),
+                "hedging": hedging.status(),
+                "endpoints": endpoint_pool.status(),
+                "clients": client_pool.status(),
+                "reimbursement": reimbursement.status(),
+                "preprocessing_pool": preprocessing_pool.status(),
+                "memory": memory_budget.status(),
+                "metrics": metrics.snapshot(),
+                "generated_at": timezone.now().strftime("%Y-%m-%d %H:%M:%S")
+            }, status=status.HTTP_200_OK)
+
+        except Exception as e:
+            logger.error(f"Error collecting pipeline metrics: {str(e)}", exc_info=True)
+            return Response(
+                {"error": "Failed to collect pipeline metrics"},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
+
 class UserUsageStatsView(APIView):
     permission_classes = [IsAuthenticated]
     
@@ -0,0 +1,80 @@
+"""Noticing that the client of a long extraction request has gone away.
+
+A WSGI view only learns that its client disconnected when it writes the
+response, long after the model calls were paid for. Under gunicorn the WSGI
+environ carries the client socket (``gunicorn.socket``), so while a view
+runs, watch() peeks at that socket every CLIENT_DISCONNECT_POLL_SECONDS: a
+socket that is readable but has no data left means the client closed the
+connection, and the request's CancelToken is cancelled.
+
+Servers that don't expose the socket get a token that is never cancelled by
+the watcher; streamed uploads still notice disconnects when their response
+is closed, and every request still ends at its deadline.
+"""
+
+import logging
+import select
+import socket
+import threading
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+from django.conf import settings
+
+from . import resilience
+
+logger = logging.getLogger(__name__)
+
+# Status returned to a client that is no longer there ("Client Closed Request")
+CLIENT_CLOSED_REQUEST = 499
+
+
+def _poll_seconds() -> float:
+    return float(getattr(settings, "CLIENT_DISCONNECT_POLL_SECONDS", 1))
+
+
+def client_socket(request) -> Optional[socket.socket]:
+    """The client connection of ``request``, when the server exposes it."""
+    return getattr(request, "META", {}).get("gunicorn.socket")
+
+
+def is_disconnected(sock: socket.socket) -> bool:
+    """True if the peer of ``sock`` closed the connection."""
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+        if not readable:
+            return False
+        # Readable without data means end of stream; pipelined bytes are left in place
+        return sock.recv(1, socket.MSG_PEEK) == b""
+    except (OSError, ValueError):
+        return True
+
+
+@contextmanager
+def watch(request) -> Iterator[resilience.CancelToken]:
+    """
+    Yield a CancelToken that is cancelled when the client of ``request`` disconnects.
+
+    The socket is watched on a daemon thread until the block exits.
+    """
+    token = resilience.CancelToken()
+    sock = client_socket(request)
+    interval = _poll_seconds()
+    if sock is None or interval <= 0:
+        yield token
+        return
+
+    stopped = threading.Event()
+
+    def run():
+        while not stopped.wait(interval):
+            if is_disconnected(sock):
+                logger.info("Client disconnected while its request was being processed")
+                token.cancel(resilience.CancelToken.CLIENT_DISCONNECTED)
+                return
+
+    threading.Thread(target=run, daemon=True, name="client-disconnect").start()
+    try:
+        yield token
+    finally:
+        stopped.set()
@@ -0,0 +1,264 @@
+"""A pool of Vertex AI clients per endpoint and model, kept warm between calls.
+
+A GenerativeModel holds one gRPC channel, and a single instance shared by
+every thread of a worker serializes its calls on that channel. vertex_model
+therefore creates VERTEX_CHANNELS clients per endpoint and model, and each
+call leases the client with the fewest calls in flight.
+
+The Vertex SDK does not take gRPC channel options, so idle channels are kept
+open with application level keep-alive pings instead: a background thread
+sends a count_tokens call (free of charge) on every client idle for
+VERTEX_KEEPALIVE_SECONDS, and refreshes the access token of every endpoint
+VERTEX_CREDENTIAL_REFRESH_MARGIN_SECONDS before it expires, so no request
+waits for a connection or a token to be minted.
+
+The first call on each client pays for the connection setup; its latency
+per page is recorded as ``vertex.call_seconds_per_page.first`` and that of
+later calls as ``vertex.call_seconds_per_page.steady``.
+"""
+
+import datetime
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional
+
+from django.conf import settings
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+FIRST_CALL_SERIES = "vertex.call_seconds_per_page.first"
+STEADY_CALL_SERIES = "vertex.call_seconds_per_page.steady"
+
+_pools = {}
+_credentials = {}
+_lock = threading.Lock()
+_create_lock = threading.Lock()
+_maintenance_thread = None
+
+
+def _setting(name: str, default):
+    return getattr(settings, name, default)
+
+
+def pool_size() -> int:
+    return max(1, int(_setting("VERTEX_CHANNELS", 4)))
+
+
+class Channel:
+    """One client of a pool and its use."""
+
+    def __init__(self, client: Any):
+        self.client = client
+        self.in_flight = 0
+        self.calls = 0
+        self.last_used = time.monotonic()
+
+
+class ClientPool:
+    """
+    Clients of one endpoint and model.
+
+    Args:
+        name: "<endpoint>/<model>", used in logs and status()
+        factory: Creates a client; called ``size`` times up front
+        size: Number of clients
+        ping: Cheap call made on an idle client to keep its channel open
+    """
+
+    def __init__(self, name: str, factory: Callable[[], Any], size: int, ping: Optional[Callable[[Any], Any]] = None):
+        self.name = name
+        self.ping = ping
+        self.channels = [Channel(factory()) for _ in range(size)]
+        self._lock = threading.Lock()
+
+    def _least_busy(self) -> Channel:
+        return min(self.channels, key=lambda channel: (channel.in_flight, channel.last_used))
+
+    def pick(self) -> Any:
+        """The least busy client, for calls that are not measured (token counts, preparation)."""
+        with self._lock:
+            return self._least_busy().client
+
+    @contextmanager
+    def lease(self, pages: int = 1):
+        """Use the least busy client for one model call, recording its latency per page."""
+        with self._lock:
+            channel = self._least_busy()
+            channel.in_flight += 1
+            first = channel.calls == 0
+            channel.calls += 1
+            channel.last_used = time.monotonic()
+        started = time.monotonic()
+        try:
+            yield channel.client
+        finally:
+            seconds = time.monotonic() - started
+            with self._lock:
+                channel.in_flight -= 1
+                channel.last_used = time.monotonic()
+            metrics.observe(FIRST_CALL_SERIES if first else STEADY_CALL_SERIES, seconds / max(1, pages))
+
+    def keep_alive(self, idle_seconds: float) -> int:
+        """Ping every client idle for ``idle_seconds``; returns the number of pings sent."""
+        if self.ping is None:
+            return 0
+        now = time.monotonic()
+        with self._lock:
+            idle = [channel for channel in self.channels if not channel.in_flight and now - channel.last_used >= idle_seconds]
+            for channel in idle:
+                channel.last_used = now
+        for channel in idle:
+            try:
+                self.ping(channel.client)
+                metrics.increment("vertex.keepalive_pings")
+            except Exception as e:
+                metrics.increment("vertex.keepalive_failures")
+                logger.warning(f"Keep-alive ping on {self.name} failed: {e}")
+        return len(idle)
+
+    def warm_up(self) -> int:
+        """
+        Ping every client once so its channel is connected before the first request.
+
+        The ping counts as the client's first call, so requests that follow
+        are recorded as steady calls. Returns the number of clients warmed.
+        """
+        if self.ping is None:
+            return 0
+        warmed = 0
+        for channel in self.channels:
+            started = time.monotonic()
+            try:
+                self.ping(channel.client)
+            except Exception as e:
+                metrics.increment("vertex.warm_up_failures")
+                logger.warning(f"Warm-up call on {self.name} failed: {e}")
+                continue
+            metrics.observe("vertex.warm_up_seconds", time.monotonic() - started)
+            with self._lock:
+                channel.calls += 1
+                channel.last_used = time.monotonic()
+            warmed += 1
+        return warmed
+
+    def status(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "channels": len(self.channels),
+                "in_flight": [channel.in_flight for channel in self.channels],
+                "calls": [channel.calls for channel in self.channels],
+            }
+
+
+def get_pool(key, create: Callable[[], ClientPool]) -> ClientPool:
+    """
+    Return the pool registered under ``key``, building it with ``create`` on first use.
+
+    Concurrent first callers wait for a single ``create``; a failed one is
+    retried by the next caller.
+    """
+    with _lock:
+        pool = _pools.get(key)
+    if pool is not None:
+        return pool
+    with _create_lock:
+        with _lock:
+            pool = _pools.get(key)
+        if pool is None:
+            pool = create()
+            with _lock:
+                _pools[key] = pool
+    return pool
+
+
+def pools() -> List[ClientPool]:
+    with _lock:
+        return list(_pools.values())
+
+
+def register_credentials(name: str, credentials, refresh: Callable[[Any], None]):
+    """Keep the credentials of endpoint ``name`` fresh, calling ``refresh(credentials)`` ahead of expiry."""
+    with _lock:
+        _credentials[name] = (credentials, refresh)
+
+
+def _expires_in(credentials) -> Optional[float]:
+    expiry = getattr(credentials, "expiry", None)
+    if expiry is None:
+        return None
+    # google-auth keeps expiry as a naive UTC datetime
+    return (expiry - datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)).total_seconds()
+
+
+def refresh_credentials(force: bool = False) -> int:
+    """Refresh credentials without a token or expiring within the margin; returns the number refreshed."""
+    margin = float(_setting("VERTEX_CREDENTIAL_REFRESH_MARGIN_SECONDS", 300))
+    with _lock:
+        registered = list(_credentials.items())
+    refreshed = 0
+    for name, (credentials, refresh) in registered:
+        expires_in = _expires_in(credentials)
+        if not force and getattr(credentials, "token", None) and (expires_in is None or expires_in > margin):
+            continue
+        try:
+            refresh(credentials)
+            refreshed += 1
+            metrics.increment("vertex.credential_refreshes")
+        except Exception as e:
+            metrics.increment("vertex.credential_refresh_failures")
+            logger.warning(f"Refreshing the credentials of endpoint '{name}' failed: {e}")
+    return refreshed
+
+
+def maintain():
+    """One round of credential refresh and keep-alive pings."""
+    refresh_credentials()
+    idle_seconds = float(_setting("VERTEX_KEEPALIVE_SECONDS", 60))
+    if idle_seconds > 0:
+        for pool in pools():
+            pool.keep_alive(idle_seconds)
+
+
+def start_maintenance() -> Optional[threading.Thread]:
+    """Run maintain() on a daemon thread for the life of the worker (once per process)."""
+    global _maintenance_thread
+    interval = float(_setting("VERTEX_KEEPALIVE_SECONDS", 60))
+    if interval <= 0:
+        return None
+
+    def run():
+        while True:
+            time.sleep(interval / 2)
+            try:
+                maintain()
+            except Exception as e:
+                logger.error(f"Vertex client maintenance failed: {e}", exc_info=True)
+
+    with _lock:
+        if _maintenance_thread is None:
+            _maintenance_thread = threading.Thread(target=run, daemon=True, name="vertex-keepalive")
+            _maintenance_thread.start()
+        return _maintenance_thread
+
+
+def status() -> Dict[str, Any]:
+    """Clients per pool, and first versus steady call latency per page."""
+    first = metrics.percentile(FIRST_CALL_SERIES, 50)
+    steady = metrics.percentile(STEADY_CALL_SERIES, 50)
+    return {
+        "pools": {pool.name: pool.status() for pool in pools()},
+        "first_call_seconds_per_page_p50": round(first, 4) if first is not None else None,
+        "steady_call_seconds_per_page_p50": round(steady, 4) if steady is not None else None,
+        "maintenance_running": _maintenance_thread is not None,
+    }
+
+
+def reset():
+    """Forget every pool and credential (used by tests)."""
+    with _lock:
+        _pools.clear()
+        _credentials.clear()
@@ -0,0 +1,279 @@
+"""Load balancing model calls across Vertex AI regions and projects.
+
+VERTEX_ENDPOINTS lists the (project, location, credentials) endpoints calls
+may go to (a JSON list in the environment)::
+
+    [{"name": "us", "location": "us-central1", "requests_per_minute": 300},
+     {"name": "eu", "project": "ida-eu", "location": "europe-west4",
+      "credentials_path": "/secrets/ida-eu.json", "requests_per_minute": 120}]
+
+Omitted fields fall back to LOCATION and SERVICE_ACCOUNT_KEY_PATH, and the
+project to the one of the credentials. Without VERTEX_ENDPOINTS every call
+goes to that single default endpoint.
+
+Each call goes to the endpoint with the lowest recent latency per page,
+weighed by the calls it has in flight and the share of its
+``requests_per_minute`` left in the current minute. An endpoint that
+returns a quota error is passed over for ENDPOINT_QUOTA_COOLDOWN_SECONDS,
+and one that keeps failing is ejected by its circuit breaker until a probe
+call succeeds (a single endpoint is never ejected). A quota or transient
+error fails the call over to the next endpoint, so the caller only sees it
+once every endpoint has failed.
+
+The fake backend honours ``fake_latency``, ``fake_error_rate`` and
+``fake_quota_error_rate`` of an endpoint, so the balancing can be exercised
+offline against local fake endpoints.
+"""
+
+import json
+import logging
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from . import metrics, resilience
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ENDPOINT = "default"
+# Weight of the latest call in an endpoint's latency average
+LATENCY_EWMA_ALPHA = 0.2
+QUOTA_WINDOW_SECONDS = 60
+
+_lock = threading.Lock()
+_pool = None
+_pool_config = None
+
+
+class Endpoint:
+    """One Vertex AI project and location, with its recent health."""
+
+    def __init__(self, config: Dict[str, Any]):
+        self.name = str(config["name"])
+        self.project = config.get("project")
+        self.location = config.get("location")
+        self.credentials_path = config.get("credentials_path")
+        self.requests_per_minute = int(config.get("requests_per_minute") or 0)
+        # Everything else, e.g. the fake backend's fake_latency
+        self.options = config
+        self.latency = None
+        self.in_flight = 0
+        self.calls = 0
+        self.failures = 0
+        self.quota_errors = 0
+        self.quota_until = 0.0
+        self.recent = deque()
+
+    @property
+    def circuit(self) -> resilience.CircuitBreaker:
+        return resilience.circuit_for(f"endpoint.{self.name}")
+
+    def _requests_last_minute(self, now: float) -> int:
+        while self.recent and self.recent[0] <= now - QUOTA_WINDOW_SECONDS:
+            self.recent.popleft()
+        return len(self.recent)
+
+    def remaining_quota(self, now: float) -> Optional[float]:
+        """Share of requests_per_minute left in the last minute, or None when unknown."""
+        if not self.requests_per_minute:
+            return None
+        return max(0.0, 1 - self._requests_last_minute(now) / self.requests_per_minute)
+
+    def score(self, now: float) -> float:
+        # Endpoints without a latency yet score 0, so new ones are tried early
+        score = (self.latency or 0.0) * (1 + self.in_flight)
+        remaining = self.remaining_quota(now)
+        if remaining is not None:
+            score /= max(remaining, 0.01)
+        return score
+
+    def __repr__(self):
+        return f"Endpoint({self.name!r}, {self.project!r}, {self.location!r})"
+
+
+def _setting(name: str, default):
+    return getattr(settings, name, default)
+
+
+def _configs() -> List[Dict[str, Any]]:
+    value = _setting("VERTEX_ENDPOINTS", [])
+    if isinstance(value, str):
+        try:
+            value = json.loads(value or "[]")
+        except ValueError as e:
+            raise ImproperlyConfigured(f"Invalid VERTEX_ENDPOINTS: {e}")
+    if not isinstance(value, list) or any(not isinstance(config, dict) for config in value):
+        raise ImproperlyConfigured("VERTEX_ENDPOINTS must be a list of objects")
+    configs = [dict(config, name=config.get("name") or f"endpoint-{index + 1}") for index, config in enumerate(value)]
+    if len({config["name"] for config in configs}) != len(configs):
+        raise ImproperlyConfigured("VERTEX_ENDPOINTS names must be unique")
+    return configs or [{"name": DEFAULT_ENDPOINT}]
+
+
+def endpoints() -> List[Endpoint]:
+    """Return the endpoints of VERTEX_ENDPOINTS, in configuration order."""
+    global _pool, _pool_config
+    configs = _configs()
+    with _lock:
+        if configs != _pool_config:
+            _pool = [Endpoint(config) for config in configs]
+            _pool_config = configs
+        return list(_pool)
+
+
+def is_cooling_down(endpoint: Endpoint, now: Optional[float] = None) -> bool:
+    return endpoint.quota_until > (now or time.monotonic())
+
+
+def select(exclude: Iterable[str] = ()) -> Endpoint:
+    """
+    Pick the endpoint for the next call.
+
+    Endpoints in a quota cooldown or out of requests_per_minute are only
+    used when no other endpoint is left.
+
+    Raises:
+        CircuitOpenError: If the circuit of every candidate is open
+    """
+    pool = endpoints()
+    if len(pool) == 1:
+        # A single endpoint is never ejected; the model's circuit already fails fast
+        return pool[0]
+    exclude = set(exclude)
+    now = time.monotonic()
+    with _lock:
+        candidates = [endpoint for endpoint in pool if endpoint.name not in exclude] or pool
+        ranked = sorted(
+            candidates,
+            key=lambda endpoint: (
+                is_cooling_down(endpoint, now) or endpoint.remaining_quota(now) == 0,
+                endpoint.score(now),
+                endpoint.in_flight,
+                endpoint._requests_last_minute(now),
+            )
+        )
+    for endpoint in ranked:
+        if endpoint.circuit.allow():
+            return endpoint
+    raise resilience.CircuitOpenError("Vertex AI is currently unavailable. Please try again shortly.")
+
+
+def _started(endpoint: Endpoint):
+    with _lock:
+        endpoint.in_flight += 1
+        endpoint.calls += 1
+        endpoint.recent.append(time.monotonic())
+    metrics.increment(f"endpoints.{endpoint.name}.calls")
+
+
+def _finished(endpoint: Endpoint, seconds_per_page: Optional[float], error: Optional[BaseException] = None) -> Optional[str]:
+    error_class = resilience.classify_error(error) if error is not None else None
+    with _lock:
+        endpoint.in_flight -= 1
+        if error_class is None:
+            endpoint.latency = seconds_per_page if endpoint.latency is None else (
+                LATENCY_EWMA_ALPHA * seconds_per_page + (1 - LATENCY_EWMA_ALPHA) * endpoint.latency
+            )
+        elif error_class == resilience.QUOTA:
+            endpoint.quota_errors += 1
+            endpoint.quota_until = time.monotonic() + float(_setting("ENDPOINT_QUOTA_COOLDOWN_SECONDS", 60))
+        else:
+            endpoint.failures += 1
+    if len(endpoints()) > 1:
+        endpoint.circuit.record(error_class)
+    if error_class is not None:
+        metrics.increment(f"endpoints.{endpoint.name}.errors.{error_class}")
+    return error_class
+
+
+def call(fn: Callable[[Endpoint], Any], pages: int = 1, stream: bool = False) -> Any:
+    """
+    Run the model call ``fn(endpoint)`` on the best endpoint, failing over to the others.
+
+    Args:
+        fn: The call, given the endpoint to use
+        pages: Pages sent, used to compare latencies of calls of different sizes
+        stream: ``fn`` returns an iterator of chunks; it can only fail over
+            before the first chunk, and its latency is taken when it ends
+
+    Returns:
+        The result of ``fn``, or an iterator over its chunks when streaming
+
+    Raises:
+        CircuitOpenError: If every endpoint is ejected
+        Exception: The error of the last endpoint tried when none succeeded
+    """
+    tried = []
+    pool_size = len(endpoints())
+    while True:
+        endpoint = select(tried)
+        tried.append(endpoint.name)
+        _started(endpoint)
+        started = time.monotonic()
+        try:
+            result = fn(endpoint)
+            if stream:
+                result = iter(result)
+                first = next(result, None)
+        except Exception as e:
+            error_class = _finished(endpoint, None, e)
+            if error_class == resilience.FATAL or len(tried) >= pool_size:
+                raise
+            metrics.increment("endpoints.failovers")
+            logger.warning(f"Vertex endpoint '{endpoint.name}' failed ({error_class}), trying another endpoint: {e}")
+            continue
+        if not stream:
+            _finished(endpoint, (time.monotonic() - started) / max(1, pages))
+            return result
+        return _stream(endpoint, first, result, started, pages)
+
+
+def _stream(endpoint: Endpoint, first, chunks: Iterator, started: float, pages: int) -> Iterator:
+    try:
+        if first is not None:
+            yield first
+            for chunk in chunks:
+                yield chunk
+    except Exception as e:
+        _finished(endpoint, None, e)
+        raise
+    except BaseException:
+        # Closed by the consumer before the end; nothing to learn about the endpoint
+        _finished(endpoint, (time.monotonic() - started) / max(1, pages))
+        raise
+    _finished(endpoint, (time.monotonic() - started) / max(1, pages))
+
+
+def status() -> Dict[str, Dict[str, Any]]:
+    """Per-endpoint health and load, by endpoint name."""
+    now = time.monotonic()
+    report = {}
+    for endpoint in endpoints():
+        with _lock:
+            remaining = endpoint.remaining_quota(now)
+            report[endpoint.name] = {
+                "project": endpoint.project,
+                "location": endpoint.location,
+                "state": endpoint.circuit.state,
+                "quota_cooldown_seconds": round(max(0.0, endpoint.quota_until - now), 1),
+                "calls": endpoint.calls,
+                "failures": endpoint.failures,
+                "quota_errors": endpoint.quota_errors,
+                "in_flight": endpoint.in_flight,
+                "seconds_per_page": round(endpoint.latency, 4) if endpoint.latency is not None else None,
+                "requests_last_minute": endpoint._requests_last_minute(now),
+                "remaining_quota": round(remaining, 4) if remaining is not None else None,
+            }
+    return report
+
+
+def reset():
+    """Forget endpoint statistics (used by tests)."""
+    global _pool, _pool_config
+    with _lock:
+        _pool = None
+        _pool_config = None
@@ -0,0 +1,315 @@
+"""Pre-flight estimates of input tokens and latency, and per-user token budgets.
+
+The estimate runs the same preprocessing as a real request (page filter, text
+layer, image normalization) on the first ESTIMATE_SAMPLE_PAGES pages and
+counts the payload locally: text at about four characters per token, each
+PDF page and image by Gemini's image tiling rule. The per-page cost of the
+sample is extrapolated to the pages the request would send.
+
+The local count is calibrated against billed promptTokenCount: every saved
+Document records the uncalibrated estimate in its processing_metadata, and
+the ratio of actual to estimated tokens over recent documents scales new
+estimates. Uploads are checked against the user's input token budget with
+the calibrated estimate before any Vertex call is made.
+
+Uploads of users without a budget only get quick_estimate(), which counts
+pages and does not preprocess anything.
+"""
+
+import io
+import logging
+import math
+import mimetypes
+import statistics
+from datetime import timedelta
+from typing import Any, Dict, List, Optional
+
+from django.conf import settings
+from django.db.models import Sum
+from django.utils import timezone
+from PIL import Image
+
+from . import extraction_backends, image_normalization, metrics, page_windows, pdf_slicing, preprocessing
+
+logger = logging.getLogger(__name__)
+
+# Gemini bills every PDF page as one image of up to 768x768 px
+PDF_PAGE_TOKENS = image_normalization.TOKENS_PER_IMAGE_TILE
+CHARS_PER_TOKEN = 4
+
+# Calibration factors are clamped so a few odd documents cannot skew estimates wildly
+MIN_CALIBRATION = 0.25
+MAX_CALIBRATION = 4.0
+
+# Method of quick_estimate(); such estimates are not used for calibration
+PAGE_COUNT = "page_count"
+
+ALLOW = "allow"
+DOWNGRADE = "downgrade"
+REJECT = "reject"
+
+
+def _setting(name: str, default):
+    return getattr(settings, name, default)
+
+
+def _text_tokens(text: str) -> int:
+    return math.ceil(len(text or "") / CHARS_PER_TOKEN)
+
+
+def _part_tokens(part: preprocessing.PreparedInput) -> int:
+    if part.data is None:
+        return _text_tokens(part.text)
+    if part.mime_type == "application/pdf":
+        try:
+            with pdf_slicing.PdfDocument(part.data) as document:
+                return document.page_count * PDF_PAGE_TOKENS
+        except Exception:
+            return part.pages * PDF_PAGE_TOKENS
+    if (part.mime_type or "").startswith("image/"):
+        try:
+            return image_normalization.estimate_image_tokens(*Image.open(io.BytesIO(part.data)).size)
+        except Exception:
+            return PDF_PAGE_TOKENS
+    return PDF_PAGE_TOKENS
+
+
+def _page_count(path: str) -> int:
+    mime_type, _ = mimetypes.guess_type(path)
+    if mime_type != "application/pdf":
+        return 1
+    try:
+        return pdf_slicing.page_count(path)
+    except Exception:
+        return 1
+
+
+def _recent_documents():
+    from .models import Document
+
+    return (
+        Document.objects.filter(input_token__gt=0, pages_processed__gt=0)
+        .order_by("-id")[:int(_setting("ESTIMATE_HISTORY_SIZE", 200))]
+    )
+
+
+def calibration_factor() -> float:
+    """Ratio of billed to locally estimated input tokens over recent documents (1.0 without history)."""
+    actual = estimated = count = 0
+    for input_token, metadata in _recent_documents().values_list("input_token", "processing_metadata"):
+        local = (metadata or {}).get("estimated_input_tokens")
+        if local:
+            actual += input_token
+            estimated += local
+            count += 1
+    if count < int(_setting("ESTIMATE_CALIBRATION_MIN_DOCUMENTS", 5)) or not estimated:
+        return 1.0
+    return max(MIN_CALIBRATION, min(MAX_CALIBRATION, actual / estimated))
+
+
+def seconds_per_page() -> float:
+    """Median model latency per page over recent documents, else the live window EWMA, else the default."""
+    history = [
+        api_response_time / pages
+        for api_response_time, pages in _recent_documents().values_list("api_response_time", "pages_processed")
+        if api_response_time
+    ]
+    if len(history) >= int(_setting("ESTIMATE_CALIBRATION_MIN_DOCUMENTS", 5)):
+        return statistics.median(history)
+    return page_windows.controller.seconds_per_page() or float(_setting("ESTIMATE_SECONDS_PER_PAGE", 4.0))
+
+
+def expected_latency(pages: int, max_pages: Optional[int]) -> float:
+    """Expected model time for ``pages`` pages; full documents run in concurrent page windows."""
+    per_page = seconds_per_page()
+    window_size = page_windows.controller.window_size()
+    if max_pages is None and pages > window_size:
+        windows = math.ceil(pages / window_size)
+        rounds = math.ceil(windows / page_windows.controller.concurrency())
+        return rounds * window_size * per_page
+    return pages * per_page
+
+
+def _count_with_backend(path: str, prompt_text: str, sample_pages: int) -> Optional[int]:
+    """Count the sample with the backend's count_tokens (a Vertex call), or None if unsupported."""
+    request = extraction_backends.ExtractionRequest(prompt_text, path, sample_pages, {})
+    backend = extraction_backends.get_backend()
+    backend.prepare(request, lambda message: None)
+    return backend.count_tokens(request)
+
+
+def estimate(path: str, prompt_text: str, max_pages: Optional[int], method: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Estimate the input tokens and latency of extracting ``path``.
+
+    Args:
+        path: Path of the uploaded document
+        prompt_text: Prompt that would be sent
+        max_pages: Page limit that would apply (None for the whole document)
+        method: "local" or "count_tokens" (ESTIMATE_METHOD by default)
+
+    Returns:
+        dict: total_pages, page_limit, pages_to_process, estimated_input_tokens
+        (calibrated), local_input_tokens (uncalibrated), prompt_tokens,
+        tokens_per_page, calibration_factor, expected_latency_seconds, method
+    """
+    method = method or _setting("ESTIMATE_METHOD", "local")
+    total_pages = _page_count(path)
+    pages = total_pages if max_pages is None else min(total_pages, max_pages)
+    sample_pages = max(1, min(pages, int(_setting("ESTIMATE_SAMPLE_PAGES", 10))))
+    prompt_tokens = _text_tokens(prompt_text)
+
+    prepared, _, _, metadata = preprocessing.prepare_inputs(path, sample_pages)
+    sample_tokens = sum(_part_tokens(part) for item in prepared for part in item.parts())
+    tokens_per_page = sample_tokens / sample_pages
+    local_tokens = prompt_tokens + math.ceil(tokens_per_page * pages)
+
+    factor = calibration_factor()
+    estimated_tokens = math.ceil(local_tokens * factor)
+    if method == "count_tokens":
+        counted = _count_with_backend(path, prompt_text, sample_pages)
+        if counted is not None:
+            # Counted tokens are exact for the sample and need no calibration
+            factor = 1.0
+            tokens_per_page = max(0, counted - prompt_tokens) / sample_pages
+            estimated_tokens = prompt_tokens + math.ceil(tokens_per_page * pages)
+        else:
+            method = "local"
+
+    skip_ratio = len(metadata.get("pages_skipped", [])) / sample_pages
+    metrics.increment("estimation.estimates")
+    return {
+        "total_pages": total_pages,
+        "page_limit": max_pages,
+        "pages_to_process": pages,
+        "estimated_pages_skipped": round(skip_ratio * pages),
+        "estimated_input_tokens": estimated_tokens,
+        "local_input_tokens": local_tokens,
+        "prompt_tokens": prompt_tokens,
+        "tokens_per_page": round(tokens_per_page, 1),
+        "calibration_factor": round(factor, 3),
+        "expected_latency_seconds": round(expected_latency(pages - round(skip_ratio * pages), max_pages), 1),
+        "method": method,
+    }
+
+
+def quick_estimate(path: str, prompt_text: str, max_pages: Optional[int]) -> Dict[str, Any]:
+    """
+    Estimate from the page count alone, counting every page as one PDF page image.
+
+    Returns:
+        dict: The keys of estimate(), with ``method`` PAGE_COUNT
+    """
+    total_pages = _page_count(path)
+    pages = total_pages if max_pages is None else min(total_pages, max_pages)
+    prompt_tokens = _text_tokens(prompt_text)
+    local_tokens = prompt_tokens + pages * PDF_PAGE_TOKENS
+    factor = calibration_factor()
+    metrics.increment("estimation.quick_estimates")
+    return {
+        "total_pages": total_pages,
+        "page_limit": max_pages,
+        "pages_to_process": pages,
+        "estimated_pages_skipped": 0,
+        "estimated_input_tokens": math.ceil(local_tokens * factor),
+        "local_input_tokens": local_tokens,
+        "prompt_tokens": prompt_tokens,
+        "tokens_per_page": float(PDF_PAGE_TOKENS),
+        "calibration_factor": round(factor, 3),
+        "expected_latency_seconds": round(expected_latency(pages, max_pages), 1),
+        "method": PAGE_COUNT,
+    }
+
+
+def limit_estimate(estimate_result: Dict[str, Any], page_limit: int) -> Dict[str, Any]:
+    """Return ``estimate_result`` rescaled to a lower page limit, e.g. after a budget downgrade."""
+    pages = min(estimate_result["total_pages"], page_limit)
+    page_tokens = math.ceil(estimate_result["tokens_per_page"] * pages)
+    skipped = round(estimate_result["estimated_pages_skipped"] * pages / max(1, estimate_result["pages_to_process"]))
+    return {
+        **estimate_result,
+        "page_limit": page_limit,
+        "pages_to_process": pages,
+        "estimated_pages_skipped": skipped,
+        "estimated_input_tokens": math.ceil((estimate_result["prompt_tokens"] + page_tokens) * estimate_result["calibration_factor"]),
+        "local_input_tokens": estimate_result["prompt_tokens"] + page_tokens,
+        "expected_latency_seconds": round(expected_latency(pages - skipped, page_limit), 1),
+    }
+
+
+def combine(estimates: List[Dict[str, Any]], calls: int = 1) -> Dict[str, Any]:
+    """Estimate of sending several documents in ``calls`` model calls, each carrying the prompt once."""
+    prompt_tokens = estimates[0]["prompt_tokens"] * calls
+    page_tokens = sum(item["local_input_tokens"] - item["prompt_tokens"] for item in estimates)
+    pages = sum(item["pages_to_process"] for item in estimates)
+    factor = estimates[0]["calibration_factor"]
+    return {
+        "total_pages": sum(item["total_pages"] for item in estimates),
+        "page_limit": estimates[0]["page_limit"],
+        "pages_to_process": pages,
+        "estimated_pages_skipped": sum(item["estimated_pages_skipped"] for item in estimates),
+        "estimated_input_tokens": math.ceil((prompt_tokens + page_tokens) * factor),
+        "local_input_tokens": prompt_tokens + page_tokens,
+        "prompt_tokens": prompt_tokens,
+        "tokens_per_page": round(page_tokens / max(1, pages), 1),
+        "calibration_factor": factor,
+        # Calls run concurrently
+        "expected_latency_seconds": round(math.ceil(pages / max(1, calls)) * seconds_per_page(), 1),
+        "method": estimates[0]["method"],
+    }
+
+
+def input_token_budget(user) -> Optional[int]:
+    """The user's input token budget per USER_TOKEN_BUDGET_PERIOD_DAYS, or None when unlimited."""
+    return (getattr(user, "input_token_budget", 0) or int(_setting("USER_INPUT_TOKEN_BUDGET", 0))) or None
+
+
+def input_tokens_used(user) -> int:
+    """Input tokens billed to the user's documents within the budget period."""
+    since = timezone.now().date() - timedelta(days=int(_setting("USER_TOKEN_BUDGET_PERIOD_DAYS", 30)))
+    used = user.documents.filter(entry_date__gt=since).aggregate(total=Sum("input_token"))["total"]
+    return used or 0
+
+
+def check_budget(user, estimate_result: Dict[str, Any], replaced_tokens: int = 0) -> Dict[str, Any]:
+    """
+    Decide whether a request fits in the user's remaining token budget.
+
+    A request that does not fit is downgraded to the number of pages that
+    does, or rejected when not even one page fits. ``replaced_tokens`` are
+    billed tokens the request replaces, e.g. those of a document that is
+    re-extracted in full.
+
+    Returns:
+        dict: decision ("allow", "downgrade" or "reject"), limit, used,
+        remaining and the page_limit to apply
+    """
+    limit = input_token_budget(user)
+    page_limit = estimate_result["page_limit"]
+    if limit is None:
+        return {"decision": ALLOW, "limit": None, "used": None, "remaining": None, "page_limit": page_limit}
+
+    used = max(0, input_tokens_used(user) - replaced_tokens)
+    remaining = max(0, limit - used)
+    result = {"decision": ALLOW, "limit": limit, "used": used, "remaining": remaining, "page_limit": page_limit}
+    if estimate_result["estimated_input_tokens"] <= remaining:
+        return result
+
+    calibrated_per_page = estimate_result["tokens_per_page"] * estimate_result["calibration_factor"]
+    prompt_tokens = estimate_result["prompt_tokens"]
+    fitting_pages = int((remaining - prompt_tokens) / calibrated_per_page) if calibrated_per_page else 0
+    if fitting_pages >= 1 and fitting_pages < estimate_result["pages_to_process"]:
+        result.update(decision=DOWNGRADE, page_limit=fitting_pages)
+        metrics.increment("estimation.budget_downgrades")
+    else:
+        result.update(decision=REJECT)
+        metrics.increment("estimation.budget_rejections")
+    return result
+
+
+def record_estimate(metadata: Dict[str, Any], estimate_result: Dict[str, Any]) -> Dict[str, Any]:
+    """Add the uncalibrated estimate to a document's processing_metadata for future calibration."""
+    if estimate_result.get("method") == PAGE_COUNT:
+        return metadata
+    metadata["estimated_input_tokens"] = estimate_result["local_input_tokens"]
+    return metadata
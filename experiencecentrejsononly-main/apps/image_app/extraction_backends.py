@@ -0,0 +1,461 @@
+"""Pluggable backends that turn one extraction request into a model response.
+
+``EXTRACTION_BACKEND`` selects the backend used by vertex_model:
+
+- ``vertex``: calls Gemini through the Vertex AI SDK (vertex_model.VertexBackend)
+- ``record``: calls Vertex and saves each response under EXTRACTION_RECORDINGS_DIR,
+  keyed by the request fingerprint
+- ``replay``: serves recorded responses without network access, and synthesizes
+  a response for requests that were never recorded
+- ``fake``: always synthesizes responses
+
+``replay`` and ``fake`` wait for a latency drawn from FAKE_BACKEND_LATENCY and
+inject quota and transient errors at the configured rates (or those of the
+endpoint of VERTEX_ENDPOINTS the call went to), so the upload pipeline can be
+load tested offline. Random draws are seeded per request
+fingerprint, which makes runs repeatable regardless of thread scheduling.
+
+Backends return objects shaped like the SDK's GenerationResponse (``text``,
+``candidates``, ``usage_metadata``), or an iterator of such chunks when
+streaming, so vertex_model formats the output of every backend the same way.
+"""
+
+import copy
+import json
+import logging
+import math
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterator, Optional
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from . import endpoint_pool, extraction_cache, metrics, preprocessing, reimbursement
+
+logger = logging.getLogger(__name__)
+
+STREAM_CHUNKS = 8
+# Request fingerprints whose call numbers the fake backend remembers, see FakeBackend._rng()
+FAKE_BACKEND_MAX_FINGERPRINTS = 10000
+
+
+class ResourceExhausted(Exception):
+    """Quota error injected by the fake backend (classified like the SDK's 429)"""
+    pass
+
+
+class ServiceUnavailable(Exception):
+    """Transient error injected by the fake backend (classified like the SDK's 503)"""
+    pass
+
+
+class ExtractionRequest:
+    """One model call: prompt, input and generation parameters."""
+
+    def __init__(
+        self,
+        prompt_text: str,
+        input_data,
+        max_pages: Optional[int],
+        generation_params: Dict[str, Any],
+        doc_type: Optional[str] = None,
+    ):
+        self.prompt_text = prompt_text
+        self.input_data = input_data
+        self.max_pages = max_pages
+        self.generation_params = generation_params
+        # Document type the prompt was chosen for, if the caller knows it
+        self.doc_type = doc_type
+        # Model chosen by model_routing for the current attempt (None for MODEL_ID)
+        self.model = None
+        self.pages_processed = 1
+        self.total_pages = 1
+        # Statistics from preprocessing (e.g. image normalization) returned with the response
+        self.preprocessing = {}
+        # Backend specific payload built by prepare(), e.g. the SDK Parts
+        self.contents = None
+        # Partial answer the model is asked to continue (see output_salvage)
+        self.continuation = None
+        self._fingerprint = None
+
+    @property
+    def pages_sent(self) -> int:
+        """Pages actually sent to the model, after blank and duplicate pages were dropped."""
+        return max(1, self.pages_processed - len(self.preprocessing.get("pages_skipped", [])))
+
+    @property
+    def fingerprint(self) -> str:
+        """Content hash of the request; independent of MODEL_ID so recordings replay under any model."""
+        if self._fingerprint is None:
+            prompt = self.prompt_text or ""
+            if self.continuation is not None:
+                prompt = f"{prompt}\n[continuation of {extraction_cache.hash_text(self.continuation)}]"
+            self._fingerprint = extraction_cache.make_key(
+                extraction_cache.fingerprint_input(self.input_data),
+                prompt,
+                "",
+                self.max_pages,
+                self.generation_params,
+            )
+        return self._fingerprint
+
+    def continue_from(self, partial_text: str) -> "ExtractionRequest":
+        """A copy of this prepared request asking the model to continue ``partial_text``."""
+        continued = copy.copy(self)
+        continued.continuation = partial_text
+        continued._fingerprint = None
+        return continued
+
+
+class UsageMetadata:
+    def __init__(self, prompt_token_count: int, candidates_token_count: int):
+        self.prompt_token_count = prompt_token_count
+        self.candidates_token_count = candidates_token_count
+        self.total_token_count = prompt_token_count + candidates_token_count
+
+
+class GenerationResponse:
+    """Minimal stand-in for the SDK response (or streamed chunk)."""
+
+    def __init__(self, text: str, usage_metadata: Optional[UsageMetadata] = None, finish_reason: Optional[str] = None):
+        self.text = text
+        self.candidates = []
+        self.usage_metadata = usage_metadata
+        self.finish_reason = finish_reason
+
+
+class ExtractionBackend:
+    """Interface implemented by every backend."""
+
+    name = None
+
+    def prepare(self, request: ExtractionRequest, update_progress: Callable[[str], None]) -> int:
+        """Build ``request.contents`` and return the number of pages that will be sent."""
+        return request.pages_processed
+
+    def generate(self, request: ExtractionRequest, stream: bool = False):
+        """Return a response, or an iterator of response chunks when ``stream`` is True."""
+        raise NotImplementedError
+
+    def count_tokens(self, request: ExtractionRequest) -> Optional[int]:
+        """Return the input tokens of a prepared request, or None if the backend cannot count them."""
+        return None
+
+
+def _setting(name: str, default):
+    return getattr(settings, name, default)
+
+
+def _recordings_dir() -> str:
+    return _setting("EXTRACTION_RECORDINGS_DIR", os.path.join(settings.BASE_DIR, "cache", "recordings"))
+
+
+def _recording_path(fingerprint: str) -> str:
+    return os.path.join(_recordings_dir(), f"{fingerprint}.json")
+
+
+def save_recording(request: ExtractionRequest, text: str, usage_metadata, latency: float):
+    """Write the response to ``request`` into the recordings directory."""
+    recording = {
+        "fingerprint": request.fingerprint,
+        "recorded_at": time.time(),
+        "pages_processed": request.pages_processed,
+        "latency_seconds": round(latency, 3),
+        "text": text,
+        "usage": {
+            "prompt_token_count": getattr(usage_metadata, "prompt_token_count", 0) or 0,
+            "candidates_token_count": getattr(usage_metadata, "candidates_token_count", 0) or 0,
+        },
+    }
+    path = _recording_path(request.fingerprint)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(recording, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+        metrics.increment("backend.recorded")
+    except (OSError, TypeError, ValueError) as e:
+        logger.warning(f"Could not save recording {request.fingerprint}: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def load_recording(fingerprint: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(_recording_path(fingerprint), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _response_text(response) -> str:
+    try:
+        return response.text or ""
+    except (AttributeError, ValueError):
+        texts = []
+        for candidate in getattr(response, "candidates", None) or []:
+            for part in getattr(getattr(candidate, "content", None), "parts", None) or []:
+                if getattr(part, "text", None):
+                    texts.append(str(part.text))
+        return "".join(texts)
+
+
+class RecordingBackend(ExtractionBackend):
+    """Pass calls through to another backend and record every successful response."""
+
+    name = "record"
+
+    def __init__(self, delegate: ExtractionBackend):
+        self.delegate = delegate
+
+    def prepare(self, request, update_progress):
+        return self.delegate.prepare(request, update_progress)
+
+    def count_tokens(self, request):
+        return self.delegate.count_tokens(request)
+
+    def generate(self, request, stream=False):
+        started = time.time()
+        response = self.delegate.generate(request, stream=stream)
+        if not stream:
+            save_recording(request, _response_text(response), response.usage_metadata, time.time() - started)
+            return response
+        return self._record_stream(request, response, started)
+
+    def _record_stream(self, request, chunks, started) -> Iterator:
+        texts = []
+        usage_metadata = None
+        for chunk in chunks:
+            texts.append(_response_text(chunk))
+            usage_metadata = getattr(chunk, "usage_metadata", None) or usage_metadata
+            yield chunk
+        save_recording(request, "".join(texts), usage_metadata, time.time() - started)
+
+
+def parse_latency(spec: str) -> Callable[[random.Random, Optional[float]], float]:
+    """
+    Parse a FAKE_BACKEND_LATENCY distribution.
+
+    Supported forms: ``fixed:<s>``, ``uniform:<low>:<high>``,
+    ``lognormal:<median>:<sigma>`` and ``recorded`` (the latency stored with a
+    recording, 0 for synthesized responses).
+
+    Returns:
+        callable: (rng, recorded_latency) -> seconds
+    """
+    kind, _, args = str(spec).strip().partition(":")
+    try:
+        values = [float(value) for value in args.split(":")] if args else []
+        if kind == "fixed" and len(values) == 1:
+            return lambda rng, recorded: values[0]
+        if kind == "uniform" and len(values) == 2:
+            return lambda rng, recorded: rng.uniform(values[0], values[1])
+        if kind == "lognormal" and len(values) == 2:
+            return lambda rng, recorded: rng.lognormvariate(math.log(values[0]), values[1])
+        if kind == "recorded" and not values:
+            return lambda rng, recorded: recorded or 0.0
+    except ValueError:
+        pass
+    raise ImproperlyConfigured(f"Invalid FAKE_BACKEND_LATENCY '{spec}'")
+
+
+def _synthesize_expenses(request: ExtractionRequest) -> str:
+    inputs = request.input_data if isinstance(request.input_data, (list, tuple)) else [request.input_data]
+    documents = max(1, sum(1 for item in inputs if isinstance(item, str) and os.path.isfile(item)))
+    expenses = [
+        {
+            "document": number,
+            "vendor": f"Vendor {number}",
+            "type": "Food" if number % 2 else "Others",
+            "date": "2024-01-15",
+            "amount_inr": f"{100 * number:.2f}",
+            "status": "Allowed" if number % 2 else "Not Allowed",
+            "reason": "synthetic",
+        }
+        for number in range(1, documents + 1)
+    ]
+
+    def group(status):
+        items = [expense for expense in expenses if expense["status"] == status]
+        return {"items": [expense["document"] for expense in items],
+                "total_inr": f"{sum(float(expense['amount_inr']) for expense in items):.2f}"}
+
+    if reimbursement.prompt_name() != reimbursement.FULL_PROMPT:
+        # reimbursement_expenses_prompt: the aggregates are computed locally
+        return json.dumps({"expenses": expenses})
+    allowed, not_allowed = group("Allowed"), group("Not Allowed")
+    return json.dumps({
+        "expenses": expenses,
+        "allowed": allowed,
+        "not_allowed": not_allowed,
+        "summary": {
+            "total_documents": str(documents),
+            "total_amount": f"{sum(float(expense['amount_inr']) for expense in expenses):.2f}",
+            "reimbursable_amount": allowed["total_inr"],
+        },
+    })
+
+
+def synthesize_text(request: ExtractionRequest) -> str:
+    """
+    Return a plausible answer: one expense per attached document for the
+    reimbursement doc type (with the aggregates only when its prompt is
+    reimbursement_extraction_prompt), otherwise a doc_extraction_prompt style
+    answer with one page_N object per page sent.
+    """
+    if request.doc_type == reimbursement.DOC_TYPE:
+        return _synthesize_expenses(request)
+    pages = request.pages_sent
+    return json.dumps({
+        f"page_{page}": {
+            "page_info": f"page {page}/{pages}",
+            "document_type": "synthetic",
+            "fields": {"field_1": f"value {page}.1", "field_2": f"value {page}.2"},
+        }
+        for page in range(1, pages + 1)
+    })
+
+
+def _limit_output(request: ExtractionRequest, text: str, usage: UsageMetadata):
+    """
+    Apply max_output_tokens the way Gemini does: an answer over the limit is
+    cut off with finish reason MAX_TOKENS. A continuation request returns the
+    rest of the answer after the partial text it was given.
+
+    Returns:
+        tuple: (text, usage, finish_reason)
+    """
+    output_tokens = usage.candidates_token_count
+    if request.continuation is not None and text.startswith(request.continuation):
+        remaining = text[len(request.continuation):]
+        output_tokens = output_tokens * len(remaining) // max(1, len(text))
+        text = remaining
+
+    limit = request.generation_params.get("max_output_tokens")
+    if limit and output_tokens > limit:
+        text = text[:len(text) * limit // output_tokens]
+        return text, UsageMetadata(usage.prompt_token_count, limit), "MAX_TOKENS"
+    return text, UsageMetadata(usage.prompt_token_count, output_tokens), "STOP"
+
+
+class FakeBackend(ExtractionBackend):
+    """Replay recorded responses or synthesize them, with simulated latency and errors."""
+
+    def __init__(self, replay: bool = False):
+        self.replay = replay
+        self.name = "replay" if replay else "fake"
+        self._calls = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _rng(self, request: ExtractionRequest) -> random.Random:
+        # Seeded by fingerprint and per-fingerprint call number, so retries draw
+        # different values but a rerun of the same workload draws the same ones.
+        # Only the most recent fingerprints are remembered.
+        with self._lock:
+            call = self._calls.pop(request.fingerprint, 0)
+            self._calls[request.fingerprint] = call + 1
+            while len(self._calls) > FAKE_BACKEND_MAX_FINGERPRINTS:
+                self._calls.popitem(last=False)
+        return random.Random(f"{_setting('FAKE_BACKEND_SEED', '0')}:{request.fingerprint}:{call}")
+
+    def reset(self):
+        """Forget the call numbers, so the next run of a workload draws the same values again."""
+        with self._lock:
+            self._calls.clear()
+
+    def prepare(self, request, update_progress):
+        update_progress("Preparing document for processing...")
+        _, request.pages_processed, request.total_pages, request.preprocessing = preprocessing.prepare_inputs(
+            request.input_data, request.max_pages
+        )
+        return request.pages_processed
+
+    def generate(self, request, stream=False):
+        return endpoint_pool.call(lambda endpoint: self._generate(request, stream, endpoint), request.pages_sent, stream)
+
+    def _generate(self, request, stream, endpoint):
+        # An endpoint of VERTEX_ENDPOINTS may simulate its own latency and error rates
+        options = endpoint.options
+        rng = self._rng(request)
+        recording = load_recording(request.fingerprint) if self.replay else None
+        latency = parse_latency(options.get("fake_latency") or _setting("FAKE_BACKEND_LATENCY", "fixed:0"))(
+            rng, recording.get("latency_seconds") if recording else None
+        )
+        latency += float(_setting("FAKE_BACKEND_LATENCY_PER_PAGE", 0)) * request.pages_sent
+        metrics.increment(f"backend.{self.name}.calls")
+
+        draw = rng.random()
+        quota_rate = float(options.get("fake_quota_error_rate", _setting("FAKE_BACKEND_QUOTA_ERROR_RATE", 0)))
+        error_rate = float(options.get("fake_error_rate", _setting("FAKE_BACKEND_ERROR_RATE", 0)))
+        if draw < quota_rate:
+            metrics.increment(f"backend.{self.name}.injected_quota_errors")
+            raise ResourceExhausted("429 Resource exhausted (injected by fake backend)")
+        if draw < quota_rate + error_rate:
+            time.sleep(latency)
+            metrics.increment(f"backend.{self.name}.injected_errors")
+            raise ServiceUnavailable("503 Service unavailable (injected by fake backend)")
+
+        if recording is not None:
+            metrics.increment(f"backend.{self.name}.replayed")
+            text = recording["text"]
+            usage = UsageMetadata(
+                recording["usage"]["prompt_token_count"], recording["usage"]["candidates_token_count"]
+            )
+        else:
+            metrics.increment(f"backend.{self.name}.synthesized")
+            text = synthesize_text(request)
+            pages = request.pages_sent
+            # Pages sent as their text layer are billed like text, roughly 4 characters per token
+            text_layer = request.preprocessing.get("text_layer", {})
+            image_pages = pages - text_layer.get("text_pages", 0)
+            usage = UsageMetadata(
+                int(_setting("FAKE_BACKEND_PROMPT_TOKENS_PER_PAGE", 258)) * image_pages
+                + (text_layer.get("text_chars", 0) + len(request.prompt_text or "")) // 4,
+                int(_setting("FAKE_BACKEND_OUTPUT_TOKENS_PER_PAGE", 350)) * pages,
+            )
+
+        text, usage, finish_reason = _limit_output(request, text, usage)
+
+        if not stream:
+            time.sleep(latency)
+            return GenerationResponse(text, usage, finish_reason)
+        return self._stream(text, usage, latency, finish_reason)
+
+    def _stream(self, text: str, usage: UsageMetadata, latency: float, finish_reason: str) -> Iterator[GenerationResponse]:
+        size = max(1, math.ceil(len(text) / STREAM_CHUNKS))
+        chunks = [text[i:i + size] for i in range(0, len(text), size)] or [""]
+        for index, chunk in enumerate(chunks):
+            time.sleep(latency / len(chunks))
+            last = index == len(chunks) - 1
+            yield GenerationResponse(chunk, usage if last else None, finish_reason if last else None)
+
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+def _create_backend(name: str) -> ExtractionBackend:
+    if name in ("vertex", "record"):
+        from .vertex_model import VertexBackend
+
+        backend = VertexBackend()
+        return RecordingBackend(backend) if name == "record" else backend
+    if name == "replay":
+        return FakeBackend(replay=True)
+    if name == "fake":
+        return FakeBackend()
+    raise ImproperlyConfigured(f"Unknown EXTRACTION_BACKEND '{name}'")
+
+
+def get_backend() -> ExtractionBackend:
+    """Return the backend selected by EXTRACTION_BACKEND."""
+    name = _setting("EXTRACTION_BACKEND", "vertex")
+    with _backends_lock:
+        if name not in _backends:
+            _backends[name] = _create_backend(name)
+        return _backends[name]
@@ -0,0 +1,306 @@
+"""Persistent, content-addressed cache for Gemini extraction results.
+
+Entries are keyed on the SHA-256 of the input bytes, the prompt text, the model,
+the page limit, the generation parameters and the preprocessing version and
+settings. The store is a SQLite file so it is shared by every worker process
+on the host and survives restarts.
+"""
+
+import copy
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Optional
+
+from django.conf import settings
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TTL_SECONDS = 7 * 24 * 3600
+DEFAULT_MAX_ENTRIES = 5000
+HASH_CHUNK_SIZE = 1024 * 1024
+
+_schema_lock = threading.Lock()
+_initialized_paths = set()
+_prompts_state = {"mtime": None, "version": None}
+
+
+def _cache_path() -> str:
+    return getattr(
+        settings,
+        "EXTRACTION_CACHE_PATH",
+        os.path.join(settings.BASE_DIR, "cache", "extraction_cache.sqlite3"),
+    )
+
+
+def _ttl_seconds() -> int:
+    return int(getattr(settings, "EXTRACTION_CACHE_TTL", DEFAULT_TTL_SECONDS))
+
+
+def _max_entries() -> int:
+    return int(getattr(settings, "EXTRACTION_CACHE_MAX_ENTRIES", DEFAULT_MAX_ENTRIES))
+
+
+def is_enabled() -> bool:
+    """Return True when the extraction cache is switched on in settings."""
+    return bool(getattr(settings, "EXTRACTION_CACHE_ENABLED", True))
+
+
+def _connect() -> sqlite3.Connection:
+    path = _cache_path()
+    conn = sqlite3.connect(path, timeout=30)
+    if path not in _initialized_paths:
+        with _schema_lock:
+            if path not in _initialized_paths:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.executescript(
+                    """
+                    CREATE TABLE IF NOT EXISTS extraction_cache (
+                        cache_key TEXT PRIMARY KEY,
+                        prompts_version TEXT,
+                        response TEXT NOT NULL,
+                        created_at REAL NOT NULL,
+                        last_access REAL NOT NULL,
+                        hits INTEGER NOT NULL DEFAULT 0
+                    );
+                    CREATE INDEX IF NOT EXISTS extraction_cache_last_access
+                        ON extraction_cache (last_access);
+                    CREATE TABLE IF NOT EXISTS extraction_cache_stats (
+                        name TEXT PRIMARY KEY,
+                        value INTEGER NOT NULL DEFAULT 0
+                    );
+                    """
+                )
+                conn.commit()
+                _initialized_paths.add(path)
+    return conn
+
+
+def _open() -> sqlite3.Connection:
+    os.makedirs(os.path.dirname(_cache_path()) or ".", exist_ok=True)
+    return _connect()
+
+
+def _bump(conn: sqlite3.Connection, name: str, value: int = 1):
+    conn.execute(
+        "INSERT INTO extraction_cache_stats (name, value) VALUES (?, ?) "
+        "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+        (name, value),
+    )
+    metrics.increment(f"extraction_cache.{name}", value)
+
+
+def hash_file(path: str) -> str:
+    """Return the SHA-256 hex digest of the file at ``path``."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def hash_text(text: str) -> str:
+    """Return the SHA-256 hex digest of ``text``."""
+    return hashlib.sha256((text or "").encode("utf-8")).hexdigest()
+
+
+def fingerprint_input(input_data) -> Optional[str]:
+    """
+    Return a content hash for the input accepted by call_gemini_api_with_streaming.
+
+    File paths are hashed by content so that re-uploads of the same bytes under a
+    new uuid file name still hit the cache.
+    """
+    if input_data is None:
+        return None
+    if isinstance(input_data, (list, tuple)):
+        return hash_text("|".join(fingerprint_input(item) or "" for item in input_data))
+    if isinstance(input_data, dict):
+        return hash_text(json.dumps(input_data, sort_keys=True, ensure_ascii=False))
+    if isinstance(input_data, str) and os.path.isfile(input_data):
+        return hash_file(input_data)
+    return hash_text(str(input_data))
+
+
+def prompts_file_path() -> str:
+    return os.path.join(settings.BASE_DIR, "Prompts", "prompts.yaml")
+
+
+def prompts_version() -> Optional[str]:
+    """Return a hash of prompts.yaml, re-read only when its mtime changes."""
+    path = prompts_file_path()
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return None
+    if _prompts_state["mtime"] != mtime:
+        _prompts_state["version"] = hash_file(path)
+        _prompts_state["mtime"] = mtime
+    return _prompts_state["version"]
+
+
+def make_key(
+    input_fingerprint: Optional[str],
+    prompt_text: str,
+    model_id: str,
+    max_pages: Optional[int],
+    generation_params: Dict[str, Any],
+    preprocessing: Optional[Dict[str, Any]] = None,
+) -> str:
+    """
+    Build the cache key for a single extraction request.
+
+    ``preprocessing`` identifies how the input is prepared before it is sent
+    (see preprocessing.fingerprint), so changing the page filter, text layer
+    or image normalization settings does not serve results of the old payload.
+    """
+    payload = {
+        "input": input_fingerprint,
+        "prompt": hash_text(prompt_text),
+        "model": model_id,
+        "max_pages": max_pages,
+        "params": generation_params,
+        "preprocessing": preprocessing,
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def get(cache_key: str) -> Optional[Dict[str, Any]]:
+    """
+    Look up a cached response.
+
+    Returns:
+        dict: The cached formatted response, or None on a miss. Entries that are
+        expired or were produced with a different prompts.yaml are dropped.
+    """
+    version = prompts_version()
+    now = time.time()
+    try:
+        conn = _open()
+        try:
+            row = conn.execute(
+                "SELECT response, prompts_version, created_at FROM extraction_cache WHERE cache_key = ?",
+                (cache_key,),
+            ).fetchone()
+            if row is None:
+                _bump(conn, "misses")
+                conn.commit()
+                return None
+
+            response, entry_version, created_at = row
+            if entry_version != version or now - created_at > _ttl_seconds():
+                conn.execute("DELETE FROM extraction_cache WHERE cache_key = ?", (cache_key,))
+                _bump(conn, "misses")
+                _bump(conn, "invalidations")
+                conn.commit()
+                return None
+
+            conn.execute(
+                "UPDATE extraction_cache SET last_access = ?, hits = hits + 1 WHERE cache_key = ?",
+                (now, cache_key),
+            )
+            _bump(conn, "hits")
+            conn.commit()
+            return json.loads(response)
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        logger.warning(f"Extraction cache lookup failed: {e}")
+        metrics.increment("extraction_cache.errors")
+        return None
+
+
+def put(cache_key: str, response: Dict[str, Any]):
+    """Store a formatted response and evict expired or least recently used entries."""
+    now = time.time()
+    try:
+        conn = _open()
+        try:
+            conn.execute(
+                "INSERT OR REPLACE INTO extraction_cache "
+                "(cache_key, prompts_version, response, created_at, last_access, hits) "
+                "VALUES (?, ?, ?, ?, ?, 0)",
+                (cache_key, prompts_version(), json.dumps(response, ensure_ascii=False), now, now),
+            )
+            _evict(conn, now)
+            conn.commit()
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        logger.warning(f"Extraction cache store failed: {e}")
+        metrics.increment("extraction_cache.errors")
+
+
+def _evict(conn: sqlite3.Connection, now: float):
+    expired = conn.execute(
+        "DELETE FROM extraction_cache WHERE created_at < ? OR prompts_version IS NOT ?",
+        (now - _ttl_seconds(), prompts_version()),
+    ).rowcount
+    overflow = conn.execute(
+        "DELETE FROM extraction_cache WHERE cache_key IN ("
+        "SELECT cache_key FROM extraction_cache ORDER BY last_access DESC LIMIT -1 OFFSET ?)",
+        (_max_entries(),),
+    ).rowcount
+    if expired or overflow:
+        _bump(conn, "evictions", expired + overflow)
+
+
+def clear():
+    """Remove every cached entry and reset the counters."""
+    try:
+        conn = _open()
+        try:
+            conn.execute("DELETE FROM extraction_cache")
+            conn.execute("DELETE FROM extraction_cache_stats")
+            conn.commit()
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        logger.warning(f"Extraction cache clear failed: {e}")
+
+
+def stats() -> Dict[str, int]:
+    """Return host-wide hit/miss/eviction counters and the current entry count."""
+    try:
+        conn = _open()
+        try:
+            counters = dict(conn.execute("SELECT name, value FROM extraction_cache_stats").fetchall())
+            entries = conn.execute("SELECT COUNT(*) FROM extraction_cache").fetchone()[0]
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        logger.warning(f"Extraction cache stats failed: {e}")
+        return {}
+    lookups = counters.get("hits", 0) + counters.get("misses", 0)
+    return {
+        "entries": entries,
+        "hits": counters.get("hits", 0),
+        "misses": counters.get("misses", 0),
+        "evictions": counters.get("evictions", 0),
+        "invalidations": counters.get("invalidations", 0),
+        "hit_rate": round(counters.get("hits", 0) / lookups, 4) if lookups else 0.0,
+    }
+
+
+def as_cache_hit(response: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Return a copy of a cached response as served to a caller.
+
+    No tokens are billed for a cache hit, so usageMetadata is zeroed and the
+    original counts are kept under ``cachedUsageMetadata`` for reference.
+    """
+    served = copy.deepcopy(response)
+    served["cachedUsageMetadata"] = served.get("usageMetadata", {})
+    served["usageMetadata"] = {
+        "promptTokenCount": 0,
+        "candidatesTokenCount": 0,
+        "totalTokenCount": 0,
+    }
+    served["cacheHit"] = True
+    return served
@@ -0,0 +1,256 @@
+"""Hedged model calls to cut tail latency.
+
+A small share of Vertex calls take far longer than the rest. When hedging is
+enabled, a call that has not finished after the HEDGE_LATENCY_PERCENTILE of
+recent latencies gets a second, identical call; whichever succeeds first is
+used and the other is abandoned. The SDK's generate_content cannot be
+interrupted, so an abandoned call runs to completion on its daemon thread and
+its result is discarded.
+
+Latencies are tracked per page sent, so a 40-page window is not hedged at
+the delay of a one-page receipt. Every call earns HEDGE_MAX_EXTRA_LOAD of a
+hedge and each hedge spends one, so hedges never add more than that share
+of extra calls. A hedge also needs an immediate rate limiter lease under the
+caller's tier and user; it does not queue behind other requests. Each call
+holds its lease until it actually finishes, so an abandoned call still
+counts as in flight.
+"""
+
+import logging
+import queue
+import threading
+import time
+from typing import Any, Callable, Optional
+
+from django.conf import settings
+
+from . import metrics, rate_limiter, resilience
+
+logger = logging.getLogger(__name__)
+
+LATENCY_SERIES = "gemini.seconds_per_page"
+# Unused hedge allowance kept for later bursts of slow calls
+MAX_BANKED_HEDGES = 5
+
+PRIMARY = "primary"
+HEDGE = "hedge"
+
+_budget_lock = threading.Lock()
+_credits = 0.0
+
+
+def _setting(name: str, default):
+    return getattr(settings, name, default)
+
+
+def is_enabled() -> bool:
+    return bool(_setting("HEDGING_ENABLED", False))
+
+
+def hedge_delay(pages: int) -> Optional[float]:
+    """
+    Seconds after which a call of ``pages`` pages is hedged.
+
+    Returns:
+        float: The latency percentile scaled to ``pages``, at least
+        HEDGE_MIN_DELAY_SECONDS; None until HEDGE_MIN_OBSERVATIONS calls were seen
+    """
+    if metrics.observation_count(LATENCY_SERIES) < int(_setting("HEDGE_MIN_OBSERVATIONS", 20)):
+        return None
+    per_page = metrics.percentile(LATENCY_SERIES, float(_setting("HEDGE_LATENCY_PERCENTILE", 95)))
+    return max(float(_setting("HEDGE_MIN_DELAY_SECONDS", 2)), per_page * max(1, pages))
+
+
+def _earn():
+    global _credits
+    with _budget_lock:
+        _credits = min(MAX_BANKED_HEDGES, _credits + float(_setting("HEDGE_MAX_EXTRA_LOAD", 0.05)))
+
+
+def _spend() -> bool:
+    global _credits
+    with _budget_lock:
+        if _credits < 1:
+            return False
+        _credits -= 1
+        return True
+
+
+def call(
+    fn: Callable[[], Any],
+    pages: int,
+    timeout: Optional[float],
+    estimated_tokens: int = 0,
+    cancel_token: Optional[resilience.CancelToken] = None,
+    lease: Optional[rate_limiter.Lease] = None,
+    requester: Optional[rate_limiter.Requester] = None,
+    used_tokens: Optional[Callable[[Any], Optional[int]]] = None
+) -> Any:
+    """
+    Run the model call ``fn``, hedging it when it is slow.
+
+    Every call holds a rate limiter lease until it actually finishes. The
+    primary call holds ``lease``, which this function releases: when the call
+    ends, right away when the request is cancelled or times out, and when the
+    primary finishes after a hedge won. The hedge leases its own slot for
+    ``requester``.
+
+    Args:
+        fn: The call; it may run twice concurrently
+        pages: Pages sent, used to scale the hedge delay
+        timeout: Seconds to wait for a result, as in resilience.call_with_timeout
+        estimated_tokens: Input tokens reserved from the rate limiter for a hedge
+        cancel_token: Stops waiting for the calls when the request is cancelled
+        lease: Rate limiter lease of the primary call (None when limiting is disabled)
+        requester: Who the call is made for; the hedge queues for their slots
+        used_tokens: Returns the billed input tokens of a result, to correct the TPM estimate
+
+    Returns:
+        The result of the first call to succeed
+
+    Raises:
+        AttemptTimeoutError: If no call succeeded within ``timeout``
+        CancelledError: If the request was cancelled first
+        Exception: The error of the primary call when every call failed
+    """
+    leases = {PRIMARY: lease}
+    leases_lock = threading.Lock()
+
+    def give_back(name: str, outcome: str, result=None):
+        with leases_lock:
+            held = leases.pop(name, None)
+        if held is None:
+            return
+        tokens = used_tokens(result) if used_tokens is not None and result is not None else None
+        rate_limiter.release(held, outcome=outcome, actual_tokens=tokens)
+
+    def give_back_all(outcome: str):
+        with leases_lock:
+            names = list(leases)
+        for name in names:
+            give_back(name, outcome)
+
+    def outcome_of(error: BaseException) -> str:
+        return "quota" if resilience.classify_error(error) == resilience.QUOTA else "error"
+
+    started = time.monotonic()
+    delay = hedge_delay(pages) if is_enabled() else None
+    if timeout == float("inf"):
+        timeout = None
+    if delay is None or (timeout and delay >= timeout):
+        try:
+            result = resilience.call_with_timeout(fn, timeout, cancel_token)
+        except resilience.CancelledError:
+            give_back(PRIMARY, "cancelled")
+            raise
+        except Exception as e:
+            give_back(PRIMARY, outcome_of(e))
+            raise
+        give_back(PRIMARY, "success", result)
+        metrics.observe(LATENCY_SERIES, (time.monotonic() - started) / max(1, pages))
+        return result
+
+    metrics.increment("hedging.calls")
+    _earn()
+    outcomes = queue.Queue()
+
+    def run(name: str):
+        begun = time.monotonic()
+        try:
+            result = fn()
+        except BaseException as e:
+            give_back(name, outcome_of(e))
+            outcomes.put((name, None, e, time.monotonic() - begun))
+            return
+        give_back(name, "success", result)
+        outcomes.put((name, result, None, time.monotonic() - begun))
+
+    def start_hedge() -> bool:
+        hedge_lease = _lease_hedge(estimated_tokens, requester)
+        if hedge_lease is False:
+            return False
+        with leases_lock:
+            leases[HEDGE] = hedge_lease
+        threading.Thread(target=run, args=(HEDGE,), daemon=True, name="vertex-hedge").start()
+        return True
+
+    threading.Thread(target=run, args=(PRIMARY,), daemon=True, name="vertex-attempt").start()
+    expires_at = started + timeout if timeout else None
+    running = 1
+    hedged = False
+    error = None
+    while running:
+        wait = None if expires_at is None else max(0.0, expires_at - time.monotonic())
+        if not hedged:
+            until_hedge = max(0.0, started + delay - time.monotonic())
+            wait = until_hedge if wait is None else min(wait, until_hedge)
+        if cancel_token is not None:
+            wait = resilience.CANCEL_POLL_SECONDS if wait is None else min(wait, resilience.CANCEL_POLL_SECONDS)
+        try:
+            name, result, exc, latency = outcomes.get(timeout=wait)
+        except queue.Empty:
+            if cancel_token is not None and cancel_token.cancelled:
+                give_back_all("cancelled")
+                cancel_token.check()
+            now = time.monotonic()
+            if expires_at is not None and now >= expires_at:
+                give_back_all("error")
+                metrics.increment("resilience.attempt_timeouts")
+                raise resilience.AttemptTimeoutError(f"Vertex AI call timed out after {timeout:.0f}s")
+            if not hedged and now >= started + delay:
+                hedged = True
+                if start_hedge():
+                    running += 1
+            continue
+
+        running -= 1
+        if exc is None:
+            metrics.observe(LATENCY_SERIES, latency / max(1, pages))
+            if name == HEDGE:
+                metrics.increment("hedging.wins")
+            if running:
+                # The other call keeps its lease until it finishes
+                metrics.increment("hedging.abandoned")
+            return result
+        if name == PRIMARY or error is None:
+            error = exc
+    raise error
+
+
+def _lease_hedge(estimated_tokens: int, requester: Optional[rate_limiter.Requester]):
+    """Return the hedge's lease (None when limiting is disabled), or False when it may not run."""
+    if not _spend():
+        metrics.increment("hedging.budget_exhausted")
+        return False
+    try:
+        lease = rate_limiter.acquire(estimated_tokens, max_wait=0, requester=requester)
+    except rate_limiter.RateLimitTimeout:
+        metrics.increment("hedging.rate_limited")
+        return False
+    metrics.increment("hedging.hedges")
+    logger.info("Model call is slower than usual, sending a hedged request")
+    return lease
+
+
+def status() -> dict:
+    """Hedge rate (hedges per hedgeable call) and win rate (hedges that finished first)."""
+    calls = metrics.get_counter("hedging.calls")
+    hedges = metrics.get_counter("hedging.hedges")
+    wins = metrics.get_counter("hedging.wins")
+    delay = metrics.percentile(LATENCY_SERIES, float(_setting("HEDGE_LATENCY_PERCENTILE", 95)))
+    return {
+        "enabled": is_enabled(),
+        "seconds_per_page_threshold": round(delay, 4) if delay is not None else None,
+        "calls": calls,
+        "hedges": hedges,
+        "wins": wins,
+        "hedge_rate": round(hedges / calls, 4) if calls else 0.0,
+        "win_rate": round(wins / hedges, 4) if hedges else 0.0,
+    }
+
+
+def reset():
+    """Forget the banked hedge allowance (used by tests)."""
+    global _credits
+    with _budget_lock:
+        _credits = 0.0
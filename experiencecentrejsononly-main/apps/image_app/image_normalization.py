@@ -0,0 +1,152 @@
+"""Normalization of photographed documents before they are sent to the model.
+
+Phone photos of bills are large, often rotated via EXIF only, and in colour
+although the content is black on white. Each image is rotated upright,
+downsized to IMAGE_MAX_LONG_EDGE, converted to grayscale when it carries no
+meaningful colour, and recompressed as JPEG. The original bytes are kept when
+normalizing would not make the payload smaller.
+"""
+
+import io
+import logging
+import math
+from typing import Any, Dict, Optional
+
+from django.conf import settings
+from PIL import Image, ImageChops, ImageOps, ImageStat
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# Gemini 2.x bills images up to 384x384 px as 258 tokens and larger images as
+# 258 tokens per 768x768 tile. Gemini 1.5 bills every image as 258 tokens.
+TOKENS_PER_IMAGE_TILE = 258
+SMALL_IMAGE_EDGE = 384
+IMAGE_TILE_EDGE = 768
+
+NORMALIZED_MIME_TYPE = "image/jpeg"
+
+
+def _setting(name: str, default):
+    return getattr(settings, name, default)
+
+
+def is_enabled() -> bool:
+    return bool(_setting("IMAGE_NORMALIZATION_ENABLED", True))
+
+
+def estimate_image_tokens(width: int, height: int) -> int:
+    """Estimate the input tokens billed for an image of ``width`` x ``height`` pixels."""
+    if width <= SMALL_IMAGE_EDGE and height <= SMALL_IMAGE_EDGE:
+        return TOKENS_PER_IMAGE_TILE
+    return math.ceil(width / IMAGE_TILE_EDGE) * math.ceil(height / IMAGE_TILE_EDGE) * TOKENS_PER_IMAGE_TILE
+
+
+def is_effectively_grayscale(image: Image.Image) -> bool:
+    """True if the channels of an RGB image differ by less than IMAGE_GRAYSCALE_THRESHOLD on average."""
+    sample = image.convert("RGB")
+    sample.thumbnail((256, 256))
+    red, green, blue = sample.split()
+    threshold = float(_setting("IMAGE_GRAYSCALE_THRESHOLD", 8))
+    return all(
+        ImageStat.Stat(ImageChops.difference(first, second)).mean[0] < threshold
+        for first, second in ((red, green), (green, blue), (red, blue))
+    )
+
+
+class NormalizedImage:
+    """Result of normalizing one image."""
+
+    def __init__(self, data: bytes, mime_type: str, stats: Dict[str, Any]):
+        self.data = data
+        self.mime_type = mime_type
+        self.stats = stats
+
+
+def normalize_image(data: bytes, mime_type: Optional[str] = None) -> NormalizedImage:
+    """
+    Rotate, downsize, grayscale and recompress an image.
+
+    Returns:
+        NormalizedImage: The bytes to send and a stats dict with the byte sizes,
+        dimensions and estimated prompt tokens before and after. Unreadable
+        images are returned unchanged.
+    """
+    try:
+        image = Image.open(io.BytesIO(data))
+        image.load()
+    except Exception as e:
+        logger.warning(f"Could not read image for normalization: {e}")
+        return NormalizedImage(data, mime_type, {})
+
+    original_size = image.size
+    rotated = _orientation(image) not in (None, 1)
+    image = ImageOps.exif_transpose(image)
+
+    max_edge = int(_setting("IMAGE_MAX_LONG_EDGE", 1536))
+    resized = max(image.size) > max_edge
+    if resized:
+        image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+
+    if image.mode in ("RGBA", "LA", "P"):
+        # Flatten transparency onto white, as the page would be printed
+        background = Image.new("RGB", image.size, "white")
+        background.paste(image.convert("RGBA"), mask=image.convert("RGBA").getchannel("A"))
+        image = background
+
+    grayscale = image.mode == "L" or (
+        _setting("IMAGE_GRAYSCALE_ENABLED", True) and is_effectively_grayscale(image)
+    )
+    image = image.convert("L" if grayscale else "RGB")
+
+    buffer = io.BytesIO()
+    image.save(buffer, "JPEG", quality=int(_setting("IMAGE_JPEG_QUALITY", 85)), optimize=True)
+    normalized = buffer.getvalue()
+
+    # Re-encoding an already small image can make it bigger; only geometry fixes justify that
+    if len(normalized) >= len(data) and not (rotated or resized):
+        normalized, out_mime_type, size = data, mime_type, original_size
+    else:
+        out_mime_type, size = NORMALIZED_MIME_TYPE, image.size
+
+    stats = {
+        "original_bytes": len(data),
+        "normalized_bytes": len(normalized),
+        "bytes_saved": len(data) - len(normalized),
+        "original_size": list(original_size),
+        "size": list(size),
+        "rotated": rotated,
+        "resized": resized,
+        "grayscale": grayscale and normalized is not data,
+        "estimated_prompt_tokens_before": estimate_image_tokens(*original_size),
+        "estimated_prompt_tokens_after": estimate_image_tokens(*size),
+    }
+    stats["prompt_token_delta"] = stats["estimated_prompt_tokens_after"] - stats["estimated_prompt_tokens_before"]
+
+    metrics.increment("image_normalization.images")
+    metrics.increment("image_normalization.bytes_saved", stats["bytes_saved"])
+    metrics.increment("image_normalization.estimated_tokens_saved", -stats["prompt_token_delta"])
+    return NormalizedImage(normalized, out_mime_type, stats)
+
+
+def _orientation(image: Image.Image) -> Optional[int]:
+    try:
+        return image.getexif().get(0x0112)
+    except Exception:
+        return None
+
+
+def merge_stats(total: Dict[str, Any], stats: Dict[str, Any]) -> Dict[str, Any]:
+    """Add one image's stats into the per-document totals."""
+    if not stats:
+        return total
+    total["images"] = total.get("images", 0) + 1
+    for key in (
+        "original_bytes", "normalized_bytes", "bytes_saved",
+        "estimated_prompt_tokens_before", "estimated_prompt_tokens_after", "prompt_token_delta",
+    ):
+        total[key] = total.get(key, 0) + stats[key]
+    for key in ("rotated", "resized", "grayscale"):
+        total[key] = total.get(key, 0) + int(stats[key])
+    return total
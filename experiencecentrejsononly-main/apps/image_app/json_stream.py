@@ -0,0 +1,142 @@
+"""Parsing helpers for the model's JSON output, including incremental parsing of streams."""
+
+import json
+from typing import Any, List, Tuple
+
+
+def safe_json_load(raw_string: str):
+    if not raw_string or not raw_string.strip():
+        raise json.JSONDecodeError("Empty or whitespace-only string", raw_string, 0)
+
+    cleaned = raw_string.strip()
+
+    if cleaned.startswith("```json"):
+        lines = cleaned.splitlines()
+        if len(lines) > 2 and lines[-1].strip() == "```":
+            cleaned = "\n".join(lines[1:-1])
+        else:
+            cleaned = "\n".join(lines[1:])
+
+    return json.loads(cleaned)
+
+
+class IncrementalObjectParser:
+    """
+    Emit each member of a top-level JSON object as soon as its value is complete.
+
+    The doc_extraction_prompt output is a single object of ``page_N`` members, so
+    feeding streamed text chunks into this parser yields every page the moment
+    its closing brace arrives. Markdown fences or chatter before the opening
+    brace are skipped.
+
+    Usage:
+
+    ```python
+    parser = IncrementalObjectParser()
+    for chunk in chunks:
+        for key, value in parser.feed(chunk):
+            ...
+    ```
+    """
+
+    def __init__(self):
+        self._buffer = []
+        self._started = False
+        self._finished = False
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._key = None
+        self._token = []
+        self._expect = "key"
+
+    @property
+    def finished(self) -> bool:
+        """True once the closing brace of the top-level object was seen."""
+        return self._finished
+
+    def feed(self, text: str) -> List[Tuple[str, Any]]:
+        """Consume ``text`` and return the (key, value) members completed by it."""
+        completed = []
+        for char in text or "":
+            if self._finished:
+                break
+            if not self._started:
+                if char == "{":
+                    self._started = True
+                    self._depth = 1
+                continue
+            self._step(char, completed)
+        return completed
+
+    def _step(self, char: str, completed: list):
+        if self._in_string:
+            self._token.append(char)
+            if self._escape:
+                self._escape = False
+            elif char == "\\":
+                self._escape = True
+            elif char == '"':
+                self._in_string = False
+                if self._depth == 1 and self._expect == "key":
+                    self._key = json.loads("".join(self._token))
+                    self._token = []
+                    self._expect = "colon"
+            return
+
+        if self._depth == 1 and self._expect in ("key", "colon"):
+            if char == '"' and self._expect == "key":
+                self._in_string = True
+                self._token = [char]
+            elif char == ":" and self._expect == "colon":
+                self._expect = "value"
+            elif char == "}":
+                self._finished = True
+            return
+
+        if char == '"':
+            self._in_string = True
+            self._token.append(char)
+            return
+
+        if char in "{[":
+            self._depth += 1
+            self._token.append(char)
+            return
+
+        if char in "}]":
+            if self._depth == 1:
+                # End of the top-level object closes a pending scalar value
+                self._emit_scalar(completed)
+                self._finished = True
+                return
+            self._depth -= 1
+            self._token.append(char)
+            if self._depth == 1:
+                self._emit(completed)
+            return
+
+        if char == "," and self._depth == 1:
+            self._emit_scalar(completed)
+            return
+
+        if self._depth == 1 and self._expect == "value" and char.isspace() and not self._token:
+            return
+        self._token.append(char)
+
+    def _emit_scalar(self, completed: list):
+        if self._expect == "value" and "".join(self._token).strip():
+            self._emit(completed)
+        else:
+            self._expect = "key"
+
+    def _emit(self, completed: list):
+        raw = "".join(self._token).strip()
+        self._token = []
+        self._expect = "key"
+        try:
+            completed.append((self._key, json.loads(raw)))
+        except json.JSONDecodeError:
+            # Leave malformed members to the full parse once the stream ends
+            pass
+        self._key = None
@@ -0,0 +1,81 @@
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.image_app import resilience
+from apps.image_app.vertex_model import call_gemini_api_with_streaming
+from apps.image_app.views import get_prompt_for_doc_type
+
+
+def _percentile(values, pct):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, int(round(pct / 100 * (len(values) - 1)))))]
+
+
+class Command(BaseCommand):
+    help = (
+        "Send concurrent extractions through the pipeline and report throughput and tail latency. "
+        "Run with EXTRACTION_BACKEND=replay or fake to benchmark offline."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("files", nargs="+", help="Documents to extract, used round-robin")
+        parser.add_argument("--requests", type=int, default=50, help="Total number of extractions")
+        parser.add_argument("--concurrency", type=int, default=8, help="Extractions in flight at once")
+        parser.add_argument("--max-pages", type=int, default=3, help="Page limit per extraction")
+        parser.add_argument("--doc-type", default="docextraction", help="doc_type selecting the prompt")
+        parser.add_argument(
+            "--cache",
+            action="store_true",
+            help="Allow the result cache and request coalescing (off by default so every request is generated)",
+        )
+
+    def handle(self, *args, **options):
+        prompt_text = get_prompt_for_doc_type(options["doc_type"])
+        if not prompt_text:
+            raise CommandError(f"No prompt found for doc_type '{options['doc_type']}'")
+        files = options["files"]
+
+        def extract(index):
+            started = time.time()
+            try:
+                response = call_gemini_api_with_streaming(
+                    prompt_text=prompt_text,
+                    input_data=files[index % len(files)],
+                    response_mime_type="application/json",
+                    max_pages=options["max_pages"],
+                    use_cache=options["cache"],
+                    coalesce=options["cache"],
+                )
+                return time.time() - started, None, response.get("usageMetadata", {})
+            except Exception as e:
+                return time.time() - started, resilience.classify_error(e), {}
+
+        self.stdout.write(
+            f"Running {options['requests']} extractions at concurrency {options['concurrency']} "
+            f"against the '{settings.EXTRACTION_BACKEND}' backend..."
+        )
+        started = time.time()
+        with ThreadPoolExecutor(max_workers=options["concurrency"]) as executor:
+            results = list(executor.map(extract, range(options["requests"])))
+        elapsed = time.time() - started
+
+        latencies = [latency for latency, error, _ in results if error is None]
+        errors = Counter(error for _, error, _ in results if error is not None)
+        tokens = sum(usage.get("totalTokenCount", 0) or 0 for _, _, usage in results)
+
+        self.stdout.write(f"Completed:   {len(latencies)}/{len(results)} in {elapsed:.2f}s")
+        self.stdout.write(f"Throughput:  {len(latencies) / elapsed:.2f} extractions/s")
+        for pct in (50, 95, 99):
+            self.stdout.write(f"p{pct} latency: {_percentile(latencies, pct):.3f}s")
+        self.stdout.write(f"Max latency: {max(latencies, default=0.0):.3f}s")
+        self.stdout.write(f"Tokens:      {tokens}")
+        if errors:
+            self.stdout.write(
+                "Errors:      " + ", ".join(f"{name}={count}" for name, count in sorted(errors.items()))
+            )
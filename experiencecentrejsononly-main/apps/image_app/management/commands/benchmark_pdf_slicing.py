@@ -0,0 +1,90 @@
+import io
+import os
+import statistics
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from PIL import Image, ImageDraw
+from PyPDF2 import PdfReader, PdfWriter
+
+from apps.image_app.pdf_slicing import PdfDocument
+
+
+def legacy_slice(file_path: str, max_pages: int) -> bytes:
+    """The previous path: count pages, re-parse into a temp file next to the input, read it back, delete it."""
+    with open(file_path, "rb") as f:
+        len(PdfReader(f).pages)
+    with open(file_path, "rb") as file:
+        reader = PdfReader(file)
+        writer = PdfWriter()
+        for i in range(min(len(reader.pages), max_pages)):
+            writer.add_page(reader.pages[i])
+        limited_file_path = file_path.replace(".pdf", f"_limited_{max_pages}pages.pdf")
+        with open(limited_file_path, "wb") as output_file:
+            writer.write(output_file)
+    with open(limited_file_path, "rb") as f:
+        data = f.read()
+    os.remove(limited_file_path)
+    return data
+
+
+def in_memory_slice(file_path: str, max_pages: int) -> bytes:
+    with PdfDocument(file_path) as document:
+        document.page_count
+        return document.head(max_pages)
+
+
+def make_scanned_pdf(path: str, pages: int):
+    """Write a PDF of ``pages`` scan-like image pages."""
+    images = []
+    for number in range(pages):
+        image = Image.effect_noise((850, 1100), 24).convert("RGB")
+        draw = ImageDraw.Draw(image)
+        for line in range(40):
+            draw.text((60, 60 + line * 25), f"Page {number + 1} line {line + 1} " * 4, fill=(0, 0, 0))
+        images.append(image)
+    images[0].save(path, "PDF", save_all=True, append_images=images[1:], resolution=100)
+
+
+class Command(BaseCommand):
+    help = "Compare the in-memory PDF slicing engine with the previous temp-file path."
+
+    def add_arguments(self, parser):
+        parser.add_argument("files", nargs="*", help="PDFs to slice (default: a generated scan-like PDF)")
+        parser.add_argument("--pages", type=int, default=200, help="Pages of the generated PDF")
+        parser.add_argument("--max-pages", type=int, default=3, help="Pages kept by each slice")
+        parser.add_argument("--repeat", type=int, default=5, help="Runs per file and method")
+
+    def handle(self, *args, **options):
+        with tempfile.TemporaryDirectory(prefix="adp-slicing-") as tmpdir:
+            files = options["files"]
+            if not files:
+                path = os.path.join(tmpdir, "generated.pdf")
+                self.stdout.write(f"Generating a {options['pages']}-page PDF...")
+                make_scanned_pdf(path, options["pages"])
+                files = [path]
+
+            for path in files:
+                if not os.path.isfile(path):
+                    raise CommandError(f"File not found: {path}")
+                # Work on a copy so the legacy temp file lands in our directory
+                copy_path = os.path.join(tmpdir, f"input_{os.getpid()}.pdf")
+                with open(path, "rb") as src, open(copy_path, "wb") as dst:
+                    dst.write(src.read())
+
+                size_mb = os.path.getsize(copy_path) / (1024 * 1024)
+                self.stdout.write(f"\n{os.path.basename(path)} ({size_mb:.1f} MB, max_pages={options['max_pages']})")
+                results = {}
+                for name, method in (("temp file", legacy_slice), ("in memory", in_memory_slice)):
+                    timings = []
+                    for _ in range(options["repeat"]):
+                        started = time.perf_counter()
+                        output = method(copy_path, options["max_pages"])
+                        timings.append(time.perf_counter() - started)
+                    results[name] = statistics.median(timings)
+                    check = len(PdfReader(io.BytesIO(output)).pages)
+                    self.stdout.write(
+                        f"  {name:<10} median {results[name] * 1000:8.1f} ms  output {len(output) / 1024:8.1f} KB  pages {check}"
+                    )
+                self.stdout.write(f"  speed-up   {results['temp file'] / results['in memory']:.2f}x")
@@ -0,0 +1,118 @@
+import json
+import os
+import tempfile
+import threading
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+
+from apps.image_app import preprocessing, preprocessing_pool
+from apps.image_app.management.commands.benchmark_pdf_slicing import make_scanned_pdf
+
+
+def _percentile(values, pct):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, int(round(pct / 100 * (len(values) - 1)))))]
+
+
+def light_request():
+    """A request that does little work of its own: a small JSON round trip and a 5 ms wait on I/O."""
+    json.loads(json.dumps({"status": "ok", "items": list(range(50))}))
+    time.sleep(0.005)
+
+
+def run_mixed_load(files, max_pages, heavy_threads, light_threads, seconds):
+    """
+    Prepare ``files`` in ``heavy_threads`` threads while ``light_threads`` threads serve light requests.
+
+    Returns:
+        tuple: (latencies of the light requests, files prepared)
+    """
+    stop = threading.Event()
+    latencies = []
+    prepared = [0]
+    lock = threading.Lock()
+
+    def heavy(offset):
+        index = offset
+        while not stop.is_set():
+            preprocessing.prepare_input(files[index % len(files)], max_pages, {})
+            index += 1
+            with lock:
+                prepared[0] += 1
+
+    def light():
+        while not stop.is_set():
+            started = time.perf_counter()
+            light_request()
+            with lock:
+                latencies.append(time.perf_counter() - started)
+
+    threads = [threading.Thread(target=heavy, args=(offset,)) for offset in range(heavy_threads)]
+    threads += [threading.Thread(target=light) for _ in range(light_threads)]
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return latencies, prepared[0]
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure the latency of light requests while other threads of the process prepare large documents, "
+        "with preprocessing in the request threads and in the process pool."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("files", nargs="*", help="PDFs or images to prepare (default: a generated scan-like PDF)")
+        parser.add_argument("--pages", type=int, default=30, help="Pages of the generated PDF")
+        parser.add_argument("--max-pages", type=int, default=10, help="Page limit per document")
+        parser.add_argument("--heavy", type=int, default=4, help="Threads preparing documents")
+        parser.add_argument("--light", type=int, default=4, help="Threads serving light requests")
+        parser.add_argument("--seconds", type=float, default=10, help="Duration of each run")
+        parser.add_argument("--workers", type=int, default=2, help="Processes of the pool")
+
+    def handle(self, *args, **options):
+        with tempfile.TemporaryDirectory(prefix="adp-preprocessing-") as tmpdir:
+            files = options["files"]
+            if not files:
+                path = os.path.join(tmpdir, "generated.pdf")
+                self.stdout.write(f"Generating a {options['pages']}-page PDF...")
+                make_scanned_pdf(path, options["pages"])
+                files = [path]
+            for path in files:
+                if not os.path.isfile(path):
+                    raise CommandError(f"File not found: {path}")
+
+            baseline = []
+            for _ in range(200):
+                started = time.perf_counter()
+                light_request()
+                baseline.append(time.perf_counter() - started)
+            self.stdout.write(
+                f"Idle light request: p50 {_percentile(baseline, 50) * 1000:.1f} ms  "
+                f"p95 {_percentile(baseline, 95) * 1000:.1f} ms"
+            )
+
+            runs = (("request thread", 0), (f"pool of {options['workers']}", options["workers"]))
+            for name, workers in runs:
+                with override_settings(PREPROCESSING_POOL_WORKERS=workers, PREPROCESSING_POOL_MIN_KB=0):
+                    if workers:
+                        # Start the processes before measuring
+                        preprocessing.prepare_input(files[0], options["max_pages"], {})
+                    latencies, prepared = run_mixed_load(
+                        files, options["max_pages"], options["heavy"], options["light"], options["seconds"],
+                    )
+                    preprocessing_pool.reset()
+                self.stdout.write(
+                    f"{name:<15} light p50 {_percentile(latencies, 50) * 1000:7.1f} ms  "
+                    f"p95 {_percentile(latencies, 95) * 1000:7.1f} ms  "
+                    f"p99 {_percentile(latencies, 99) * 1000:7.1f} ms  "
+                    f"max {max(latencies, default=0.0) * 1000:7.1f} ms  "
+                    f"requests {len(latencies):6d}  documents {prepared / options['seconds']:.1f}/s"
+                )
@@ -0,0 +1,82 @@
+import os
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# Modules that should only be imported on first use, never at startup
+LAZY_MODULES = ["vertexai", "google.cloud.aiplatform", "grpc"]
+
+
+def parse_importtime(output: str):
+    """
+    Parse ``python -X importtime`` output.
+
+    Returns:
+        list: (module, cumulative_seconds, nesting_level) per imported module
+    """
+    entries = []
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        try:
+            _, cumulative, name = line[len("import time:"):].split("|", 2)
+            name = name[1:]
+            level = (len(name) - len(name.lstrip(" "))) // 2
+            entries.append((name.strip(), int(cumulative) / 1_000_000, level))
+        except ValueError:
+            continue
+    return entries
+
+
+class Command(BaseCommand):
+    help = "Measure the time a fresh worker process spends importing the app and fail if it exceeds the budget."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--budget",
+            type=float,
+            default=None,
+            help="Seconds allowed for imports (default: IMPORT_TIME_BUDGET_SECONDS)",
+        )
+        parser.add_argument(
+            "--module",
+            action="append",
+            dest="modules",
+            help="Module to import after django.setup() (default: the project URLconf)",
+        )
+        parser.add_argument("--top", type=int, default=10, help="Number of slowest imports to list")
+
+    def handle(self, *args, **options):
+        budget = options["budget"] or settings.IMPORT_TIME_BUDGET_SECONDS
+        modules = options["modules"] or [settings.ROOT_URLCONF]
+        code = "import django, importlib; django.setup(); " + "; ".join(
+            f"importlib.import_module({module!r})" for module in modules
+        )
+        env = {**os.environ, "DJANGO_SETTINGS_MODULE": settings.SETTINGS_MODULE}
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", code],
+            cwd=settings.BASE_DIR,
+            env=env,
+            capture_output=True,
+            text=True,
+        )
+        if result.returncode != 0:
+            errors = [line for line in result.stderr.splitlines() if not line.startswith("import time:")]
+            raise CommandError("Import failed:\n" + "\n".join(errors[-20:]))
+
+        entries = parse_importtime(result.stderr)
+        total = sum(seconds for _, seconds, level in entries if level == 0)
+
+        self.stdout.write(f"Imported {len(entries)} modules in {total:.3f}s (budget {budget:.3f}s)")
+        for name, seconds, _ in sorted(entries, key=lambda entry: entry[1], reverse=True)[:options["top"]]:
+            self.stdout.write(f"  {seconds:8.3f}s  {name}")
+
+        imported = {name for name, _, _ in entries}
+        eager = [module for module in LAZY_MODULES if module in imported]
+        if eager:
+            raise CommandError(f"Modules that should load lazily were imported at startup: {', '.join(eager)}")
+        if total > budget:
+            raise CommandError(f"Import time {total:.3f}s exceeds the budget of {budget:.3f}s")
+        self.stdout.write(self.style.SUCCESS("Import time within budget"))
@@ -0,0 +1,316 @@
+"""Per-worker memory budget for document extraction.
+
+A request keeps its document in memory from preprocessing until the model
+has answered: the prepared PDF slice or image, the Part built from it and
+the serialized request. Without a limit, a few concurrent scans of hundreds
+of megabytes grow a worker until it is OOM-killed. Every extraction
+therefore reserves its estimated peak memory from the worker's
+MEMORY_BUDGET_MB before its document is prepared, and returns it when the
+call is done.
+
+The estimate is the share of the file that will be sent (pages sent over
+total pages for PDFs, whose source pdf_slicing memory-maps) times
+PAYLOAD_COPIES, plus the decoded pixels of images. The page count is the one
+routing already took (pdf_slicing.page_count remembers it per file), so the
+estimate does not parse the PDF again. Requests wait in arrival
+order while the budget is used up, for at most
+MEMORY_ADMISSION_TIMEOUT_SECONDS and never past their deadline, then fail
+with MemoryBudgetTimeout. A request whose estimate alone exceeds the budget
+is rejected at once with DocumentTooLargeError. A call made while the same
+thread holds a reservation (re-extracting missing pages) is admitted
+without waiting, since it cannot finish before the reservation it waits
+for.
+
+While reservations are held, the worker's resident set size is sampled
+every RSS_SAMPLE_SECONDS. Each request reports the peak RSS of the worker
+while it ran and its growth over the RSS at admission (``memory`` in the
+response's preprocessing metadata, stored on the Document), and both are
+recorded as ``memory.*`` timings next to the estimates.
+"""
+
+import itertools
+import json
+import logging
+import mimetypes
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Optional
+
+from django.conf import settings
+from PIL import Image
+
+from . import metrics, pdf_slicing, resilience
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+# The prepared bytes, the Part built from them and the serialized request
+PAYLOAD_COPIES = 3
+BYTES_PER_PIXEL = 4
+RSS_SAMPLE_SECONDS = 0.05
+# Waiters re-check their deadline at least this often
+WAIT_SLICE_SECONDS = 0.5
+
+
+class DocumentTooLargeError(Exception):
+    """Raised when a request alone would need more memory than the worker's budget"""
+    pass
+
+
+class MemoryBudgetTimeout(Exception):
+    """Raised when a request waited longer than MEMORY_ADMISSION_TIMEOUT_SECONDS for memory"""
+    pass
+
+
+_condition = threading.Condition()
+_tickets = itertools.count()
+_queue = deque()
+_active = set()
+_in_use = 0
+_sampler = None
+_local = threading.local()
+
+
+def _setting(name: str, default):
+    return getattr(settings, name, default)
+
+
+def budget_bytes() -> int:
+    """The worker's budget in bytes; 0 when unlimited."""
+    return max(0, int(float(_setting("MEMORY_BUDGET_MB", 1024)) * MB))
+
+
+def _mb(value: Optional[float]) -> Optional[float]:
+    return round(value / MB, 1) if value is not None else None
+
+
+def rss_bytes() -> Optional[int]:
+    """Current resident set size of this process, or None where it cannot be read."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+
+        # Only the peak is available here; ru_maxrss is in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    except (ImportError, OSError):
+        return None
+
+
+def _estimate_file(path: str, max_pages: Optional[int]) -> int:
+    size = os.path.getsize(path)
+    mime_type, _ = mimetypes.guess_type(path)
+    if mime_type == "application/pdf":
+        try:
+            total_pages = pdf_slicing.page_count(path)
+        except Exception as e:
+            logger.debug(f"Could not count pages for the memory estimate: {e}")
+            total_pages = 0
+        if total_pages:
+            pages = total_pages if max_pages is None else min(total_pages, max_pages)
+            size = size * pages // total_pages
+        return size * PAYLOAD_COPIES
+    if (mime_type or "").startswith("image/"):
+        try:
+            with Image.open(path) as image:
+                width, height = image.size
+        except Exception as e:
+            logger.debug(f"Could not read image size for the memory estimate: {e}")
+            width, height = 0, 0
+        return width * height * BYTES_PER_PIXEL + size * PAYLOAD_COPIES
+    return size * PAYLOAD_COPIES
+
+
+def estimate(input_data, max_pages: Optional[int] = None) -> int:
+    """
+    Estimate the peak memory in bytes of extracting ``input_data``.
+
+    Args:
+        input_data: A file path, text, JSON, or a list of them
+        max_pages: Maximum number of pages sent for PDFs (None for all)
+    """
+    if input_data is None:
+        return 0
+    if isinstance(input_data, (list, tuple)):
+        return sum(estimate(item, max_pages) for item in input_data)
+    if isinstance(input_data, str) and os.path.exists(input_data):
+        try:
+            return _estimate_file(input_data, max_pages)
+        except OSError:
+            return 0
+    text = input_data if isinstance(input_data, str) else json.dumps(input_data, default=str)
+    return len(text.encode("utf-8")) * PAYLOAD_COPIES
+
+
+class Reservation:
+    """Memory held by one request, and the worker's RSS while it ran."""
+
+    def __init__(self, estimated: int, waited: float):
+        self.estimated = estimated
+        self.waited = waited
+        self.rss_at_start = rss_bytes()
+        self.peak_rss = self.rss_at_start
+
+    def observe(self, rss: Optional[int]):
+        if rss is not None:
+            self.peak_rss = max(self.peak_rss or 0, rss)
+
+    def report(self) -> Dict[str, Any]:
+        """Estimated memory, peak RSS and RSS growth in MB, and the seconds waited for admission."""
+        self.observe(rss_bytes())
+        growth = self.peak_rss - self.rss_at_start if self.peak_rss is not None and self.rss_at_start is not None else None
+        return {
+            "estimated_mb": _mb(self.estimated),
+            "peak_rss_mb": _mb(self.peak_rss),
+            "rss_growth_mb": _mb(growth),
+            "waited_seconds": round(self.waited, 3),
+        }
+
+
+def _sample():
+    global _sampler
+    while True:
+        rss = rss_bytes()
+        with _condition:
+            if not _active:
+                _sampler = None
+                return
+            for reservation in _active:
+                reservation.observe(rss)
+        time.sleep(RSS_SAMPLE_SECONDS)
+
+
+def _wait_for_turn(
+    ticket: int,
+    estimated: int,
+    budget: int,
+    deadline: Optional[resilience.Deadline],
+    on_wait: Optional[Callable[[str], None]],
+):
+    limit = float(_setting("MEMORY_ADMISSION_TIMEOUT_SECONDS", 60))
+    if deadline is not None:
+        limit = deadline.cap(limit)
+    started = time.monotonic()
+    told = False
+    while _queue[0] != ticket or (budget and _in_use + estimated > budget):
+        waited = time.monotonic() - started
+        if waited >= limit:
+            metrics.increment("memory.timeouts")
+            raise MemoryBudgetTimeout(
+                f"Waited {waited:.0f}s for memory to process this document. Please try again later."
+            )
+        if on_wait and not told:
+            told = True
+            on_wait(
+                f"Waiting for memory: {_mb(_in_use):.0f} of {_mb(budget):.0f} MB in use, "
+                f"this document needs about {_mb(estimated):.0f} MB..."
+            )
+        _condition.wait(min(WAIT_SLICE_SECONDS, limit - waited))
+        if deadline is not None:
+            deadline.check()
+
+
+@contextmanager
+def admit(
+    estimated: int,
+    deadline: Optional[resilience.Deadline] = None,
+    on_wait: Optional[Callable[[str], None]] = None,
+):
+    """
+    Hold ``estimated`` bytes of the worker's budget for the duration of the block.
+
+    Args:
+        estimated: Bytes needed, see estimate()
+        deadline: Stops waiting when the request is cancelled or out of time
+        on_wait: Optional progress callback, told once when the request has to wait
+
+    Yields:
+        Reservation: Reports the request's memory use
+
+    Raises:
+        DocumentTooLargeError: If ``estimated`` exceeds the whole budget
+        MemoryBudgetTimeout: If memory did not free up in time
+        CancelledError, DeadlineExceededError: From ``deadline`` while waiting
+    """
+    global _in_use, _sampler
+    budget = budget_bytes()
+    nested = getattr(_local, "depth", 0) > 0
+    if budget and estimated > budget and not nested:
+        metrics.increment("memory.rejected")
+        raise DocumentTooLargeError(
+            f"This document needs about {_mb(estimated):.0f} MB of memory to process, "
+            f"more than the {_mb(budget):.0f} MB a worker may use."
+        )
+
+    started = time.monotonic()
+    with _condition:
+        ticket = next(_tickets)
+        _queue.append(ticket)
+        try:
+            if not nested:
+                _wait_for_turn(ticket, estimated, budget, deadline, on_wait)
+            _in_use += estimated
+        finally:
+            _queue.remove(ticket)
+            _condition.notify_all()
+
+    reservation = Reservation(estimated, time.monotonic() - started)
+    metrics.observe("memory.wait_seconds", reservation.waited)
+    metrics.observe("memory.estimated_mb", estimated / MB)
+    with _condition:
+        _active.add(reservation)
+        if _sampler is None:
+            _sampler = threading.Thread(target=_sample, name="memory-sampler", daemon=True)
+            _sampler.start()
+    _local.depth = getattr(_local, "depth", 0) + 1
+    try:
+        yield reservation
+    finally:
+        _local.depth -= 1
+        report = reservation.report()
+        with _condition:
+            _in_use -= estimated
+            _active.discard(reservation)
+            _condition.notify_all()
+        if report["peak_rss_mb"] is not None:
+            metrics.observe("memory.peak_rss_mb", report["peak_rss_mb"])
+            metrics.observe("memory.rss_growth_mb", report["rss_growth_mb"])
+
+
+def status() -> Dict[str, Any]:
+    """Budget and memory in use, waiting requests, and RSS per request."""
+    def p95(name):
+        value = metrics.percentile(name, 95)
+        return round(value, 3) if value is not None else None
+
+    with _condition:
+        in_use, waiting, in_flight = _in_use, len(_queue), len(_active)
+    return {
+        "budget_mb": _mb(budget_bytes()),
+        "in_use_mb": _mb(in_use),
+        "in_flight": in_flight,
+        "waiting": waiting,
+        "rss_mb": _mb(rss_bytes()),
+        "rejected": metrics.get_counter("memory.rejected"),
+        "timeouts": metrics.get_counter("memory.timeouts"),
+        "wait_seconds_p95": p95("memory.wait_seconds"),
+        "estimated_mb_p95": p95("memory.estimated_mb"),
+        "peak_rss_mb_p95": p95("memory.peak_rss_mb"),
+        "rss_growth_mb_p95": p95("memory.rss_growth_mb"),
+    }
+
+
+def reset():
+    """Forget every reservation (used by tests)."""
+    global _in_use
+    with _condition:
+        _queue.clear()
+        _active.clear()
+        _in_use = 0
+        _condition.notify_all()
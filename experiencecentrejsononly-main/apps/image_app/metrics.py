@@ -0,0 +1,82 @@
+"""In-process counters and timings for the document extraction pipeline."""
+
+import threading
+from collections import defaultdict, deque
+
+# Number of recent observations kept per timing series
+MAX_OBSERVATIONS = 1000
+
+_lock = threading.Lock()
+_counters = defaultdict(int)
+_observations = defaultdict(lambda: deque(maxlen=MAX_OBSERVATIONS))
+
+
+def increment(name: str, value: int = 1):
+    """Increase the counter ``name`` by ``value``."""
+    with _lock:
+        _counters[name] += value
+
+
+def observe(name: str, value: float):
+    """Record a single observation (e.g. a latency in seconds) for ``name``."""
+    with _lock:
+        _observations[name].append(value)
+
+
+def get_counter(name: str) -> int:
+    """Return the current value of the counter ``name``."""
+    with _lock:
+        return _counters.get(name, 0)
+
+
+def observation_count(name: str) -> int:
+    """Return how many recent observations are kept for ``name``."""
+    with _lock:
+        return len(_observations.get(name, ()))
+
+
+def percentile(name: str, pct: float, default: float = None):
+    """Return the ``pct`` percentile (0-100) of recent observations for ``name``."""
+    with _lock:
+        values = sorted(_observations.get(name, ()))
+    if not values:
+        return default
+    index = min(len(values) - 1, max(0, int(round(pct / 100 * (len(values) - 1)))))
+    return values[index]
+
+
+def _summarize(values):
+    values = sorted(values)
+    count = len(values)
+    if not count:
+        return {"count": 0}
+
+    def pick(pct):
+        return values[min(count - 1, int(round(pct / 100 * (count - 1))))]
+
+    return {
+        "count": count,
+        "avg": round(sum(values) / count, 4),
+        "p50": round(pick(50), 4),
+        "p95": round(pick(95), 4),
+        "p99": round(pick(99), 4),
+        "max": round(values[-1], 4),
+    }
+
+
+def snapshot() -> dict:
+    """Return a JSON serialisable view of all counters and timing summaries."""
+    with _lock:
+        counters = dict(_counters)
+        observations = {name: list(values) for name, values in _observations.items()}
+    return {
+        "counters": dict(sorted(counters.items())),
+        "timings": {name: _summarize(values) for name, values in sorted(observations.items())},
+    }
+
+
+def reset():
+    """Clear all recorded metrics (used by tests)."""
+    with _lock:
+        _counters.clear()
+        _observations.clear()
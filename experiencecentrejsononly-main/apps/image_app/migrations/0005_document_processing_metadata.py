@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("image_app", "0004_rename_filepath_document_file_path"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="document",
+            name="processing_metadata",
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
@@ -0,0 +1,207 @@
+"""Per-request model selection with a fallback chain.
+
+MODEL_ROUTES is an ordered table of routes (a JSON list in the environment).
+A route matches on the number of pages that will be sent, the file size, the
+doc_type and the user tier, and lists its models in order of preference::
+
+    [{"name": "receipts", "max_pages": 3, "max_file_mb": 5, "models": ["gemini-2.0-flash-lite"]},
+     {"name": "contracts", "min_pages": 50, "user_types": ["power", "admin"], "models": ["gemini-1.5-pro"]}]
+
+The first matching route wins and requests matching none use MODEL_ID. Every
+chain ends with MODEL_ID and MODEL_FALLBACK_IDS, so a routed request can
+always fall back to the default model.
+
+Each model has its own circuit breaker, and a model that returned a quota
+error is passed over by new requests for MODEL_QUOTA_COOLDOWN_SECONDS, so
+traffic moves down the chain while a model is rate limited or failing.
+"""
+
+import json
+import logging
+import mimetypes
+import os
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from . import metrics, pdf_slicing, resilience
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ROUTE = "default"
+
+_quota_until = {}
+_quota_lock = threading.Lock()
+
+
+class Route:
+    """The models a request may use, in order of preference."""
+
+    def __init__(self, name: str, models: List[Optional[str]]):
+        self.name = name
+        self.models = models
+
+    @property
+    def primary(self) -> Optional[str]:
+        return self.models[0]
+
+    @property
+    def key(self) -> Optional[str]:
+        """Identity of the chain for cache keys; a single model keys like MODEL_ID alone."""
+        if len(self.models) == 1:
+            return self.models[0]
+        return "|".join(str(model) for model in self.models)
+
+    def __repr__(self):
+        return f"Route({self.name!r}, {self.models!r})"
+
+
+def _setting(name: str, default):
+    return getattr(settings, name, default)
+
+
+def routes() -> List[Dict[str, Any]]:
+    """Return the MODEL_ROUTES table."""
+    value = _setting("MODEL_ROUTES", [])
+    if isinstance(value, str):
+        try:
+            value = json.loads(value or "[]")
+        except ValueError as e:
+            raise ImproperlyConfigured(f"Invalid MODEL_ROUTES: {e}")
+    if not isinstance(value, list) or any(not isinstance(route, dict) or not route.get("models") for route in value):
+        raise ImproperlyConfigured("MODEL_ROUTES must be a list of objects with a non-empty 'models' list")
+    return value
+
+
+def _matches(route: Dict[str, Any], pages: int, file_size: int, doc_type: Optional[str], user_type: Optional[str]) -> bool:
+    megabytes = file_size / (1024 * 1024)
+    if "min_pages" in route and pages < route["min_pages"]:
+        return False
+    if "max_pages" in route and pages > route["max_pages"]:
+        return False
+    if "min_file_mb" in route and megabytes < route["min_file_mb"]:
+        return False
+    if "max_file_mb" in route and megabytes > route["max_file_mb"]:
+        return False
+    if "doc_types" in route and doc_type not in route["doc_types"]:
+        return False
+    if "user_types" in route and user_type not in route["user_types"]:
+        return False
+    return True
+
+
+def _chain(models: Iterable[str], default_model: Optional[str]) -> List[Optional[str]]:
+    chain = []
+    for model in list(models) + [default_model] + list(_setting("MODEL_FALLBACK_IDS", [])):
+        if model and model not in chain:
+            chain.append(model)
+    return chain or [default_model]
+
+
+def select_route(
+    pages: int,
+    file_size: int,
+    doc_type: Optional[str],
+    user_type: Optional[str],
+    default_model: Optional[str],
+) -> Route:
+    """Return the first route matching the request, or the default route."""
+    for index, route in enumerate(routes()):
+        if _matches(route, pages, file_size, doc_type, user_type):
+            return Route(route.get("name") or f"route_{index + 1}", _chain(route["models"], default_model))
+    return Route(DEFAULT_ROUTE, _chain([], default_model))
+
+
+def describe_input(input_data, max_pages: Optional[int]) -> Tuple[int, int]:
+    """
+    Size up a request input without preparing it.
+
+    Returns:
+        tuple: (pages that will be sent, size in bytes)
+    """
+    if isinstance(input_data, (list, tuple)):
+        sizes = [describe_input(item, max_pages) for item in input_data]
+        return max([pages for pages, _ in sizes] or [1]), sum(size for _, size in sizes)
+
+    if isinstance(input_data, str) and os.path.exists(input_data):
+        pages = 1
+        mime_type, _ = mimetypes.guess_type(input_data)
+        if mime_type == "application/pdf":
+            try:
+                pages = pdf_slicing.page_count(input_data)
+            except Exception as e:
+                logger.debug(f"Could not count pages for routing: {e}")
+        if max_pages is not None:
+            pages = min(pages, max_pages)
+        return pages, os.path.getsize(input_data)
+
+    return 1, len(json.dumps(input_data, default=str).encode("utf-8")) if input_data is not None else 0
+
+
+def route_for(
+    input_data,
+    max_pages: Optional[int],
+    doc_type: Optional[str] = None,
+    user_type: Optional[str] = None,
+    default_model: Optional[str] = None,
+) -> Route:
+    """Pick the route for one extraction request."""
+    pages, file_size = describe_input(input_data, max_pages)
+    route = select_route(pages, file_size, doc_type, user_type, default_model)
+    metrics.increment(f"routing.routes.{route.name}")
+    logger.debug(f"Routing {pages} pages / {file_size} bytes ({doc_type}, {user_type}) to {route}")
+    return route
+
+
+def circuit(model: Optional[str]) -> resilience.CircuitBreaker:
+    """Circuit breaker tracking the health of ``model``."""
+    return resilience.circuit_for(f"model.{model or DEFAULT_ROUTE}")
+
+
+def record_quota_error(model: Optional[str]):
+    """Pass over ``model`` for MODEL_QUOTA_COOLDOWN_SECONDS while another model is available."""
+    with _quota_lock:
+        _quota_until[model] = time.monotonic() + float(_setting("MODEL_QUOTA_COOLDOWN_SECONDS", 60))
+
+
+def is_rate_limited(model: Optional[str]) -> bool:
+    with _quota_lock:
+        return _quota_until.get(model, 0) > time.monotonic()
+
+
+def has_fallback(route: Route, failed: Iterable[Optional[str]]) -> bool:
+    """True while the chain has a model that has not failed for this request."""
+    failed = set(failed)
+    return any(model not in failed for model in route.models)
+
+
+def select_model(route: Route, failed: Iterable[Optional[str]] = ()) -> Optional[str]:
+    """
+    Pick the model for the next attempt of a request.
+
+    Models that already failed for this request, and models in a quota
+    cooldown, are only used when nothing else is left.
+
+    Raises:
+        CircuitOpenError: If the circuit of every candidate is open
+    """
+    failed = set(failed)
+    candidates = [model for model in route.models if model not in failed] or list(route.models)
+    ordered = [model for model in candidates if not is_rate_limited(model)]
+    ordered += [model for model in candidates if model not in ordered]
+    for model in ordered:
+        if circuit(model).allow():
+            if model != route.primary:
+                metrics.increment("routing.fallbacks")
+                logger.info(f"Route '{route.name}' falling back from {route.primary} to {model}")
+            return model
+    raise resilience.CircuitOpenError("Vertex AI is currently unavailable. Please try again shortly.")
+
+
+def reset():
+    """Forget quota cooldowns (used by tests)."""
+    with _quota_lock:
+        _quota_until.clear()
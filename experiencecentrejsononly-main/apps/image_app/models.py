@@ -21,6 +21,7 @@ class Document(models.Model):
     llm_model_used = models.CharField(max_length=255, blank=True, null=True)
     pages_processed = models.IntegerField(default=1)  # New field
     is_full_document = models.BooleanField(default=False)  # New field for power users
+    processing_metadata = models.JSONField(default=dict, blank=True)  # Preprocessing stats, e.g. image bytes saved
  
     def __str__(self):
         return f"Document {self.id} for {self.userid.username}"
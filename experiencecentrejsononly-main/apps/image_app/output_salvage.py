@@ -0,0 +1,143 @@
+"""Recovering usable output from truncated or malformed model responses.
+
+A long document can exhaust max_output_tokens, leaving the answer cut off in
+the middle of a JSON object. Instead of discarding it and running the whole
+document again, the output is salvaged in three steps:
+
+1. Continuation: when the finish reason shows the answer hit the token limit,
+   the model is asked to continue it, with the partial answer sent back as
+   its own turn, and the pieces are joined.
+2. Repair: output that still does not parse is cleaned up (markdown fences,
+   text around the JSON, trailing commas), and failing that, every complete
+   top-level member is kept.
+3. Refill: page_N entries that are missing or empty after that are extracted
+   again from a PDF holding only those pages, and merged in without
+   replacing the pages that already succeeded.
+"""
+
+import json
+import logging
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from django.conf import settings
+
+from .json_stream import IncrementalObjectParser, safe_json_load
+from .page_windows import PAGE_KEY_RE
+
+logger = logging.getLogger(__name__)
+
+# Finish reasons (FinishReason names) of an answer cut off by max_output_tokens
+TRUNCATED_REASONS = ("MAX_TOKENS",)
+
+CONTINUE_PROMPT = (
+    "Your previous answer was cut off. Continue it exactly where it stopped, "
+    "without repeating anything already written."
+)
+
+# How repair() recovered the output
+CLEANED = "cleaned"
+MEMBERS = "members"
+
+
+def _setting(name: str, default):
+    return getattr(settings, name, default)
+
+
+def is_enabled() -> bool:
+    return bool(_setting("OUTPUT_SALVAGE_ENABLED", True))
+
+
+def is_truncated(finish_reason: Optional[str]) -> bool:
+    return finish_reason in TRUNCATED_REASONS
+
+
+def _strip_trailing_commas(text: str) -> str:
+    # Drop commas directly followed by a closing bracket, outside strings
+    result = []
+    in_string = escape = False
+    for char in text:
+        if in_string:
+            if escape:
+                escape = False
+            elif char == "\\":
+                escape = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char in "}]":
+            while result and result[-1].isspace():
+                result.pop()
+            if result and result[-1] == ",":
+                result.pop()
+        result.append(char)
+    return "".join(result)
+
+
+def repair(text: str) -> Tuple[Optional[Any], Optional[str]]:
+    """
+    Parse near-valid JSON output.
+
+    Returns:
+        tuple: (value, method) where method is None when the text parsed as
+        is, CLEANED or MEMBERS; (None, None) when nothing could be recovered
+    """
+    try:
+        return safe_json_load(text), None
+    except (ValueError, TypeError):
+        pass
+
+    text = text or ""
+    starts = [index for index in (text.find("{"), text.find("[")) if index >= 0]
+    if not starts:
+        return None, None
+    cleaned = _strip_trailing_commas(text[min(starts):])
+    try:
+        # raw_decode ignores whatever follows the JSON value (closing fences, remarks)
+        value, _ = json.JSONDecoder().raw_decode(cleaned)
+        return value, CLEANED
+    except ValueError:
+        pass
+
+    members = dict(IncrementalObjectParser().feed(cleaned))
+    if members:
+        return members, MEMBERS
+    return None, None
+
+
+def is_page_wise(parsed: Any) -> bool:
+    """True for doc_extraction_prompt style output with page_N members."""
+    return isinstance(parsed, dict) and any(PAGE_KEY_RE.match(str(key)) for key in parsed)
+
+
+def expected_pages(pages_processed: int, pages_skipped: Iterable[Dict[str, Any]]) -> List[int]:
+    """Page numbers the output should hold: every page sent, minus dropped ones."""
+    skipped = {page.get("page") for page in pages_skipped or []}
+    return [page for page in range(1, pages_processed + 1) if page not in skipped]
+
+
+def missing_pages(parsed: Dict[str, Any], pages: Iterable[int]) -> List[int]:
+    """Pages of ``pages`` whose page_N entry is absent or not a non-empty object."""
+    return [page for page in pages if not (isinstance(parsed.get(f"page_{page}"), dict) and parsed[f"page_{page}"])]
+
+
+def fill_pages(parsed: Dict[str, Any], refill: Dict[str, Any], pages: Iterable[int]) -> Dict[str, Any]:
+    """
+    Add the entries of ``refill`` for ``pages`` to ``parsed``.
+
+    Entries of pages that already succeeded are never replaced. page_N
+    members are ordered by page number, followed by the other members.
+    """
+    merged = dict(parsed)
+    for page in pages:
+        value = refill.get(f"page_{page}")
+        if isinstance(value, dict) and value:
+            merged[f"page_{page}"] = value
+
+    page_keys = sorted(
+        (key for key in merged if PAGE_KEY_RE.match(str(key))),
+        key=lambda key: int(PAGE_KEY_RE.match(key).group(1))
+    )
+    ordered = {key: merged[key] for key in page_keys}
+    ordered.update((key, value) for key, value in merged.items() if key not in ordered)
+    return ordered
@@ -0,0 +1,157 @@
+"""JSON schemas for the model's output, declared next to the prompts.
+
+A prompt in Prompts/prompts.yaml may declare the shape of its answer under
+``schemas``, using the prompt's name::
+
+    schemas:
+      reimbursement_extraction_prompt:
+        type: object
+        properties: ...
+
+The schema is sent as ``response_schema`` so Gemini only generates output of
+that shape, and the parsed output is checked against it. Schemas use the
+OpenAPI subset Vertex AI accepts (type, properties, required, items, enum,
+nullable), which is also what validate() understands.
+
+Every parse of model output is counted per doc_type and mode (``schema`` or
+``free``) under ``parsing.*``, so parse-failure rates with and without a
+schema can be compared.
+"""
+
+import logging
+from typing import Any, Dict, List, Optional
+
+from django.conf import settings
+
+from . import metrics
+from .json_stream import safe_json_load
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = "schema"
+FREE = "free"
+
+_TYPES = {
+    "object": dict,
+    "array": list,
+    "string": str,
+    "boolean": bool,
+    "integer": int,
+    "number": (int, float),
+}
+
+
+def is_enabled() -> bool:
+    return bool(getattr(settings, "STRUCTURED_OUTPUT_ENABLED", True))
+
+
+def schema_for(config: Dict[str, Any], prompt_name: str) -> Optional[Dict[str, Any]]:
+    """Return the schema prompts.yaml declares for ``prompt_name``, or None."""
+    if not is_enabled():
+        return None
+    schema = (config.get("schemas") or {}).get(prompt_name)
+    return schema if isinstance(schema, dict) else None
+
+
+def validate(value: Any, schema: Dict[str, Any], path: str = "$") -> List[str]:
+    """
+    Check ``value`` against ``schema``.
+
+    Returns:
+        list: One message per violation, prefixed with its JSON path; empty
+        when the value conforms
+    """
+    if value is None:
+        return [] if schema.get("nullable") else [f"{path}: null is not allowed"]
+
+    schema_type = str(schema.get("type", "")).lower()
+    expected = _TYPES.get(schema_type)
+    if expected is not None:
+        # bool is an int in Python, but not a JSON integer or number
+        if not isinstance(value, expected) or (schema_type in ("integer", "number") and isinstance(value, bool)):
+            return [f"{path}: expected {schema_type}, got {type(value).__name__}"]
+
+    if "enum" in schema and value not in schema["enum"]:
+        return [f"{path}: {value!r} is not one of {schema['enum']}"]
+
+    errors = []
+    if isinstance(value, dict):
+        for name in schema.get("required", []):
+            if name not in value:
+                errors.append(f"{path}.{name}: missing")
+        for name, property_schema in (schema.get("properties") or {}).items():
+            if name in value:
+                errors.extend(validate(value[name], property_schema, f"{path}.{name}"))
+    elif isinstance(value, list) and isinstance(schema.get("items"), dict):
+        for index, item in enumerate(value):
+            errors.extend(validate(item, schema["items"], f"{path}[{index}]"))
+    return errors
+
+
+def record(doc_type: Optional[str], constrained: bool, ok: bool):
+    """Count one parse of model output for ``doc_type``."""
+    mode = SCHEMA if constrained else FREE
+    doc_type = doc_type or "unknown"
+    metrics.increment(f"parsing.{mode}.attempts.{doc_type}")
+    if not ok:
+        metrics.increment(f"parsing.{mode}.failures.{doc_type}")
+
+
+def parse_output(text: str, doc_type: Optional[str] = None, schema: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    Parse the model's text output into a dict and check it against ``schema``.
+
+    Output that parses but does not match the schema is returned, since
+    Gemini only deviates from a response_schema when its answer was cut
+    off, but is logged and counted as a failure.
+
+    Raises:
+        json.JSONDecodeError: If the text is not valid JSON
+        ValueError: If the JSON is not an object (or a list starting with one)
+    """
+    try:
+        parsed = safe_json_load(text)
+        if isinstance(parsed, list) and parsed:
+            parsed = parsed[0]
+        if not isinstance(parsed, dict):
+            raise ValueError("Parsed JSON is not a dictionary")
+    except ValueError:
+        record(doc_type, schema is not None, ok=False)
+        raise
+
+    errors = validate(parsed, schema) if schema else []
+    if errors:
+        logger.warning(f"Output for {doc_type} does not match its schema: {'; '.join(errors[:5])}")
+    record(doc_type, schema is not None, ok=not errors)
+    return parsed
+
+
+def conforms(text: str, schema: Dict[str, Any]) -> bool:
+    """True if ``text`` parses into a value matching ``schema``."""
+    try:
+        return not validate(safe_json_load(text), schema)
+    except ValueError:
+        return False
+
+
+def failure_rates() -> Dict[str, Dict[str, Dict[str, Any]]]:
+    """
+    Summarize the ``parsing.*`` counters.
+
+    Returns:
+        dict: ``{doc_type: {"schema"|"free": {"attempts", "failures", "failure_rate"}}}``
+    """
+    rates = {}
+    counters = metrics.snapshot()["counters"]
+    for name, attempts in counters.items():
+        parts = name.split(".", 3)
+        if len(parts) != 4 or parts[0] != "parsing" or parts[2] != "attempts":
+            continue
+        _, mode, _, doc_type = parts
+        failures = counters.get(f"parsing.{mode}.failures.{doc_type}", 0)
+        rates.setdefault(doc_type, {})[mode] = {
+            "attempts": attempts,
+            "failures": failures,
+            "failure_rate": round(failures / attempts, 4) if attempts else 0.0,
+        }
+    return rates
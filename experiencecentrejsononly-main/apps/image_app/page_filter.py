@@ -0,0 +1,169 @@
+"""Blank and duplicate page elimination for PDFs.
+
+Scanned batches often contain blank separator sheets and pages scanned twice.
+Before a PDF is sent, every page is fingerprinted: pages with a text layer by
+a digest of their normalized text, scanned pages by a 64-bit difference hash
+(dHash) of their largest image. A page is dropped when it is blank (no text
+and almost no ink) or when its fingerprint matches a page already kept. The
+kept pages are renumbered 1..n for the model and the output is mapped back
+to the original page numbers with the returned mapping.
+"""
+
+import hashlib
+import io
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+
+from django.conf import settings
+from PIL import Image, ImageStat
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+HASH_SIZE = 8
+# Pages whose content stream is shorter than this draw (almost) nothing
+EMPTY_CONTENT_BYTES = 64
+# A pixel is ink when it is this much darker than the page's median (paper) level
+INK_CONTRAST = 64
+ANALYSIS_EDGE = 512
+
+
+def _setting(name: str, default):
+    return getattr(settings, name, default)
+
+
+def is_enabled() -> bool:
+    return bool(_setting("PAGE_FILTER_ENABLED", True))
+
+
+def dhash(image: Image.Image) -> int:
+    """Return the 64-bit difference hash of ``image``."""
+    small = image.convert("L").resize((HASH_SIZE + 1, HASH_SIZE), Image.LANCZOS)
+    pixels = list(small.getdata())
+    value = 0
+    for row in range(HASH_SIZE):
+        for column in range(HASH_SIZE):
+            left = pixels[row * (HASH_SIZE + 1) + column]
+            right = pixels[row * (HASH_SIZE + 1) + column + 1]
+            value = (value << 1) | int(left > right)
+    return value
+
+
+def ink_ratio(image: Image.Image) -> float:
+    """Share of pixels clearly darker than the paper."""
+    gray = image.convert("L")
+    gray.thumbnail((ANALYSIS_EDGE, ANALYSIS_EDGE))
+    paper = ImageStat.Stat(gray).median[0]
+    histogram = gray.histogram()
+    threshold = max(0, int(paper) - INK_CONTRAST)
+    return sum(histogram[:threshold]) / max(1, gray.width * gray.height)
+
+
+def _largest_image(page) -> Optional[Image.Image]:
+    try:
+        images = page.images
+    except Exception as e:
+        logger.debug(f"Could not read page images: {e}")
+        return None
+    for candidate in sorted(images, key=lambda image: len(image.data), reverse=True):
+        try:
+            image = Image.open(io.BytesIO(candidate.data))
+            # JPEG scans can be decoded at a fraction of their size
+            image.draft("L", (ANALYSIS_EDGE, ANALYSIS_EDGE))
+            image.load()
+            return image
+        except Exception:
+            continue
+    return None
+
+
+def _content_length(page) -> int:
+    try:
+        contents = page.get_contents()
+        return len(contents.get_data()) if contents is not None else 0
+    except Exception:
+        return EMPTY_CONTENT_BYTES
+
+
+def fingerprint(document, index: int) -> Tuple[Optional[str], Any]:
+    """
+    Fingerprint one page.
+
+    Returns:
+        tuple: (kind, value) where kind is "text" (value: digest of the text),
+        "image" (value: dHash) or None for a blank page
+    """
+    text = document.page_text(index)
+    if text:
+        normalized = " ".join(text.split()).lower()
+        return "text", hashlib.sha1(normalized.encode("utf-8")).hexdigest()
+
+    page = document.page(index)
+    image = _largest_image(page)
+    if image is not None:
+        if ink_ratio(image) < float(_setting("PAGE_BLANK_INK_RATIO", 0.002)):
+            return None, None
+        return "image", dhash(image)
+
+    if _content_length(page) < EMPTY_CONTENT_BYTES:
+        return None, None
+    # Vector drawings without text or images are kept, but not compared
+    return "other", index
+
+
+def _is_duplicate(kind: str, value: Any, seen: List[Tuple[str, Any, int]]) -> Optional[int]:
+    max_distance = int(_setting("PAGE_DUPLICATE_MAX_DISTANCE", 4))
+    for seen_kind, seen_value, seen_index in seen:
+        if seen_kind != kind or kind == "other":
+            continue
+        if kind == "text" and value == seen_value:
+            return seen_index
+        if kind == "image" and bin(value ^ seen_value).count("1") <= max_distance:
+            return seen_index
+    return None
+
+
+def filter_pages(document, indices: List[int]) -> Tuple[List[int], List[Dict[str, Any]]]:
+    """
+    Drop blank and duplicate pages.
+
+    Args:
+        document: An open pdf_slicing.PdfDocument
+        indices: 0-based indices of the candidate pages, in order
+
+    Returns:
+        tuple: (kept indices, skipped pages) where each skipped page is
+        {"page": n, "reason": "blank"} or {"page": n, "reason": "duplicate",
+        "duplicateOf": m} with 1-based original page numbers. At least one
+        page is always kept.
+    """
+    kept = []
+    skipped = []
+    seen = []
+    for index in indices:
+        try:
+            kind, value = fingerprint(document, index)
+        except Exception as e:
+            logger.debug(f"Could not fingerprint page {index + 1}: {e}")
+            kind, value = "other", index
+
+        if kind is None:
+            skipped.append({"page": index + 1, "reason": "blank"})
+            continue
+        duplicate_of = _is_duplicate(kind, value, seen)
+        if duplicate_of is not None:
+            skipped.append({"page": index + 1, "reason": "duplicate", "duplicateOf": duplicate_of + 1})
+            continue
+        seen.append((kind, value, index))
+        kept.append(index)
+
+    if not kept and indices:
+        # An all-blank document is still sent, so the caller gets a normal response
+        kept = [indices[0]]
+        skipped = [page for page in skipped if page["page"] != indices[0] + 1]
+
+    metrics.increment("page_filter.pages_skipped", len(skipped))
+    if skipped:
+        logger.info(f"Skipping {len(skipped)} blank or duplicate pages: {[page['page'] for page in skipped]}")
+    return kept, skipped
@@ -0,0 +1,187 @@
+"""Page-window planning, adaptive sizing and result merging for large PDFs."""
+
+import logging
+import re
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+from django.conf import settings
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+PAGE_KEY_RE = re.compile(r"^page_(\d+)$")
+PAGE_INFO_RE = re.compile(r"^\s*page\s+(\d+)\s*/\s*(\d+)\s*$", re.IGNORECASE)
+
+# Exponential moving average weight given to the newest latency observation
+LATENCY_EWMA_ALPHA = 0.3
+
+
+def _setting(name: str, default):
+    return getattr(settings, name, default)
+
+
+def split_page_ranges(total_pages: int, window_size: int) -> List[Tuple[int, int]]:
+    """
+    Split ``total_pages`` into consecutive windows.
+
+    Returns:
+        list: (start, end) pairs with a 0-based start and exclusive end
+    """
+    window_size = max(1, int(window_size))
+    return [
+        (start, min(start + window_size, total_pages))
+        for start in range(0, total_pages, window_size)
+    ]
+
+
+def renumber_pages(window_json: Dict[str, Any], page_offset: int, total_pages: int) -> Dict[str, Any]:
+    """
+    Shift the window-local ``page_N`` keys of one window's output to global numbers.
+
+    ``page_info`` strings of the form "page k/n" are rewritten to the global
+    page number and document length as well.
+    """
+    return _renumber(window_json, lambda page: page + page_offset, total_pages)
+
+
+def remap_pages(output_json: Dict[str, Any], page_numbers: List[int], total_pages: int) -> Dict[str, Any]:
+    """
+    Map the ``page_N`` keys of output produced from a subset of pages back to original numbers.
+
+    ``page_numbers[i]`` is the original number of the page sent as page i + 1.
+    Keys outside the mapping are left unchanged.
+    """
+    return _renumber(
+        output_json,
+        lambda page: page_numbers[page - 1] if 1 <= page <= len(page_numbers) else page,
+        total_pages
+    )
+
+
+def _renumber(output_json: Dict[str, Any], number_for, total_pages: int) -> Dict[str, Any]:
+    renumbered = {}
+    for key, value in output_json.items():
+        match = PAGE_KEY_RE.match(str(key))
+        if not match:
+            renumbered[key] = value
+            continue
+        page = number_for(int(match.group(1)))
+        if isinstance(value, dict) and isinstance(value.get("page_info"), str):
+            if PAGE_INFO_RE.match(value["page_info"]):
+                value = {**value, "page_info": f"page {page}/{total_pages}"}
+        renumbered[f"page_{page}"] = value
+    return renumbered
+
+
+def merge_window_results(window_results: List[Tuple[int, Dict[str, Any]]], total_pages: int) -> Dict[str, Any]:
+    """
+    Merge the parsed output of every window into one json_data object.
+
+    Args:
+        window_results: (page_offset, parsed_json) per window, in any order
+        total_pages: Page count of the whole document
+
+    Returns:
+        dict: page_N members ordered by global page number, followed by any
+        other top-level members. Lists under the same key are concatenated;
+        for other values the earliest window wins.
+    """
+    pages = {}
+    extras = {}
+    for page_offset, window_json in sorted(window_results, key=lambda item: item[0]):
+        for key, value in renumber_pages(window_json, page_offset, total_pages).items():
+            if PAGE_KEY_RE.match(str(key)):
+                pages[key] = value
+            elif key not in extras:
+                extras[key] = value
+            elif isinstance(extras[key], list) and isinstance(value, list):
+                extras[key] = extras[key] + value
+
+    merged = {key: pages[key] for key in sorted(pages, key=lambda k: int(PAGE_KEY_RE.match(k).group(1)))}
+    merged.update(extras)
+    return merged
+
+
+def sum_usage_metadata(responses: List[Dict[str, Any]]) -> Dict[str, int]:
+    """Add up the usageMetadata token counts of several formatted responses."""
+    totals = {"promptTokenCount": 0, "candidatesTokenCount": 0, "totalTokenCount": 0}
+    for response in responses:
+        usage = response.get("usageMetadata") or {}
+        for name in totals:
+            totals[name] += usage.get(name, 0) or 0
+    return totals
+
+
+class AdaptiveWindowController:
+    """
+    Choose window size and fan-out from the per-window latencies seen so far.
+
+    Window size targets ``PAGE_WINDOW_TARGET_SECONDS`` per window based on an
+    EWMA of seconds per page. Concurrency grows by one after each window that
+    finishes within 1.5x the target and is halved after a slow or failed window.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._seconds_per_page = None
+        self._concurrency = None
+
+    @property
+    def target_seconds(self) -> float:
+        return float(_setting("PAGE_WINDOW_TARGET_SECONDS", 30))
+
+    def window_size(self) -> int:
+        minimum = int(_setting("PAGE_WINDOW_MIN_SIZE", 2))
+        maximum = int(_setting("PAGE_WINDOW_MAX_SIZE", 25))
+        with self._lock:
+            seconds_per_page = self._seconds_per_page
+        if not seconds_per_page:
+            size = int(_setting("PAGE_WINDOW_SIZE", 10))
+        else:
+            size = int(self.target_seconds / seconds_per_page)
+        return max(minimum, min(maximum, size))
+
+    def seconds_per_page(self) -> Optional[float]:
+        """EWMA of observed seconds per page, or None before the first window finished."""
+        with self._lock:
+            return self._seconds_per_page
+
+    def concurrency(self) -> int:
+        maximum = int(_setting("PAGE_WINDOW_MAX_WORKERS", 4))
+        with self._lock:
+            if self._concurrency is None:
+                self._concurrency = maximum
+            return max(1, min(maximum, self._concurrency))
+
+    def record(self, pages: int, latency: float, ok: bool = True):
+        """Feed back the outcome of one window."""
+        maximum = int(_setting("PAGE_WINDOW_MAX_WORKERS", 4))
+        with self._lock:
+            if self._concurrency is None:
+                self._concurrency = maximum
+            if ok and pages > 0:
+                per_page = latency / pages
+                if self._seconds_per_page is None:
+                    self._seconds_per_page = per_page
+                else:
+                    self._seconds_per_page = (
+                        LATENCY_EWMA_ALPHA * per_page + (1 - LATENCY_EWMA_ALPHA) * self._seconds_per_page
+                    )
+            if ok and latency <= 1.5 * self.target_seconds:
+                self._concurrency = min(maximum, self._concurrency + 1)
+            else:
+                self._concurrency = max(1, self._concurrency // 2)
+            concurrency = self._concurrency
+        metrics.observe("page_windows.window_seconds", latency)
+        metrics.increment("page_windows.windows_ok" if ok else "page_windows.windows_failed")
+        logger.debug(f"Page window finished: pages={pages} latency={latency:.2f}s ok={ok} concurrency={concurrency}")
+
+    def reset(self):
+        with self._lock:
+            self._seconds_per_page = None
+            self._concurrency = None
+
+
+controller = AdaptiveWindowController()
@@ -0,0 +1,181 @@
+"""In-memory PDF page slicing.
+
+A PDF is parsed once; page ranges are written to in-memory buffers and handed
+to the model as bytes, so no temporary files are created next to the upload
+and concurrent requests on the same file cannot collide. The file is
+memory-mapped and the parser reads objects from the mapping on demand, so
+slicing a few pages out of a large scan neither loads the whole file into the
+heap nor copies it through read buffers.
+"""
+
+import io
+import logging
+import mmap
+import os
+import threading
+from collections import OrderedDict
+from typing import Iterable, Optional, Union
+
+from PyPDF2 import PdfReader, PdfWriter
+
+from . import metrics, preprocessing_pool
+
+logger = logging.getLogger(__name__)
+
+# Page counts remembered by file, see page_count()
+PAGE_COUNT_CACHE_SIZE = 256
+
+_page_counts = OrderedDict()
+_page_counts_lock = threading.Lock()
+
+
+class PdfDocument:
+    """
+    A PDF parsed once, from which page ranges can be sliced repeatedly.
+
+    Usage:
+
+    ```python
+    with PdfDocument(path) as document:
+        first_pages = document.head(3)
+        total = document.page_count
+    ```
+    """
+
+    def __init__(self, source: Union[str, bytes]):
+        self._file = None
+        if isinstance(source, (bytes, bytearray)):
+            self.path = None
+            self._data = bytes(source)
+            self._stream = io.BytesIO(self._data)
+        else:
+            self.path = source
+            self._data = None
+            self._file = open(source, "rb")
+            try:
+                self._stream = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, OSError):
+                # Empty files and file systems without mmap support are read as a stream
+                self._stream = self._file
+        self._texts = {}
+        try:
+            self._reader = PdfReader(self._stream)
+            self._page_count = len(self._reader.pages)
+        except Exception:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._stream.close()
+        if self._file is not None:
+            self._file.close()
+
+    @property
+    def page_count(self) -> int:
+        """Total number of pages in the document."""
+        return self._page_count
+
+    def page(self, index: int):
+        """Return the PyPDF2 page object at ``index`` (0-based)."""
+        return self._reader.pages[index]
+
+    def page_text(self, index: int) -> str:
+        """
+        Return the text layer of page ``index``, one line per text line.
+
+        Returns "" when the page has no text or it cannot be extracted. The
+        result is cached, since several preprocessing steps read it.
+        """
+        if index not in self._texts:
+            try:
+                text = self._reader.pages[index].extract_text() or ""
+            except Exception as e:
+                logger.debug(f"Text extraction failed on page {index + 1}: {e}")
+                text = ""
+            # Keep the line structure (it carries the table rows) but drop trailing blanks
+            self._texts[index] = "\n".join(line.rstrip() for line in text.splitlines()).strip()
+        return self._texts[index]
+
+    def read(self) -> bytes:
+        """Return the original bytes of the whole document."""
+        if self._data is None:
+            if isinstance(self._stream, mmap.mmap):
+                self._data = self._stream[:]
+            else:
+                with open(self.path, "rb") as f:
+                    self._data = f.read()
+        return self._data
+
+    def slice(self, start: int, end: int) -> bytes:
+        """
+        Return a PDF holding pages ``start`` (0-based) up to ``end`` (exclusive).
+
+        The original bytes are returned unchanged when the range covers the
+        whole document.
+        """
+        return self.select(range(max(0, start), min(end, self._page_count)))
+
+    def select(self, indices: Iterable[int]) -> bytes:
+        """
+        Return a PDF holding the pages at ``indices`` (0-based), in that order.
+
+        The original bytes are returned unchanged when all pages are selected
+        in their original order.
+        """
+        indices = list(indices)
+        if indices == list(range(self._page_count)):
+            return self.read()
+
+        writer = PdfWriter()
+        for index in indices:
+            writer.add_page(self._reader.pages[index])
+        buffer = io.BytesIO()
+        writer.write(buffer)
+        metrics.increment("pdf_slicing.slices")
+        return buffer.getvalue()
+
+    def head(self, max_pages: Optional[int]) -> bytes:
+        """Return the first ``max_pages`` pages, or the whole document for None."""
+        if max_pages is None:
+            return self.read()
+        return self.slice(0, max_pages)
+
+
+def _count_pages(path: str) -> int:
+    with PdfDocument(path) as document:
+        return document.page_count
+
+
+def page_count(path: str) -> int:
+    """
+    Return the number of pages of the PDF at ``path``.
+
+    Routing, the token estimate and the memory budget each need the count
+    before the document is prepared, so it is remembered for the file's size
+    and modification time and the PDF is parsed once per upload. Files large
+    enough for the preprocessing pool are parsed there, off the request thread.
+    """
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    with _page_counts_lock:
+        if key in _page_counts:
+            _page_counts.move_to_end(key)
+            return _page_counts[key]
+
+    if preprocessing_pool.should_offload(path):
+        count = preprocessing_pool.page_count(path, _count_pages)
+    else:
+        count = _count_pages(path)
+    metrics.increment("pdf_slicing.page_counts")
+
+    with _page_counts_lock:
+        _page_counts[key] = count
+        while len(_page_counts) > PAGE_COUNT_CACHE_SIZE:
+            _page_counts.popitem(last=False)
+    return count
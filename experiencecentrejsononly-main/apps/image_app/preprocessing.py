@@ -0,0 +1,235 @@
+"""Backend independent preparation of request inputs.
+
+Every input (file path, JSON or text) is turned into a PreparedInput holding
+either the bytes or the text to send. PDFs are sliced to ``max_pages`` in
+memory, blank and duplicate PDF pages are dropped, born-digital PDF pages are
+replaced by their text layer and images are normalized, so the Vertex and fake
+backends send and count exactly the same payload. Per-request statistics are
+collected in a metadata dict which is returned with the response and stored on
+the Document. Large PDFs and images are prepared in a process pool (see
+preprocessing_pool).
+"""
+
+import json
+import logging
+import mimetypes
+import os
+from typing import Any, Dict, List, Optional
+
+from django.conf import settings
+
+from . import image_normalization, page_filter, pdf_slicing, preprocessing_pool, text_layer
+
+logger = logging.getLogger(__name__)
+
+# Bumped whenever a change to preparation changes the payload sent for the same file
+PREPROCESSING_VERSION = 1
+# Settings that change the payload sent for the same file
+PAYLOAD_SETTINGS = (
+    "PAGE_FILTER_ENABLED", "PAGE_BLANK_INK_RATIO", "PAGE_DUPLICATE_MAX_DISTANCE",
+    "PDF_TEXT_LAYER_ENABLED", "PDF_TEXT_LAYER_MIN_CHARS", "PDF_TEXT_LAYER_MIN_QUALITY",
+    "IMAGE_NORMALIZATION_ENABLED", "IMAGE_MAX_LONG_EDGE", "IMAGE_GRAYSCALE_ENABLED",
+    "IMAGE_GRAYSCALE_THRESHOLD", "IMAGE_JPEG_QUALITY",
+)
+
+
+class PreparedInput:
+    """
+    One input ready to be sent: ``data`` with ``mime_type``, or ``text``.
+
+    A PDF sent partly as text carries its parts in ``segments`` instead.
+    """
+
+    def __init__(
+        self,
+        mime_type: Optional[str] = None,
+        data: Optional[bytes] = None,
+        text: Optional[str] = None,
+        pages: int = 1,
+        total_pages: int = 1,
+        segments: Optional[List["PreparedInput"]] = None,
+    ):
+        self.mime_type = mime_type
+        self.data = data
+        self.text = text
+        self.pages = pages
+        self.total_pages = total_pages
+        self.segments = segments
+
+    def parts(self) -> List["PreparedInput"]:
+        """The payloads to send, in order."""
+        return self.segments or [self]
+
+
+def fingerprint() -> Dict[str, Any]:
+    """Identity of the current preparation (version and settings), part of the extraction cache key."""
+    return {
+        "version": PREPROCESSING_VERSION,
+        "settings": {name: getattr(settings, name, None) for name in PAYLOAD_SETTINGS},
+    }
+
+
+def _select_pages(document, pages: int, metadata: Dict[str, Any]) -> List[int]:
+    indices = list(range(pages))
+    if not page_filter.is_enabled():
+        return indices
+    kept, skipped = page_filter.filter_pages(document, indices)
+    if skipped:
+        metadata.setdefault("pages_skipped", []).extend(skipped)
+        # The model numbers the kept pages 1..n; this maps them back
+        metadata["page_mapping"] = [index + 1 for index in kept]
+    return kept
+
+
+def _read_file(path: str, max_pages: Optional[int], metadata: Dict[str, Any], page_level: bool) -> PreparedInput:
+    mime_type, _ = mimetypes.guess_type(path)
+    if not mime_type:
+        mime_type = "application/octet-stream"
+
+    if mime_type == "application/pdf":
+        # Parse once and pass the page subset straight to the API
+        try:
+            with pdf_slicing.PdfDocument(path) as document:
+                total_pages = document.page_count
+                pages = total_pages if max_pages is None else min(total_pages, max_pages)
+                if not page_level:
+                    return PreparedInput(mime_type, document.head(max_pages), pages=pages, total_pages=total_pages)
+
+                indices = _select_pages(document, pages, metadata)
+                segments = text_layer.split_document(document, indices, metadata) if text_layer.is_enabled() else None
+                if segments is not None:
+                    return PreparedInput(mime_type, pages=pages, total_pages=total_pages, segments=[
+                        PreparedInput(text=value) if kind == text_layer.TEXT else PreparedInput(mime_type, value)
+                        for kind, value in segments
+                    ])
+                file_bytes = document.select(indices)
+            return PreparedInput(mime_type, file_bytes, pages=pages, total_pages=total_pages)
+        except (IOError, OSError):
+            raise
+        except Exception as e:
+            logger.warning(f"Could not limit PDF pages: {e}, processing full document")
+
+    with open(path, "rb") as f:
+        file_bytes = f.read()
+
+    if mime_type.startswith("image/") and image_normalization.is_enabled():
+        normalized = image_normalization.normalize_image(file_bytes, mime_type)
+        image_normalization.merge_stats(metadata.setdefault("image_normalization", {}), normalized.stats)
+        return PreparedInput(normalized.mime_type, normalized.data)
+
+    return PreparedInput(mime_type, file_bytes)
+
+
+def prepare_input(
+    input_data,
+    max_pages: Optional[int] = None,
+    metadata: Optional[Dict[str, Any]] = None,
+    page_level: bool = True,
+) -> PreparedInput:
+    """
+    Prepare one input for the model.
+
+    Args:
+        input_data: A file path (str), text (str), or JSON (dict/str)
+        max_pages: Maximum number of pages to send for PDFs (None for all)
+        metadata: Dict that receives preprocessing statistics
+        page_level: Apply the PDF page filter and text-layer fast path. Both
+            change the pages the model sees (the page filter records a
+            ``page_mapping`` for the output), and the text layer returns a
+            PreparedInput with several segments
+
+    Returns:
+        PreparedInput: The payload with the number of pages sent and the total
+    """
+    if metadata is None:
+        metadata = {}
+
+    # If input is a dictionary (already parsed JSON)
+    if isinstance(input_data, dict):
+        return PreparedInput(text=json.dumps(input_data, ensure_ascii=False))
+
+    # If input is a string, check if it's a file path or JSON string
+    if isinstance(input_data, str):
+        if os.path.exists(input_data):
+            try:
+                if preprocessing_pool.should_offload(input_data):
+                    return preprocessing_pool.read_file(input_data, max_pages, metadata, page_level, _read_file)
+                return _read_file(input_data, max_pages, metadata, page_level)
+            except (IOError, OSError):
+                # If file read fails, treat as text
+                pass
+
+        try:
+            json_data = json.loads(input_data)
+            return PreparedInput(text=json.dumps(json_data, ensure_ascii=False))
+        except (json.JSONDecodeError, TypeError):
+            # If not JSON, treat as plain text
+            return PreparedInput(text=input_data)
+
+    # For any other type, convert to string
+    return PreparedInput(text=str(input_data))
+
+
+def prepare_inputs(input_data, max_pages: Optional[int] = None) -> tuple[List[PreparedInput], int, int, Dict[str, Any]]:
+    """
+    Prepare a single input or a list of inputs.
+
+    Skipped pages of a list of inputs carry the 1-based position of their
+    input under ``input``.
+
+    Returns:
+        tuple: (prepared inputs, pages_processed, total_pages, metadata)
+    """
+    metadata = {}
+    if input_data is None:
+        return [], 1, 1, metadata
+
+    if isinstance(input_data, (list, tuple)) and len(input_data) == 1:
+        input_data = input_data[0]
+    if not isinstance(input_data, (list, tuple)):
+        prepared = [prepare_input(input_data, max_pages, metadata)]
+        return prepared, prepared[0].pages, prepared[0].total_pages, metadata
+
+    # Several documents: page numbers are per input, so skipped pages are tagged
+    # with their input's position and no page_mapping applies to the output
+    prepared = []
+    item_metadata = []
+    for position, item in enumerate(input_data, start=1):
+        values = {}
+        prepared.append(prepare_input(item, max_pages, values))
+        for page in values.pop("pages_skipped", []):
+            metadata.setdefault("pages_skipped", []).append({"input": position, **page})
+        values.pop("page_mapping", None)
+        item_metadata.append(values)
+    metadata.update(merge_metadata(item_metadata))
+    pages = max([item.pages for item in prepared] or [1])
+    total_pages = max([item.total_pages for item in prepared] or [1])
+    return prepared, pages, total_pages, metadata
+
+
+def merge_metadata(metadata_list: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Add up the preprocessing metadata of several requests, e.g. the windows of one document.
+
+    Only counters are merged; page lists (pages_skipped, page_mapping) use
+    window-local numbers and are left to the caller. Of the ``memory``
+    reports, estimates and waits add up while RSS figures keep the largest.
+    """
+    def add(total: Dict[str, Any], values: Dict[str, Any]):
+        for key, value in values.items():
+            if isinstance(value, dict):
+                add(total.setdefault(key, {}), value)
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                total[key] = total.get(key, 0) + value
+
+    merged = {}
+    for metadata in metadata_list:
+        add(merged, metadata or {})
+    if "text_layer" in merged:
+        merged["text_layer"]["mode"] = text_layer.mode(merged["text_layer"])
+    if "memory" in merged:
+        reports = [metadata["memory"] for metadata in metadata_list if metadata and metadata.get("memory")]
+        for key in ("peak_rss_mb", "rss_growth_mb"):
+            values = [report[key] for report in reports if report.get(key) is not None]
+            merged["memory"][key] = max(values) if values else None
+    return merged
@@ -0,0 +1,292 @@
+"""Process pool for CPU-heavy document preprocessing.
+
+Parsing and slicing PDFs, fingerprinting their pages and recompressing
+photos is pure Python and Pillow work that holds the GIL, so under gthread
+workers one large upload stalls every other request of the process. Files of
+at least PREPROCESSING_POOL_MIN_KB that are PDFs or images are therefore
+prepared in a pool of PREPROCESSING_POOL_WORKERS processes while the request
+thread waits without holding the GIL.
+
+Payloads are not pickled through the pool's pipe. The worker opens the
+upload by its path, and writes the bytes it prepared (PDF slices, the
+normalized image) into one shared memory block that the request thread reads
+them from; only the page counts, text segments, preprocessing metadata and
+the worker's metric counters travel as pickles. At most twice as many files
+as there are workers are in flight, later callers wait for a slot. The page
+count that routing and admission read before a large PDF is prepared is
+taken in the pool as well (see pdf_slicing.page_count).
+
+Workers are spawned, not forked, since the server process runs threads, and
+set up Django themselves. The preprocessing settings of the caller are sent
+with every file, so a worker always applies the current values. A pool that
+breaks (a worker killed) is replaced, and the file is prepared in the request
+thread meanwhile.
+"""
+
+import logging
+import mimetypes
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+from typing import Any, Dict, List, Optional, Tuple
+
+from django.conf import settings
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# Settings read by the preprocessing steps, sent to the worker with each file
+WORKER_SETTING_PREFIXES = ("IMAGE_", "PAGE_FILTER_", "PAGE_BLANK_", "PAGE_DUPLICATE_", "PDF_TEXT_LAYER_")
+PENDING_PER_WORKER = 2
+
+_executor = None
+_slots = None
+_pending = 0
+_lock = threading.Lock()
+# Set in the pool's own processes, which never hand work on
+_in_worker = False
+
+
+def _setting(name: str, default):
+    return getattr(settings, name, default)
+
+
+def workers() -> int:
+    return max(0, int(_setting("PREPROCESSING_POOL_WORKERS", 2)))
+
+
+def is_enabled() -> bool:
+    return workers() > 0
+
+
+def should_offload(path: str) -> bool:
+    """True if the file at ``path`` is a PDF or an image large enough to prepare in the pool."""
+    if _in_worker or not is_enabled():
+        return False
+    mime_type, _ = mimetypes.guess_type(path)
+    if mime_type != "application/pdf" and not (mime_type or "").startswith("image/"):
+        return False
+    try:
+        return os.path.getsize(path) >= float(_setting("PREPROCESSING_POOL_MIN_KB", 256)) * 1024
+    except OSError:
+        return False
+
+
+def _worker_settings() -> Dict[str, Any]:
+    return {name: getattr(settings, name) for name in dir(settings) if name.startswith(WORKER_SETTING_PREFIXES)}
+
+
+def _init_worker(settings_module: Optional[str]):
+    global _in_worker
+    _in_worker = True
+    if settings_module:
+        os.environ["DJANGO_SETTINGS_MODULE"] = settings_module
+    import django
+
+    django.setup()
+
+
+def _get_executor() -> Tuple[ProcessPoolExecutor, threading.BoundedSemaphore]:
+    global _executor, _slots
+    with _lock:
+        if _executor is None:
+            size = workers()
+            _executor = ProcessPoolExecutor(
+                max_workers=size,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(os.environ.get("DJANGO_SETTINGS_MODULE"),),
+            )
+            _slots = threading.BoundedSemaphore(size * PENDING_PER_WORKER)
+            logger.info(f"Started preprocessing pool with {size} processes")
+        return _executor, _slots
+
+
+def _discard_executor(executor: ProcessPoolExecutor):
+    global _executor
+    with _lock:
+        if _executor is executor:
+            _executor = None
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _prepare_in_worker(path: str, max_pages: Optional[int], metadata: Dict[str, Any], page_level: bool, overrides):
+    """
+    Run preprocessing._read_file in a pool process.
+
+    Returns:
+        dict: The shared memory block holding the prepared bytes (None when
+        there are none), the parts without their bytes, page counts,
+        metadata and the metric counters incremented while preparing
+    """
+    from django.test import override_settings
+
+    from . import preprocessing
+
+    metrics.reset()
+    with override_settings(**overrides):
+        prepared = preprocessing._read_file(path, max_pages, metadata, page_level)
+
+    parts = []
+    blobs = []
+    offset = 0
+    for part in prepared.parts():
+        if part.data is None:
+            parts.append((part.mime_type, part.text, None))
+            continue
+        parts.append((part.mime_type, None, (offset, len(part.data))))
+        blobs.append(part.data)
+        offset += len(part.data)
+
+    block = None
+    if offset:
+        block = shared_memory.SharedMemory(create=True, size=offset)
+        position = 0
+        for blob in blobs:
+            block.buf[position:position + len(blob)] = blob
+            position += len(blob)
+        block.close()
+
+    return {
+        "block": block.name if block else None,
+        "parts": parts,
+        "segmented": prepared.segments is not None,
+        "mime_type": prepared.mime_type,
+        "pages": prepared.pages,
+        "total_pages": prepared.total_pages,
+        "metadata": metadata,
+        "counters": metrics.snapshot()["counters"],
+    }
+
+
+def _read_block(name: Optional[str], parts: List[tuple]) -> List[Optional[bytes]]:
+    if name is None:
+        return [None for _ in parts]
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        data = []
+        for _, _, span in parts:
+            # The one copy: bytes handed to the Part, read straight from the block
+            data.append(bytes(block.buf[span[0]:span[0] + span[1]]) if span else None)
+        metrics.increment("preprocessing_pool.bytes_shared", block.size)
+        return data
+    finally:
+        block.close()
+        block.unlink()
+
+
+def _rebuild(result: Dict[str, Any]):
+    from .preprocessing import PreparedInput
+
+    data = _read_block(result["block"], result["parts"])
+    parts = [
+        PreparedInput(mime_type, blob, text)
+        for (mime_type, text, _), blob in zip(result["parts"], data)
+    ]
+    if result["segmented"]:
+        return PreparedInput(
+            result["mime_type"], pages=result["pages"], total_pages=result["total_pages"], segments=parts,
+        )
+    prepared = parts[0]
+    prepared.pages, prepared.total_pages = result["pages"], result["total_pages"]
+    return prepared
+
+
+def _run(fn, *args):
+    """
+    Run ``fn(*args)`` in the pool, waiting for a slot first.
+
+    Raises:
+        BrokenProcessPool: After discarding the broken pool, so the caller can work inline
+    """
+    global _pending
+    executor, slots = _get_executor()
+    waited = time.monotonic()
+    with slots:
+        with _lock:
+            _pending += 1
+        started = time.monotonic()
+        metrics.observe("preprocessing_pool.queue_seconds", started - waited)
+        try:
+            result = executor.submit(fn, *args).result()
+        except BrokenProcessPool:
+            metrics.increment("preprocessing_pool.fallbacks")
+            _discard_executor(executor)
+            raise
+        finally:
+            with _lock:
+                _pending -= 1
+        metrics.observe("preprocessing_pool.seconds", time.monotonic() - started)
+    return result
+
+
+def page_count(path: str, count_pages) -> int:
+    """
+    Count the pages of the PDF at ``path`` with ``count_pages(path)`` in the pool.
+
+    ``count_pages`` must be a module-level function; it is called in the
+    request thread when the pool is broken.
+    """
+    try:
+        count = _run(count_pages, path)
+    except BrokenProcessPool as e:
+        logger.warning(f"Preprocessing pool broke ({e}), counting pages of {os.path.basename(path)} in the request thread")
+        return count_pages(path)
+    metrics.increment("preprocessing_pool.page_counts")
+    return count
+
+
+def read_file(path: str, max_pages: Optional[int], metadata: Dict[str, Any], page_level: bool, read_inline):
+    """
+    Prepare the file at ``path`` in the pool.
+
+    Takes the arguments of preprocessing._read_file, which is passed as
+    ``read_inline`` and used when the pool is broken. ``metadata`` receives
+    the worker's statistics.
+
+    Returns:
+        PreparedInput: As preprocessing._read_file
+    """
+    try:
+        result = _run(_prepare_in_worker, path, max_pages, dict(metadata), page_level, _worker_settings())
+    except BrokenProcessPool as e:
+        logger.warning(f"Preprocessing pool broke ({e}), preparing {os.path.basename(path)} in the request thread")
+        return read_inline(path, max_pages, metadata, page_level)
+
+    metrics.increment("preprocessing_pool.tasks")
+    for name, value in result["counters"].items():
+        metrics.increment(name, value)
+    metadata.clear()
+    metadata.update(result["metadata"])
+    return _rebuild(result)
+
+
+def status() -> Dict[str, Any]:
+    """Pool size, files in flight and where files were prepared."""
+    queue = metrics.percentile("preprocessing_pool.queue_seconds", 95)
+    with _lock:
+        started, pending = _executor is not None, _pending
+    return {
+        "workers": workers(),
+        "started": started,
+        "pending": pending,
+        "tasks": metrics.get_counter("preprocessing_pool.tasks"),
+        "page_counts": metrics.get_counter("preprocessing_pool.page_counts"),
+        "fallbacks": metrics.get_counter("preprocessing_pool.fallbacks"),
+        "bytes_shared": metrics.get_counter("preprocessing_pool.bytes_shared"),
+        "queue_seconds_p95": round(queue, 4) if queue is not None else None,
+    }
+
+
+def reset():
+    """Shut the pool down (used by tests and the benchmark)."""
+    global _executor
+    with _lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,492 @@
+"""Shared token-bucket rate limiter with adaptive (AIMD) concurrency for Vertex calls.
+
+State lives in a SQLite file so every worker process on the host draws from the
+same requests-per-minute and tokens-per-minute budgets. Callers queue in FIFO
+order across processes instead of each reacting to 429s on its own. Pointing
+``RATE_LIMIT_STATE_PATH`` at storage shared by several hosts extends the budget
+to all of them, as long as that storage supports SQLite locking.
+
+The concurrency limit grows additively after successful calls and is halved on
+quota errors, which also start a short cooldown for every waiting caller.
+
+Waiting callers are not served strictly in arrival order. Each call is made for
+a Requester (the user's tier and id), and TIER_CONCURRENCY gives every tier a
+weight, a cap on its calls in flight and a cap per user::
+
+    {"default": {"weight": 1, "max_concurrency": 4, "max_per_user": 1},
+     "power": {"weight": 3, "max_concurrency": 12, "max_per_user": 4}}
+
+The next call granted is that of the waiting user with the fewest calls in
+flight relative to the weight of their tier (weighted fair sharing), among
+the waiters whose tier and user are under their caps; ties go to the
+earliest arrival. A user with many calls queued therefore takes turns with
+everyone else instead of holding the head of the queue. Calls without a
+requester (tier None) are capped by nothing but the shared limits.
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import Counter
+from typing import Callable, Dict, List, Optional, Tuple
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from . import metrics, resilience
+
+logger = logging.getLogger(__name__)
+
+POLL_INTERVAL_SECONDS = 0.25
+# Leases and queue tickets of crashed workers are reclaimed after these timeouts
+LEASE_TIMEOUT_SECONDS = 900
+WAITER_TIMEOUT_SECONDS = 10
+
+# Used when TIER_CONCURRENCY is not set; 0 means no cap
+DEFAULT_TIER_CONCURRENCY = {
+    "default": {"weight": 1, "max_concurrency": 4, "max_per_user": 1},
+    "power": {"weight": 3, "max_concurrency": 12, "max_per_user": 4},
+    "admin": {"weight": 3, "max_concurrency": 12, "max_per_user": 4},
+}
+# Tier of calls made without a requester, e.g. from management commands
+SYSTEM_TIER = "system"
+
+# Why a waiting call is held back
+CAPPED_BY_TIER = "tier"
+CAPPED_BY_USER = "user"
+
+_schema_lock = threading.Lock()
+_initialized_paths = set()
+
+
+class RateLimitTimeout(Exception):
+    """Raised when a caller waited longer than RATE_LIMIT_MAX_WAIT_SECONDS for capacity"""
+    pass
+
+
+def _setting(name: str, default):
+    return getattr(settings, name, default)
+
+
+def is_enabled() -> bool:
+    return bool(_setting("RATE_LIMIT_ENABLED", True))
+
+
+def _limits():
+    return {
+        "rpm": float(_setting("VERTEX_REQUESTS_PER_MINUTE", 60)),
+        "tpm": float(_setting("VERTEX_TOKENS_PER_MINUTE", 4000000)),
+        "max_concurrency": float(_setting("VERTEX_MAX_CONCURRENCY", 16)),
+        "min_concurrency": float(_setting("VERTEX_MIN_CONCURRENCY", 1)),
+        "cooldown": float(_setting("RATE_LIMIT_QUOTA_COOLDOWN_SECONDS", 10)),
+    }
+
+
+def tier_policies() -> Dict[str, Dict[str, float]]:
+    """Weight, max_concurrency and max_per_user of every tier of TIER_CONCURRENCY."""
+    value = _setting("TIER_CONCURRENCY", DEFAULT_TIER_CONCURRENCY)
+    if isinstance(value, str):
+        try:
+            value = json.loads(value) if value.strip() else DEFAULT_TIER_CONCURRENCY
+        except ValueError as e:
+            raise ImproperlyConfigured(f"Invalid TIER_CONCURRENCY: {e}")
+    if not isinstance(value, dict) or any(not isinstance(policy, dict) for policy in value.values()):
+        raise ImproperlyConfigured("TIER_CONCURRENCY must map tier names to objects")
+    policies = {}
+    for tier, policy in value.items():
+        weight = float(policy.get("weight", 1))
+        if weight <= 0:
+            raise ImproperlyConfigured(f"TIER_CONCURRENCY weight of '{tier}' must be positive")
+        policies[tier] = {
+            "weight": weight,
+            "max_concurrency": int(policy.get("max_concurrency") or 0),
+            "max_per_user": int(policy.get("max_per_user") or 0),
+        }
+    return policies
+
+
+class Requester:
+    """
+    Who a Vertex call is made for.
+
+    Args:
+        tier: The user's ``user_type``; None for calls made outside a request
+        user_id: The user's id; None when the call is not made for a user
+    """
+
+    def __init__(self, tier: Optional[str] = None, user_id=None):
+        self.tier = tier or SYSTEM_TIER
+        self.user_key = str(user_id) if user_id is not None else None
+
+    def __repr__(self):
+        return f"Requester({self.tier!r}, {self.user_key!r})"
+
+
+def fair_order(
+    waiters: List[Tuple[int, str, Optional[str]]],
+    leases: List[Tuple[str, Optional[str]]],
+    policies: Dict[str, Dict[str, float]],
+) -> Tuple[List[int], Dict[int, str]]:
+    """
+    Order waiting calls by weighted fair share.
+
+    Args:
+        waiters: (ticket, tier, user_key) of every waiting call
+        leases: (tier, user_key) of every call in flight
+        policies: From tier_policies()
+
+    Returns:
+        The tickets in the order they are to be served, and the reason
+        (CAPPED_BY_TIER or CAPPED_BY_USER) of every ticket held back by a cap;
+        capped tickets come last.
+    """
+    by_tier = Counter(tier for tier, _ in leases)
+    by_user = Counter(user_key for _, user_key in leases if user_key)
+    ranked = []
+    capped = {}
+    for ticket, tier, user_key in waiters:
+        policy = policies.get(tier, {})
+        running = by_user[user_key] if user_key else 0
+        if policy.get("max_concurrency") and by_tier[tier] >= policy["max_concurrency"]:
+            capped[ticket] = CAPPED_BY_TIER
+        elif user_key and policy.get("max_per_user") and running >= policy["max_per_user"]:
+            capped[ticket] = CAPPED_BY_USER
+        share = (running + 1) / policy.get("weight", 1)
+        ranked.append((ticket in capped, share, ticket))
+    ranked.sort()
+    return [ticket for _, _, ticket in ranked], capped
+
+
+def _state_path() -> str:
+    return _setting("RATE_LIMIT_STATE_PATH", os.path.join(settings.BASE_DIR, "cache", "rate_limiter.sqlite3"))
+
+
+def _connect() -> sqlite3.Connection:
+    path = _state_path()
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+    if path not in _initialized_paths:
+        with _schema_lock:
+            if path not in _initialized_paths:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.executescript(
+                    """
+                    CREATE TABLE IF NOT EXISTS limiter_state (
+                        id INTEGER PRIMARY KEY CHECK (id = 1),
+                        request_tokens REAL NOT NULL,
+                        token_tokens REAL NOT NULL,
+                        concurrency_limit REAL NOT NULL,
+                        cooldown_until REAL NOT NULL DEFAULT 0,
+                        updated_at REAL NOT NULL
+                    );
+                    CREATE TABLE IF NOT EXISTS limiter_leases (
+                        lease_id TEXT PRIMARY KEY,
+                        estimated_tokens INTEGER NOT NULL,
+                        acquired_at REAL NOT NULL,
+                        tier TEXT NOT NULL DEFAULT 'system',
+                        user_key TEXT
+                    );
+                    CREATE TABLE IF NOT EXISTS limiter_waiters (
+                        ticket INTEGER PRIMARY KEY AUTOINCREMENT,
+                        heartbeat REAL NOT NULL,
+                        tier TEXT NOT NULL DEFAULT 'system',
+                        user_key TEXT
+                    );
+                    """
+                )
+                # State files written before tiers were tracked lack these columns
+                for table in ("limiter_leases", "limiter_waiters"):
+                    columns = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+                    if "tier" not in columns:
+                        conn.execute(f"ALTER TABLE {table} ADD COLUMN tier TEXT NOT NULL DEFAULT 'system'")
+                    if "user_key" not in columns:
+                        conn.execute(f"ALTER TABLE {table} ADD COLUMN user_key TEXT")
+                _initialized_paths.add(path)
+    return conn
+
+
+class Lease:
+    """Permission to make one Vertex call; pass it back to :func:`release`."""
+
+    def __init__(self, lease_id: str, estimated_tokens: int, waited: float, tier: str = SYSTEM_TIER):
+        self.lease_id = lease_id
+        self.estimated_tokens = estimated_tokens
+        self.waited = waited
+        self.tier = tier
+
+
+def _load_state(conn: sqlite3.Connection, now: float, limits: dict):
+    """Return the refilled bucket state inside an open write transaction."""
+    row = conn.execute(
+        "SELECT request_tokens, token_tokens, concurrency_limit, cooldown_until, updated_at "
+        "FROM limiter_state WHERE id = 1"
+    ).fetchone()
+    if row is None:
+        state = {
+            "request_tokens": limits["rpm"],
+            "token_tokens": limits["tpm"],
+            "concurrency_limit": limits["max_concurrency"],
+            "cooldown_until": 0.0,
+        }
+        conn.execute(
+            "INSERT INTO limiter_state (id, request_tokens, token_tokens, concurrency_limit, cooldown_until, updated_at) "
+            "VALUES (1, ?, ?, ?, 0, ?)",
+            (state["request_tokens"], state["token_tokens"], state["concurrency_limit"], now),
+        )
+        return state
+
+    request_tokens, token_tokens, concurrency_limit, cooldown_until, updated_at = row
+    elapsed = max(0.0, now - updated_at)
+    return {
+        "request_tokens": min(limits["rpm"], request_tokens + elapsed * limits["rpm"] / 60.0),
+        "token_tokens": min(limits["tpm"], token_tokens + elapsed * limits["tpm"] / 60.0),
+        "concurrency_limit": min(limits["max_concurrency"], max(limits["min_concurrency"], concurrency_limit)),
+        "cooldown_until": cooldown_until,
+    }
+
+
+def _save_state(conn: sqlite3.Connection, state: dict, now: float):
+    conn.execute(
+        "UPDATE limiter_state SET request_tokens = ?, token_tokens = ?, concurrency_limit = ?, "
+        "cooldown_until = ?, updated_at = ? WHERE id = 1",
+        (state["request_tokens"], state["token_tokens"], state["concurrency_limit"], state["cooldown_until"], now),
+    )
+
+
+def acquire(
+    estimated_tokens: int,
+    on_wait: Optional[Callable[[str], None]] = None,
+    max_wait: Optional[float] = None,
+    cancel_token: Optional[resilience.CancelToken] = None,
+    requester: Optional[Requester] = None,
+) -> Optional[Lease]:
+    """
+    Block until a request slot and ``estimated_tokens`` of TPM budget are free.
+
+    Args:
+        estimated_tokens: Expected input tokens of the call
+        on_wait: Optional progress callback told the caller's queue position
+        max_wait: Seconds to wait before giving up (RATE_LIMIT_MAX_WAIT_SECONDS)
+        cancel_token: Leaves the queue as soon as the request is cancelled
+        requester: Tier and user the call is made for, for their slots and fair share
+
+    Returns:
+        Lease: To be passed to :func:`release`, or None when limiting is disabled
+
+    Raises:
+        RateLimitTimeout: If capacity did not free up within ``max_wait``
+        CancelledError: If the request was cancelled while waiting
+    """
+    if not is_enabled():
+        return None
+
+    limits = _limits()
+    policies = tier_policies()
+    requester = requester or Requester()
+    if max_wait is None:
+        max_wait = float(_setting("RATE_LIMIT_MAX_WAIT_SECONDS", 300))
+    # A request larger than the whole bucket would otherwise never run
+    needed_tokens = min(float(estimated_tokens), limits["tpm"])
+    started = time.time()
+    conn = _connect()
+    ticket = None
+    last_position = None
+    capped_by = set()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        ticket = conn.execute(
+            "INSERT INTO limiter_waiters (heartbeat, tier, user_key) VALUES (?, ?, ?)",
+            (started, requester.tier, requester.user_key),
+        ).lastrowid
+        conn.execute("COMMIT")
+
+        while True:
+            now = time.time()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute("DELETE FROM limiter_waiters WHERE heartbeat < ?", (now - WAITER_TIMEOUT_SECONDS,))
+                conn.execute("DELETE FROM limiter_leases WHERE acquired_at < ?", (now - LEASE_TIMEOUT_SECONDS,))
+                # Re-inserted if it was reaped while this worker was stalled
+                conn.execute(
+                    "INSERT OR REPLACE INTO limiter_waiters (ticket, heartbeat, tier, user_key) VALUES (?, ?, ?, ?)",
+                    (ticket, now, requester.tier, requester.user_key),
+                )
+                waiters = conn.execute("SELECT ticket, tier, user_key FROM limiter_waiters").fetchall()
+                leases = conn.execute("SELECT tier, user_key FROM limiter_leases").fetchall()
+                order, capped = fair_order(waiters, leases, policies)
+                position = order.index(ticket)
+                state = _load_state(conn, now, limits)
+                inflight = len(leases)
+
+                granted = (
+                    position == 0
+                    and ticket not in capped
+                    and now >= state["cooldown_until"]
+                    and inflight < int(state["concurrency_limit"])
+                    and state["request_tokens"] >= 1
+                    and state["token_tokens"] >= needed_tokens
+                )
+                if granted:
+                    state["request_tokens"] -= 1
+                    state["token_tokens"] -= needed_tokens
+                    lease_id = uuid.uuid4().hex
+                    conn.execute(
+                        "INSERT INTO limiter_leases (lease_id, estimated_tokens, acquired_at, tier, user_key) "
+                        "VALUES (?, ?, ?, ?, ?)",
+                        (lease_id, int(needed_tokens), now, requester.tier, requester.user_key),
+                    )
+                    conn.execute("DELETE FROM limiter_waiters WHERE ticket = ?", (ticket,))
+                    # Served ahead of earlier arrivals by fair share or their caps
+                    overtook = any(other < ticket for other, _, _ in waiters)
+                    ticket = None
+                _save_state(conn, state, now)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+            if granted:
+                waited = now - started
+                metrics.observe("rate_limiter.wait_seconds", waited)
+                metrics.observe(f"rate_limiter.tiers.{requester.tier}.wait_seconds", waited)
+                metrics.increment("rate_limiter.granted")
+                metrics.increment(f"rate_limiter.tiers.{requester.tier}.granted")
+                if overtook:
+                    metrics.increment("rate_limiter.fair_share_overtakes")
+                return Lease(lease_id, int(needed_tokens), waited, requester.tier)
+
+            reason = capped.get(ticket)
+            if reason is not None and reason not in capped_by:
+                capped_by.add(reason)
+                metrics.increment(f"rate_limiter.tiers.{requester.tier}.capped_by_{reason}")
+
+            if now - started > max_wait:
+                metrics.increment("rate_limiter.timeouts")
+                raise RateLimitTimeout(
+                    f"Waited {now - started:.0f}s for Vertex AI capacity. Please try again later."
+                )
+
+            if cancel_token is not None:
+                cancel_token.check()
+            if on_wait and (position, reason) != last_position:
+                if reason == CAPPED_BY_USER:
+                    on_wait(f"Waiting for your other documents to finish (queue position {position + 1})...")
+                elif reason == CAPPED_BY_TIER:
+                    on_wait(f"Waiting for a free {requester.tier} slot (queue position {position + 1})...")
+                else:
+                    on_wait(f"Waiting for AI capacity (queue position {position + 1})...")
+                last_position = (position, reason)
+            time.sleep(POLL_INTERVAL_SECONDS)
+    finally:
+        if ticket is not None:
+            try:
+                conn.execute("DELETE FROM limiter_waiters WHERE ticket = ?", (ticket,))
+            except sqlite3.Error:
+                pass
+        conn.close()
+
+
+def release(lease: Optional[Lease], outcome: str = "success", actual_tokens: Optional[int] = None):
+    """
+    Return a lease and feed the call's outcome back into the limiter.
+
+    Args:
+        lease: The lease from :func:`acquire` (None is ignored)
+        outcome: "success", "quota" for 429/resource exhausted, "error", or
+            "cancelled" for a call abandoned because its request was cancelled
+        actual_tokens: Billed input tokens, used to correct the TPM estimate
+    """
+    if lease is None:
+        return
+
+    limits = _limits()
+    now = time.time()
+    conn = _connect()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM limiter_leases WHERE lease_id = ?", (lease.lease_id,))
+            state = _load_state(conn, now, limits)
+            if actual_tokens is not None:
+                state["token_tokens"] = min(limits["tpm"], state["token_tokens"] + lease.estimated_tokens - actual_tokens)
+            if outcome == "quota":
+                state["concurrency_limit"] = max(limits["min_concurrency"], state["concurrency_limit"] / 2)
+                state["cooldown_until"] = max(state["cooldown_until"], now + limits["cooldown"])
+                state["request_tokens"] = min(state["request_tokens"], 0)
+            elif outcome == "success":
+                state["concurrency_limit"] = min(
+                    limits["max_concurrency"],
+                    state["concurrency_limit"] + 1.0 / max(1.0, state["concurrency_limit"]),
+                )
+            _save_state(conn, state, now)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    except sqlite3.Error as e:
+        logger.warning(f"Could not release rate limiter lease: {e}")
+    finally:
+        conn.close()
+
+    metrics.increment(f"rate_limiter.outcome.{outcome}")
+    metrics.increment(f"rate_limiter.tiers.{lease.tier}.outcome.{outcome}")
+    if outcome == "quota":
+        logger.warning("Vertex AI quota error, halving shared concurrency and cooling down")
+
+
+def status() -> dict:
+    """Return the current shared budget, concurrency limit, queue length and calls per tier."""
+    limits = _limits()
+    policies = tier_policies()
+    now = time.time()
+    conn = _connect()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            state = _load_state(conn, now, limits)
+            inflight = conn.execute("SELECT COUNT(*) FROM limiter_leases").fetchone()[0]
+            waiting = conn.execute("SELECT COUNT(*) FROM limiter_waiters").fetchone()[0]
+            inflight_by_tier = dict(conn.execute("SELECT tier, COUNT(*) FROM limiter_leases GROUP BY tier").fetchall())
+            waiting_by_tier = dict(conn.execute("SELECT tier, COUNT(*) FROM limiter_waiters GROUP BY tier").fetchall())
+            users_by_tier = dict(conn.execute(
+                "SELECT tier, COUNT(DISTINCT user_key) FROM limiter_leases WHERE user_key IS NOT NULL GROUP BY tier"
+            ).fetchall())
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+    finally:
+        conn.close()
+    return {
+        "requests_available": round(state["request_tokens"], 2),
+        "tokens_available": int(state["token_tokens"]),
+        "concurrency_limit": round(state["concurrency_limit"], 2),
+        "inflight": inflight,
+        "waiting": waiting,
+        "cooling_down": now < state["cooldown_until"],
+        "tiers": {
+            tier: dict(
+                policies.get(tier, {}),
+                inflight=inflight_by_tier.get(tier, 0),
+                waiting=waiting_by_tier.get(tier, 0),
+                active_users=users_by_tier.get(tier, 0),
+                granted=metrics.get_counter(f"rate_limiter.tiers.{tier}.granted"),
+            )
+            for tier in sorted(set(policies) | set(inflight_by_tier) | set(waiting_by_tier))
+        },
+    }
+
+
+def reset():
+    """Drop all shared limiter state (used by tests)."""
+    conn = _connect()
+    try:
+        conn.execute("DELETE FROM limiter_state")
+        conn.execute("DELETE FROM limiter_leases")
+        conn.execute("DELETE FROM limiter_waiters")
+    finally:
+        conn.close()
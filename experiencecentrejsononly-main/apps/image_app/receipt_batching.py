@@ -0,0 +1,241 @@
+"""Packing many reimbursement receipts into few model calls.
+
+The reimbursement_extraction_prompt already numbers the documents of a
+request ("document": 1, 2, ...), so receipts are sent together: each file is
+attached as its own Part behind a ``--- Document n ---`` marker and the
+prompt is sent once per call instead of once per receipt.
+
+Files are packed in upload order into batches that stay under
+RECEIPT_BATCH_MAX_DOCUMENTS files, RECEIPT_BATCH_MAX_REQUEST_MB of attached
+bytes and RECEIPT_BATCH_MAX_OUTPUT_TOKENS of expected output (a base cost
+per document plus a cost per page). Batches run concurrently, and each
+batch's expenses are split back to their files by document number. The
+merged result's aggregates are rebuilt from all expenses (see reimbursement).
+"""
+
+import logging
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from django.conf import settings
+
+from . import metrics, model_routing, output_schema, reimbursement, resilience
+from .reimbursement import document_number
+
+logger = logging.getLogger(__name__)
+
+# Expected output of one expense record, and of every page it spans
+OUTPUT_TOKENS_PER_DOCUMENT = 150
+OUTPUT_TOKENS_PER_PAGE = 150
+
+BATCH_INSTRUCTIONS = (
+    "The {count} attached documents each follow a '--- Document n ---' marker. "
+    "Use that n as \"document\" and return at least one entry in \"expenses\" for every document."
+)
+
+
+def _setting(name: str, default):
+    return getattr(settings, name, default)
+
+
+def expected_output_tokens(pages: int) -> int:
+    return OUTPUT_TOKENS_PER_DOCUMENT + OUTPUT_TOKENS_PER_PAGE * max(1, pages)
+
+
+def plan_batches(sizes: List[Tuple[int, int]]) -> List[List[int]]:
+    """
+    Pack documents into batches, keeping upload order.
+
+    Args:
+        sizes: (pages that will be sent, size in bytes) of every document
+
+    Returns:
+        list: Lists of document indices; a document exceeding a limit on its
+        own is sent alone
+    """
+    max_documents = max(1, int(_setting("RECEIPT_BATCH_MAX_DOCUMENTS", 10)))
+    max_bytes = float(_setting("RECEIPT_BATCH_MAX_REQUEST_MB", 15)) * 1024 * 1024
+    max_output_tokens = int(_setting("RECEIPT_BATCH_MAX_OUTPUT_TOKENS", 8192))
+
+    batches = []
+    current, current_bytes, current_tokens = [], 0, 0
+    for index, (pages, size) in enumerate(sizes):
+        tokens = expected_output_tokens(pages)
+        if current and (
+            len(current) >= max_documents
+            or current_bytes + size > max_bytes
+            or current_tokens + tokens > max_output_tokens
+        ):
+            batches.append(current)
+            current, current_bytes, current_tokens = [], 0, 0
+        current.append(index)
+        current_bytes += size
+        current_tokens += tokens
+    if current:
+        batches.append(current)
+    return batches
+
+
+def batch_input(paths: List[str]) -> List[str]:
+    """The input_data list of one batch: each file behind its document marker."""
+    items = []
+    for number, path in enumerate(paths, start=1):
+        items.append(f"--- Document {number} ---")
+        items.append(path)
+    return items
+
+
+def batch_prompt(prompt_text: str, count: int) -> str:
+    if count < 2:
+        return prompt_text
+    return f"{prompt_text.rstrip()}\n\n{BATCH_INSTRUCTIONS.format(count=count)}"
+
+
+def split_expenses(parsed: Dict[str, Any], count: int) -> Tuple[List[List[Dict[str, Any]]], List[Dict[str, Any]]]:
+    """
+    Split a batch's expenses by document.
+
+    Returns:
+        tuple: (expenses of each of the ``count`` documents, expenses whose
+        document number is missing or out of range)
+    """
+    per_document = [[] for _ in range(count)]
+    unassigned = []
+    expenses = parsed.get("expenses") if isinstance(parsed, dict) else None
+    for expense in expenses if isinstance(expenses, list) else []:
+        if not isinstance(expense, dict):
+            continue
+        number = document_number(expense.get("document"))
+        if number is not None and 1 <= number <= count:
+            per_document[number - 1].append(expense)
+        else:
+            unassigned.append(expense)
+    return per_document, unassigned
+
+
+def merge_results(batch_results: List[Tuple[List[int], Dict[str, Any]]], total_documents: int) -> Dict[str, Any]:
+    """
+    Combine the outputs of several batches into one reimbursement result.
+
+    Args:
+        batch_results: (0-based global indices of the batch's documents, parsed output)
+        total_documents: Number of documents uploaded
+
+    Returns:
+        dict: The reimbursement_extraction_prompt shape with global document
+        numbers, its aggregates computed from the merged expenses
+    """
+    expenses = []
+    for indices, parsed in batch_results:
+        numbers = [index + 1 for index in indices]
+        per_document, unassigned = split_expenses(parsed, len(indices))
+        for number, document_expenses in zip(numbers, per_document):
+            expenses.extend({**expense, "document": number} for expense in document_expenses)
+        expenses.extend(unassigned)
+    return {"expenses": expenses, **reimbursement.aggregate(expenses, total_documents)}
+
+
+def split_usage(usage_metadata: Dict[str, Any], weights: List[int]) -> List[Dict[str, int]]:
+    """Share a batch's token counts between its documents in proportion to ``weights`` (pages)."""
+    total_weight = sum(weights) or len(weights)
+    shares = []
+    for key in ("promptTokenCount", "candidatesTokenCount", "totalTokenCount"):
+        value = int(usage_metadata.get(key, 0) or 0)
+        parts = [value * weight // total_weight for weight in weights]
+        parts[-1] += value - sum(parts)
+        shares.append(parts)
+    return [
+        {"promptTokenCount": prompt, "candidatesTokenCount": output, "totalTokenCount": total}
+        for prompt, output, total in zip(*shares)
+    ]
+
+
+def extract_batches(
+    paths: List[str],
+    prompt_text: str,
+    max_pages: Optional[int],
+    doc_type: Optional[str] = None,
+    user_type: Optional[str] = None,
+    progress_callback: Optional[Callable[[str], None]] = None,
+    response_schema: Optional[Dict[str, Any]] = None,
+    cancel_token: Optional[resilience.CancelToken] = None,
+    user_id: Optional[int] = None,
+) -> Dict[str, Any]:
+    """
+    Extract many receipts with as few model calls as the limits allow.
+
+    ``cancel_token`` cancels every batch still running or waiting. The first
+    batch to fail cancels the others, since the whole result is discarded.
+    Batches queue for the rate limiter slots of ``user_type`` and ``user_id``.
+
+    Returns:
+        dict: ``batches`` (one entry per call with its document indices,
+        response, parsed output and latency), ``pages`` per document and
+        ``result``, the merged output
+    """
+    from .vertex_model import call_gemini_api_with_streaming
+
+    def update_progress(message: str):
+        if progress_callback:
+            progress_callback(message)
+        logger.info(f"Progress: {message}")
+
+    pages = [model_routing.describe_input(path, max_pages) for path in paths]
+    plan = plan_batches(pages)
+    update_progress(f"Sending {len(paths)} documents in {len(plan)} requests...")
+    metrics.increment("receipt_batching.documents", len(paths))
+    metrics.increment("receipt_batching.calls", len(plan))
+
+    def run_batch(indices, batch_token):
+        started = time.time()
+        response = call_gemini_api_with_streaming(
+            prompt_text=batch_prompt(prompt_text, len(indices)),
+            input_data=batch_input([paths[index] for index in indices]) if len(indices) > 1 else paths[indices[0]],
+            response_mime_type="application/json",
+            max_pages=max_pages,
+            progress_callback=lambda message: update_progress(
+                f"[documents {indices[0] + 1}-{indices[-1] + 1}] {message}"
+            ),
+            doc_type=doc_type,
+            user_type=user_type,
+            response_schema=response_schema,
+            cancel_token=batch_token,
+            user_id=user_id,
+        )
+        try:
+            parsed = output_schema.parse_output(
+                response["candidates"][0]["content"]["parts"][0]["text"], doc_type, response_schema
+            )
+        except ValueError as e:
+            raise ValueError(f"Batch of documents {indices[0] + 1}-{indices[-1] + 1} did not return a JSON object: {e}") from e
+        latency = time.time() - started
+        parsed = reimbursement.complete(parsed, len(indices), response, latency, len(indices))
+        return {"indices": indices, "response": response, "parsed": parsed, "latency": latency}
+
+    workers = max(1, min(len(plan), int(_setting("RECEIPT_BATCH_MAX_WORKERS", 4))))
+    results = {}
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="receipt-batch") as executor:
+        running = {}
+        for number, indices in enumerate(plan):
+            batch_token = cancel_token.child() if cancel_token is not None else resilience.CancelToken()
+            running[executor.submit(run_batch, indices, batch_token)] = (number, batch_token)
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                number, _ = running.pop(future)
+                try:
+                    results[number] = future.result()
+                except Exception:
+                    # Stop the batches still calling Gemini; the executor waits for them on exit
+                    for other, (_, batch_token) in running.items():
+                        other.cancel()
+                        batch_token.cancel(resilience.CancelToken.SIBLING_FAILED)
+                    raise
+    batches = [results[number] for number in range(len(plan))]
+
+    return {
+        "batches": batches,
+        "pages": [document_pages for document_pages, _ in pages],
+        "result": merge_results([(batch["indices"], batch["parsed"]) for batch in batches], len(paths)),
+    }
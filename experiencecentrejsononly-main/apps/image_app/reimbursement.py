@@ -0,0 +1,224 @@
+"""Reimbursement aggregates computed from the extracted expenses.
+
+The reimbursement answer is an ``expenses`` list plus aggregates derived
+from it: the ``allowed`` and ``not_allowed`` groups (document numbers and
+total_inr) and a ``summary`` block. Generating the aggregates costs output
+tokens, the slowest part of a call, and the model's totals are not always
+right. aggregate() rebuilds them from the expenses instead. The amounts are
+held as integer paise in an int64 numpy array and the totals are masked
+sums over it, so they are vectorized and exact.
+
+With REIMBURSEMENT_LOCAL_AGGREGATES the reimbursement doc type uses
+``reimbursement_expenses_prompt``, which asks for the expenses only. Output
+of the full ``reimbursement_extraction_prompt`` has its aggregates replaced
+too, and totals that disagree with the expenses are counted.
+
+Every reimbursement call is measured per variant (``local`` when the model
+returned only expenses, ``model`` when it generated the aggregates): output
+tokens and seconds per document, and for the local variant the estimated
+output tokens the aggregates would have cost. status() compares the two.
+"""
+
+import json
+import logging
+import re
+from decimal import ROUND_HALF_UP, Decimal, InvalidOperation
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from django.conf import settings
+
+from . import estimation, metrics
+
+logger = logging.getLogger(__name__)
+
+# Document type answered with the reimbursement prompts
+DOC_TYPE = "Bill Reimbursment"
+
+FULL_PROMPT = "reimbursement_extraction_prompt"
+EXPENSES_PROMPT = "reimbursement_expenses_prompt"
+
+ALLOWED = "Allowed"
+NOT_ALLOWED = "Not Allowed"
+# Expense types the prompts declare reimbursable
+ALLOWED_TYPES = ("Travel", "Food")
+AGGREGATE_KEYS = ("allowed", "not_allowed", "summary")
+
+LOCAL = "local"
+MODEL = "model"
+
+_AMOUNT_RE = re.compile(r"-?\d+(?:\.\d+)?")
+_CENTS = Decimal("0.01")
+
+
+def is_enabled() -> bool:
+    return bool(getattr(settings, "REIMBURSEMENT_LOCAL_AGGREGATES", True))
+
+
+def prompt_name() -> str:
+    """The prompts.yaml prompt used for reimbursement documents."""
+    return EXPENSES_PROMPT if is_enabled() else FULL_PROMPT
+
+
+def document_number(value) -> Optional[int]:
+    """The document number of an expense ("2", 2 or "Document 2")."""
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return value
+    match = re.search(r"\d+", str(value or ""))
+    return int(match.group()) if match else None
+
+
+def parse_amount(value) -> Decimal:
+    """Read an amount such as "₹1,234.50" or 1234.5; unreadable amounts count as 0."""
+    if isinstance(value, bool):
+        return Decimal(0)
+    if isinstance(value, (int, float)):
+        return Decimal(str(value))
+    match = _AMOUNT_RE.search(str(value or "").replace(",", ""))
+    try:
+        return Decimal(match.group()) if match else Decimal(0)
+    except InvalidOperation:
+        return Decimal(0)
+
+
+def to_paise(amount: Decimal) -> int:
+    """``amount`` in rupees as whole paise."""
+    return int((amount * 100).to_integral_value(rounding=ROUND_HALF_UP))
+
+
+def format_amount(value: Decimal) -> str:
+    return str(Decimal(value).quantize(_CENTS))
+
+
+def format_paise(paise) -> str:
+    return format_amount(Decimal(int(paise)).scaleb(-2))
+
+
+def status_of(expense: Dict[str, Any]) -> str:
+    """The expense's eligibility as the model judged it, else by its type."""
+    status = str(expense.get("status") or "").strip().lower()
+    if status in (ALLOWED.lower(), NOT_ALLOWED.lower()):
+        return ALLOWED if status == ALLOWED.lower() else NOT_ALLOWED
+    return ALLOWED if str(expense.get("type") or "").strip().title() in ALLOWED_TYPES else NOT_ALLOWED
+
+
+def aggregate(expenses: List[Dict[str, Any]], total_documents: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Build the allowed, not_allowed and summary blocks of ``expenses``.
+
+    Args:
+        expenses: Expense records of the reimbursement answer
+        total_documents: Documents uploaded; defaults to the distinct
+            document numbers of the expenses
+
+    Returns:
+        dict: ``allowed`` and ``not_allowed`` (document numbers and
+        total_inr) and ``summary``, amounts formatted with two decimals
+    """
+    expenses = [expense for expense in expenses if isinstance(expense, dict)]
+    # One pass builds the amount and status columns; the totals are sums over them
+    paise = np.fromiter(
+        (to_paise(parse_amount(expense.get("amount_inr"))) for expense in expenses), dtype=np.int64, count=len(expenses)
+    )
+    allowed = np.fromiter((status_of(expense) == ALLOWED for expense in expenses), dtype=bool, count=len(expenses))
+    numbers = [document_number(expense.get("document")) for expense in expenses]
+
+    groups = {}
+    for key, mask in (("allowed", allowed), ("not_allowed", ~allowed)):
+        items = [numbers[index] for index in np.flatnonzero(mask) if numbers[index] is not None]
+        groups[key] = {"items": list(dict.fromkeys(items)), "total_inr": format_paise(paise[mask].sum())}
+
+    if total_documents is None:
+        total_documents = len({number for number in numbers if number is not None}) or (1 if expenses else 0)
+    return {
+        "allowed": groups["allowed"],
+        "not_allowed": groups["not_allowed"],
+        "summary": {
+            "total_documents": str(total_documents),
+            "total_amount": format_paise(paise.sum()),
+            "reimbursable_amount": groups["allowed"]["total_inr"],
+        },
+    }
+
+
+def _totals(parsed: Dict[str, Any]) -> List[Decimal]:
+    groups = [parsed.get(key) if isinstance(parsed.get(key), dict) else {} for key in AGGREGATE_KEYS]
+    return [
+        parse_amount(groups[0].get("total_inr")),
+        parse_amount(groups[1].get("total_inr")),
+        parse_amount(groups[2].get("total_amount")),
+        parse_amount(groups[2].get("reimbursable_amount")),
+    ]
+
+
+def complete(
+    parsed: Dict[str, Any],
+    total_documents: Optional[int] = None,
+    response: Optional[Dict[str, Any]] = None,
+    seconds: Optional[float] = None,
+    documents: int = 1,
+) -> Dict[str, Any]:
+    """
+    Return ``parsed`` with its aggregates rebuilt from its expenses.
+
+    Output without an ``expenses`` list is returned unchanged. When the
+    model ``response`` and its latency are given, the call is measured (see
+    the module docstring); cached responses are not.
+
+    Args:
+        parsed: The parsed reimbursement answer
+        total_documents: Documents uploaded, see aggregate()
+        response: Formatted model response the answer came from
+        seconds: Latency of that response
+        documents: Documents sent in that call
+    """
+    expenses = parsed.get("expenses") if isinstance(parsed, dict) else None
+    if not isinstance(expenses, list):
+        return parsed
+    aggregates = aggregate(expenses, total_documents)
+    generated = any(key in parsed for key in AGGREGATE_KEYS)
+    if response is not None and not response.get("cacheHit"):
+        _record_call(parsed, aggregates, generated, response, seconds, documents)
+    return {**parsed, **aggregates}
+
+
+def _record_call(parsed, aggregates, generated, response, seconds, documents):
+    variant = MODEL if generated else LOCAL
+    documents = max(1, documents)
+    output_tokens = (response.get("usageMetadata") or {}).get("candidatesTokenCount") or 0
+    metrics.increment(f"reimbursement.{variant}.calls")
+    metrics.observe(f"reimbursement.{variant}.output_tokens_per_document", output_tokens / documents)
+    if seconds is not None:
+        metrics.observe(f"reimbursement.{variant}.seconds_per_document", seconds / documents)
+    if generated:
+        if _totals(parsed) != _totals(aggregates):
+            metrics.increment("reimbursement.model_totals_corrected")
+            logger.info("Replaced reimbursement totals that did not match the expenses")
+    else:
+        text = json.dumps(aggregates, ensure_ascii=False)
+        metrics.increment("reimbursement.output_tokens_saved", -(-len(text) // estimation.CHARS_PER_TOKEN))
+
+
+def _median(name: str) -> Optional[float]:
+    value = metrics.percentile(name, 50)
+    return round(value, 4) if value is not None else None
+
+
+def status() -> Dict[str, Any]:
+    """Calls, median output tokens and seconds per document of each variant, and the savings."""
+    report = {"prompt": prompt_name()}
+    for variant in (LOCAL, MODEL):
+        report[variant] = {
+            "calls": metrics.get_counter(f"reimbursement.{variant}.calls"),
+            "output_tokens_per_document_p50": _median(f"reimbursement.{variant}.output_tokens_per_document"),
+            "seconds_per_document_p50": _median(f"reimbursement.{variant}.seconds_per_document"),
+        }
+    report["output_tokens_saved"] = metrics.get_counter("reimbursement.output_tokens_saved")
+    report["model_totals_corrected"] = metrics.get_counter("reimbursement.model_totals_corrected")
+    for name in ("output_tokens_per_document_p50", "seconds_per_document_p50"):
+        local, model = report[LOCAL][name], report[MODEL][name]
+        saved = name.replace("_p50", "_saved")
+        report[saved] = round(model - local, 4) if local is not None and model is not None else None
+    return report
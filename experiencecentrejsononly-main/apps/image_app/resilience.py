@@ -0,0 +1,359 @@
+"""Retry classification, deadlines, cancellation, attempt timeouts and a circuit breaker for Vertex calls."""
+
+import json
+import logging
+import threading
+import time
+from typing import Any, Callable, Optional
+
+from django.conf import settings
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# Error classes returned by classify_error
+QUOTA = "quota"
+TRANSIENT = "transient"
+FATAL = "fatal"
+
+# gRPC / HTTP failures worth retrying; anything else from the API is permanent
+_TRANSIENT_NAMES = {
+    "ServiceUnavailable", "InternalServerError", "DeadlineExceeded", "GatewayTimeout",
+    "Aborted", "Unknown", "ServerError", "RetryError", "ConnectionError",
+    "ConnectionResetError", "TimeoutError", "AttemptTimeoutError",
+}
+_TRANSIENT_CODES = {500, 502, 503, 504}
+_TRANSIENT_TERMS = ["unavailable", "timed out", "timeout", "deadline exceeded", "connection reset", "internal error", "503", "504"]
+_QUOTA_TERMS = ["rate limit", "quota", "429", "resource exhausted"]
+
+
+class AttemptTimeoutError(TimeoutError):
+    """Raised when a single Vertex call exceeds its per-attempt timeout"""
+    pass
+
+
+class DeadlineExceededError(Exception):
+    """Raised when the overall deadline for a request is used up"""
+    pass
+
+
+class CancelledError(Exception):
+    """Raised when nobody waits for the request any more, e.g. the client disconnected"""
+    pass
+
+
+class CircuitOpenError(Exception):
+    """Raised without calling Vertex while the circuit breaker is open"""
+    pass
+
+
+def _error_chain(error: BaseException):
+    seen = set()
+    while error is not None and id(error) not in seen:
+        seen.add(id(error))
+        yield error
+        error = error.__cause__ or error.__context__
+
+
+def classify_error(error: BaseException) -> str:
+    """
+    Decide whether an error from a Vertex call is worth retrying.
+
+    Returns:
+        str: QUOTA for 429/resource exhausted, TRANSIENT for timeouts, 5xx and
+        connection failures, FATAL for everything else (bad MIME types, invalid
+        arguments, permission errors, unparsable JSON, ...).
+    """
+    for err in _error_chain(error):
+        name = type(err).__name__
+        code = getattr(err, "code", None)
+        code = code if isinstance(code, int) else None
+        message = str(err).lower()
+
+        if name in ("ResourceExhausted", "TooManyRequests") or code == 429:
+            return QUOTA
+        if any(term in message for term in _QUOTA_TERMS):
+            return QUOTA
+        if isinstance(err, (json.JSONDecodeError, ValueError, TypeError, KeyError)):
+            return FATAL
+        if isinstance(err, (DeadlineExceededError, CircuitOpenError, CancelledError)):
+            return FATAL
+        if name in _TRANSIENT_NAMES or code in _TRANSIENT_CODES:
+            return TRANSIENT
+        if isinstance(err, (ConnectionError, TimeoutError)):
+            return TRANSIENT
+
+    message = str(error).lower()
+    if any(term in message for term in _TRANSIENT_TERMS):
+        return TRANSIENT
+    return FATAL
+
+
+# Longest a wait on a model call goes without checking for cancellation
+CANCEL_POLL_SECONDS = 0.25
+
+
+class CancelToken:
+    """
+    Cancellation of one request, set when its client goes away.
+
+    Cancellations are counted once per request under ``cancellations.<reason>``,
+    apart from the errors counted under ``resilience.errors``. A child token
+    (see child()) is cancelled with its parent, and a parent's cancellation is
+    counted once however many children see it.
+    """
+
+    CLIENT_DISCONNECTED = "client_disconnected"
+    # Another part of the same request failed, so this part is not needed any more
+    SIBLING_FAILED = "sibling_failed"
+
+    def __init__(self, parent: Optional["CancelToken"] = None):
+        self.reason = None
+        self._event = threading.Event()
+        self._counted = False
+        self._lock = threading.Lock()
+        self._parent = parent
+        self._children = []
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def child(self) -> "CancelToken":
+        """Return a token cancelled with this one that can also be cancelled on its own."""
+        child = CancelToken(self)
+        with self._lock:
+            self._children.append(child)
+            reason = self.reason if self._event.is_set() else None
+        if reason is not None:
+            child.cancel(reason)
+        return child
+
+    def cancel(self, reason: str = CLIENT_DISCONNECTED):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self.reason = reason
+            self._event.set()
+            children, self._children = self._children, []
+        for child in children:
+            child.cancel(reason)
+        if self._parent is None or not self._parent.cancelled:
+            logger.info(f"Extraction cancelled: {reason}")
+
+    def check(self):
+        """Raise CancelledError if the request was cancelled."""
+        if not self._event.is_set():
+            return
+        if self._parent is not None and self._parent.cancelled:
+            self._parent.check()
+        with self._lock:
+            first, self._counted = not self._counted, True
+        if first:
+            metrics.increment(f"cancellations.{self.reason}")
+        raise CancelledError(f"Request cancelled ({self.reason})")
+
+    def wait(self, seconds: float) -> bool:
+        """Sleep for ``seconds``, waking up early on cancellation; returns True if cancelled."""
+        return self._event.wait(seconds)
+
+
+class Deadline:
+    """Overall time budget shared by every attempt of one request, and its cancellation."""
+
+    def __init__(self, seconds: Optional[float], cancel_token: Optional[CancelToken] = None):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds if seconds else None
+        self.cancel_token = cancel_token
+
+    def remaining(self) -> float:
+        if self.expires_at is None:
+            return float("inf")
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0 or (self.cancel_token is not None and self.cancel_token.cancelled)
+
+    def check(self):
+        """Raise CancelledError if the request was cancelled, DeadlineExceededError if the budget is used up."""
+        if self.cancel_token is not None:
+            self.cancel_token.check()
+        if self.remaining() <= 0:
+            metrics.increment("resilience.deadline_exceeded")
+            raise DeadlineExceededError(f"Request deadline of {self.seconds:.0f}s exceeded")
+
+    def cap(self, timeout: Optional[float]) -> Optional[float]:
+        """Return ``timeout`` limited to the remaining budget."""
+        remaining = self.remaining()
+        if timeout is None:
+            return None if remaining == float("inf") else remaining
+        return min(timeout, remaining)
+
+    def sleep(self, seconds: float):
+        """Back off for ``seconds``; raises CancelledError as soon as the request is cancelled."""
+        if self.cancel_token is None:
+            time.sleep(seconds)
+            return
+        self.cancel_token.wait(seconds)
+        self.cancel_token.check()
+
+
+def call_with_timeout(fn: Callable[[], Any], timeout: Optional[float], cancel_token: Optional[CancelToken] = None) -> Any:
+    """
+    Run ``fn`` and give up waiting after ``timeout`` seconds, or on cancellation.
+
+    The SDK's generate_content has no timeout of its own, so the call runs on a
+    daemon thread. On timeout or cancellation the thread is abandoned and its
+    result discarded.
+    """
+    if timeout == float("inf"):
+        timeout = None
+    if not timeout and cancel_token is None:
+        return fn()
+
+    outcome = {}
+    done = threading.Event()
+
+    def target():
+        try:
+            outcome["result"] = fn()
+        except BaseException as e:
+            outcome["error"] = e
+        finally:
+            done.set()
+
+    threading.Thread(target=target, daemon=True, name="vertex-attempt").start()
+    expires_at = time.monotonic() + timeout if timeout else None
+    while True:
+        wait = CANCEL_POLL_SECONDS if cancel_token is not None else None
+        if expires_at is not None:
+            remaining = max(0.0, expires_at - time.monotonic())
+            wait = remaining if wait is None else min(wait, remaining)
+        if done.wait(wait):
+            break
+        if cancel_token is not None:
+            cancel_token.check()
+        if expires_at is not None and time.monotonic() >= expires_at:
+            metrics.increment("resilience.attempt_timeouts")
+            raise AttemptTimeoutError(f"Vertex AI call timed out after {timeout:.0f}s")
+    if "error" in outcome:
+        raise outcome["error"]
+    return outcome["result"]
+
+
+class CircuitBreaker:
+    """
+    Fail fast while Vertex AI is unhealthy.
+
+    After ``CIRCUIT_BREAKER_FAILURE_THRESHOLD`` consecutive transient failures
+    the circuit opens and calls are rejected for ``CIRCUIT_BREAKER_RESET_SECONDS``.
+    Then a single probe call is let through: success closes the circuit, failure
+    opens it again. A probe that is never made (the request was cancelled or
+    ran out of time first) must be handed back with release_probe().
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str = "vertex"):
+        self.name = name
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        # Thread that was let through as the half-open probe
+        self._probe_owner = None
+
+    @property
+    def failure_threshold(self) -> int:
+        return int(getattr(settings, "CIRCUIT_BREAKER_FAILURE_THRESHOLD", 5))
+
+    @property
+    def reset_seconds(self) -> float:
+        return float(getattr(settings, "CIRCUIT_BREAKER_RESET_SECONDS", 30))
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._current_state()
+
+    def _current_state(self) -> str:
+        if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_seconds:
+            self._transition(self.HALF_OPEN)
+        return self._state
+
+    def _transition(self, state: str):
+        if state != self._state:
+            logger.warning(f"Circuit breaker '{self.name}' {self._state} -> {state}")
+            metrics.increment(f"resilience.circuit.{self.name}.{state}")
+        self._state = state
+        if state == self.OPEN:
+            self._opened_at = time.monotonic()
+        self._probe_owner = None
+
+    def allow(self) -> bool:
+        """Return True if a call may be made now."""
+        with self._lock:
+            state = self._current_state()
+            if state == self.CLOSED:
+                return True
+            if state == self.HALF_OPEN and self._probe_owner is None:
+                self._probe_owner = threading.get_ident()
+                return True
+        metrics.increment(f"resilience.circuit.{self.name}.rejected")
+        return False
+
+    def check(self):
+        """Raise CircuitOpenError if calls are currently rejected."""
+        if not self.allow():
+            raise CircuitOpenError("Vertex AI is currently unavailable. Please try again shortly.")
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            if self._state != self.CLOSED:
+                self._transition(self.CLOSED)
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                self._transition(self.OPEN)
+
+    def record(self, error_class: Optional[str]):
+        """Record a call outcome; only transient failures count against health."""
+        if error_class is None:
+            self.record_success()
+        elif error_class == TRANSIENT:
+            self.record_failure()
+        else:
+            # Quota and input errors say nothing about endpoint health; release a probe
+            with self._lock:
+                self._probe_owner = None
+
+    def release_probe(self):
+        """Hand back the probe this thread was let through with, if its call was never recorded."""
+        with self._lock:
+            if self._probe_owner == threading.get_ident():
+                self._probe_owner = None
+
+
+_circuits = {}
+_circuits_lock = threading.Lock()
+
+
+def circuit_for(name: str) -> CircuitBreaker:
+    """Return the circuit breaker called ``name`` (one per model), creating it on first use."""
+    with _circuits_lock:
+        if name not in _circuits:
+            _circuits[name] = CircuitBreaker(name)
+        return _circuits[name]
+
+
+def circuit_states() -> dict:
+    """Current state of every circuit breaker, by name."""
+    with _circuits_lock:
+        circuits = list(_circuits.values())
+    return {circuit.name: circuit.state for circuit in circuits}
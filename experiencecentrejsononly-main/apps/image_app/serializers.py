@@ -23,6 +23,7 @@ class DocumentSerializer(serializers.ModelSerializer):
             "llm_model_used",
             "pages_processed",
             "is_full_document",
+            "processing_metadata",
             "filename",
         ]
 
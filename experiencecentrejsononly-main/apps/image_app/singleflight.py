@@ -0,0 +1,302 @@
+"""Coalescing of identical in-flight extractions and per-document locking.
+
+Threads in one worker share a single call through an in-process table. Worker
+processes on the same host are coordinated with ``flock`` lock files: the first
+process runs the call, and processes that were blocked on the lock pick its
+result up instead of calling Gemini. A process that finds the lock held marks
+the key as awaited; only then is the result published next to the lock.
+Published results and marks are swept every CLEANUP_INTERVAL_SECONDS.
+"""
+
+import copy
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Optional
+
+from django.conf import settings
+
+from . import metrics, resilience
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows development machines
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Published results older than this are ignored and cleaned up
+RESULT_TTL_SECONDS = 600
+# Least time between two sweeps of expired results in one process
+CLEANUP_INTERVAL_SECONDS = 60
+# How often a caller waiting with a deadline retries a lock held by another process
+LOCK_POLL_SECONDS = 0.05
+
+
+class LockBusyError(Exception):
+    """Raised when a non-blocking lock is already held by another request"""
+    pass
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+_inflight = {}
+_inflight_lock = threading.Lock()
+_last_cleanup = 0.0
+
+
+def _lock_dir() -> str:
+    path = getattr(
+        settings,
+        "EXTRACTION_LOCK_DIR",
+        os.path.join(settings.BASE_DIR, "cache", "locks"),
+    )
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def _safe_name(name: str) -> str:
+    return hashlib.sha256(name.encode("utf-8")).hexdigest()
+
+
+def _acquire_until(fd: int, deadline: resilience.Deadline):
+    while True:
+        deadline.check()
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return
+        except BlockingIOError:
+            deadline.sleep(min(LOCK_POLL_SECONDS, deadline.remaining()))
+
+
+@contextmanager
+def file_lock(
+    name: str,
+    blocking: bool = True,
+    deadline: Optional[resilience.Deadline] = None,
+    on_contended: Optional[Callable[[], None]] = None,
+):
+    """
+    Hold an exclusive host-wide lock called ``name``.
+
+    Args:
+        name: Name of the lock
+        blocking: Wait for a lock held by someone else instead of failing
+        deadline: Stops waiting when the request is cancelled or out of time
+        on_contended: Called before waiting for a lock held by someone else
+
+    Yields:
+        bool: True if the lock was held by someone else and we had to wait for it.
+
+    Raises:
+        LockBusyError: If ``blocking`` is False and the lock is already held.
+        CancelledError, DeadlineExceededError: From ``deadline`` while waiting
+    """
+    if fcntl is None:
+        yield False
+        return
+
+    path = os.path.join(_lock_dir(), f"{_safe_name(name)}.lock")
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    waited = False
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            if not blocking:
+                raise LockBusyError(name)
+            waited = True
+            if on_contended is not None:
+                on_contended()
+            if deadline is None:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            else:
+                _acquire_until(fd, deadline)
+        try:
+            yield waited
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+    finally:
+        os.close(fd)
+
+
+@contextmanager
+def document_lock(document_id):
+    """Non-blocking lock that stops two requests from reprocessing one Document."""
+    with file_lock(f"document-{document_id}", blocking=False):
+        yield
+
+
+def _result_path(key: str) -> str:
+    return os.path.join(_lock_dir(), f"{_safe_name(key)}.result.json")
+
+
+def _awaited_path(key: str) -> str:
+    return os.path.join(_lock_dir(), f"{_safe_name(key)}.awaited")
+
+
+def _mark_awaited(key: str):
+    """Tell the holder of the extraction lock of ``key`` that its result is awaited."""
+    try:
+        with open(_awaited_path(key), "a"):
+            pass
+        os.utime(_awaited_path(key))
+    except OSError as e:
+        logger.warning(f"Could not mark coalesced request as awaited: {e}")
+
+
+def _awaited_since(key: str, since: float) -> bool:
+    """True if another process found the lock of ``key`` held at or after ``since``."""
+    try:
+        return os.path.getmtime(_awaited_path(key)) >= since
+    except OSError:
+        return False
+
+
+def _publish_result(key: str, result: Dict[str, Any]):
+    path = _result_path(key)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    except (OSError, TypeError, ValueError) as e:
+        logger.warning(f"Could not publish coalesced result: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _read_published_result(key: str, since: float) -> Optional[Dict[str, Any]]:
+    path = _result_path(key)
+    try:
+        if os.path.getmtime(path) < since:
+            return None
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _cleanup_results():
+    cutoff = time.time() - RESULT_TTL_SECONDS
+    try:
+        for entry in os.scandir(_lock_dir()):
+            if entry.name.endswith((".result.json", ".awaited")) and entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+    except OSError:
+        pass
+
+
+def _maybe_cleanup():
+    """Sweep expired results, at most once per CLEANUP_INTERVAL_SECONDS in this process."""
+    global _last_cleanup
+    now = time.monotonic()
+    with _inflight_lock:
+        if now - _last_cleanup < CLEANUP_INTERVAL_SECONDS:
+            return
+        _last_cleanup = now
+    _cleanup_results()
+
+
+def as_shared_result(result: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Return a copy of another request's result as served to a coalesced caller.
+
+    The tokens were billed to the request that made the call, so usageMetadata
+    is zeroed here and the original counts are kept under ``sharedUsageMetadata``.
+    """
+    shared = copy.deepcopy(result)
+    if not shared.get("coalesced"):
+        shared["sharedUsageMetadata"] = shared.get("usageMetadata", {})
+        shared["usageMetadata"] = {
+            "promptTokenCount": 0,
+            "candidatesTokenCount": 0,
+            "totalTokenCount": 0,
+        }
+        shared["coalesced"] = True
+    return shared
+
+
+def run(
+    key: str,
+    fn: Callable[[], Dict[str, Any]],
+    on_wait: Optional[Callable[[str], None]] = None,
+    deadline: Optional[resilience.Deadline] = None,
+) -> Dict[str, Any]:
+    """
+    Run ``fn`` once for every concurrent caller using the same ``key``.
+
+    Args:
+        key: Identity of the request (file hash, prompt, model, page limit, ...)
+        fn: Callable performing the extraction and returning the formatted response
+        on_wait: Optional progress callback told when the caller is waiting
+        deadline: Stops a caller waiting for another's result when it is
+            cancelled or out of time; the call it waited for goes on
+
+    Returns:
+        dict: The result of ``fn``; callers that waited receive a shared copy.
+
+    Raises:
+        CancelledError, DeadlineExceededError: From ``deadline`` while waiting
+
+    A caller waiting on a leader that was cancelled runs ``fn`` itself
+    rather than failing with the leader's CancelledError.
+    """
+    with _inflight_lock:
+        call = _inflight.get(key)
+        leader = call is None
+        if leader:
+            call = _Call()
+            _inflight[key] = call
+
+    if not leader:
+        metrics.increment("singleflight.coalesced_local")
+        if on_wait:
+            on_wait("Identical document is already being processed, waiting for its result...")
+        if deadline is None:
+            call.done.wait()
+        else:
+            while not call.done.wait(min(resilience.CANCEL_POLL_SECONDS, deadline.remaining())):
+                deadline.check()
+        if isinstance(call.error, resilience.CancelledError):
+            # The leader's client went away, but this caller still wants the result
+            return run(key, fn, on_wait, deadline)
+        if call.error is not None:
+            raise call.error
+        return as_shared_result(call.result)
+
+    try:
+        started = time.time()
+        with file_lock(f"extraction-{key}", deadline=deadline, on_contended=lambda: _mark_awaited(key)) as waited:
+            acquired = time.time()
+            result = None
+            if waited:
+                published = _read_published_result(key, since=started)
+                if published is not None:
+                    metrics.increment("singleflight.coalesced_remote")
+                    result = as_shared_result(published)
+            if result is None:
+                metrics.increment("singleflight.leader_calls")
+                result = fn()
+                # Only processes blocked on the lock read the result
+                if _awaited_since(key, acquired):
+                    _publish_result(key, result)
+        _maybe_cleanup()
+        call.result = result
+        return result
+    except BaseException as e:
+        call.error = e
+        raise
+    finally:
+        with _inflight_lock:
+            _inflight.pop(key, None)
+        call.done.set()
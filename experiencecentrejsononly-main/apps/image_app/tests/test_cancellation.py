@@ -0,0 +1,165 @@
+import os
+import socket
+import tempfile
+import threading
+import time
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import SimpleTestCase, override_settings
+from django.urls import reverse
+from rest_framework.test import APITestCase
+
+from apps.image_app import client_disconnect, extraction_cache, metrics, model_routing, rate_limiter, resilience
+from apps.image_app.models import Document
+from apps.image_app.tests.test_extraction_backends import make_pdf
+from apps.image_app.vertex_model import MODEL_ID, call_gemini_api_with_streaming
+
+
+def cancel_after(token, seconds):
+    timer = threading.Timer(seconds, token.cancel)
+    timer.start()
+    return timer
+
+
+class CancelTokenTests(SimpleTestCase):
+    def setUp(self):
+        metrics.reset()
+
+    def test_backoff_wakes_up_on_cancellation(self):
+        token = resilience.CancelToken()
+        deadline = resilience.Deadline(60, token)
+        cancel_after(token, 0.05)
+        started = time.monotonic()
+        with self.assertRaises(resilience.CancelledError):
+            deadline.sleep(10)
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertTrue(deadline.expired())
+
+    def test_waiting_call_is_abandoned(self):
+        token = resilience.CancelToken()
+        cancel_after(token, 0.05)
+        started = time.monotonic()
+        with self.assertRaises(resilience.CancelledError):
+            resilience.call_with_timeout(lambda: time.sleep(5), None, token)
+        self.assertLess(time.monotonic() - started, 1)
+
+    def test_cancellation_is_counted_once_and_not_as_an_error(self):
+        token = resilience.CancelToken()
+        token.cancel()
+        for _ in range(2):
+            with self.assertRaises(resilience.CancelledError):
+                token.check()
+        self.assertEqual(metrics.get_counter("cancellations.client_disconnected"), 1)
+        self.assertEqual(resilience.classify_error(resilience.CancelledError()), resilience.FATAL)
+
+    def test_child_tokens_follow_their_parent(self):
+        parent = resilience.CancelToken()
+        children = [parent.child() for _ in range(3)]
+        children[0].cancel(resilience.CancelToken.SIBLING_FAILED)
+        self.assertFalse(parent.cancelled)
+        self.assertFalse(children[1].cancelled)
+
+        parent.cancel()
+        self.assertTrue(parent.child().cancelled)
+        for child in children[1:]:
+            with self.assertRaises(resilience.CancelledError):
+                child.check()
+        self.assertEqual(metrics.get_counter("cancellations.client_disconnected"), 1)
+
+    @override_settings(CLIENT_DISCONNECT_POLL_SECONDS=0.02)
+    def test_closed_client_socket_cancels_the_request(self):
+        server, client = socket.socketpair()
+        self.addCleanup(server.close)
+        request = type("Request", (), {"META": {"gunicorn.socket": server}})()
+        with client_disconnect.watch(request) as token:
+            time.sleep(0.05)
+            self.assertFalse(token.cancelled)
+            client.close()
+            token.wait(1)
+        self.assertTrue(token.cancelled)
+
+
+class CancelledExtractionTests(SimpleTestCase):
+    def setUp(self):
+        metrics.reset()
+        extraction_cache.clear()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "doc.pdf")
+        with open(self.path, "wb") as f:
+            f.write(make_pdf(2))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _extract(self, token):
+        started = time.monotonic()
+        with self.assertRaises(resilience.CancelledError):
+            call_gemini_api_with_streaming("Extract", input_data=self.path, max_pages=2, use_cache=False, cancel_token=token)
+        return time.monotonic() - started
+
+    @override_settings(FAKE_BACKEND_LATENCY="fixed:5")
+    def test_in_flight_call_is_cancelled(self):
+        token = resilience.CancelToken()
+        cancel_after(token, 0.1)
+        self.assertLess(self._extract(token), 2)
+        self.assertEqual(metrics.get_counter("cancellations.client_disconnected"), 1)
+        self.assertEqual(metrics.get_counter("resilience.errors.fatal"), 0)
+
+    @override_settings(FAKE_BACKEND_ERROR_RATE=1)
+    @mock.patch("apps.image_app.vertex_model.INITIAL_RETRY_DELAY", 5)
+    def test_pending_backoff_is_cancelled(self):
+        token = resilience.CancelToken()
+        cancel_after(token, 0.1)
+        self.assertLess(self._extract(token), 2)
+
+    @override_settings(CIRCUIT_BREAKER_RESET_SECONDS=0)
+    def test_half_open_probe_is_released_when_cancelled_after_selection(self):
+        circuit = model_routing.circuit(MODEL_ID)
+        self.addCleanup(circuit.record_success)
+        for _ in range(circuit.failure_threshold):
+            circuit.record_failure()
+        token = resilience.CancelToken()
+
+        def cancelled_in_queue(*args, **kwargs):
+            token.cancel()
+            token.check()
+
+        with mock.patch.object(rate_limiter, "acquire", side_effect=cancelled_in_queue):
+            self._extract(token)
+
+        self.assertEqual(circuit.state, circuit.HALF_OPEN)
+        # The next request is let through as the probe
+        response = call_gemini_api_with_streaming("Extract", input_data=self.path, max_pages=2, use_cache=False)
+        self.assertEqual(response["modelUsed"], MODEL_ID)
+        self.assertEqual(circuit.state, circuit.CLOSED)
+
+
+@override_settings(
+    DATABASES={"default": {"ENGINE": "django.db.backends.sqlite3", "NAME": ":memory:"}},
+    MEDIA_ROOT=tempfile.mkdtemp(),
+    FAKE_BACKEND_LATENCY="fixed:5",
+    CLIENT_DISCONNECT_POLL_SECONDS=0.02,
+    EXTRACTION_CACHE_ENABLED=False,
+)
+class DisconnectedUploadTests(APITestCase):
+    def setUp(self):
+        extraction_cache.clear()
+        self.user = get_user_model().objects.create_user(username="leaver", password="pass")
+        self.client.force_authenticate(user=self.user)
+
+    def test_upload_of_a_disconnected_client_is_not_stored(self):
+        server, client = socket.socketpair()
+        self.addCleanup(server.close)
+        threading.Timer(0.1, client.close).start()
+        upload = SimpleUploadedFile("invoice.pdf", make_pdf(1), content_type="application/pdf")
+        started = time.monotonic()
+        response = self.client.post(
+            reverse("upload_file"), {"pdf_file": upload, "doc_type": "docextraction"}, **{"gunicorn.socket": server}
+        )
+        self.assertLess(time.monotonic() - started, 3)
+        self.assertEqual(response.status_code, client_disconnect.CLIENT_CLOSED_REQUEST)
+        self.assertFalse(Document.objects.filter(userid=self.user).exists())
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.documents_processed, 0)
@@ -0,0 +1,80 @@
+import datetime
+import itertools
+import types
+
+from django.test import SimpleTestCase, override_settings
+
+from apps.image_app import client_pool, metrics
+
+
+def make_pool(size=3, pings=None):
+    counter = itertools.count()
+    ping = pings.append if pings is not None else None
+    return client_pool.ClientPool("default/model", lambda: f"client-{next(counter)}", size, ping=ping)
+
+
+def expiring_credentials(seconds):
+    expiry = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None) + datetime.timedelta(seconds=seconds)
+    return types.SimpleNamespace(token="token", expiry=expiry)
+
+
+class ClientPoolTests(SimpleTestCase):
+    def setUp(self):
+        metrics.reset()
+        client_pool.reset()
+
+    def tearDown(self):
+        metrics.reset()
+        client_pool.reset()
+
+    def test_calls_spread_over_clients(self):
+        pool = make_pool()
+        with pool.lease() as first, pool.lease() as second, pool.lease() as third:
+            self.assertEqual(len({first, second, third}), 3)
+            self.assertEqual(pool.status()["in_flight"], [1, 1, 1])
+        self.assertEqual(pool.status()["in_flight"], [0, 0, 0])
+
+    def test_first_and_steady_calls_are_measured_apart(self):
+        pool = make_pool(size=2)
+        for _ in range(5):
+            with pool.lease(pages=2):
+                pass
+        self.assertEqual(metrics.observation_count(client_pool.FIRST_CALL_SERIES), 2)
+        self.assertEqual(metrics.observation_count(client_pool.STEADY_CALL_SERIES), 3)
+        self.assertIsNotNone(client_pool.status()["steady_call_seconds_per_page_p50"])
+
+    def test_warmed_clients_only_make_steady_calls(self):
+        pings = []
+        pool = make_pool(size=2, pings=pings)
+        self.assertEqual(pool.warm_up(), 2)
+        self.assertEqual(sorted(pings), ["client-0", "client-1"])
+        with pool.lease():
+            pass
+        self.assertEqual(metrics.observation_count(client_pool.FIRST_CALL_SERIES), 0)
+
+    def test_only_idle_clients_are_pinged(self):
+        pings = []
+        pool = make_pool(size=2, pings=pings)
+        with pool.lease() as busy:
+            self.assertEqual(pool.keep_alive(idle_seconds=0), 1)
+        self.assertNotIn(busy, pings)
+        self.assertEqual(pool.keep_alive(idle_seconds=3600), 0)
+        self.assertEqual(metrics.get_counter("vertex.keepalive_pings"), 1)
+
+    def test_pool_is_created_once(self):
+        created = []
+        pool = client_pool.get_pool("key", lambda: created.append(1) or make_pool())
+        self.assertIs(client_pool.get_pool("key", lambda: created.append(1) or make_pool()), pool)
+        self.assertEqual(created, [1])
+        self.assertEqual(client_pool.status()["pools"]["default/model"]["channels"], 3)
+
+    @override_settings(VERTEX_CREDENTIAL_REFRESH_MARGIN_SECONDS=300)
+    def test_credentials_are_refreshed_ahead_of_expiry(self):
+        refreshed = []
+        client_pool.register_credentials("fresh", expiring_credentials(3600), refreshed.append)
+        expiring = expiring_credentials(60)
+        client_pool.register_credentials("expiring", expiring, refreshed.append)
+
+        self.assertEqual(client_pool.refresh_credentials(), 1)
+        self.assertEqual(refreshed, [expiring])
+        self.assertEqual(client_pool.refresh_credentials(force=True), 2)
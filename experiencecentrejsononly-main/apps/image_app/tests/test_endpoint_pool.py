@@ -0,0 +1,117 @@
+import os
+import tempfile
+import time
+
+from django.test import SimpleTestCase, override_settings
+
+from apps.image_app import endpoint_pool, extraction_cache, resilience
+from apps.image_app.extraction_backends import ResourceExhausted, ServiceUnavailable
+from apps.image_app.tests.test_extraction_backends import make_pdf
+from apps.image_app.vertex_model import call_gemini_api_with_streaming
+
+ENDPOINTS = [{"name": "east", "location": "us-east1"}, {"name": "west", "location": "us-west1"}]
+
+
+def answer_from(delays=None, errors=None):
+    """A model call answering with the endpoint's name, after a delay or with an error per endpoint."""
+    delays, errors = delays or {}, errors or {}
+
+    def fn(endpoint):
+        time.sleep(delays.get(endpoint.name, 0))
+        if endpoint.name in errors:
+            raise errors[endpoint.name]
+        return endpoint.name
+
+    return fn
+
+
+@override_settings(VERTEX_ENDPOINTS=ENDPOINTS)
+class EndpointPoolTests(SimpleTestCase):
+    def setUp(self):
+        endpoint_pool.reset()
+
+    def tearDown(self):
+        for endpoint in endpoint_pool.endpoints():
+            endpoint.circuit.record_success()
+        endpoint_pool.reset()
+
+    def test_default_endpoint(self):
+        with override_settings(VERTEX_ENDPOINTS="[]"):
+            self.assertEqual([endpoint.name for endpoint in endpoint_pool.endpoints()], ["default"])
+
+    def test_faster_endpoint_takes_the_load(self):
+        fn = answer_from(delays={"east": 0.05})
+        used = [endpoint_pool.call(fn) for _ in range(6)]
+        # Each endpoint is tried once, then the faster one is preferred
+        self.assertEqual(used, ["east"] + ["west"] * 5)
+        self.assertEqual(endpoint_pool.status()["west"]["calls"], 5)
+
+    def test_endpoint_out_of_quota_is_passed_over(self):
+        with override_settings(VERTEX_ENDPOINTS=[dict(ENDPOINTS[0], requests_per_minute=1), ENDPOINTS[1]]):
+            self.assertEqual(endpoint_pool.call(answer_from(), 1), "east")
+            self.assertEqual(endpoint_pool.status()["east"]["remaining_quota"], 0.0)
+            self.assertEqual(endpoint_pool.select().name, "west")
+
+    def test_quota_error_fails_over_and_cools_down(self):
+        fn = answer_from(errors={"east": ResourceExhausted("429 Resource exhausted")})
+        self.assertEqual(endpoint_pool.call(fn), "west")
+        status = endpoint_pool.status()["east"]
+        self.assertEqual(status["quota_errors"], 1)
+        self.assertGreater(status["quota_cooldown_seconds"], 0)
+        self.assertEqual(endpoint_pool.select().name, "west")
+
+    @override_settings(CIRCUIT_BREAKER_FAILURE_THRESHOLD=1, CIRCUIT_BREAKER_RESET_SECONDS=0.05)
+    def test_failing_endpoint_is_ejected_and_probed_back(self):
+        fn = answer_from(errors={"east": ServiceUnavailable("503 Service unavailable")})
+        self.assertEqual(endpoint_pool.call(fn), "west")
+        self.assertEqual(endpoint_pool.status()["east"]["state"], resilience.CircuitBreaker.OPEN)
+        self.assertEqual(endpoint_pool.select().name, "west")
+        with self.assertRaises(resilience.CircuitOpenError):
+            endpoint_pool.select(exclude=["west"])
+
+        time.sleep(0.06)
+        self.assertEqual(endpoint_pool.call(answer_from(), 1), "east")
+        self.assertEqual(endpoint_pool.status()["east"]["state"], resilience.CircuitBreaker.CLOSED)
+
+    def test_error_of_the_last_endpoint_is_raised(self):
+        fn = answer_from(errors={name: ServiceUnavailable(f"503 {name}") for name in ("east", "west")})
+        with self.assertRaisesMessage(ServiceUnavailable, "503 west"):
+            endpoint_pool.call(fn)
+
+        with self.assertRaises(ValueError):
+            endpoint_pool.call(answer_from(errors={"east": ValueError("bad input")}))
+        self.assertEqual(endpoint_pool.status()["west"]["calls"], 1)
+
+    def test_stream_latency_is_taken_at_the_end(self):
+        def chunks(endpoint):
+            for chunk in ("a", "b"):
+                time.sleep(0.01)
+                yield chunk
+
+        self.assertEqual(list(endpoint_pool.call(chunks, 2, stream=True)), ["a", "b"])
+        status = endpoint_pool.status()["east"]
+        self.assertEqual(status["in_flight"], 0)
+        self.assertGreaterEqual(status["seconds_per_page"], 0.01)
+
+
+class FakeEndpointTests(SimpleTestCase):
+    def setUp(self):
+        extraction_cache.clear()
+        endpoint_pool.reset()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "doc.pdf")
+        with open(self.path, "wb") as f:
+            f.write(make_pdf(2))
+
+    def tearDown(self):
+        endpoint_pool.reset()
+        self.tmpdir.cleanup()
+
+    @override_settings(VERTEX_ENDPOINTS=[
+        {"name": "exhausted", "fake_quota_error_rate": 1}, {"name": "healthy", "fake_latency": "fixed:0"},
+    ])
+    def test_extraction_fails_over_between_fake_endpoints(self):
+        response = call_gemini_api_with_streaming("Extract", input_data=self.path, max_pages=2, use_cache=False)
+        self.assertEqual(response["pagesProcessed"], 2)
+        status = endpoint_pool.status()
+        self.assertEqual((status["exhausted"]["quota_errors"], status["healthy"]["calls"]), (1, 1))
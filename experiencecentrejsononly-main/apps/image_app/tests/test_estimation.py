@@ -0,0 +1,159 @@
+import os
+import tempfile
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from rest_framework.test import APITestCase
+
+from apps.image_app import estimation, extraction_cache, preprocessing
+from apps.image_app.models import Document
+from apps.image_app.tests.test_page_filter import make_scan_pdf
+from apps.image_app.tests.test_text_layer import INVOICE_LINES, make_text_pdf
+from apps.image_app.views import encrypt_id, get_prompt_for_doc_type
+
+
+def text_pdf(pages) -> bytes:
+    # Distinct pages, so the page filter keeps all of them
+    return make_text_pdf([INVOICE_LINES + [f"Page {n}"] for n in range(pages)])
+
+
+class EstimationTests(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.user = get_user_model().objects.create_user(username="estimates", password="pass")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write(self, data: bytes, name="doc.pdf") -> str:
+        path = os.path.join(self.tmpdir.name, name)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def test_text_pages_are_cheaper_than_scans(self):
+        text = estimation.estimate(self.write(text_pdf(4)), "Extract", 3)
+        scanned = estimation.estimate(self.write(make_scan_pdf([1, 2, 3, 4]), "scan.pdf"), "Extract", 3)
+
+        self.assertEqual((text["total_pages"], text["pages_to_process"], text["page_limit"]), (4, 3, 3))
+        self.assertEqual(scanned["estimated_input_tokens"], scanned["prompt_tokens"] + 3 * estimation.PDF_PAGE_TOKENS)
+        self.assertLess(text["estimated_input_tokens"], scanned["estimated_input_tokens"])
+        self.assertEqual(text["method"], "local")
+
+    @override_settings(ESTIMATE_SAMPLE_PAGES=2)
+    def test_sample_is_extrapolated(self):
+        estimate = estimation.estimate(self.write(make_scan_pdf([1, 2, 3, 4, 5])), "", None)
+        self.assertEqual(estimate["estimated_input_tokens"], 5 * estimation.PDF_PAGE_TOKENS)
+
+    def test_calibration_uses_billed_tokens(self):
+        self.assertEqual(estimation.calibration_factor(), 1.0)
+        for _ in range(5):
+            Document.objects.create(
+                userid=self.user, input_token=1500, pages_processed=3, api_response_time=6.0,
+                processing_metadata={"estimated_input_tokens": 1000},
+            )
+        self.assertEqual(estimation.calibration_factor(), 1.5)
+        self.assertEqual(estimation.seconds_per_page(), 2.0)
+
+        estimate = estimation.estimate(self.write(make_scan_pdf([1, 2])), "", 3)
+        self.assertEqual(estimate["local_input_tokens"], 2 * estimation.PDF_PAGE_TOKENS)
+        self.assertEqual(estimate["estimated_input_tokens"], 3 * estimation.PDF_PAGE_TOKENS)
+        self.assertEqual(estimate["expected_latency_seconds"], 4.0)
+
+    def test_budget_decisions(self):
+        estimate = {"page_limit": 3, "pages_to_process": 3, "prompt_tokens": 100, "tokens_per_page": 300,
+                    "calibration_factor": 1.0, "estimated_input_tokens": 1000}
+        self.assertEqual(estimation.check_budget(self.user, estimate)["decision"], estimation.ALLOW)
+
+        self.user.input_token_budget = 2000
+        Document.objects.create(userid=self.user, input_token=1200)
+        budget = estimation.check_budget(self.user, estimate)
+        self.assertEqual(budget["decision"], estimation.DOWNGRADE)
+        self.assertEqual((budget["remaining"], budget["page_limit"]), (800, 2))
+
+        Document.objects.create(userid=self.user, input_token=500)
+        self.assertEqual(estimation.check_budget(self.user, estimate)["decision"], estimation.REJECT)
+
+    @override_settings(USER_INPUT_TOKEN_BUDGET=100)
+    def test_user_budget_overrides_default(self):
+        self.assertEqual(estimation.input_token_budget(self.user), 100)
+        self.user.input_token_budget = 5000
+        self.assertEqual(estimation.input_token_budget(self.user), 5000)
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class EstimateUploadTests(APITestCase):
+    def setUp(self):
+        extraction_cache.clear()
+        self.user = get_user_model().objects.create_user(username="budget", password="pass")
+        self.client.force_authenticate(user=self.user)
+
+    def upload(self, name, pages=4):
+        return SimpleUploadedFile(name, make_scan_pdf(range(1, pages + 1)), content_type="application/pdf")
+
+    def test_estimate_endpoint(self):
+        response = self.client.post(reverse("upload_estimate"), {"pdf_file": self.upload("a.pdf"), "doc_type": "docextraction"})
+
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual((response.data["total_pages"], response.data["page_limit"]), (4, 3))
+        self.assertGreater(response.data["estimated_input_tokens"], 3 * estimation.PDF_PAGE_TOKENS)
+        self.assertEqual(response.data["budget"]["decision"], estimation.ALLOW)
+        self.assertEqual(Document.objects.count(), 0)
+
+    def test_upload_over_budget_is_rejected_before_the_model_call(self):
+        self.user.input_token_budget = 100
+        self.user.save()
+        with mock.patch("apps.image_app.views.call_gemini_api_with_streaming") as extract:
+            response = self.client.post(reverse("upload_file"), {"pdf_file": self.upload("b.pdf"), "doc_type": "docextraction"})
+
+        self.assertEqual(response.status_code, 403, response.content)
+        self.assertEqual(response.data["budget"]["decision"], estimation.REJECT)
+        extract.assert_not_called()
+        self.assertEqual(Document.objects.count(), 0)
+
+    def test_upload_is_downgraded_to_the_pages_that_fit(self):
+        prompt_tokens = estimation._text_tokens(get_prompt_for_doc_type("docextraction"))
+        self.user.input_token_budget = prompt_tokens + 2 * estimation.PDF_PAGE_TOKENS + 100
+        self.user.save()
+        response = self.client.post(reverse("upload_file"), {"pdf_file": self.upload("c.pdf"), "doc_type": "docextraction"})
+
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(response.data["pages_processed"], 2)
+        self.assertEqual(response.data["estimate"]["page_limit"], 2)
+        doc = Document.objects.get(userid=self.user)
+        self.assertEqual(doc.processing_metadata["estimated_input_tokens"], response.data["estimate"]["local_input_tokens"])
+
+    def test_upload_without_budget_is_not_preprocessed_for_the_estimate(self):
+        prepare_inputs = preprocessing.prepare_inputs
+        with mock.patch.object(preprocessing, "prepare_inputs", side_effect=prepare_inputs) as prepare:
+            response = self.client.post(reverse("upload_file"), {"pdf_file": self.upload("d.pdf"), "doc_type": "docextraction"})
+
+        self.assertEqual(response.status_code, 200, response.content)
+        # Only the extraction prepares the document
+        self.assertEqual(prepare.call_count, 1)
+        self.assertEqual(response.data["estimate"]["method"], estimation.PAGE_COUNT)
+        self.assertEqual(response.data["estimate"]["pages_to_process"], 3)
+        doc = Document.objects.get(userid=self.user)
+        self.assertNotIn("estimated_input_tokens", doc.processing_metadata)
+
+    def test_full_document_run_is_checked_against_the_budget(self):
+        prompt_tokens = estimation._text_tokens(get_prompt_for_doc_type("docextraction"))
+        self.user.user_type = "power"
+        self.user.input_token_budget = prompt_tokens + 2 * estimation.PDF_PAGE_TOKENS + 100
+        self.user.save()
+        response = self.client.post(reverse("upload_file"), {"pdf_file": self.upload("e.pdf"), "doc_type": "docextraction"})
+        self.assertEqual(response.data["pages_processed"], 2)
+        doc = Document.objects.get(userid=self.user)
+
+        with mock.patch("apps.image_app.views.call_gemini_api_windowed") as extract:
+            response = self.client.post(reverse("process-full-document"), {"document_id": encrypt_id(doc.id)})
+
+        self.assertEqual(response.status_code, 403, response.content)
+        self.assertEqual(response.data["budget"]["decision"], estimation.DOWNGRADE)
+        self.assertEqual(response.data["budget"]["used"], 0)
+        extract.assert_not_called()
+        doc.refresh_from_db()
+        self.assertFalse(doc.is_full_document)
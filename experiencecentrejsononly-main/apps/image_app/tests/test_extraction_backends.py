@@ -0,0 +1,144 @@
+import json
+import os
+import random
+import tempfile
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import SimpleTestCase, override_settings
+from django.urls import reverse
+from rest_framework.test import APITestCase
+
+from apps.image_app import extraction_backends, extraction_cache, reimbursement, resilience
+from apps.image_app.extraction_backends import ExtractionRequest, FakeBackend, RecordingBackend
+from apps.image_app.models import Document
+from apps.image_app.tests.test_text_layer import make_text_pdf
+from apps.image_app.vertex_model import call_gemini_api_with_streaming
+
+
+def make_pdf(pages: int) -> bytes:
+    # Distinct, short pages: not dropped as blank or duplicate, too short for the text-layer path
+    return make_text_pdf([[f"Page {number}"] for number in range(1, pages + 1)])
+
+
+def make_request(prompt="Extract", input_data=None, max_pages=3):
+    return ExtractionRequest(prompt, input_data, max_pages, {"temperature": 0.9, "response_mime_type": "application/json"})
+
+
+class FakeBackendTests(SimpleTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.override = override_settings(EXTRACTION_RECORDINGS_DIR=self.tmpdir.name)
+        self.override.enable()
+
+    def tearDown(self):
+        self.override.disable()
+        self.tmpdir.cleanup()
+
+    def test_pipeline_runs_offline(self):
+        path = os.path.join(self.tmpdir.name, "doc.pdf")
+        with open(path, "wb") as f:
+            f.write(make_pdf(5))
+
+        response = call_gemini_api_with_streaming(
+            "Extract", input_data=path, response_mime_type="application/json", max_pages=3, use_cache=False
+        )
+
+        self.assertEqual(response["pagesProcessed"], 3)
+        self.assertEqual(response["totalPages"], 5)
+        output = json.loads(response["candidates"][0]["content"]["parts"][0]["text"])
+        self.assertEqual(list(output), ["page_1", "page_2", "page_3"])
+        self.assertEqual(response["usageMetadata"]["candidatesTokenCount"], 3 * 350)
+
+    @override_settings(FAKE_BACKEND_LATENCY="lognormal:2:0.5", FAKE_BACKEND_SEED="7")
+    def test_latency_draws_are_deterministic(self):
+        distribution = extraction_backends.parse_latency("lognormal:2:0.5")
+        draws = [distribution(FakeBackend()._rng(make_request()), None) for _ in range(2)]
+        self.assertEqual(draws[0], draws[1])
+
+        backend = FakeBackend()
+        first, second = backend._rng(make_request()), backend._rng(make_request())
+        self.assertNotEqual(first.random(), second.random())
+
+    def test_call_numbers_are_bounded_and_reset(self):
+        backend = FakeBackend()
+        with mock.patch.object(extraction_backends, "FAKE_BACKEND_MAX_FINGERPRINTS", 2):
+            for prompt in ("a", "b", "c", "c"):
+                backend._rng(make_request(prompt=prompt))
+        self.assertEqual(list(backend._calls.values()), [1, 2])
+
+        first = backend._rng(make_request()).random()
+        backend.reset()
+        self.assertEqual(backend._rng(make_request()).random(), first)
+
+    def test_answer_follows_the_doc_type(self):
+        request = make_request(prompt='Return {"expenses": [...], "summary": {...}}')
+        self.assertEqual(list(json.loads(extraction_backends.synthesize_text(request))), ["page_1"])
+
+        request.doc_type = reimbursement.DOC_TYPE
+        self.assertEqual(list(json.loads(extraction_backends.synthesize_text(request))), ["expenses"])
+        with override_settings(REIMBURSEMENT_LOCAL_AGGREGATES=False):
+            self.assertEqual(
+                list(json.loads(extraction_backends.synthesize_text(request))),
+                ["expenses", "allowed", "not_allowed", "summary"],
+            )
+
+    def test_parse_latency(self):
+        rng = random.Random(0)
+        self.assertEqual(extraction_backends.parse_latency("fixed:1.5")(rng, None), 1.5)
+        self.assertTrue(0.5 <= extraction_backends.parse_latency("uniform:0.5:1")(rng, None) <= 1)
+        self.assertEqual(extraction_backends.parse_latency("recorded")(rng, 3.2), 3.2)
+        with self.assertRaises(ImproperlyConfigured):
+            extraction_backends.parse_latency("normal:1")
+
+    @override_settings(FAKE_BACKEND_QUOTA_ERROR_RATE=0.5, FAKE_BACKEND_ERROR_RATE=0.5)
+    def test_injected_errors_are_classified(self):
+        classes = set()
+        backend = FakeBackend()
+        for _ in range(20):
+            try:
+                backend.generate(make_request())
+            except Exception as e:
+                classes.add(resilience.classify_error(e))
+        self.assertEqual(classes, {resilience.QUOTA, resilience.TRANSIENT})
+
+    def test_record_then_replay(self):
+        recorder = RecordingBackend(FakeBackend())
+        request = make_request()
+        recorder.prepare(request, lambda message: None)
+        recorded = recorder.generate(request)
+
+        replayed = FakeBackend(replay=True).generate(make_request())
+        self.assertEqual(replayed.text, recorded.text)
+        self.assertEqual(replayed.usage_metadata.prompt_token_count, recorded.usage_metadata.prompt_token_count)
+
+    def test_streamed_responses_are_recorded(self):
+        request = make_request(prompt="Streamed")
+        chunks = list(RecordingBackend(FakeBackend()).generate(request, stream=True))
+        self.assertGreater(len(chunks), 1)
+
+        recording = extraction_backends.load_recording(request.fingerprint)
+        self.assertEqual(recording["text"], "".join(chunk.text for chunk in chunks))
+        self.assertEqual(recording["usage"]["candidates_token_count"], 350)
+
+
+@override_settings(
+    DATABASES={"default": {"ENGINE": "django.db.backends.sqlite3", "NAME": ":memory:"}},
+    MEDIA_ROOT=tempfile.mkdtemp(),
+)
+class UploadWithFakeBackendTests(APITestCase):
+    def setUp(self):
+        extraction_cache.clear()
+        self.user = get_user_model().objects.create_user(username="loadtest", password="pass")
+        self.client.force_authenticate(user=self.user)
+
+    def test_upload_is_processed_end_to_end(self):
+        upload = SimpleUploadedFile("invoice.pdf", make_pdf(2), content_type="application/pdf")
+        response = self.client.post(reverse("upload_file"), {"pdf_file": upload, "doc_type": "docextraction"})
+
+        self.assertEqual(response.status_code, 200, response.content)
+        doc = Document.objects.get(userid=self.user)
+        self.assertEqual(list(doc.json_data), ["page_1", "page_2"])
+        self.assertEqual(doc.output_token, 2 * 350)
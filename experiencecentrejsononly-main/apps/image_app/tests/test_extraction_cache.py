@@ -0,0 +1,113 @@
+import os
+import tempfile
+import time
+from unittest import mock
+
+from django.test import SimpleTestCase, override_settings
+
+from apps.image_app import extraction_cache, model_routing, preprocessing
+from apps.image_app.vertex_model import _request_key
+
+
+def _response(text="{}", prompt_tokens=100, output_tokens=20):
+    return {
+        "candidates": [{"content": {"parts": [{"text": text}], "role": "model"}}],
+        "usageMetadata": {
+            "promptTokenCount": prompt_tokens,
+            "candidatesTokenCount": output_tokens,
+            "totalTokenCount": prompt_tokens + output_tokens,
+        },
+        "pagesProcessed": 1,
+    }
+
+
+class ExtractionCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.override = override_settings(
+            EXTRACTION_CACHE_PATH=os.path.join(self.tmpdir.name, "cache.sqlite3"),
+            EXTRACTION_CACHE_TTL=3600,
+            EXTRACTION_CACHE_MAX_ENTRIES=3,
+        )
+        self.override.enable()
+
+    def tearDown(self):
+        self.override.disable()
+        self.tmpdir.cleanup()
+
+    def _key(self, fingerprint="abc", prompt="prompt", max_pages=3, temperature=0.9):
+        return extraction_cache.make_key(fingerprint, prompt, "model", max_pages, {"temperature": temperature})
+
+    def test_round_trip_serves_zero_billed_tokens(self):
+        key = self._key()
+        self.assertIsNone(extraction_cache.get(key))
+        extraction_cache.put(key, _response())
+
+        cached = extraction_cache.get(key)
+        served = extraction_cache.as_cache_hit(cached)
+
+        self.assertTrue(served["cacheHit"])
+        self.assertEqual(served["usageMetadata"]["promptTokenCount"], 0)
+        self.assertEqual(served["cachedUsageMetadata"]["promptTokenCount"], 100)
+        stats = extraction_cache.stats()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 1)
+
+    def test_key_depends_on_request_parameters(self):
+        base = self._key()
+        self.assertNotEqual(base, self._key(prompt="other"))
+        self.assertNotEqual(base, self._key(max_pages=None))
+        self.assertNotEqual(base, self._key(temperature=0.1))
+        self.assertEqual(base, self._key())
+
+    def test_request_key_depends_on_preprocessing(self):
+        route = model_routing.Route(model_routing.DEFAULT_ROUTE, ["model"])
+
+        def key():
+            return _request_key("prompt", "text", 3, 0.9, 1.0, 32, 1024, None, route)
+
+        base = key()
+        for name, value in [("PDF_TEXT_LAYER_ENABLED", False), ("PAGE_FILTER_ENABLED", False), ("IMAGE_MAX_LONG_EDGE", 768)]:
+            with override_settings(**{name: value}):
+                self.assertNotEqual(key(), base, name)
+        with mock.patch.object(preprocessing, "PREPROCESSING_VERSION", preprocessing.PREPROCESSING_VERSION + 1):
+            self.assertNotEqual(key(), base)
+        self.assertEqual(key(), base)
+
+    def test_file_fingerprint_is_content_based(self):
+        paths = []
+        for _ in range(2):
+            fd, path = tempfile.mkstemp(dir=self.tmpdir.name, suffix=".pdf")
+            with os.fdopen(fd, "wb") as f:
+                f.write(b"%PDF-1.4 same bytes")
+            paths.append(path)
+        self.assertEqual(
+            extraction_cache.fingerprint_input(paths[0]),
+            extraction_cache.fingerprint_input(paths[1]),
+        )
+
+    def test_expired_entries_are_misses(self):
+        key = self._key()
+        extraction_cache.put(key, _response())
+        with override_settings(EXTRACTION_CACHE_TTL=0):
+            with mock.patch("apps.image_app.extraction_cache.time.time", return_value=time.time() + 1):
+                self.assertIsNone(extraction_cache.get(key))
+
+    def test_least_recently_used_entries_are_evicted(self):
+        keys = [self._key(fingerprint=str(i)) for i in range(4)]
+        for key in keys:
+            extraction_cache.put(key, _response())
+            time.sleep(0.01)
+
+        self.assertIsNone(extraction_cache.get(keys[0]))
+        self.assertIsNotNone(extraction_cache.get(keys[3]))
+        self.assertEqual(extraction_cache.stats()["entries"], 3)
+
+    def test_prompts_change_invalidates_entries(self):
+        key = self._key()
+        with mock.patch("apps.image_app.extraction_cache.prompts_version", return_value="v1"):
+            extraction_cache.put(key, _response())
+            self.assertIsNotNone(extraction_cache.get(key))
+        with mock.patch("apps.image_app.extraction_cache.prompts_version", return_value="v2"):
+            self.assertIsNone(extraction_cache.get(key))
+        self.assertEqual(extraction_cache.stats()["invalidations"], 1)
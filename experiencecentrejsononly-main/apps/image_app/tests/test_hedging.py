@@ -0,0 +1,151 @@
+import threading
+import time
+from unittest import mock
+
+from django.test import SimpleTestCase, override_settings
+
+from apps.image_app import hedging, metrics, rate_limiter, resilience
+
+
+def slow_first_call(results=("primary", "hedge"), delay=5.0):
+    """A call whose first invocation hangs until released, while later ones return at once."""
+    calls = []
+    release = threading.Event()
+
+    def fn():
+        calls.append(time.monotonic())
+        if len(calls) == 1:
+            release.wait(delay)
+            return results[0]
+        return results[1]
+
+    return fn, calls, release
+
+
+@override_settings(
+    HEDGING_ENABLED=True, HEDGE_MIN_OBSERVATIONS=5, HEDGE_MIN_DELAY_SECONDS=0.05,
+    HEDGE_LATENCY_PERCENTILE=95, HEDGE_MAX_EXTRA_LOAD=1,
+)
+class HedgingTests(SimpleTestCase):
+    def setUp(self):
+        metrics.reset()
+        hedging.reset()
+        for _ in range(5):
+            metrics.observe(hedging.LATENCY_SERIES, 0.01)
+
+    def tearDown(self):
+        metrics.reset()
+        hedging.reset()
+
+    def test_delay_follows_recent_latency_per_page(self):
+        self.assertEqual(hedging.hedge_delay(1), 0.05)
+        self.assertAlmostEqual(hedging.hedge_delay(20), 0.2)
+        metrics.reset()
+        self.assertIsNone(hedging.hedge_delay(1))
+
+    def test_slow_call_is_hedged_and_hedge_wins(self):
+        fn, calls, release = slow_first_call()
+        try:
+            started = time.monotonic()
+            self.assertEqual(hedging.call(fn, 1, timeout=10), "hedge")
+            self.assertLess(time.monotonic() - started, 2)
+        finally:
+            release.set()
+        self.assertEqual(len(calls), 2)
+        status = hedging.status()
+        self.assertEqual((status["calls"], status["hedges"], status["wins"]), (1, 1, 1))
+        self.assertEqual((status["hedge_rate"], status["win_rate"]), (1.0, 1.0))
+
+    def test_fast_call_is_not_hedged(self):
+        calls = []
+        self.assertEqual(hedging.call(lambda: calls.append(1) or "done", 1, timeout=10), "done")
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(metrics.get_counter("hedging.hedges"), 0)
+
+    @override_settings(HEDGE_MAX_EXTRA_LOAD=0.5)
+    def test_extra_load_is_capped(self):
+        fn, calls, release = slow_first_call(delay=0.3)
+        # Half a hedge earned: the slow call waits for the primary
+        self.assertEqual(hedging.call(fn, 1, timeout=10), "primary")
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(metrics.get_counter("hedging.budget_exhausted"), 1)
+
+    def test_failed_hedge_falls_back_to_the_primary(self):
+        calls = []
+
+        def fn():
+            calls.append(1)
+            if len(calls) == 1:
+                time.sleep(0.2)
+                return "primary"
+            raise ConnectionError("hedge failed")
+
+        self.assertEqual(hedging.call(fn, 1, timeout=10), "primary")
+        self.assertEqual(metrics.get_counter("hedging.wins"), 0)
+
+    def test_timeout(self):
+        fn, _, release = slow_first_call(results=("primary", "primary"))
+        hedging.reset()
+        try:
+            with override_settings(HEDGE_MAX_EXTRA_LOAD=0):
+                with self.assertRaises(resilience.AttemptTimeoutError):
+                    hedging.call(fn, 1, timeout=0.2)
+        finally:
+            release.set()
+
+    @override_settings(HEDGING_ENABLED=False)
+    def test_disabled_calls_still_record_latency(self):
+        self.assertEqual(hedging.call(lambda: "done", 2, timeout=None), "done")
+        self.assertEqual(metrics.observation_count(hedging.LATENCY_SERIES), 6)
+
+    def test_hedge_is_leased_for_the_caller(self):
+        fn, _, release = slow_first_call()
+        requester = rate_limiter.Requester("free", 7)
+        try:
+            with mock.patch.object(rate_limiter, "acquire", return_value="hedge-lease") as acquire, \
+                    mock.patch.object(rate_limiter, "release") as give_back:
+                hedging.call(fn, 1, timeout=10, estimated_tokens=100, lease="primary-lease", requester=requester)
+                release.set()
+                deadline = time.monotonic() + 5
+                while give_back.call_count < 2 and time.monotonic() < deadline:
+                    time.sleep(0.01)
+        finally:
+            release.set()
+        acquire.assert_called_once_with(100, max_wait=0, requester=requester)
+
+    def test_primary_keeps_its_lease_until_it_finishes(self):
+        fn, _, release = slow_first_call()
+        released = []
+        finished = threading.Event()
+
+        def record(lease, outcome="success", actual_tokens=None):
+            released.append((lease, outcome, actual_tokens))
+            if lease == "primary-lease":
+                finished.set()
+
+        with mock.patch.object(rate_limiter, "acquire", return_value="hedge-lease"), \
+                mock.patch.object(rate_limiter, "release", side_effect=record):
+            result = hedging.call(fn, 1, timeout=10, lease="primary-lease", used_tokens=len)
+            self.assertEqual(result, "hedge")
+            self.assertEqual(released, [("hedge-lease", "success", 5)])
+
+            release.set()
+            self.assertTrue(finished.wait(5))
+        self.assertEqual(released[1], ("primary-lease", "success", 7))
+
+    @override_settings(HEDGE_MAX_EXTRA_LOAD=0)
+    def test_lease_is_released_at_once_on_cancellation(self):
+        fn, calls, release = slow_first_call()
+        token = resilience.CancelToken()
+        threading.Timer(0.1, token.cancel).start()
+        try:
+            with mock.patch.object(rate_limiter, "release") as give_back:
+                with self.assertRaises(resilience.CancelledError):
+                    hedging.call(fn, 1, timeout=10, cancel_token=token, lease="primary-lease")
+                give_back.assert_called_once_with("primary-lease", outcome="cancelled", actual_tokens=None)
+                release.set()
+                time.sleep(0.1)
+                # The abandoned call finishing later does not release the lease twice
+                self.assertEqual(give_back.call_count, 1)
+        finally:
+            release.set()
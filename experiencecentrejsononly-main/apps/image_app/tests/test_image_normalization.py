@@ -0,0 +1,117 @@
+import io
+import random
+import tempfile
+
+from django.contrib.auth import get_user_model
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import SimpleTestCase, override_settings
+from django.urls import reverse
+from PIL import Image
+from rest_framework.test import APITestCase
+
+from apps.image_app import extraction_cache, image_normalization, preprocessing
+from apps.image_app.models import Document
+
+
+def make_photo(width, height, colour=False, orientation=None, fmt="JPEG") -> bytes:
+    """A photo of black text on paper with sensor noise, optionally tinted and EXIF rotated."""
+    paper = Image.effect_noise((width, height), 10).point(lambda value: min(255, value + 100))
+    if colour:
+        image = Image.merge("RGB", (paper, paper.point(lambda value: value - 60), paper.point(lambda value: value - 120)))
+    else:
+        image = Image.merge("RGB", (paper, paper, paper))
+    rng = random.Random(0)
+    for _ in range(200):
+        x, y = rng.randrange(width - 40), rng.randrange(height - 8)
+        image.paste((20, 20, 20), (x, y, x + 40, y + 8))
+    exif = Image.Exif()
+    if orientation:
+        exif[0x0112] = orientation
+    buffer = io.BytesIO()
+    image.save(buffer, fmt, exif=exif.tobytes())
+    return buffer.getvalue()
+
+
+@override_settings(IMAGE_MAX_LONG_EDGE=1000)
+class ImageNormalizationTests(SimpleTestCase):
+    def test_exif_rotation_is_applied(self):
+        # Orientation 6: stored landscape, displayed portrait
+        result = image_normalization.normalize_image(make_photo(400, 200, orientation=6), "image/jpeg")
+
+        self.assertTrue(result.stats["rotated"])
+        self.assertEqual(Image.open(io.BytesIO(result.data)).size, (200, 400))
+
+    def test_large_image_is_downsized_and_uses_fewer_tokens(self):
+        data = make_photo(3000, 2000)
+        result = image_normalization.normalize_image(data, "image/jpeg")
+
+        self.assertEqual(result.stats["size"], [1000, 667])
+        self.assertTrue(result.stats["resized"])
+        self.assertLess(len(result.data), len(data))
+        self.assertEqual(result.stats["estimated_prompt_tokens_before"], 4 * 3 * 258)
+        self.assertEqual(result.stats["prompt_token_delta"], (2 * 1 - 4 * 3) * 258)
+
+    def test_colourless_image_becomes_grayscale(self):
+        result = image_normalization.normalize_image(make_photo(800, 600, fmt="PNG"), "image/png")
+
+        self.assertTrue(result.stats["grayscale"])
+        self.assertEqual(result.mime_type, "image/jpeg")
+        self.assertEqual(Image.open(io.BytesIO(result.data)).mode, "L")
+
+    def test_colour_image_stays_in_colour(self):
+        result = image_normalization.normalize_image(make_photo(800, 600, colour=True), "image/jpeg")
+        self.assertFalse(result.stats["grayscale"])
+
+    def test_original_is_kept_when_normalizing_does_not_help(self):
+        buffer = io.BytesIO()
+        Image.new("L", (50, 50), 255).save(buffer, "PNG")
+        data = buffer.getvalue()
+
+        result = image_normalization.normalize_image(data, "image/png")
+        self.assertIs(result.data, data)
+        self.assertEqual(result.mime_type, "image/png")
+        self.assertEqual(result.stats["bytes_saved"], 0)
+
+    def test_token_estimate(self):
+        self.assertEqual(image_normalization.estimate_image_tokens(384, 300), 258)
+        self.assertEqual(image_normalization.estimate_image_tokens(1536, 1000), 2 * 2 * 258)
+
+    def test_preprocessing_collects_stats_per_document(self):
+        with tempfile.NamedTemporaryFile(suffix=".jpg") as f:
+            f.write(make_photo(3000, 2000))
+            f.flush()
+            prepared, pages, total_pages, metadata = preprocessing.prepare_inputs([f.name, f.name])
+
+        self.assertEqual([item.mime_type for item in prepared], ["image/jpeg", "image/jpeg"])
+        self.assertEqual(metadata["image_normalization"]["images"], 2)
+        self.assertGreater(metadata["image_normalization"]["bytes_saved"], 0)
+
+    @override_settings(IMAGE_NORMALIZATION_ENABLED=False)
+    def test_can_be_disabled(self):
+        data = make_photo(3000, 2000)
+        with tempfile.NamedTemporaryFile(suffix=".jpg") as f:
+            f.write(data)
+            f.flush()
+            prepared = preprocessing.prepare_input(f.name)
+        self.assertEqual(prepared.data, data)
+
+
+@override_settings(
+    DATABASES={"default": {"ENGINE": "django.db.backends.sqlite3", "NAME": ":memory:"}},
+    MEDIA_ROOT=tempfile.mkdtemp(),
+)
+class NormalizedUploadTests(APITestCase):
+    def setUp(self):
+        extraction_cache.clear()
+        self.user = get_user_model().objects.create_user(username="photos", password="pass")
+        self.client.force_authenticate(user=self.user)
+
+    def test_upload_stores_processing_metadata(self):
+        upload = SimpleUploadedFile("receipt.jpg", make_photo(3000, 2000), content_type="image/jpeg")
+        response = self.client.post(reverse("upload_file"), {"pdf_file": upload, "doc_type": "docextraction"})
+
+        self.assertEqual(response.status_code, 200, response.content)
+        stats = Document.objects.get(userid=self.user).processing_metadata["image_normalization"]
+        self.assertEqual(stats["images"], 1)
+        self.assertGreater(stats["bytes_saved"], 0)
+        self.assertLess(stats["prompt_token_delta"], 0)
@@ -0,0 +1,202 @@
+import os
+import tempfile
+import threading
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import SimpleTestCase, override_settings
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APITestCase
+
+from apps.image_app import extraction_cache, memory_budget, metrics, preprocessing, resilience
+from apps.image_app.models import Document
+from apps.image_app.tests.test_extraction_backends import make_pdf
+from apps.image_app.tests.test_image_normalization import make_photo
+from apps.image_app.vertex_model import call_gemini_api_with_streaming, stream_gemini_api
+
+MB = memory_budget.MB
+
+
+def hold(estimated, release, held):
+    """Hold ``estimated`` bytes in a thread until ``release`` is set."""
+    def run():
+        with memory_budget.admit(estimated):
+            held.set()
+            release.wait(5)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    held.wait(5)
+    return thread
+
+
+class EstimateTests(SimpleTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write(self, name, data):
+        path = os.path.join(self.tmpdir.name, name)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def test_pdf_counts_the_pages_sent(self):
+        path = self.write("doc.pdf", make_pdf(6))
+        size = os.path.getsize(path)
+        self.assertEqual(memory_budget.estimate(path, 2), size * 2 // 6 * memory_budget.PAYLOAD_COPIES)
+        self.assertEqual(memory_budget.estimate(path, None), size * memory_budget.PAYLOAD_COPIES)
+
+    def test_image_counts_its_decoded_pixels(self):
+        path = self.write("receipt.jpg", make_photo(400, 300))
+        self.assertEqual(
+            memory_budget.estimate(path),
+            400 * 300 * memory_budget.BYTES_PER_PIXEL + os.path.getsize(path) * memory_budget.PAYLOAD_COPIES,
+        )
+
+    def test_text_and_lists(self):
+        self.assertEqual(memory_budget.estimate("abc"), 3 * memory_budget.PAYLOAD_COPIES)
+        self.assertEqual(memory_budget.estimate(["abc", {"a": 1}]), (3 + 8) * memory_budget.PAYLOAD_COPIES)
+        self.assertEqual(memory_budget.estimate(None), 0)
+
+
+@override_settings(MEMORY_BUDGET_MB=1, MEMORY_ADMISSION_TIMEOUT_SECONDS=5)
+class AdmissionTests(SimpleTestCase):
+    def setUp(self):
+        metrics.reset()
+        memory_budget.reset()
+        self.release = threading.Event()
+        self.addCleanup(self.release.set)
+
+    def test_request_above_the_budget_is_rejected(self):
+        with self.assertRaises(memory_budget.DocumentTooLargeError):
+            with memory_budget.admit(2 * MB):
+                pass
+        self.assertEqual(metrics.get_counter("memory.rejected"), 1)
+
+    def test_request_waits_until_memory_is_released(self):
+        holder = hold(MB * 3 // 4, self.release, threading.Event())
+        threading.Timer(0.2, self.release.set).start()
+        messages = []
+        with memory_budget.admit(MB // 2, on_wait=messages.append) as reservation:
+            self.assertEqual(memory_budget.status()["in_flight"], 1)
+        holder.join()
+
+        self.assertGreaterEqual(reservation.waited, 0.15)
+        self.assertEqual(len(messages), 1)
+        self.assertIn("Waiting for memory", messages[0])
+        self.assertEqual(memory_budget.status()["in_use_mb"], 0)
+
+    @override_settings(MEMORY_ADMISSION_TIMEOUT_SECONDS=0.1)
+    def test_wait_is_bounded(self):
+        holder = hold(MB * 3 // 4, self.release, threading.Event())
+        with self.assertRaises(memory_budget.MemoryBudgetTimeout):
+            with memory_budget.admit(MB // 2):
+                pass
+        self.release.set()
+        holder.join()
+        self.assertEqual(metrics.get_counter("memory.timeouts"), 1)
+
+    def test_cancelled_request_leaves_the_queue(self):
+        holder = hold(MB * 3 // 4, self.release, threading.Event())
+        token = resilience.CancelToken()
+        threading.Timer(0.1, token.cancel).start()
+        with self.assertRaises(resilience.CancelledError):
+            with memory_budget.admit(MB // 2, resilience.Deadline(None, token)):
+                pass
+        self.assertEqual(memory_budget.status()["waiting"], 0)
+        self.release.set()
+        holder.join()
+
+    def test_streamed_extraction_reports_the_wait_while_it_lasts(self):
+        path = os.path.join(tempfile.mkdtemp(), "doc.pdf")
+        with open(path, "wb") as f:
+            f.write(make_pdf(1))
+        holder = hold(MB, self.release, threading.Event())
+        reported = threading.Event()
+
+        def on_progress(message):
+            if "Waiting for memory" in message:
+                reported.set()
+
+        events = stream_gemini_api("Extract", input_data=path, max_pages=1, use_cache=False, progress_callback=on_progress)
+        consumer = threading.Thread(target=lambda: list(events))
+        consumer.start()
+        # Reported before the memory is released, not once the wait is over
+        self.assertTrue(reported.wait(5))
+        self.release.set()
+        consumer.join(5)
+        holder.join()
+
+    def test_nested_call_of_the_same_thread_does_not_wait(self):
+        with memory_budget.admit(MB * 3 // 4):
+            started = time.monotonic()
+            with memory_budget.admit(MB // 2) as nested:
+                self.assertLess(nested.waited, 0.05)
+                self.assertEqual(memory_budget.status()["in_flight"], 2)
+        self.assertLess(time.monotonic() - started, 0.1)
+
+    @override_settings(MEMORY_BUDGET_MB=0)
+    def test_peak_rss_is_recorded(self):
+        with memory_budget.admit(0) as reservation:
+            data = b"x" * (40 * MB)
+            time.sleep(0.2)
+            del data
+        report = reservation.report()
+
+        self.assertGreaterEqual(report["rss_growth_mb"], 30)
+        self.assertGreaterEqual(report["peak_rss_mb"], report["rss_growth_mb"])
+        self.assertEqual(metrics.observation_count("memory.peak_rss_mb"), 1)
+
+    def test_window_reports_keep_the_largest_peak(self):
+        merged = preprocessing.merge_metadata([
+            {"memory": {"estimated_mb": 1.0, "peak_rss_mb": 300.0, "rss_growth_mb": 20.0, "waited_seconds": 0.5}},
+            {"memory": {"estimated_mb": 2.0, "peak_rss_mb": 250.0, "rss_growth_mb": 40.0, "waited_seconds": 0.0}},
+        ])
+        self.assertEqual(merged["memory"], {
+            "estimated_mb": 3.0, "peak_rss_mb": 300.0, "rss_growth_mb": 40.0, "waited_seconds": 0.5,
+        })
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp(), EXTRACTION_CACHE_ENABLED=False)
+class MemoryBudgetUploadTests(APITestCase):
+    def setUp(self):
+        metrics.reset()
+        memory_budget.reset()
+        extraction_cache.clear()
+        self.user = get_user_model().objects.create_user(username="scanner", password="pass")
+        self.client.force_authenticate(user=self.user)
+
+    def upload(self):
+        upload = SimpleUploadedFile("scan.pdf", make_pdf(2), content_type="application/pdf")
+        return self.client.post(reverse("upload_file"), {"pdf_file": upload, "doc_type": "docextraction"})
+
+    def test_memory_use_is_stored_with_the_document(self):
+        response = self.upload()
+
+        self.assertEqual(response.status_code, 200, response.content)
+        memory = Document.objects.get(userid=self.user).processing_metadata["memory"]
+        self.assertEqual(sorted(memory), ["estimated_mb", "peak_rss_mb", "rss_growth_mb", "waited_seconds"])
+        self.assertIsNotNone(memory["peak_rss_mb"])
+        self.assertGreater(metrics.percentile("memory.estimated_mb", 50), 0)
+        # The token estimate, routing and admission share one page count
+        self.assertEqual(metrics.get_counter("pdf_slicing.page_counts"), 1)
+
+    @override_settings(MEMORY_BUDGET_MB=0.001)
+    def test_document_above_the_budget_is_rejected(self):
+        response = self.upload()
+
+        self.assertEqual(response.status_code, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, response.content)
+        self.assertIn("memory", response.json()["error"])
+        self.assertFalse(Document.objects.filter(userid=self.user).exists())
+
+    def test_direct_call_reports_memory(self):
+        path = os.path.join(tempfile.mkdtemp(), "doc.pdf")
+        with open(path, "wb") as f:
+            f.write(make_pdf(1))
+        response = call_gemini_api_with_streaming("Extract", input_data=path, max_pages=1, use_cache=False)
+        self.assertLess(response["preprocessing"]["memory"]["waited_seconds"], 0.05)
@@ -0,0 +1,137 @@
+import os
+import tempfile
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import SimpleTestCase, override_settings
+from django.urls import reverse
+from rest_framework.test import APITestCase
+
+from apps.image_app import extraction_cache, model_routing, resilience
+from apps.image_app.extraction_backends import FakeBackend, ResourceExhausted, ServiceUnavailable
+from apps.image_app.models import Document
+from apps.image_app.tests.test_extraction_backends import make_pdf
+from apps.image_app.vertex_model import call_gemini_api_with_streaming
+
+ROUTES = [
+    {"name": "receipts", "max_pages": 3, "doc_types": ["Bill Reimbursment"], "models": ["flash-lite"]},
+    {"name": "contracts", "min_pages": 50, "user_types": ["power", "admin"], "models": ["pro", "flash"]},
+    {"models": ["big-file"], "min_file_mb": 10},
+]
+
+
+@override_settings(MODEL_ROUTES=ROUTES, MODEL_FALLBACK_IDS=["flash"])
+class RouteSelectionTests(SimpleTestCase):
+    def test_first_matching_route_wins(self):
+        route = model_routing.select_route(2, 1000, "Bill Reimbursment", "default", "default-model")
+        self.assertEqual((route.name, route.models), ("receipts", ["flash-lite", "default-model", "flash"]))
+
+        route = model_routing.select_route(120, 1000, "docextraction", "power", "default-model")
+        self.assertEqual((route.name, route.models), ("contracts", ["pro", "flash", "default-model"]))
+
+        self.assertEqual(model_routing.select_route(1, 20 * 1024 * 1024, None, None, "default-model").name, "route_3")
+
+    def test_unmatched_requests_use_the_default_model(self):
+        route = model_routing.select_route(120, 1000, "docextraction", "default", "default-model")
+        self.assertEqual((route.name, route.models), ("default", ["default-model", "flash"]))
+
+    def test_route_key(self):
+        self.assertEqual(model_routing.Route("default", ["m"]).key, "m")
+        self.assertEqual(model_routing.Route("default", ["a", "b"]).key, "a|b")
+
+    @override_settings(MODEL_ROUTES='[{"name": "bad"}]')
+    def test_invalid_table(self):
+        with self.assertRaises(ImproperlyConfigured):
+            model_routing.routes()
+
+    def test_describe_input_counts_pages_to_send(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "doc.pdf")
+            with open(path, "wb") as f:
+                f.write(make_pdf(5))
+            self.assertEqual(model_routing.describe_input(path, 3), (3, os.path.getsize(path)))
+            self.assertEqual(model_routing.describe_input(path, None)[0], 5)
+
+
+def failing_for(*models, error=ResourceExhausted):
+    original = FakeBackend.generate
+
+    def generate(self, request, stream=False):
+        if request.model in models:
+            raise error(f"{request.model} is unavailable")
+        return original(self, request, stream=stream)
+
+    return mock.patch.object(FakeBackend, "generate", generate)
+
+
+@override_settings(
+    MODEL_ROUTES=[{"name": "chain", "models": ["primary", "secondary"]}],
+    RATE_LIMIT_QUOTA_COOLDOWN_SECONDS=0,
+)
+class FallbackTests(SimpleTestCase):
+    def setUp(self):
+        model_routing.reset()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "doc.pdf")
+        with open(self.path, "wb") as f:
+            f.write(make_pdf(2))
+
+    def tearDown(self):
+        model_routing.reset()
+        self.tmpdir.cleanup()
+
+    def extract(self):
+        return call_gemini_api_with_streaming("Extract", input_data=self.path, max_pages=2, use_cache=False, coalesce=False)
+
+    def test_rate_limited_primary_falls_back(self):
+        with failing_for("primary"):
+            response = self.extract()
+            self.assertEqual((response["modelUsed"], response["route"]), ("secondary", "chain"))
+            self.assertTrue(model_routing.is_rate_limited("primary"))
+
+            # New requests start on the fallback while the primary cools down
+            self.assertEqual(model_routing.select_model(model_routing.Route("chain", ["primary", "secondary"])), "secondary")
+
+    def test_failing_primary_falls_back(self):
+        with failing_for("primary", error=ServiceUnavailable):
+            response = self.extract()
+        self.assertEqual(response["modelUsed"], "secondary")
+        self.assertFalse(model_routing.is_rate_limited("primary"))
+
+    def test_open_circuit_is_skipped(self):
+        circuit = model_routing.circuit("primary")
+        for _ in range(circuit.failure_threshold):
+            circuit.record_failure()
+        try:
+            self.assertEqual(self.extract()["modelUsed"], "secondary")
+        finally:
+            circuit.record_success()
+
+    def test_all_circuits_open(self):
+        circuits = [model_routing.circuit(model) for model in ("primary", "secondary")]
+        for circuit in circuits:
+            for _ in range(circuit.failure_threshold):
+                circuit.record_failure()
+        try:
+            with self.assertRaises(resilience.CircuitOpenError):
+                self.extract()
+        finally:
+            for circuit in circuits:
+                circuit.record_success()
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp(), MODEL_ROUTES=[{"name": "short", "max_pages": 3, "models": ["flash-lite"]}])
+class RoutedUploadTests(APITestCase):
+    def setUp(self):
+        extraction_cache.clear()
+        self.user = get_user_model().objects.create_user(username="routing", password="pass")
+        self.client.force_authenticate(user=self.user)
+
+    def test_model_used_is_stored(self):
+        upload = SimpleUploadedFile("doc.pdf", make_pdf(2), content_type="application/pdf")
+        response = self.client.post(reverse("upload_file"), {"pdf_file": upload, "doc_type": "docextraction"})
+
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(Document.objects.get(userid=self.user).llm_model_used, "flash-lite")
@@ -0,0 +1,121 @@
+import json
+import os
+import tempfile
+from unittest import mock
+
+from django.test import SimpleTestCase, override_settings
+
+from apps.image_app import extraction_cache, output_salvage
+from apps.image_app.extraction_backends import FakeBackend
+from apps.image_app.json_stream import safe_json_load
+from apps.image_app.tests.test_extraction_backends import make_pdf
+from apps.image_app.vertex_model import call_gemini_api_with_streaming, stream_gemini_api
+
+PAGE_OUTPUT_TOKENS = 350
+
+
+class RepairTests(SimpleTestCase):
+    def test_valid_output_needs_no_repair(self):
+        self.assertEqual(output_salvage.repair('{"page_1": {"a": 1}}'), ({"page_1": {"a": 1}}, None))
+
+    def test_near_valid_output_is_cleaned(self):
+        text = 'Here is the result:\n```json\n{"page_1": {"items": [1, 2,],}, "note": "a, }",}\n```\nDone.'
+        self.assertEqual(
+            output_salvage.repair(text),
+            ({"page_1": {"items": [1, 2]}, "note": "a, }"}, output_salvage.CLEANED)
+        )
+
+    def test_truncated_output_keeps_complete_members(self):
+        text = '{"page_1": {"a": 1}, "page_2": {"b": [1, 2]}, "page_3": {"c": "cut o'
+        self.assertEqual(
+            output_salvage.repair(text),
+            ({"page_1": {"a": 1}, "page_2": {"b": [1, 2]}}, output_salvage.MEMBERS)
+        )
+
+    def test_unrecoverable_output(self):
+        self.assertEqual(output_salvage.repair("Sorry, I cannot help with that."), (None, None))
+        self.assertEqual(output_salvage.repair('{"page_1": {"a'), (None, None))
+
+    def test_missing_pages_are_filled_without_replacing_others(self):
+        parsed = {"page_1": {"a": 1}, "page_3": {}, "summary": "x"}
+        pages = output_salvage.expected_pages(4, [{"page": 2, "reason": "blank"}])
+        self.assertEqual(pages, [1, 3, 4])
+        self.assertEqual(output_salvage.missing_pages(parsed, pages), [3, 4])
+
+        merged = output_salvage.fill_pages(parsed, {"page_1": {"a": 2}, "page_3": {"c": 3}, "page_4": {"d": 4}}, [3, 4])
+        self.assertEqual(list(merged), ["page_1", "page_3", "page_4", "summary"])
+        self.assertEqual(merged["page_1"], {"a": 1})
+
+
+@override_settings(FAKE_BACKEND_OUTPUT_TOKENS_PER_PAGE=PAGE_OUTPUT_TOKENS)
+class SalvageTests(SimpleTestCase):
+    def setUp(self):
+        extraction_cache.clear()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "doc.pdf")
+        with open(self.path, "wb") as f:
+            f.write(make_pdf(4))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def extract(self):
+        # Half of the four pages fit in the output limit
+        return call_gemini_api_with_streaming(
+            "Extract", input_data=self.path, max_pages=4, max_output_tokens=2 * PAGE_OUTPUT_TOKENS,
+            use_cache=False, coalesce=False,
+        )
+
+    def pages_sent(self):
+        sent = []
+        original = FakeBackend.generate
+
+        def generate(backend, request, stream=False):
+            sent.append((request.pages_sent, request.continuation is not None))
+            return original(backend, request, stream=stream)
+
+        return sent, mock.patch.object(FakeBackend, "generate", generate)
+
+    def test_truncated_output_is_continued(self):
+        sent, patch = self.pages_sent()
+        with patch:
+            response = self.extract()
+
+        parsed = safe_json_load(response["candidates"][0]["content"]["parts"][0]["text"])
+        self.assertEqual(list(parsed), ["page_1", "page_2", "page_3", "page_4"])
+        self.assertEqual(sent, [(4, False), (4, True)])
+        self.assertEqual(response["candidates"][0]["finishReason"], "STOP")
+        self.assertEqual(response["usageMetadata"]["candidatesTokenCount"], 4 * PAGE_OUTPUT_TOKENS)
+        self.assertEqual(response["preprocessing"]["salvage"], {"continuations": 1})
+
+    @override_settings(OUTPUT_CONTINUATION_MAX_ROUNDS=0)
+    def test_only_missing_pages_are_extracted_again(self):
+        sent, patch = self.pages_sent()
+        with patch:
+            response = self.extract()
+
+        parsed = safe_json_load(response["candidates"][0]["content"]["parts"][0]["text"])
+        self.assertEqual(list(parsed), ["page_1", "page_2", "page_3", "page_4"])
+        self.assertEqual(parsed["page_4"]["page_info"], "page 4/4")
+        salvage = response["preprocessing"]["salvage"]
+        self.assertEqual(salvage["repaired"], 1)
+        # The first call completed some pages; only the rest were sent again
+        self.assertEqual(sent[0], (4, False))
+        self.assertEqual(sent[1], (salvage["pages_refilled"], False))
+        self.assertLess(salvage["pages_refilled"], 4)
+
+    @override_settings(OUTPUT_SALVAGE_ENABLED=False)
+    def test_disabled(self):
+        response = self.extract()
+        self.assertEqual(response["candidates"][0]["finishReason"], "MAX_TOKENS")
+        with self.assertRaises(json.JSONDecodeError):
+            safe_json_load(response["candidates"][0]["content"]["parts"][0]["text"])
+
+    def test_streamed_output_is_salvaged(self):
+        events = list(stream_gemini_api(
+            "Extract", input_data=self.path, max_pages=4, max_output_tokens=2 * PAGE_OUTPUT_TOKENS, use_cache=False
+        ))
+        response = events[-1]["response"]
+        parsed = safe_json_load(response["candidates"][0]["content"]["parts"][0]["text"])
+        self.assertEqual(len(parsed), 4)
+        self.assertEqual(response["preprocessing"]["salvage"], {"continuations": 1})
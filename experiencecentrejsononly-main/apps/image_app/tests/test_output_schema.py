@@ -0,0 +1,126 @@
+import json
+import tempfile
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import SimpleTestCase, override_settings
+from django.urls import reverse
+from rest_framework.test import APITestCase
+
+from apps.image_app import extraction_cache, metrics, output_schema, vertex_model
+from apps.image_app.extraction_backends import ExtractionRequest, FakeBackend, synthesize_text
+from apps.image_app.models import Document
+from apps.image_app.tests.test_image_normalization import make_photo
+from apps.image_app.views import get_prompt_for_doc_type, get_schema_for_doc_type
+
+SCHEMA = {
+    "type": "object",
+    "properties": {
+        "id": {"type": "integer"},
+        "status": {"type": "string", "enum": ["Allowed", "Not Allowed"]},
+        "items": {"type": "array", "items": {"type": "number"}},
+        "note": {"type": "string", "nullable": True},
+    },
+    "required": ["id", "status"],
+}
+
+
+class SchemaValidationTests(SimpleTestCase):
+    def test_valid_output(self):
+        self.assertEqual(output_schema.validate({"id": 1, "status": "Allowed", "items": [1, 2.5], "note": None}, SCHEMA), [])
+
+    def test_violations_name_their_path(self):
+        errors = output_schema.validate({"id": True, "status": "Maybe", "items": [1, "2"]}, SCHEMA)
+        self.assertEqual(errors, [
+            "$.id: expected integer, got bool",
+            "$.status: 'Maybe' is not one of ['Allowed', 'Not Allowed']",
+            "$.items[1]: expected number, got str",
+        ])
+        self.assertEqual(output_schema.validate({"status": "Allowed"}, SCHEMA), ["$.id: missing"])
+
+    def test_reimbursement_schema_matches_its_prompt(self):
+        schema = get_schema_for_doc_type("Bill Reimbursment")
+        self.assertEqual(schema["required"], ["expenses"])
+        self.assertIsNone(get_schema_for_doc_type("docextraction"))
+        self.assertIsNone(get_schema_for_doc_type("Bill Reimbursment", "Custom prompt"))
+
+        request = ExtractionRequest(get_prompt_for_doc_type("Bill Reimbursment"), None, 3, {}, "Bill Reimbursment")
+        self.assertEqual(output_schema.validate(json.loads(synthesize_text(request)), schema), [])
+
+    @override_settings(REIMBURSEMENT_LOCAL_AGGREGATES=False)
+    def test_full_reimbursement_schema_matches_its_prompt(self):
+        schema = get_schema_for_doc_type("Bill Reimbursment")
+        self.assertEqual(schema["required"], ["expenses", "allowed", "not_allowed", "summary"])
+
+        request = ExtractionRequest(get_prompt_for_doc_type("Bill Reimbursment"), None, 3, {}, "Bill Reimbursment")
+        self.assertEqual(output_schema.validate(json.loads(synthesize_text(request)), schema), [])
+
+    @override_settings(STRUCTURED_OUTPUT_ENABLED=False)
+    def test_disabled(self):
+        self.assertIsNone(get_schema_for_doc_type("Bill Reimbursment"))
+
+    def test_schema_is_part_of_the_request_key(self):
+        route = vertex_model.model_routing.Route("default", ["model"])
+        args = ("Extract", "text", 3, 0.9, 1.0, 32, 1024, "application/json", route)
+        self.assertNotIn("response_schema", vertex_model._generation_params(0.9, 1.0, 32, 1024, "application/json"))
+        self.assertEqual(vertex_model._request_key(*args), vertex_model._request_key(*args, None))
+        self.assertNotEqual(vertex_model._request_key(*args), vertex_model._request_key(*args, SCHEMA))
+
+
+class ParseOutcomeTests(SimpleTestCase):
+    def setUp(self):
+        metrics.reset()
+
+    def tearDown(self):
+        metrics.reset()
+
+    def test_outcomes_are_counted_per_doc_type_and_mode(self):
+        output_schema.parse_output('{"id": 1, "status": "Allowed"}', "receipts", SCHEMA)
+        output_schema.parse_output('{"id": "one", "status": "Allowed"}', "receipts", SCHEMA)
+        output_schema.parse_output('```json\n{"page_1": {}}\n```', "invoices")
+        with self.assertRaises(ValueError):
+            output_schema.parse_output('{"page_1": {', "invoices")
+
+        self.assertEqual(output_schema.failure_rates(), {
+            "receipts": {"schema": {"attempts": 2, "failures": 1, "failure_rate": 0.5}},
+            "invoices": {"free": {"attempts": 2, "failures": 1, "failure_rate": 0.5}},
+        })
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class StructuredUploadTests(APITestCase):
+    def setUp(self):
+        extraction_cache.clear()
+        self.user = get_user_model().objects.create_user(username="schemas", password="pass")
+        self.client.force_authenticate(user=self.user)
+
+    def upload(self):
+        upload = SimpleUploadedFile("receipt.jpg", make_photo(400, 600), content_type="image/jpeg")
+        return self.client.post(reverse("upload_file"), {"pdf_file": upload, "doc_type": "Bill Reimbursment"})
+
+    def test_schema_is_sent_and_output_counted(self):
+        attempts = metrics.get_counter("parsing.schema.attempts.Bill Reimbursment")
+        original = FakeBackend.generate
+        sent = []
+
+        def generate(backend, request, stream=False):
+            sent.append(request.generation_params.get("response_schema"))
+            return original(backend, request, stream=stream)
+
+        with mock.patch.object(FakeBackend, "generate", generate):
+            response = self.upload()
+
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(sent, [get_schema_for_doc_type("Bill Reimbursment")])
+        self.assertEqual(metrics.get_counter("parsing.schema.attempts.Bill Reimbursment") - attempts, 1)
+        self.assertEqual(Document.objects.get(userid=self.user).json_data["expenses"][0]["document"], 1)
+
+    def test_output_off_schema_is_not_cached(self):
+        with mock.patch("apps.image_app.extraction_backends.synthesize_text", return_value='{"expenses": "none"}'):
+            failures = metrics.get_counter("parsing.schema.failures.Bill Reimbursment")
+            response = self.upload()
+
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(metrics.get_counter("parsing.schema.failures.Bill Reimbursment") - failures, 1)
+        self.assertEqual(extraction_cache.stats()["entries"], 0)
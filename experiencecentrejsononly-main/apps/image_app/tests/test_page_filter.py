@@ -0,0 +1,101 @@
+import io
+import json
+import os
+import random
+import tempfile
+
+from django.test import SimpleTestCase, override_settings
+from PIL import Image, ImageDraw
+from PyPDF2 import PdfReader
+
+from apps.image_app import page_filter, page_windows, pdf_slicing, preprocessing
+from apps.image_app.tests.test_text_layer import make_text_pdf
+from apps.image_app.vertex_model import call_gemini_api_with_streaming
+
+
+def scan(layout=None) -> Image.Image:
+    """A scanned sheet: noisy paper, with dark blocks placed by ``layout`` (None for a blank sheet)."""
+    image = Image.effect_noise((850, 1100), 12).point(lambda value: min(255, value + 110)).convert("RGB")
+    if layout is not None:
+        rng = random.Random(layout)
+        draw = ImageDraw.Draw(image)
+        for _ in range(12):
+            x, y = rng.randrange(50, 500), rng.randrange(50, 1000)
+            draw.rectangle((x, y, x + rng.randrange(100, 300), y + rng.randrange(10, 60)), fill=(10, 10, 10))
+    return image
+
+
+def make_scan_pdf(layouts) -> bytes:
+    pages = [scan(layout) for layout in layouts]
+    buffer = io.BytesIO()
+    pages[0].save(buffer, "PDF", save_all=True, append_images=pages[1:], resolution=100)
+    return buffer.getvalue()
+
+
+class PageFilterTests(SimpleTestCase):
+    def test_blank_and_rescanned_pages_are_skipped(self):
+        # Page 3 is a second scan of page 1: same layout, different sensor noise
+        with pdf_slicing.PdfDocument(make_scan_pdf([1, None, 1, 2])) as document:
+            kept, skipped = page_filter.filter_pages(document, [0, 1, 2, 3])
+
+        self.assertEqual(kept, [0, 3])
+        self.assertEqual(skipped, [
+            {"page": 2, "reason": "blank"},
+            {"page": 3, "reason": "duplicate", "duplicateOf": 1},
+        ])
+
+    def test_text_pages_are_compared_by_text(self):
+        data = make_text_pdf([["Invoice 1"], [], ["Invoice  1"], ["Invoice 2"]])
+        with pdf_slicing.PdfDocument(data) as document:
+            kept, skipped = page_filter.filter_pages(document, [0, 1, 2, 3])
+
+        self.assertEqual(kept, [0, 3])
+        self.assertEqual([page["reason"] for page in skipped], ["blank", "duplicate"])
+
+    def test_an_all_blank_document_keeps_its_first_page(self):
+        with pdf_slicing.PdfDocument(make_text_pdf([None, None])) as document:
+            kept, skipped = page_filter.filter_pages(document, [0, 1])
+
+        self.assertEqual(kept, [0])
+        self.assertEqual(skipped, [{"page": 2, "reason": "blank"}])
+
+    def test_only_kept_pages_are_sent(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "batch.pdf")
+            with open(path, "wb") as f:
+                f.write(make_scan_pdf([1, None, 2, 2, 3]))
+            prepared, pages, _, metadata = preprocessing.prepare_inputs(path, max_pages=4)
+
+        self.assertEqual(pages, 4)
+        self.assertEqual(len(PdfReader(io.BytesIO(prepared[0].data)).pages), 2)
+        self.assertEqual(metadata["page_mapping"], [1, 3])
+
+    def test_remap_pages(self):
+        output = {"page_1": {"page_info": "page 1/2"}, "page_2": {"page_info": "page 2/2"}, "summary": "x"}
+        self.assertEqual(page_windows.remap_pages(output, [1, 4], 5), {
+            "page_1": {"page_info": "page 1/5"},
+            "page_4": {"page_info": "page 4/5"},
+            "summary": "x",
+        })
+
+    def test_output_keeps_original_page_numbers(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "batch.pdf")
+            with open(path, "wb") as f:
+                f.write(make_scan_pdf([1, None, 2, 1]))
+            response = call_gemini_api_with_streaming("Extract", input_data=path, max_pages=4, use_cache=False)
+
+        output = json.loads(response["candidates"][0]["content"]["parts"][0]["text"])
+        self.assertEqual(list(output), ["page_1", "page_3"])
+        self.assertEqual(output["page_3"]["page_info"], "page 3/4")
+        self.assertEqual([page["page"] for page in response["pagesSkipped"]], [2, 4])
+        self.assertEqual(response["pagesProcessed"], 4)
+
+    @override_settings(PAGE_FILTER_ENABLED=False)
+    def test_can_be_disabled(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "batch.pdf")
+            with open(path, "wb") as f:
+                f.write(make_scan_pdf([1, None]))
+            _, _, _, metadata = preprocessing.prepare_inputs(path)
+        self.assertNotIn("pages_skipped", metadata)
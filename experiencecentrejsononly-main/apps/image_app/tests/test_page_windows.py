@@ -0,0 +1,120 @@
+import os
+import tempfile
+from unittest import mock
+
+from django.test import SimpleTestCase, override_settings
+
+from apps.image_app import extraction_cache, memory_budget, metrics, page_windows, rate_limiter
+from apps.image_app.extraction_backends import FakeBackend
+from apps.image_app.tests.test_extraction_backends import make_pdf
+from apps.image_app.vertex_model import call_gemini_api_windowed
+
+
+class PageWindowMergeTests(SimpleTestCase):
+    def test_split_page_ranges_covers_every_page(self):
+        self.assertEqual(page_windows.split_page_ranges(23, 10), [(0, 10), (10, 20), (20, 23)])
+        self.assertEqual(page_windows.split_page_ranges(3, 10), [(0, 3)])
+
+    def test_windows_are_merged_with_global_page_numbers(self):
+        first = {
+            "page_1": {"page_info": "page 1/2", "metadata": {"invoice": "A"}},
+            "page_2": {"page_info": "page 2/2"},
+            "notes": ["first"],
+        }
+        second = {
+            "page_1": {"page_info": "page 1/1", "content": "tail"},
+            "notes": ["second"],
+        }
+        merged = page_windows.merge_window_results([(2, second), (0, first)], total_pages=3)
+
+        self.assertEqual(list(merged), ["page_1", "page_2", "page_3", "notes"])
+        self.assertEqual(merged["page_3"], {"page_info": "page 3/3", "content": "tail"})
+        self.assertEqual(merged["page_1"]["page_info"], "page 1/3")
+        self.assertEqual(merged["notes"], ["first", "second"])
+
+    def test_usage_metadata_is_summed(self):
+        usage = page_windows.sum_usage_metadata([
+            {"usageMetadata": {"promptTokenCount": 10, "candidatesTokenCount": 2, "totalTokenCount": 12}},
+            {"usageMetadata": {"promptTokenCount": 5, "candidatesTokenCount": 1, "totalTokenCount": 6}},
+            {},
+        ])
+        self.assertEqual(usage, {"promptTokenCount": 15, "candidatesTokenCount": 3, "totalTokenCount": 18})
+
+
+@override_settings(
+    PAGE_WINDOW_SIZE=10,
+    PAGE_WINDOW_MIN_SIZE=2,
+    PAGE_WINDOW_MAX_SIZE=25,
+    PAGE_WINDOW_MAX_WORKERS=4,
+    PAGE_WINDOW_TARGET_SECONDS=30,
+)
+class AdaptiveWindowControllerTests(SimpleTestCase):
+    def setUp(self):
+        self.controller = page_windows.AdaptiveWindowController()
+
+    def test_window_size_follows_observed_seconds_per_page(self):
+        self.assertEqual(self.controller.window_size(), 10)
+        self.controller.record(pages=10, latency=60)  # 6 s/page -> 5 pages per 30 s
+        self.assertEqual(self.controller.window_size(), 5)
+        fast = page_windows.AdaptiveWindowController()
+        fast.record(pages=10, latency=5)
+        self.assertEqual(fast.window_size(), 25)
+
+    def test_concurrency_halves_on_slow_windows_and_recovers(self):
+        self.assertEqual(self.controller.concurrency(), 4)
+        self.controller.record(pages=10, latency=100)
+        self.assertEqual(self.controller.concurrency(), 2)
+        self.controller.record(pages=10, latency=0, ok=False)
+        self.assertEqual(self.controller.concurrency(), 1)
+        self.controller.record(pages=5, latency=10)
+        self.controller.record(pages=5, latency=10)
+        self.assertEqual(self.controller.concurrency(), 3)
+
+
+@override_settings(FAKE_BACKEND_LATENCY="fixed:5", PAGE_WINDOW_MAX_WORKERS=4)
+class WindowedExtractionTests(SimpleTestCase):
+    def setUp(self):
+        metrics.reset()
+        extraction_cache.clear()
+        # Earlier tests may have used up the rate limiter budget or the memory budget
+        rate_limiter.reset()
+        memory_budget.reset()
+        # Slow or failed windows of earlier tests would lower the concurrency
+        page_windows.controller.reset()
+        self.addCleanup(page_windows.controller.reset)
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "doc.pdf")
+        with open(self.path, "wb") as f:
+            f.write(make_pdf(8))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def extract(self):
+        return call_gemini_api_windowed("Extract", self.path, window_size=2, max_workers=4)
+
+    def test_failed_window_cancels_the_running_windows(self):
+        original = FakeBackend.generate
+        calls = []
+
+        def generate(self, request, stream=False):
+            calls.append(os.path.basename(request.input_data))
+            if calls[-1].startswith("pages_1_"):
+                raise ValueError("unreadable window")
+            return original(self, request, stream=stream)
+
+        with mock.patch.object(FakeBackend, "generate", generate):
+            with self.assertRaises(Exception):
+                self.extract()
+        # The other windows were cancelled instead of being answered or retried
+        self.assertEqual(metrics.get_counter("cancellations.sibling_failed"), 3)
+        self.assertEqual(len(calls), len(set(calls)))
+
+    @override_settings(FAKE_BACKEND_LATENCY="fixed:0", EXTRACTION_CACHE_ENABLED=True)
+    def test_cached_windows_are_not_recorded(self):
+        with mock.patch.object(page_windows.controller, "record") as record:
+            self.extract()
+            self.assertEqual(record.call_count, 4)
+            response = self.extract()
+        self.assertTrue(all(window["cacheHit"] for window in response["windows"]))
+        self.assertEqual(record.call_count, 4)
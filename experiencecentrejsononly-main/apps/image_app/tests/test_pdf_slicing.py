@@ -0,0 +1,74 @@
+import io
+import mmap
+import os
+import tempfile
+
+from django.test import SimpleTestCase
+from PyPDF2 import PdfReader, PdfWriter
+
+from apps.image_app import metrics, pdf_slicing
+
+
+def make_pdf(pages: int) -> bytes:
+    writer = PdfWriter()
+    for index in range(pages):
+        writer.add_blank_page(width=100 + index, height=100)
+    buffer = io.BytesIO()
+    writer.write(buffer)
+    return buffer.getvalue()
+
+
+def page_widths(data: bytes):
+    return [int(page.mediabox.width) for page in PdfReader(io.BytesIO(data)).pages]
+
+
+class PdfSlicingTests(SimpleTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "doc.pdf")
+        self.data = make_pdf(6)
+        with open(self.path, "wb") as f:
+            f.write(self.data)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_slices_come_from_one_parse(self):
+        with pdf_slicing.PdfDocument(self.path) as document:
+            self.assertEqual(document.page_count, 6)
+            self.assertEqual(page_widths(document.head(2)), [100, 101])
+            self.assertEqual(page_widths(document.slice(3, 5)), [103, 104])
+
+    def test_whole_document_is_passed_through(self):
+        with pdf_slicing.PdfDocument(self.path) as document:
+            self.assertEqual(document.head(None), self.data)
+            self.assertEqual(document.head(10), self.data)
+
+    def test_no_files_are_written_next_to_the_upload(self):
+        with pdf_slicing.PdfDocument(self.path) as document:
+            document.head(3)
+        self.assertEqual(os.listdir(self.tmpdir.name), ["doc.pdf"])
+
+    def test_file_is_memory_mapped(self):
+        document = pdf_slicing.PdfDocument(self.path)
+        self.assertIsInstance(document._stream, mmap.mmap)
+        self.assertEqual(document.read(), self.data)
+        document.close()
+        self.assertTrue(document._stream.closed)
+
+    def test_bytes_source_and_page_count(self):
+        with pdf_slicing.PdfDocument(self.data) as document:
+            self.assertEqual(page_widths(document.head(1)), [100])
+        self.assertEqual(pdf_slicing.page_count(self.path), 6)
+
+    def test_page_count_is_remembered_until_the_file_changes(self):
+        metrics.reset()
+        for _ in range(3):
+            self.assertEqual(pdf_slicing.page_count(self.path), 6)
+        self.assertEqual(metrics.get_counter("pdf_slicing.page_counts"), 1)
+
+        stat = os.stat(self.path)
+        with open(self.path, "wb") as f:
+            f.write(make_pdf(2))
+        os.utime(self.path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+        self.assertEqual(pdf_slicing.page_count(self.path), 2)
@@ -0,0 +1,83 @@
+import io
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from unittest import mock
+
+from django.test import SimpleTestCase, override_settings
+from PIL import Image
+
+from apps.image_app import metrics, pdf_slicing, preprocessing, preprocessing_pool
+from apps.image_app.management.commands.benchmark_pdf_slicing import make_scanned_pdf
+from apps.image_app.tests.test_image_normalization import make_photo
+
+
+@override_settings(PREPROCESSING_POOL_WORKERS=1, PREPROCESSING_POOL_MIN_KB=1)
+class PreprocessingPoolTests(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.tmpdir = tempfile.TemporaryDirectory()
+        cls.pdf = os.path.join(cls.tmpdir.name, "scan.pdf")
+        make_scanned_pdf(cls.pdf, 4)
+        cls.photo = os.path.join(cls.tmpdir.name, "receipt.jpg")
+        with open(cls.photo, "wb") as f:
+            f.write(make_photo(1600, 1200))
+
+    @classmethod
+    def tearDownClass(cls):
+        preprocessing_pool.reset()
+        cls.tmpdir.cleanup()
+        super().tearDownClass()
+
+    def setUp(self):
+        metrics.reset()
+
+    def test_pdf_is_prepared_in_the_pool_like_inline(self):
+        metadata = {}
+        prepared = preprocessing.prepare_input(self.pdf, 2, metadata)
+        inline_metadata = {}
+        inline = preprocessing._read_file(self.pdf, 2, inline_metadata, True)
+
+        self.assertEqual(prepared.data, inline.data)
+        self.assertEqual((prepared.mime_type, prepared.pages, prepared.total_pages), ("application/pdf", 2, 4))
+        self.assertEqual(metadata, inline_metadata)
+        self.assertEqual(metrics.get_counter("preprocessing_pool.tasks"), 1)
+        self.assertEqual(metrics.get_counter("preprocessing_pool.bytes_shared"), len(prepared.data))
+        # The worker's counters are added to this process's
+        self.assertEqual(metrics.get_counter("pdf_slicing.slices"), 2)
+        self.assertTrue(preprocessing_pool.status()["started"])
+
+    @override_settings(IMAGE_MAX_LONG_EDGE=400)
+    def test_worker_applies_the_current_settings(self):
+        metadata = {}
+        prepared = preprocessing.prepare_input(self.photo, None, metadata)
+
+        self.assertEqual(max(Image.open(io.BytesIO(prepared.data)).size), 400)
+        self.assertEqual(metadata["image_normalization"]["resized"], 1)
+        self.assertEqual(metrics.get_counter("image_normalization.images"), 1)
+
+    def test_large_pdf_pages_are_counted_in_the_pool(self):
+        self.assertEqual(pdf_slicing.page_count(self.pdf), 4)
+        self.assertEqual(metrics.get_counter("preprocessing_pool.page_counts"), 1)
+        self.assertEqual(preprocessing_pool.status()["page_counts"], 1)
+
+    def test_small_and_unsupported_files_stay_in_the_request_thread(self):
+        text = os.path.join(self.tmpdir.name, "notes.txt")
+        with open(text, "w") as f:
+            f.write("x" * 4096)
+        self.assertFalse(preprocessing_pool.should_offload(text))
+        self.assertTrue(preprocessing_pool.should_offload(self.pdf))
+        with override_settings(PREPROCESSING_POOL_MIN_KB=100000):
+            self.assertFalse(preprocessing_pool.should_offload(self.pdf))
+        with override_settings(PREPROCESSING_POOL_WORKERS=0):
+            self.assertFalse(preprocessing_pool.should_offload(self.pdf))
+
+    def test_broken_pool_falls_back_to_the_request_thread(self):
+        with mock.patch.object(ProcessPoolExecutor, "submit", side_effect=BrokenProcessPool("worker killed")):
+            prepared = preprocessing.prepare_input(self.pdf, 1, {})
+
+        self.assertEqual(prepared.pages, 1)
+        self.assertEqual(metrics.get_counter("preprocessing_pool.fallbacks"), 1)
+        self.assertFalse(preprocessing_pool.status()["started"])
@@ -0,0 +1,160 @@
+import os
+import tempfile
+import threading
+import time
+
+from django.core.exceptions import ImproperlyConfigured
+from django.test import SimpleTestCase, override_settings
+
+from apps.image_app import metrics, rate_limiter
+
+TIERS = {
+    "default": {"weight": 1, "max_concurrency": 2, "max_per_user": 1},
+    "power": {"weight": 3, "max_concurrency": 4, "max_per_user": 4},
+}
+
+
+class RateLimiterTests(SimpleTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.override = override_settings(
+            RATE_LIMIT_ENABLED=True,
+            RATE_LIMIT_STATE_PATH=os.path.join(self.tmpdir.name, "limiter.sqlite3"),
+            VERTEX_REQUESTS_PER_MINUTE=600,
+            VERTEX_TOKENS_PER_MINUTE=6000,
+            VERTEX_MAX_CONCURRENCY=4,
+            VERTEX_MIN_CONCURRENCY=1,
+            RATE_LIMIT_QUOTA_COOLDOWN_SECONDS=0.5,
+        )
+        self.override.enable()
+
+    def tearDown(self):
+        self.override.disable()
+        self.tmpdir.cleanup()
+
+    def test_token_budget_is_consumed_and_reconciled(self):
+        lease = rate_limiter.acquire(5000)
+        self.assertLessEqual(rate_limiter.status()["tokens_available"], 1000)
+        rate_limiter.release(lease, actual_tokens=1000)
+        self.assertGreaterEqual(rate_limiter.status()["tokens_available"], 5000)
+
+    def test_waits_instead_of_exceeding_token_budget(self):
+        lease = rate_limiter.acquire(6000)
+        with self.assertRaises(rate_limiter.RateLimitTimeout):
+            rate_limiter.acquire(6000, max_wait=0.1)
+        rate_limiter.release(lease)
+
+    def test_concurrency_limit_blocks_extra_callers(self):
+        leases = [rate_limiter.acquire(10) for _ in range(4)]
+        self.assertEqual(rate_limiter.status()["inflight"], 4)
+        with self.assertRaises(rate_limiter.RateLimitTimeout):
+            rate_limiter.acquire(10, max_wait=0.1)
+        rate_limiter.release(leases.pop())
+        leases.append(rate_limiter.acquire(10, max_wait=2))
+        for lease in leases:
+            rate_limiter.release(lease)
+
+    def test_quota_error_halves_concurrency_and_cools_down(self):
+        lease = rate_limiter.acquire(10)
+        rate_limiter.release(lease, outcome="quota")
+        state = rate_limiter.status()
+        self.assertEqual(state["concurrency_limit"], 2)
+        self.assertTrue(state["cooling_down"])
+
+        started = time.time()
+        lease = rate_limiter.acquire(10, max_wait=5)
+        self.assertGreaterEqual(time.time() - started, 0.3)
+        rate_limiter.release(lease, outcome="success")
+        self.assertGreater(rate_limiter.status()["concurrency_limit"], 2)
+
+    def test_waiters_are_told_their_queue_position(self):
+        leases = [rate_limiter.acquire(10) for _ in range(4)]
+        messages = []
+        waiter = threading.Thread(target=lambda: rate_limiter.release(
+            rate_limiter.acquire(10, on_wait=messages.append, max_wait=5)
+        ))
+        waiter.start()
+        time.sleep(0.4)
+        for lease in leases:
+            rate_limiter.release(lease)
+        waiter.join(5)
+        self.assertIn("Waiting for AI capacity (queue position 1)...", messages)
+
+
+class FairOrderTests(SimpleTestCase):
+    def test_light_user_goes_before_a_busy_one(self):
+        leases = [("power", "1")] * 3
+        waiters = [(1, "power", "1"), (2, "default", "2"), (3, "power", "3")]
+        order, capped = rate_limiter.fair_order(waiters, leases, TIERS)
+        # Shares: user 1 (3 + 1) / 3, user 2 1 / 1, user 3 1 / 3
+        self.assertEqual((order, capped), ([3, 2, 1], {}))
+
+    def test_capped_waiters_come_last(self):
+        leases = [("default", "1")] + [("power", "2")] * 4
+        waiters = [(1, "default", "1"), (2, "power", "5"), (3, "default", "6"), (4, "system", None)]
+        order, capped = rate_limiter.fair_order(waiters, leases, TIERS)
+        self.assertEqual(order, [3, 4, 2, 1])
+        self.assertEqual(capped, {1: rate_limiter.CAPPED_BY_USER, 2: rate_limiter.CAPPED_BY_TIER})
+
+    def test_invalid_policies_are_rejected(self):
+        for value in ("{not json", '{"power": {"weight": 0}}', "[1]"):
+            with override_settings(TIER_CONCURRENCY=value), self.assertRaises(ImproperlyConfigured):
+                rate_limiter.tier_policies()
+
+
+class TierSlotTests(SimpleTestCase):
+    def setUp(self):
+        metrics.reset()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.override = override_settings(
+            RATE_LIMIT_ENABLED=True,
+            RATE_LIMIT_STATE_PATH=os.path.join(self.tmpdir.name, "limiter.sqlite3"),
+            VERTEX_REQUESTS_PER_MINUTE=600,
+            VERTEX_MAX_CONCURRENCY=8,
+            TIER_CONCURRENCY=TIERS,
+        )
+        self.override.enable()
+
+    def tearDown(self):
+        self.override.disable()
+        self.tmpdir.cleanup()
+
+    def test_user_waits_for_their_own_calls(self):
+        lease = rate_limiter.acquire(10, requester=rate_limiter.Requester("default", 1))
+        messages = []
+        with self.assertRaises(rate_limiter.RateLimitTimeout):
+            rate_limiter.acquire(10, on_wait=messages.append, max_wait=0.1, requester=rate_limiter.Requester("default", 1))
+        self.assertEqual(messages, ["Waiting for your other documents to finish (queue position 1)..."])
+        self.assertEqual(metrics.get_counter("rate_limiter.tiers.default.capped_by_user"), 1)
+
+        other = rate_limiter.acquire(10, max_wait=0.1, requester=rate_limiter.Requester("default", 2))
+        tiers = rate_limiter.status()["tiers"]
+        self.assertEqual((tiers["default"]["inflight"], tiers["default"]["active_users"]), (2, 2))
+        self.assertEqual(tiers["default"]["granted"], 2)
+        for held in (lease, other):
+            rate_limiter.release(held)
+
+    @override_settings(VERTEX_MAX_CONCURRENCY=3)
+    def test_busy_user_is_overtaken_when_a_slot_frees_up(self):
+        leases = [rate_limiter.acquire(10, requester=rate_limiter.Requester("power", 1)) for _ in range(3)]
+        granted = []
+
+        def wait_for_slot(requester):
+            lease = rate_limiter.acquire(10, max_wait=5, requester=requester)
+            granted.append(requester.user_key)
+            rate_limiter.release(lease)
+
+        busy = threading.Thread(target=wait_for_slot, args=(rate_limiter.Requester("power", 1),))
+        busy.start()
+        time.sleep(0.3)
+        light = threading.Thread(target=wait_for_slot, args=(rate_limiter.Requester("power", 2),))
+        light.start()
+        time.sleep(0.3)
+        rate_limiter.release(leases.pop())
+        for thread in (busy, light):
+            thread.join(5)
+        for lease in leases:
+            rate_limiter.release(lease)
+
+        self.assertEqual(granted, ["2", "1"])
+        self.assertEqual(metrics.get_counter("rate_limiter.fair_share_overtakes"), 1)
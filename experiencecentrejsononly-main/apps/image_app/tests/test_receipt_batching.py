@@ -0,0 +1,153 @@
+import os
+import tempfile
+from unittest import mock
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import SimpleTestCase, override_settings
+from django.urls import reverse
+from rest_framework.test import APITestCase
+
+from apps.image_app import extraction_cache, metrics, rate_limiter, receipt_batching, resilience
+from apps.image_app.extraction_backends import FakeBackend
+from apps.image_app.models import Document
+from apps.image_app.tests.test_image_normalization import make_photo
+from apps.image_app.tests.test_extraction_backends import make_pdf
+
+
+class BatchPlanningTests(SimpleTestCase):
+    @override_settings(RECEIPT_BATCH_MAX_DOCUMENTS=3, RECEIPT_BATCH_MAX_REQUEST_MB=1, RECEIPT_BATCH_MAX_OUTPUT_TOKENS=1000)
+    def test_batches_respect_every_limit(self):
+        small = (1, 100 * 1024)
+        self.assertEqual(receipt_batching.plan_batches([small] * 7), [[0, 1, 2], [3, 4, 5], [6]])
+        # 600 KB each: two do not fit in 1 MB
+        self.assertEqual(receipt_batching.plan_batches([(1, 600 * 1024)] * 3), [[0], [1], [2]])
+        # A 3-page document expects 600 output tokens, so only one fits next to it
+        self.assertEqual(receipt_batching.plan_batches([(3, 1024), (1, 1024), (3, 1024)]), [[0, 1], [2]])
+
+    def test_oversized_document_is_sent_alone(self):
+        self.assertEqual(receipt_batching.plan_batches([(1, 10), (200, 10), (1, 10)]), [[0], [1], [2]])
+
+    def test_batch_input_marks_documents(self):
+        self.assertEqual(receipt_batching.batch_input(["a.jpg", "b.pdf"]), [
+            "--- Document 1 ---", "a.jpg", "--- Document 2 ---", "b.pdf",
+        ])
+        self.assertIn("2 attached documents", receipt_batching.batch_prompt("Extract", 2))
+        self.assertEqual(receipt_batching.batch_prompt("Extract", 1), "Extract")
+
+    def test_split_expenses(self):
+        parsed = {"expenses": [
+            {"document": 1, "amount_inr": "10"},
+            {"document": "Document 2", "amount_inr": "20"},
+            {"document": 2, "amount_inr": "5"},
+            {"document": 9, "amount_inr": "1"},
+        ]}
+        per_document, unassigned = receipt_batching.split_expenses(parsed, 3)
+        self.assertEqual([len(expenses) for expenses in per_document], [1, 2, 0])
+        self.assertEqual(unassigned, [{"document": 9, "amount_inr": "1"}])
+
+    def test_merge_results_renumbers_and_sums(self):
+        first = {
+            "expenses": [
+                {"document": 1, "status": "Allowed", "amount_inr": "₹1,200.50"},
+                {"document": 2, "status": "Not Allowed", "amount_inr": "300"},
+            ],
+            "allowed": {"items": [1], "total_inr": "₹1,200.50"},
+            "not_allowed": {"items": [2], "total_inr": "300"},
+            "summary": {"total_documents": "2", "total_amount": "1500.50", "reimbursable_amount": "1200.50"},
+        }
+        second = {
+            "expenses": [{"document": 1, "status": "Allowed", "amount_inr": "99.50"}],
+            "allowed": {"items": [1], "total_inr": "99.50"},
+            "not_allowed": {"items": [], "total_inr": "0"},
+            "summary": {"total_documents": "1", "total_amount": "99.50", "reimbursable_amount": "99.50"},
+        }
+        merged = receipt_batching.merge_results([([0, 1], first), ([2], second)], 3)
+
+        self.assertEqual([expense["document"] for expense in merged["expenses"]], [1, 2, 3])
+        self.assertEqual(merged["allowed"], {"items": [1, 3], "total_inr": "1300.00"})
+        self.assertEqual(merged["not_allowed"], {"items": [2], "total_inr": "300.00"})
+        self.assertEqual(merged["summary"], {"total_documents": "3", "total_amount": "1600.00", "reimbursable_amount": "1300.00"})
+
+    def test_split_usage(self):
+        shares = receipt_batching.split_usage({"promptTokenCount": 1000, "candidatesTokenCount": 301}, [1, 3])
+        self.assertEqual([share["promptTokenCount"] for share in shares], [250, 750])
+        self.assertEqual(sum(share["candidatesTokenCount"] for share in shares), 301)
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp(), RECEIPT_BATCH_MAX_DOCUMENTS=3)
+class BatchUploadTests(APITestCase):
+    def setUp(self):
+        extraction_cache.clear()
+        self.user = get_user_model().objects.create_user(username="receipts", password="pass")
+        self.client.force_authenticate(user=self.user)
+
+    def files(self, count):
+        files = []
+        for number in range(count):
+            if number % 2:
+                files.append(SimpleUploadedFile(f"bill_{number}.pdf", make_pdf(number + 1), content_type="application/pdf"))
+            else:
+                files.append(SimpleUploadedFile(f"receipt_{number}.jpg", make_photo(400 + number, 600), content_type="image/jpeg"))
+        return files
+
+    def test_receipts_are_batched_and_split_per_file(self):
+        calls = metrics.get_counter("receipt_batching.calls")
+        response = self.client.post(reverse("upload_batch"), {"pdf_files": self.files(5), "doc_type": "Bill Reimbursment"})
+
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(metrics.get_counter("receipt_batching.calls") - calls, 2)
+        self.assertEqual([batch["documents"] for batch in response.data["batches"]], [[1, 2, 3], [4, 5]])
+        self.assertEqual([item["document"] for item in response.data["result"]["expenses"]], [1, 2, 3, 4, 5])
+        self.assertEqual(response.data["missing_documents"], [])
+
+        documents = Document.objects.filter(userid=self.user).order_by("id")
+        self.assertEqual(documents.count(), 5)
+        self.assertEqual(documents[3].json_data["expenses"][0]["vendor"], "Vendor 1")
+        self.assertEqual(documents[3].processing_metadata["batch"]["call"], 2)
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.documents_processed, 5)
+
+    def test_batch_over_document_limit_is_rejected(self):
+        self.user.max_documents_allowed = 4
+        self.user.save()
+        response = self.client.post(reverse("upload_batch"), {"pdf_files": self.files(5)})
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(Document.objects.count(), 0)
+
+    @override_settings(FAKE_BACKEND_LATENCY="fixed:5")
+    def test_failed_batch_cancels_the_others(self):
+        metrics.reset()
+        rate_limiter.reset()
+        original = FakeBackend.generate
+
+        def generate(self, request, stream=False):
+            # The second batch (documents 4-5) cannot be read
+            if isinstance(request.input_data, list) and len(request.input_data) == 4:
+                raise ValueError("unreadable batch")
+            return original(self, request, stream=stream)
+
+        with mock.patch.object(FakeBackend, "generate", generate):
+            response = self.client.post(reverse("upload_batch"), {"pdf_files": self.files(5), "doc_type": "Bill Reimbursment"})
+
+        self.assertEqual(response.status_code, 500, response.content)
+        self.assertEqual(metrics.get_counter("cancellations.sibling_failed"), 1)
+        self.assertEqual(Document.objects.count(), 0)
+
+    def test_uploads_are_deleted_on_every_failure(self):
+        for error, code in [
+            (resilience.CircuitOpenError("open"), 503),
+            (resilience.DeadlineExceededError("late"), 504),
+            (RuntimeError("broken"), 500),
+        ]:
+            before = sorted(os.path.join(path, name) for path, _, names in os.walk(settings.MEDIA_ROOT) for name in names)
+            with mock.patch.object(receipt_batching, "extract_batches", side_effect=error):
+                response = self.client.post(reverse("upload_batch"), {"pdf_files": self.files(2), "doc_type": "Bill Reimbursment"})
+            self.assertEqual(response.status_code, code, response.content)
+            after = sorted(os.path.join(path, name) for path, _, names in os.walk(settings.MEDIA_ROOT) for name in names)
+            self.assertEqual(after, before)
+
+    def test_other_doc_types_are_rejected(self):
+        response = self.client.post(reverse("upload_batch"), {"pdf_files": self.files(2), "doc_type": "docextraction"})
+        self.assertEqual(response.status_code, 400)
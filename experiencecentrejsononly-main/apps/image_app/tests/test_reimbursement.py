@@ -0,0 +1,109 @@
+import json
+import tempfile
+
+from django.contrib.auth import get_user_model
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import SimpleTestCase, override_settings
+from django.urls import reverse
+from rest_framework.test import APITestCase
+
+from apps.image_app import estimation, extraction_cache, metrics, reimbursement
+from apps.image_app.models import Document
+from apps.image_app.tests.test_image_normalization import make_photo
+
+EXPENSES = [
+    {"document": 1, "type": "Travel", "amount_inr": "₹1,200.50", "status": "Allowed"},
+    {"document": "Document 2", "type": "Stay", "amount_inr": "3000", "status": "Not Allowed"},
+    {"document": 3, "type": "food", "amount_inr": 99.5, "status": ""},
+    {"document": 3, "type": "Mobile", "amount_inr": "n/a"},
+]
+
+
+def response(output_tokens, cache_hit=False):
+    return {"usageMetadata": {"candidatesTokenCount": output_tokens}, "cacheHit": cache_hit}
+
+
+class AggregateTests(SimpleTestCase):
+    def test_totals_are_computed_from_the_expenses(self):
+        self.assertEqual(reimbursement.aggregate(EXPENSES), {
+            "allowed": {"items": [1, 3], "total_inr": "1300.00"},
+            "not_allowed": {"items": [2, 3], "total_inr": "3000.00"},
+            "summary": {"total_documents": "3", "total_amount": "4300.00", "reimbursable_amount": "1300.00"},
+        })
+        self.assertEqual(reimbursement.aggregate([], 2)["summary"]["total_documents"], "2")
+
+    def test_sums_are_exact_in_paise(self):
+        expenses = [{"document": 1, "type": "Food", "amount_inr": "0.10", "status": "Allowed"}] * 1000
+        expenses += [{"document": 2, "type": "Stay", "amount_inr": "19.995", "status": "Not Allowed"}]
+        aggregates = reimbursement.aggregate(expenses)
+        self.assertEqual(aggregates["allowed"]["total_inr"], "100.00")
+        self.assertEqual(aggregates["not_allowed"]["total_inr"], "20.00")
+        self.assertEqual(aggregates["summary"]["total_amount"], "120.00")
+
+    def test_missing_status_falls_back_to_the_type(self):
+        self.assertEqual(reimbursement.status_of({"type": " travel "}), reimbursement.ALLOWED)
+        self.assertEqual(reimbursement.status_of({"type": "Stay", "status": "maybe"}), reimbursement.NOT_ALLOWED)
+        self.assertEqual(reimbursement.status_of({"type": "Stay", "status": "allowed"}), reimbursement.ALLOWED)
+
+    def test_prompt_follows_the_setting(self):
+        self.assertEqual(reimbursement.prompt_name(), reimbursement.EXPENSES_PROMPT)
+        with override_settings(REIMBURSEMENT_LOCAL_AGGREGATES=False):
+            self.assertEqual(reimbursement.prompt_name(), reimbursement.FULL_PROMPT)
+
+
+class CompleteTests(SimpleTestCase):
+    def setUp(self):
+        metrics.reset()
+
+    def test_local_variant_is_measured_with_its_savings(self):
+        completed = reimbursement.complete({"expenses": EXPENSES}, 3, response(300), 2.0, 2)
+
+        self.assertEqual(completed["summary"]["reimbursable_amount"], "1300.00")
+        saved = -(-len(json.dumps(reimbursement.aggregate(EXPENSES, 3), ensure_ascii=False)) // estimation.CHARS_PER_TOKEN)
+        self.assertEqual(metrics.get_counter("reimbursement.output_tokens_saved"), saved)
+        status = reimbursement.status()
+        self.assertEqual(status["local"], {
+            "calls": 1, "output_tokens_per_document_p50": 150.0, "seconds_per_document_p50": 1.0,
+        })
+        self.assertIsNone(status["output_tokens_per_document_saved"])
+
+        reimbursement.complete({"expenses": EXPENSES}, 3, response(300, cache_hit=True), 0.0)
+        self.assertEqual(metrics.get_counter("reimbursement.local.calls"), 1)
+
+    def test_wrong_model_totals_are_replaced_and_counted(self):
+        parsed = {"expenses": EXPENSES, **reimbursement.aggregate(EXPENSES, 3)}
+        reimbursement.complete(parsed, 3, response(500), 1.0)
+        self.assertEqual(metrics.get_counter("reimbursement.model_totals_corrected"), 0)
+
+        parsed["allowed"] = {"items": [1, 3], "total_inr": "1300.50"}
+        completed = reimbursement.complete(parsed, 3, response(500), 3.0)
+        self.assertEqual(completed["allowed"]["total_inr"], "1300.00")
+        self.assertEqual(metrics.get_counter("reimbursement.model_totals_corrected"), 1)
+
+        reimbursement.complete({"expenses": EXPENSES}, 3, response(200), 1.0)
+        status = reimbursement.status()
+        self.assertEqual(status["model"]["calls"], 2)
+        self.assertEqual(status["output_tokens_per_document_saved"], 300.0)
+
+    def test_output_without_expenses_is_unchanged(self):
+        self.assertEqual(reimbursement.complete({"error": "unreadable"}, 1, response(10), 1.0), {"error": "unreadable"})
+        self.assertEqual(metrics.get_counter("reimbursement.local.calls"), 0)
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class ReimbursementUploadTests(APITestCase):
+    def setUp(self):
+        metrics.reset()
+        extraction_cache.clear()
+        self.user = get_user_model().objects.create_user(username="claims", password="pass")
+        self.client.force_authenticate(user=self.user)
+
+    def test_upload_stores_local_totals(self):
+        upload = SimpleUploadedFile("receipt.jpg", make_photo(400, 600), content_type="image/jpeg")
+        response = self.client.post(reverse("upload_file"), {"pdf_file": upload, "doc_type": "Bill Reimbursment"})
+
+        self.assertEqual(response.status_code, 200, response.content)
+        json_data = Document.objects.get(userid=self.user).json_data
+        self.assertEqual(json_data["summary"], reimbursement.aggregate(json_data["expenses"], 1)["summary"])
+        self.assertEqual(metrics.get_counter("reimbursement.local.calls"), 1)
+        self.assertGreater(metrics.get_counter("reimbursement.output_tokens_saved"), 0)
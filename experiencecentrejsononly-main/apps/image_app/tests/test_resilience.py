@@ -0,0 +1,117 @@
+import json
+import threading
+import time
+
+from django.test import SimpleTestCase, override_settings
+
+from apps.image_app import resilience
+
+
+class ServiceUnavailable(Exception):
+    pass
+
+
+class ResourceExhausted(Exception):
+    pass
+
+
+class ClassifyErrorTests(SimpleTestCase):
+    def test_quota_errors(self):
+        self.assertEqual(resilience.classify_error(ResourceExhausted("limit")), resilience.QUOTA)
+        self.assertEqual(resilience.classify_error(Exception("429 Quota exceeded")), resilience.QUOTA)
+
+    def test_transient_errors(self):
+        self.assertEqual(resilience.classify_error(ServiceUnavailable("down")), resilience.TRANSIENT)
+        self.assertEqual(resilience.classify_error(ConnectionResetError()), resilience.TRANSIENT)
+        self.assertEqual(resilience.classify_error(resilience.AttemptTimeoutError()), resilience.TRANSIENT)
+
+    def test_fatal_errors(self):
+        self.assertEqual(resilience.classify_error(ValueError("Unsupported MIME type")), resilience.FATAL)
+        self.assertEqual(
+            resilience.classify_error(json.JSONDecodeError("bad", "{", 0)), resilience.FATAL
+        )
+        self.assertEqual(resilience.classify_error(Exception("Permission denied")), resilience.FATAL)
+
+    def test_wrapped_error_uses_cause(self):
+        try:
+            try:
+                raise ServiceUnavailable("down")
+            except ServiceUnavailable as e:
+                raise RuntimeError("call failed") from e
+        except RuntimeError as wrapped:
+            self.assertEqual(resilience.classify_error(wrapped), resilience.TRANSIENT)
+
+
+class DeadlineTests(SimpleTestCase):
+    def test_cap_and_expiry(self):
+        deadline = resilience.Deadline(0.2)
+        self.assertLessEqual(deadline.cap(10), 0.2)
+        self.assertEqual(deadline.cap(0.05), 0.05)
+        time.sleep(0.25)
+        self.assertTrue(deadline.expired())
+        with self.assertRaises(resilience.DeadlineExceededError):
+            deadline.check()
+
+    def test_no_deadline(self):
+        deadline = resilience.Deadline(None)
+        self.assertIsNone(deadline.cap(None))
+        self.assertEqual(deadline.cap(5), 5)
+        deadline.check()
+
+    def test_call_with_timeout(self):
+        self.assertEqual(resilience.call_with_timeout(lambda: 42, 1), 42)
+        with self.assertRaises(resilience.AttemptTimeoutError):
+            resilience.call_with_timeout(lambda: time.sleep(1), 0.05)
+        with self.assertRaises(ValueError):
+            resilience.call_with_timeout(lambda: int("x"), 1)
+
+
+@override_settings(CIRCUIT_BREAKER_FAILURE_THRESHOLD=2, CIRCUIT_BREAKER_RESET_SECONDS=0.1)
+class CircuitBreakerTests(SimpleTestCase):
+    def test_opens_after_transient_failures_and_recovers(self):
+        breaker = resilience.CircuitBreaker("test")
+        breaker.record(resilience.TRANSIENT)
+        self.assertEqual(breaker.state, breaker.CLOSED)
+        breaker.record(resilience.TRANSIENT)
+        self.assertEqual(breaker.state, breaker.OPEN)
+        with self.assertRaises(resilience.CircuitOpenError):
+            breaker.check()
+
+        time.sleep(0.15)
+        self.assertEqual(breaker.state, breaker.HALF_OPEN)
+        self.assertTrue(breaker.allow())
+        # Only one probe at a time
+        self.assertFalse(breaker.allow())
+        breaker.record_success()
+        self.assertEqual(breaker.state, breaker.CLOSED)
+
+    def test_failed_probe_reopens(self):
+        breaker = resilience.CircuitBreaker("test")
+        breaker.record(resilience.TRANSIENT)
+        breaker.record(resilience.TRANSIENT)
+        time.sleep(0.15)
+        self.assertTrue(breaker.allow())
+        breaker.record(resilience.TRANSIENT)
+        self.assertEqual(breaker.state, breaker.OPEN)
+
+    def test_unused_probe_is_released(self):
+        breaker = resilience.CircuitBreaker("test")
+        breaker.record(resilience.TRANSIENT)
+        breaker.record(resilience.TRANSIENT)
+        time.sleep(0.15)
+        self.assertTrue(breaker.allow())
+        breaker.release_probe()
+        self.assertTrue(breaker.allow())
+
+        # Only the thread holding the probe can hand it back
+        other = threading.Thread(target=breaker.release_probe)
+        other.start()
+        other.join()
+        self.assertFalse(breaker.allow())
+
+    def test_fatal_and_quota_errors_do_not_open(self):
+        breaker = resilience.CircuitBreaker("test")
+        for _ in range(5):
+            breaker.record(resilience.FATAL)
+            breaker.record(resilience.QUOTA)
+        self.assertEqual(breaker.state, breaker.CLOSED)
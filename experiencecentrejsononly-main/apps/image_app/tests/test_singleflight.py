@@ -0,0 +1,219 @@
+import configparser
+import os
+import tempfile
+import threading
+import time
+from unittest import mock
+
+from cryptography.fernet import Fernet
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import SimpleTestCase, override_settings
+from django.urls import reverse
+from rest_framework import status
+from rest_framework.test import APITestCase
+
+from apps.image_app import resilience, singleflight
+from apps.image_app.models import Document
+
+
+class SingleFlightTests(SimpleTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.override = override_settings(EXTRACTION_LOCK_DIR=self.tmpdir.name)
+        self.override.enable()
+
+    def tearDown(self):
+        self.override.disable()
+        self.tmpdir.cleanup()
+
+    def test_concurrent_callers_share_one_call(self):
+        calls = []
+        release = threading.Event()
+
+        def extraction():
+            calls.append(1)
+            release.wait(5)
+            return {"candidates": [], "usageMetadata": {"promptTokenCount": 10}}
+
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(singleflight.run("same-key", extraction)))
+            for _ in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.2)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(results), 4)
+        billed = [r["usageMetadata"]["promptTokenCount"] for r in results]
+        self.assertEqual(sorted(billed), [0, 0, 0, 10])
+
+    def test_failure_is_propagated_to_waiters(self):
+        release = threading.Event()
+        errors = []
+
+        def failing():
+            release.wait(5)
+            raise ValueError("boom")
+
+        def call():
+            try:
+                singleflight.run("failing-key", failing)
+            except ValueError as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=call) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.2)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(len(errors), 3)
+
+    def test_published_result_is_reused_after_waiting_on_lock(self):
+        holder_ready = threading.Event()
+        release = threading.Event()
+
+        def other_worker():
+            with singleflight.file_lock("extraction-remote-key"):
+                holder_ready.set()
+                release.wait(5)
+                singleflight._publish_result("remote-key", {"usageMetadata": {"promptTokenCount": 7}})
+
+        worker = threading.Thread(target=other_worker)
+        worker.start()
+        holder_ready.wait(5)
+        threading.Timer(0.2, release.set).start()
+
+        result = singleflight.run("remote-key", lambda: self.fail("extraction should not run again"))
+        worker.join(5)
+        self.assertTrue(result["coalesced"])
+        self.assertEqual(result["sharedUsageMetadata"]["promptTokenCount"], 7)
+
+    def test_result_is_published_only_when_awaited(self):
+        singleflight.run("lonely-key", lambda: {"candidates": []})
+        self.assertFalse(os.path.exists(singleflight._result_path("lonely-key")))
+
+        started = time.time()
+        leader_ready = threading.Event()
+        release = threading.Event()
+
+        def extraction():
+            leader_ready.set()
+            release.wait(5)
+            return {"candidates": [], "usageMetadata": {"promptTokenCount": 3}}
+
+        leader = threading.Thread(target=lambda: singleflight.run("awaited-key", extraction))
+        leader.start()
+        leader_ready.wait(5)
+        threading.Timer(0.2, release.set).start()
+        # Another worker process blocks on the lock while the leader runs
+        with singleflight.file_lock(
+            "extraction-awaited-key", on_contended=lambda: singleflight._mark_awaited("awaited-key")
+        ) as waited:
+            self.assertTrue(waited)
+            published = singleflight._read_published_result("awaited-key", since=started)
+        leader.join(5)
+        self.assertEqual(published["usageMetadata"]["promptTokenCount"], 3)
+
+    def test_expired_results_are_swept_periodically(self):
+        singleflight._last_cleanup = 0.0
+        with mock.patch.object(singleflight, "_cleanup_results") as cleanup:
+            for number in range(3):
+                singleflight.run(f"key-{number}", lambda: {"candidates": []})
+        self.assertEqual(cleanup.call_count, 1)
+
+    def test_cancelled_waiter_is_released_while_the_leader_runs(self):
+        release = threading.Event()
+        self.addCleanup(release.set)
+        leader_results = []
+
+        def extraction():
+            release.wait(5)
+            return {"candidates": []}
+
+        leader = threading.Thread(target=lambda: leader_results.append(singleflight.run("busy-key", extraction)))
+        leader.start()
+        time.sleep(0.1)
+
+        token = resilience.CancelToken()
+        threading.Timer(0.1, token.cancel).start()
+        started = time.monotonic()
+        with self.assertRaises(resilience.CancelledError):
+            singleflight.run("busy-key", extraction, deadline=resilience.Deadline(None, token))
+        self.assertLess(time.monotonic() - started, 1)
+
+        release.set()
+        leader.join(5)
+        self.assertEqual(leader_results, [{"candidates": []}])
+
+    def test_wait_on_another_workers_lock_is_bounded(self):
+        with singleflight.file_lock("extraction-remote-key"):
+            started = time.monotonic()
+            with self.assertRaises(resilience.DeadlineExceededError):
+                with singleflight.file_lock("extraction-remote-key", deadline=resilience.Deadline(0.2)):
+                    pass
+            self.assertLess(time.monotonic() - started, 1)
+
+    def test_document_lock_is_exclusive(self):
+        with singleflight.document_lock(42):
+            with self.assertRaises(singleflight.LockBusyError):
+                with singleflight.document_lock(42):
+                    pass
+        with singleflight.document_lock(42):
+            pass
+
+
+@override_settings(
+    DATABASES={"default": {"ENGINE": "django.db.backends.sqlite3", "NAME": ":memory:"}},
+    MEDIA_ROOT=tempfile.gettempdir(),
+)
+class ProcessFullDocumentLockTests(APITestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.power_user = User.objects.create_user(username="power", password="pass", user_type="power")
+        upload = SimpleUploadedFile("test.pdf", b"filecontent", content_type="application/pdf")
+        self.document = Document.objects.create(
+            userid=self.power_user,
+            file_path="uploads/test.pdf",
+            file=upload,
+            json_data={},
+        )
+        config = configparser.ConfigParser()
+        config.read(os.path.join(settings.BASE_DIR, "apps", "image_app", "config.properties"))
+        fernet = Fernet(config.get("Input", "FERNET_KEY").encode())
+        self.encrypted_id = fernet.encrypt(str(self.document.id).encode()).decode()
+
+    def test_concurrent_full_document_request_is_rejected(self):
+        self.client.force_authenticate(user=self.power_user)
+        with singleflight.document_lock(self.document.id):
+            response = self.client.post(
+                reverse("process-full-document"), {"document_id": self.encrypted_id}, format="json"
+            )
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+
+    def test_unavailable_vertex_and_deadline_map_to_503_and_504(self):
+        path = os.path.join(settings.MEDIA_ROOT, self.document.file_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(b"filecontent")
+        self.addCleanup(os.remove, path)
+        self.client.force_authenticate(user=self.power_user)
+
+        cases = (
+            (resilience.CircuitOpenError("Vertex AI is currently unavailable."), status.HTTP_503_SERVICE_UNAVAILABLE),
+            (resilience.DeadlineExceededError("Request deadline of 300s exceeded"), status.HTTP_504_GATEWAY_TIMEOUT),
+        )
+        for error, expected in cases:
+            with mock.patch("apps.image_app.views.call_gemini_api_windowed", side_effect=error):
+                response = self.client.post(
+                    reverse("process-full-document"), {"document_id": self.encrypted_id}, format="json"
+                )
+            self.assertEqual(response.status_code, expected, response.content)
@@ -0,0 +1,117 @@
+import importlib
+import io
+import sys
+import threading
+import time
+import types
+from unittest import mock
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import SimpleTestCase, override_settings
+
+import apps.image_app
+from apps.image_app import client_pool
+from apps.image_app.management.commands.check_import_time import parse_importtime
+
+VERTEX_MODEL = "apps.image_app.vertex_model"
+
+
+class LazyVertexInitTests(SimpleTestCase):
+    def setUp(self):
+        # Import a fresh copy so every test starts before initialization
+        self.original = sys.modules.pop(VERTEX_MODEL, None)
+        self.vertex_model = importlib.import_module(VERTEX_MODEL)
+        client_pool.reset()
+
+    def tearDown(self):
+        client_pool.reset()
+        sys.modules.pop(VERTEX_MODEL, None)
+        if self.original is not None:
+            sys.modules[VERTEX_MODEL] = self.original
+            apps.image_app.vertex_model = self.original
+
+    def test_import_does_not_load_vertex_sdk(self):
+        self.assertNotIn("vertexai", sys.modules)
+        self.assertEqual(client_pool.pools(), [])
+
+    def test_init_failure_raises_instead_of_exiting(self):
+        with mock.patch.dict(sys.modules, {"google": None, "google.auth": None}):
+            with self.assertRaises(self.vertex_model.VertexInitError):
+                self.vertex_model.get_model()
+        self.assertEqual(client_pool.pools(), [])
+
+    def fake_sdk(self, inits, pings=None):
+        def init(**kwargs):
+            inits.append(kwargs)
+            time.sleep(0.05)
+
+        class GenerativeModel:
+            def __init__(self, model_id):
+                self.model_id = model_id
+
+            def count_tokens(self, contents):
+                pings.append(self)
+
+        google = types.ModuleType("google")
+        google.auth = types.SimpleNamespace(load_credentials_from_file=lambda path, **kwargs: ("creds", "project"))
+        vertexai = types.ModuleType("vertexai")
+        vertexai.init = init
+        generative_models = types.ModuleType("vertexai.generative_models")
+        generative_models.GenerativeModel = GenerativeModel
+        return mock.patch.dict(sys.modules, {
+            "google": google,
+            "google.auth": google.auth,
+            "vertexai": vertexai,
+            "vertexai.generative_models": generative_models,
+        })
+
+    @override_settings(VERTEX_CHANNELS=1)
+    def test_concurrent_first_calls_initialize_once(self):
+        inits = []
+        models = []
+        with self.fake_sdk(inits):
+            threads = [
+                threading.Thread(target=lambda: models.append(self.vertex_model.get_model()))
+                for _ in range(5)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(len(inits), 1)
+        self.assertEqual(len({id(model) for model in models}), 1)
+
+    @override_settings(VERTEX_CHANNELS=3, VERTEX_WARM_UP_CALL=True)
+    def test_warm_up_connects_every_client(self):
+        inits, pings = [], []
+        with self.fake_sdk(inits, pings):
+            self.vertex_model.warm_up()
+
+        pool = self.vertex_model.get_model_pool()
+        self.assertEqual(len(inits), 1)
+        self.assertEqual({id(model) for model in pings}, {id(channel.client) for channel in pool.channels})
+        self.assertEqual(pool.status()["calls"], [1, 1, 1])
+
+
+class ImportTimeCheckTests(SimpleTestCase):
+    def test_parse_importtime(self):
+        output = (
+            "import time: self [us] | cumulative | imported package\n"
+            "import time:       100 |        100 |     json.decoder\n"
+            "import time:       200 |        300 |   json\n"
+            "import time:       500 |       1500 | apps.image_app.views\n"
+        )
+        self.assertEqual(
+            parse_importtime(output),
+            [("json.decoder", 0.0001, 2), ("json", 0.0003, 1), ("apps.image_app.views", 0.0015, 0)],
+        )
+
+    def test_command_enforces_budget(self):
+        out = io.StringIO()
+        call_command("check_import_time", budget=60, stdout=out)
+        self.assertIn("within budget", out.getvalue())
+
+        with self.assertRaises(CommandError):
+            call_command("check_import_time", budget=0.001, stdout=io.StringIO())
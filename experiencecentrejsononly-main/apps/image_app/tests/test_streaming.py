@@ -0,0 +1,175 @@
+import json
+import os
+import tempfile
+import threading
+from unittest import mock
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import SimpleTestCase, override_settings
+from django.urls import reverse
+from rest_framework.test import APITestCase
+
+from apps.image_app import extraction_cache, metrics, model_routing, rate_limiter
+from apps.image_app.json_stream import IncrementalObjectParser
+from apps.image_app.models import Document
+from apps.image_app.tests.test_extraction_backends import make_pdf
+from apps.image_app.vertex_model import MODEL_ID, stream_gemini_api
+
+
+class IncrementalObjectParserTests(SimpleTestCase):
+    def _parse(self, text, chunk_size):
+        parser = IncrementalObjectParser()
+        members = []
+        for i in range(0, len(text), chunk_size):
+            members.extend(parser.feed(text[i:i + chunk_size]))
+        return parser, members
+
+    def test_pages_are_emitted_as_they_close(self):
+        parser = IncrementalObjectParser()
+        self.assertEqual(parser.feed('{"page_1": {"page_info": "page 1/2", "items": [1, 2]}'), [
+            ("page_1", {"page_info": "page 1/2", "items": [1, 2]}),
+        ])
+        self.assertEqual(parser.feed(', "page_2": {"notes": "a } in text"'), [])
+        self.assertEqual(parser.feed("}}"), [("page_2", {"notes": "a } in text"})])
+        self.assertTrue(parser.finished)
+
+    def test_chunk_boundaries_do_not_matter(self):
+        text = '```json\n{"page_1": {"a": "x\\"y"}, "total": 12.5, "flag": true, "page_2": [1, {"b": null}]}\n```'
+        expected = list(json.loads(text[8:-4]).items())
+        for chunk_size in (1, 2, 5, len(text)):
+            parser, members = self._parse(text, chunk_size)
+            self.assertEqual(members, expected)
+            self.assertTrue(parser.finished)
+
+
+def _fake_stream(*args, **kwargs):
+    yield {"type": "progress", "message": "Sending request to AI model..."}
+    yield {"type": "member", "key": "page_1", "value": {"page_info": "page 1/1"}}
+    yield {
+        "type": "complete",
+        "response": {
+            "candidates": [{"content": {"parts": [{"text": '{"page_1": {"page_info": "page 1/1"}}'}]}}],
+            "usageMetadata": {"promptTokenCount": 11, "candidatesTokenCount": 5},
+            "pagesProcessed": 1,
+        },
+    }
+
+
+def _failing_stream(*args, **kwargs):
+    yield {"type": "progress", "message": "Sending request to AI model..."}
+    raise Exception("503 Service unavailable")
+
+
+def _queued_stream(relayed):
+    def stream(*args, progress_callback=None, **kwargs):
+        # Still blocked in the rate limiter queue until the client has seen the message
+        progress_callback("Waiting for a model slot (position 2 in queue)...")
+        if not relayed.wait(5):
+            raise Exception("queue position was not relayed while waiting")
+        yield from _fake_stream()
+
+    return stream
+
+
+def _files(root):
+    return sorted(os.path.join(path, name) for path, _, names in os.walk(root) for name in names)
+
+
+class StreamClosedByClientTests(SimpleTestCase):
+    def setUp(self):
+        metrics.reset()
+        extraction_cache.clear()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "doc.pdf")
+        with open(self.path, "wb") as f:
+            f.write(make_pdf(2))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_closed_stream_is_not_an_error(self):
+        events = stream_gemini_api("Extract", input_data=self.path, max_pages=2, use_cache=False)
+        for event in events:
+            if event["type"] == "member":
+                break
+        events.close()
+
+        self.assertEqual(metrics.get_counter("rate_limiter.outcome.cancelled"), 1)
+        self.assertEqual(metrics.get_counter("rate_limiter.outcome.error"), 0)
+        self.assertEqual(model_routing.circuit(MODEL_ID)._failures, 0)
+
+    def test_waits_are_reported_while_they_last(self):
+        acquire = rate_limiter.acquire
+        messages = []
+
+        def queued(*args, on_wait=None, **kwargs):
+            on_wait("Waiting for a model slot (position 2 in queue)...")
+            self.assertEqual(messages[-1], "Waiting for a model slot (position 2 in queue)...")
+            return acquire(*args, on_wait=on_wait, **kwargs)
+
+        with mock.patch.object(rate_limiter, "acquire", side_effect=queued):
+            events = list(stream_gemini_api(
+                "Extract", input_data=self.path, max_pages=2, use_cache=False, progress_callback=messages.append
+            ))
+
+        progress = [event["message"] for event in events if event["type"] == "progress"]
+        self.assertNotIn("Waiting for a model slot (position 2 in queue)...", progress)
+        self.assertEqual(events[-1]["type"], "complete")
+
+
+@override_settings(
+    DATABASES={"default": {"ENGINE": "django.db.backends.sqlite3", "NAME": ":memory:"}},
+    MEDIA_ROOT=tempfile.mkdtemp(),
+)
+class StreamUploadViewTests(APITestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(username="streamer", password="pass")
+        self.client.force_authenticate(user=self.user)
+
+    @mock.patch("apps.image_app.views.stream_gemini_api", side_effect=_fake_stream)
+    def test_events_are_streamed_and_document_saved(self, _):
+        upload = SimpleUploadedFile("invoice.pdf", b"%PDF-1.4", content_type="application/pdf")
+        response = self.client.post(reverse("upload_file_stream"), {"pdf_file": upload, "doc_type": "docextraction"})
+
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        body = b"".join(response.streaming_content).decode()
+        events = [block.split("\n")[0] for block in body.strip().split("\n\n")]
+        self.assertEqual(events, ["event: progress", "event: page", "event: complete"])
+
+        doc = Document.objects.get(userid=self.user)
+        self.assertEqual(doc.json_data, {"page_1": {"page_info": "page 1/1"}})
+        self.assertEqual(doc.input_token, 11)
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.documents_processed, 1)
+
+    def test_queue_position_is_sent_while_waiting(self):
+        relayed = threading.Event()
+        upload = SimpleUploadedFile("invoice.pdf", b"%PDF-1.4", content_type="application/pdf")
+        with mock.patch("apps.image_app.views.stream_gemini_api", side_effect=_queued_stream(relayed)):
+            response = self.client.post(reverse("upload_file_stream"), {"pdf_file": upload, "doc_type": "docextraction"})
+            chunks = iter(response.streaming_content)
+            first = next(chunks).decode()
+            relayed.set()
+            rest = b"".join(chunks).decode()
+
+        self.assertTrue(first.startswith("event: progress"))
+        self.assertIn("position 2 in queue", first)
+        self.assertIn("event: complete", rest)
+
+    @mock.patch("apps.image_app.views.stream_gemini_api", side_effect=_failing_stream)
+    def test_upload_is_deleted_after_an_error_event(self, _):
+        before = _files(settings.MEDIA_ROOT)
+        upload = SimpleUploadedFile("invoice.pdf", b"%PDF-1.4", content_type="application/pdf")
+        response = self.client.post(reverse("upload_file_stream"), {"pdf_file": upload, "doc_type": "docextraction"})
+
+        body = b"".join(response.streaming_content).decode()
+        self.assertIn("event: error", body)
+        self.assertFalse(Document.objects.filter(userid=self.user).exists())
+        self.assertEqual(_files(settings.MEDIA_ROOT), before)
+
+    def test_unsupported_file_type_is_rejected_before_streaming(self):
+        upload = SimpleUploadedFile("notes.txt", b"text", content_type="text/plain")
+        response = self.client.post(reverse("upload_file_stream"), {"pdf_file": upload})
+        self.assertEqual(response.status_code, 400)
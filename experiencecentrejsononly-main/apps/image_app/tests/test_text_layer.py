@@ -0,0 +1,119 @@
+import io
+import os
+import tempfile
+
+from django.test import SimpleTestCase, override_settings
+from PyPDF2 import PageObject, PdfReader, PdfWriter
+from PyPDF2.generic import DecodedStreamObject, DictionaryObject, NameObject
+
+from apps.image_app import pdf_slicing, preprocessing, text_layer
+from apps.image_app.vertex_model import call_gemini_api_with_streaming
+
+INVOICE_LINES = ["INVOICE No 4711 - Acme Supplies Pvt Ltd"] + [
+    f"Item {n:02d}  Office chair, ergonomic  Qty 2  Rate 4,500.00  Amount 9,000.00" for n in range(1, 6)
+]
+
+
+def make_text_pdf(pages) -> bytes:
+    """A born-digital PDF; ``None`` entries become pages without text, like scans."""
+    writer = PdfWriter()
+    font = writer._add_object(DictionaryObject({
+        NameObject("/Type"): NameObject("/Font"),
+        NameObject("/Subtype"): NameObject("/Type1"),
+        NameObject("/BaseFont"): NameObject("/Helvetica"),
+    }))
+    for lines in pages:
+        page = PageObject.create_blank_page(None, 612, 792)
+        if lines is not None:
+            operations = ["BT", "/F1 10 Tf"]
+            for number, line in enumerate(lines):
+                operations.append(f"1 0 0 1 50 {750 - 14 * number} Tm ({line}) Tj")
+            operations.append("ET")
+            stream = DecodedStreamObject()
+            stream.set_data("\n".join(operations).encode("latin-1"))
+            page[NameObject("/Contents")] = writer._add_object(stream)
+            page[NameObject("/Resources")] = DictionaryObject({
+                NameObject("/Font"): DictionaryObject({NameObject("/F1"): font})
+            })
+        writer.add_page(page)
+    buffer = io.BytesIO()
+    writer.write(buffer)
+    return buffer.getvalue()
+
+
+# Pages without text in these fixtures are blank and would be dropped by the page filter
+@override_settings(PAGE_FILTER_ENABLED=False)
+class TextLayerTests(SimpleTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write(self, data: bytes) -> str:
+        path = os.path.join(self.tmpdir.name, "doc.pdf")
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def test_born_digital_pdf_is_sent_as_text(self):
+        path = self.write(make_text_pdf([INVOICE_LINES, INVOICE_LINES]))
+        prepared, pages, _, metadata = preprocessing.prepare_inputs(path)
+
+        parts = prepared[0].parts()
+        self.assertEqual([part.data for part in parts], [None])
+        self.assertIn("--- Page 2 (text layer) ---", parts[0].text)
+        self.assertIn("Office chair", parts[0].text)
+        self.assertEqual(pages, 2)
+        self.assertEqual(metadata["text_layer"]["mode"], "text")
+
+    def test_pages_without_text_fall_back_to_pdf(self):
+        path = self.write(make_text_pdf([INVOICE_LINES, None, None, INVOICE_LINES]))
+        prepared, _, _, metadata = preprocessing.prepare_inputs(path)
+
+        parts = prepared[0].parts()
+        self.assertTrue(parts[1].text.startswith("--- Page 1 (text layer) ---"))
+        self.assertEqual(parts[2].text, "--- Pages 2-3 (attached PDF) ---")
+        self.assertEqual(len(PdfReader(io.BytesIO(parts[3].data)).pages), 2)
+        self.assertTrue(parts[4].text.startswith("--- Page 4 (text layer) ---"))
+        self.assertEqual(metadata["text_layer"]["mode"], "mixed")
+        self.assertEqual(metadata["text_layer"]["image_pages"], 2)
+
+    def test_scanned_pdf_is_sent_unchanged(self):
+        data = make_text_pdf([None, None])
+        prepared, _, _, metadata = preprocessing.prepare_inputs(self.write(data))
+
+        self.assertEqual(prepared[0].data, data)
+        self.assertEqual(metadata["text_layer"]["mode"], "binary")
+
+    def test_text_quality(self):
+        self.assertFalse(text_layer.is_usable("Total 10.00"))
+        self.assertFalse(text_layer.is_usable("(cid:12)(cid:7) " * 50))
+        self.assertFalse(text_layer.is_usable("■□▪ " * 100))
+        self.assertTrue(text_layer.is_usable("\n".join(INVOICE_LINES)))
+
+    @override_settings(PDF_TEXT_LAYER_ENABLED=False)
+    def test_can_be_disabled(self):
+        data = make_text_pdf([INVOICE_LINES])
+        prepared, _, _, metadata = preprocessing.prepare_inputs(self.write(data))
+        self.assertEqual(prepared[0].data, data)
+        self.assertNotIn("text_layer", metadata)
+
+    def test_text_pages_use_fewer_prompt_tokens(self):
+        path = self.write(make_text_pdf([INVOICE_LINES] * 3))
+        response = call_gemini_api_with_streaming("Extract", input_data=path, max_pages=3, use_cache=False)
+
+        self.assertEqual(response["preprocessing"]["text_layer"]["text_pages"], 3)
+        self.assertLess(response["usageMetadata"]["promptTokenCount"], 3 * 258)
+
+    def test_window_metadata_is_merged(self):
+        merged = preprocessing.merge_metadata([
+            {"text_layer": {"text_pages": 2, "image_pages": 0, "text_chars": 900, "mode": "text"}},
+            {"text_layer": {"text_pages": 0, "image_pages": 3, "text_chars": 0, "mode": "binary"}},
+            None,
+        ])
+        self.assertEqual(merged["text_layer"], {"text_pages": 2, "image_pages": 3, "text_chars": 900, "mode": "mixed"})
+
+    def test_page_text(self):
+        with pdf_slicing.PdfDocument(make_text_pdf([INVOICE_LINES])) as document:
+            self.assertIn("INVOICE No 4711", document.page_text(0))
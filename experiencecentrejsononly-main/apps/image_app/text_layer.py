@@ -0,0 +1,126 @@
+"""Text-layer fast path for born-digital PDFs.
+
+PDFs exported by accounting systems carry their content as text, yet sent as
+bytes every page is billed and read like an image. For each page that will be
+sent, the embedded text is extracted line by line. Pages whose text is long
+and clean enough are sent as text under a page marker; the remaining pages
+are sent as PDF slices, so scans and mixed documents still work. The choice
+per document is recorded in the request's preprocessing metadata.
+"""
+
+import logging
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+from django.conf import settings
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+TEXT = "text"
+PDF = "pdf"
+
+_UNMAPPED_GLYPH_RE = re.compile(r"\(cid:\d+\)|\ufffd")
+_READABLE_PUNCTUATION = set(".,:;-_/\\()[]{}#%&@*+=<>'\"!?$€£₹|~`^")
+
+
+def _setting(name: str, default):
+    return getattr(settings, name, default)
+
+
+def is_enabled() -> bool:
+    return bool(_setting("PDF_TEXT_LAYER_ENABLED", True))
+
+
+def text_quality(text: str) -> float:
+    """Share of non-space characters that are readable (letters, digits, common punctuation)."""
+    if _UNMAPPED_GLYPH_RE.search(text):
+        return 0.0
+    characters = [c for c in text if not c.isspace()]
+    if not characters:
+        return 0.0
+    readable = sum(1 for c in characters if c.isalnum() or c in _READABLE_PUNCTUATION)
+    return readable / len(characters)
+
+
+def is_usable(text: str) -> bool:
+    """True if ``text`` is long and clean enough to replace the page image."""
+    characters = sum(1 for c in text if not c.isspace())
+    return (
+        characters >= int(_setting("PDF_TEXT_LAYER_MIN_CHARS", 200))
+        and text_quality(text) >= float(_setting("PDF_TEXT_LAYER_MIN_QUALITY", 0.9))
+    )
+
+
+def _format_text_pages(pages: List[Tuple[int, str]]) -> str:
+    return "\n\n".join(f"--- Page {number} (text layer) ---\n{text}" for number, text in pages)
+
+
+def split_document(document, indices: List[int], metadata: Dict[str, Any]) -> Optional[List[Tuple[str, Any]]]:
+    """
+    Decide per page whether to send the text layer or the page itself.
+
+    Args:
+        document: An open pdf_slicing.PdfDocument
+        indices: 0-based indices of the pages that will be sent, in order.
+            Pages are labelled by their position in this list, which is the
+            numbering the model sees.
+        metadata: Preprocessing metadata; the page counts are added to its
+            ``text_layer`` summary
+
+    Returns:
+        list: (TEXT, str) and (PDF, bytes) segments in page order, or None when
+        no page has a usable text layer and the document should be sent as is
+    """
+    pages = len(indices)
+    usable = []
+    for index in indices:
+        text = document.page_text(index)
+        usable.append(text if is_usable(text) else None)
+
+    text_pages = sum(1 for text in usable if text is not None)
+    summary = metadata.setdefault("text_layer", {"text_pages": 0, "image_pages": 0, "text_chars": 0})
+    summary["text_pages"] += text_pages
+    summary["image_pages"] += pages - text_pages
+    summary["text_chars"] += sum(len(text) for text in usable if text is not None)
+    summary["mode"] = mode(summary)
+    metrics.increment(f"text_layer.documents.{mode({'text_pages': text_pages, 'image_pages': pages - text_pages})}")
+    metrics.increment("text_layer.pages", text_pages)
+
+    if not text_pages:
+        return None
+
+    segments: List[Tuple[str, Any]] = []
+    if text_pages < pages:
+        segments.append((TEXT, (
+            f"The document has {pages} pages. Pages marked '(text layer)' are the PDF's embedded text, "
+            "one line per printed line; the other pages are attached as PDF."
+        )))
+
+    position = 0
+    while position < pages:
+        end = position
+        if usable[position] is not None:
+            while end < pages and usable[end] is not None:
+                end += 1
+            segments.append((TEXT, _format_text_pages(
+                [(number + 1, usable[number]) for number in range(position, end)]
+            )))
+        else:
+            while end < pages and usable[end] is None:
+                end += 1
+            label = f"Page {position + 1}" if end - position == 1 else f"Pages {position + 1}-{end}"
+            segments.append((TEXT, f"--- {label} (attached PDF) ---"))
+            segments.append((PDF, document.select(indices[position:end])))
+        position = end
+    return segments
+
+
+def mode(summary: Dict[str, Any]) -> str:
+    """Return ``text``, ``binary`` or ``mixed`` for a text_layer summary."""
+    if not summary.get("text_pages"):
+        return "binary"
+    if not summary.get("image_pages"):
+        return "text"
+    return "mixed"
@@ -7,17 +7,24 @@ from .views import (
     UserDocumentView, 
     FilteredDocumentView,
     UploadAndProcessFileView,
+    EstimateUploadView,
+    BatchUploadView,
+    StreamUploadAndProcessFileView,
     ProcessFullDocumentView
 )
 from .admin_views import (
     AdminUserReportView,
     AdminUserManagementView,
+    AdminPipelineMetricsView,
     UserUsageStatsView
 )
 
 urlpatterns = [
     # Existing endpoints
     path("upload/", UploadAndProcessFileView.as_view(), name="upload_file"),
+    path("upload/estimate/", EstimateUploadView.as_view(), name="upload_estimate"),
+    path("upload/batch/", BatchUploadView.as_view(), name="upload_batch"),
+    path("upload/stream/", StreamUploadAndProcessFileView.as_view(), name="upload_file_stream"),
     path('documents/', UserDocumentView.as_view(), name='user-documents'),
     path('document-filter/', FilteredDocumentView.as_view(), name='filtered-documents'),
     path('get-document/<path:doc_id>/', GetDocumentByIdView.as_view(), name='get-document-by-id'),
@@ -29,6 +36,7 @@ urlpatterns = [
     # Admin endpoints
     path('admin/user-report/', AdminUserReportView.as_view(), name='admin-user-report'),
     path('admin/manage-user/', AdminUserManagementView.as_view(), name='admin-manage-user'),
+    path('admin/metrics/', AdminPipelineMetricsView.as_view(), name='admin-pipeline-metrics'),
     
 ] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
 
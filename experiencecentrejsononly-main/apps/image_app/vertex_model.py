@@ -1,17 +1,24 @@
-import vertexai
-from vertexai.generative_models import GenerativeModel, Part, GenerationConfig
-import google.auth
 import json
 import mimetypes
 import os
 import time
 import random
-from typing import Union, Dict, Any, Optional, Callable
+import threading
+from typing import TYPE_CHECKING, Union, Dict, Any, List, Optional, Callable, Iterator
 from dotenv import load_dotenv
 import logging
-from PyPDF2 import PdfReader, PdfWriter
-import io
-from PIL import Image
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from django.conf import settings
+
+from . import (
+    client_pool, endpoint_pool, extraction_backends, extraction_cache, hedging, memory_budget, metrics, model_routing,
+    output_salvage, output_schema, page_windows, pdf_slicing, preprocessing, rate_limiter, resilience, singleflight,
+)
+from .json_stream import IncrementalObjectParser, safe_json_load
+
+if TYPE_CHECKING:
+    from vertexai.generative_models import GenerativeModel, Part, GenerationConfig
 
 # Setup logger
 logger = logging.getLogger(__name__)
@@ -23,24 +30,134 @@ LOCATION = os.getenv("LOCATION")
 MODEL_ID = os.getenv("MODEL_ID") # This should be 'gemini-1.5-flash' in your .env
 service_account_key_path = os.getenv('SERVICE_ACCOUNT_KEY_PATH')
 
-# Initialize Vertex AI
-try:
-    credentials, project_id = google.auth.load_credentials_from_file(service_account_key_path)
-    vertexai.init(project=project_id, location=LOCATION, credentials=credentials)
-    print(f"Vertex AI initialized for project: {project_id}, location: {LOCATION}")
-except Exception as e:
-    print(f"Error initializing Vertex AI: {e}")
-    # You might want to raise this error or handle it more robustly in production
-    exit(1) # Exit if initialization fails, as API calls won't work
-
-# Load the GenerativeModel
-try:
-    model = GenerativeModel(MODEL_ID)
-    print(f"Using model: {MODEL_ID} in project: {project_id}, location: {LOCATION}")
-except Exception as e:
-    print(f"Error loading GenerativeModel '{MODEL_ID}': {e}")
-    # This might indicate an incorrect MODEL_ID or permissions issue
-    exit(1)
+# OAuth scope of the credentials, so they can be refreshed ahead of expiry
+CLOUD_PLATFORM_SCOPE = "https://www.googleapis.com/auth/cloud-platform"
+
+# The Vertex SDK import, credential loading and model creation are deferred to
+# the first request (or warm_up()) so that manage.py commands, migrations and
+# worker boot don't pay for them, and a bad credential fails requests instead
+# of killing the process. The GenerativeModels themselves live in client_pool.
+
+# Endpoint vertexai.init() was last run for
+_vertex_endpoint = None
+
+
+class VertexInitError(Exception):
+    """Raised when Vertex AI credentials or the GenerativeModel cannot be loaded"""
+    pass
+
+
+def _refresh_credentials(credentials):
+    import google.auth.transport.requests
+
+    credentials.refresh(google.auth.transport.requests.Request())
+
+
+def _ping(model: "GenerativeModel"):
+    # count_tokens is not billed, and keeps the channel and the access token in use
+    model.count_tokens("ping")
+
+
+def _create_pool(model_id: str, endpoint: endpoint_pool.Endpoint) -> client_pool.ClientPool:
+    global _vertex_endpoint
+    started = time.time()
+    try:
+        from vertexai.generative_models import GenerativeModel
+
+        # vertexai.init() is process wide, so it is re-run whenever the
+        # next model belongs to another endpoint than the last one
+        if _vertex_endpoint != endpoint.name:
+            import google.auth
+            import vertexai
+
+            credentials, project_id = google.auth.load_credentials_from_file(
+                endpoint.credentials_path or service_account_key_path, scopes=[CLOUD_PLATFORM_SCOPE]
+            )
+            project_id = endpoint.project or project_id
+            location = endpoint.location or LOCATION
+            vertexai.init(project=project_id, location=location, credentials=credentials)
+            client_pool.register_credentials(endpoint.name, credentials, _refresh_credentials)
+            _vertex_endpoint = endpoint.name
+            logger.info(f"Vertex AI initialized for project: {project_id}, location: {location} ({endpoint.name})")
+
+        def create_model():
+            model = GenerativeModel(model_id)
+            # Create the prediction client now, while the SDK is configured for this endpoint
+            getattr(model, "_prediction_client", None)
+            return model
+
+        pool = client_pool.ClientPool(f"{endpoint.name}/{model_id}", create_model, client_pool.pool_size(), ping=_ping)
+    except Exception as e:
+        metrics.increment("vertex.init_failures")
+        logger.error(f"Error initializing Vertex AI model '{model_id}' on endpoint '{endpoint.name}': {e}", exc_info=True)
+        raise VertexInitError(f"Could not initialize Vertex AI model '{model_id}': {e}") from e
+    init_seconds = time.time() - started
+    metrics.observe("vertex.init_seconds", init_seconds)
+    logger.info(f"Vertex AI model {model_id} loaded on endpoint {endpoint.name} in {init_seconds:.2f}s")
+    client_pool.start_maintenance()
+    return pool
+
+
+def get_model_pool(model_id: Optional[str] = None, endpoint: Optional[endpoint_pool.Endpoint] = None) -> client_pool.ClientPool:
+    """
+    Return the VERTEX_CHANNELS GenerativeModels for ``model_id`` (MODEL_ID by
+    default) on ``endpoint`` (the first of VERTEX_ENDPOINTS by default),
+    initializing Vertex AI on first use.
+
+    Thread-safe: concurrent first callers wait for a single initialization.
+    A failed initialization is retried by the next caller.
+
+    Raises:
+        VertexInitError: If credentials, project or model cannot be loaded
+    """
+    model_id = model_id or MODEL_ID
+    endpoint = endpoint or endpoint_pool.endpoints()[0]
+    return client_pool.get_pool((endpoint.name, model_id), lambda: _create_pool(model_id, endpoint))
+
+
+def get_model(model_id: Optional[str] = None, endpoint: Optional[endpoint_pool.Endpoint] = None) -> "GenerativeModel":
+    """
+    Return the least busy GenerativeModel of get_model_pool(), for calls that
+    are not measured (preparation, token counts).
+
+    Raises:
+        VertexInitError: If credentials, project or model cannot be loaded
+    """
+    return get_model_pool(model_id, endpoint).pick()
+
+
+def warm_up(background: bool = False) -> Optional[threading.Thread]:
+    """
+    Initialize Vertex AI ahead of the first request.
+
+    Called from wsgi.py / asgi.py when VERTEX_WARM_UP_ON_START is set. The
+    clients of MODEL_ID on every endpoint are created and, with
+    VERTEX_WARM_UP_CALL, each makes a count_tokens call so its channel is
+    connected and the access token minted. With ``background=True`` this
+    runs on a daemon thread so the worker can start accepting requests
+    immediately; errors are logged, not raised.
+    """
+    def run():
+        started = time.time()
+        for endpoint in endpoint_pool.endpoints():
+            pool = get_model_pool(endpoint=endpoint)
+            if getattr(settings, "VERTEX_WARM_UP_CALL", True):
+                pool.warm_up()
+        metrics.observe("vertex.warm_up_total_seconds", time.time() - started)
+
+    if not background:
+        run()
+        return None
+
+    def run_logged():
+        try:
+            run()
+        except VertexInitError:
+            pass
+
+    thread = threading.Thread(target=run_logged, daemon=True, name="vertex-warm-up")
+    thread.start()
+    return thread
 
 
 # Retry configuration
@@ -49,6 +166,9 @@ INITIAL_RETRY_DELAY = 1  # seconds
 MAX_RETRY_DELAY = 60  # seconds
 BACKOFF_FACTOR = 2
 
+# Input tokens reserved per page/image before the real count is known
+ESTIMATED_TOKENS_PER_PAGE = 600
+
 class APIRateLimitError(Exception):
     """Custom exception for API rate limiting errors"""
     pass
@@ -61,7 +181,15 @@ def exponential_backoff(retry_count):
     logger.debug(f"Calculated retry delay: {total_delay:.2f} seconds (base: {delay:.2f}, jitter: {jitter:.2f})")
     return total_delay
 
-def process_input(input_data) -> Part:
+def _is_rate_limit_error(error: Exception) -> bool:
+    """Return True for quota / 429 / resource exhausted errors from Vertex AI."""
+    return resilience.classify_error(error) == resilience.QUOTA
+
+def _estimate_input_tokens(prompt_text: str, pages: int) -> int:
+    """Rough input token estimate used to reserve tokens-per-minute budget."""
+    return len(prompt_text or "") // 4 + max(1, pages) * ESTIMATED_TOKENS_PER_PAGE
+
+def process_input(input_data) -> "Part":
     """
     Process different types of input data and return the appropriate Part for the API.
     
@@ -71,6 +199,8 @@ def process_input(input_data) -> Part:
     Returns:
         Part: Formatted input part for the Vertex AI API
     """
+    from vertexai.generative_models import Part
+
     # If input is a dictionary (already parsed JSON)
     if isinstance(input_data, dict):
         return Part.from_text(json.dumps(input_data, ensure_ascii=False))
@@ -105,112 +235,466 @@ def process_input(input_data) -> Part:
     # For any other type, convert to string
     return Part.from_text(str(input_data))
 
-def limit_pdf_pages(file_path: str, max_pages: int = 3) -> str:
+def process_input_with_page_limit(input_data, max_pages: int = None) -> tuple["Part", int]:
     """
-    Create a temporary PDF with only the first N pages
+    Process different types of input data with page limitation and return the appropriate Part for the API.
 
     Args:
-        file_path: Path to the original PDF
-        max_pages: Maximum number of pages to include
+        input_data: Can be a file path (str), text (str), or JSON (dict/str)
+        max_pages: Maximum number of pages to process for PDFs
 
     Returns:
-        Path to the limited PDF file
+        tuple: (Part object for API, actual_pages_processed)
     """
-    try:
-        with open(file_path, 'rb') as file:
-            reader = PdfReader(file)
-            writer = PdfWriter()
+    part, actual_pages, _ = _process_input(input_data, max_pages)
+    return part, actual_pages
 
-            # Add only the first max_pages pages
-            pages_to_add = min(len(reader.pages), max_pages)
 
-            for i in range(pages_to_add):
-                writer.add_page(reader.pages[i])
+def _to_part(prepared: preprocessing.PreparedInput) -> "Part":
+    from vertexai.generative_models import Part
 
-            # Create temporary file
-            limited_file_path = file_path.replace('.pdf', f'_limited_{max_pages}pages.pdf')
+    if prepared.data is not None:
+        return Part.from_data(prepared.data, prepared.mime_type)
+    return Part.from_text(prepared.text)
 
-            with open(limited_file_path, 'wb') as output_file:
-                writer.write(output_file)
 
-            logger.info(f"Created limited PDF with {pages_to_add} pages: {limited_file_path}")
-            return limited_file_path
+def _process_input(input_data, max_pages: Optional[int] = None) -> tuple["Part", int, int]:
+    """
+    Build the Part for one input, slicing PDFs to ``max_pages`` in memory.
 
-    except Exception as e:
-        logger.error(f"Error limiting PDF pages: {e}")
-        return file_path  # Return original file if limiting fails
+    Returns:
+        tuple: (Part object for API, actual_pages_processed, total_pages)
+    """
+    # Callers expect a single Part with the original page numbering, so pages are not filtered here
+    prepared = preprocessing.prepare_input(input_data, max_pages, page_level=False)
+    return _to_part(prepared), prepared.pages, prepared.total_pages
 
 
-def process_input_with_page_limit(input_data, max_pages: int = None) -> tuple[Part, int]:
+def _build_content_parts(
+    prompt_text: str,
+    input_data: Optional[Union[str, dict, list]],
+    max_pages: Optional[int],
+    update_progress: Callable[[str], None]
+) -> tuple[list, int, int, Dict[str, Any]]:
     """
-    Process different types of input data with page limitation and return the appropriate Part for the API.
-
-    Args:
-        input_data: Can be a file path (str), text (str), or JSON (dict/str)
-        max_pages: Maximum number of pages to process for PDFs
+    Turn the request input and prompt into the list of Parts sent to the model.
 
     Returns:
-        tuple: (Part object for API, actual_pages_processed)
+        tuple: (content_parts, actual_pages_processed, total_pages, preprocessing_metadata)
     """
-    actual_pages = 1  # Default for non-PDF files
+    from vertexai.generative_models import Part
 
-    # If input is a dictionary (already parsed JSON)
-    if isinstance(input_data, dict):
-        return Part.from_text(json.dumps(input_data, ensure_ascii=False)), actual_pages
+    update_progress("Preparing document for processing...")
 
-    # If input is a string, check if it's a file path or JSON string
-    if isinstance(input_data, str):
-        # Check if it's a valid file path
-        if os.path.exists(input_data):
-            try:
-                # Get MIME type
-                mime_type, _ = mimetypes.guess_type(input_data)
-                if not mime_type:
-                    mime_type = "application/octet-stream"
+    if input_data is not None:
+        update_progress("Processing input data...")
 
-                file_path = input_data
+    prepared, actual_pages_processed, total_pages, metadata = preprocessing.prepare_inputs(input_data, max_pages)
+    content_parts = [_to_part(part) for item in prepared for part in item.parts()]
 
-                # Handle PDF page limitation
-                if mime_type == "application/pdf" and max_pages is not None:
-                    # Get original page count for tracking
-                    try:
-                        with open(input_data, 'rb') as f:
-                            reader = PdfReader(f)
-                            total_pages = len(reader.pages)
-                            actual_pages = min(total_pages, max_pages)
-
-                        file_path = limit_pdf_pages(input_data, max_pages)
-                    except Exception as e:
-                        logger.warning(f"Could not limit PDF pages: {e}, processing full document")
-                        actual_pages = 1  # Fallback
-
-                # Read the (possibly limited) file
-                with open(file_path, "rb") as f:
-                    file_bytes = f.read()
+    # Add prompt text (required)
+    if not prompt_text and not content_parts:
+        raise ValueError("Either prompt_text or input_data must be provided")
 
-                # Clean up temporary limited file
-                if file_path != input_data and os.path.exists(file_path):
-                    try:
-                        os.remove(file_path)
-                    except:
-                        pass  # Ignore cleanup errors
+    if prompt_text:
+        content_parts.append(Part.from_text(prompt_text))
 
-                return Part.from_data(file_bytes, mime_type), actual_pages
+    return content_parts, actual_pages_processed, total_pages, metadata
 
-            except (IOError, OSError):
-                # If file read fails, treat as text
-                pass
 
-        # Check if it's a JSON string
+def _build_generation_config(
+    temperature: float,
+    top_p: float,
+    top_k: int,
+    max_output_tokens: int,
+    response_mime_type: Optional[str] = None,
+    response_schema: Optional[Dict[str, Any]] = None
+) -> "GenerationConfig":
+    """Build the GenerationConfig for a request."""
+    from vertexai.generative_models import GenerationConfig
+
+    generation_config = GenerationConfig(
+        temperature=temperature,
+        top_p=top_p,
+        top_k=top_k,
+        max_output_tokens=max_output_tokens,
+        # Constrains decoding to the prompt's output schema (JSON responses only)
+        response_schema=response_schema,
+    )
+
+    # Add response MIME type if specified
+    if response_mime_type:
+        generation_config.response_mime_type = response_mime_type
+
+    return generation_config
+
+
+def _new_formatted_response(
+    pages_processed: int,
+    total_pages: Optional[int] = None,
+    preprocessing_metadata: Optional[Dict[str, Any]] = None
+) -> Dict[str, Any]:
+    """Return an empty response dict matching the original REST API structure."""
+    return {
+        "candidates": [],
+        "promptFeedback": {
+            "blockReason": None,
+            "safetyRatings": []
+        },
+        "usageMetadata": {
+            "promptTokenCount": 0,
+            "candidatesTokenCount": 0,
+            "totalTokenCount": 0
+        },
+        "pagesProcessed": pages_processed,  # Add metadata about pages processed
+        "totalPages": total_pages or pages_processed,
+        "pagesSkipped": (preprocessing_metadata or {}).get("pages_skipped", []),
+        "preprocessing": preprocessing_metadata or {}
+    }
+
+
+def _remap_skipped_pages(formatted_response: Dict[str, Any], request) -> None:
+    """
+    Rewrite the page_N keys of the response to original page numbers.
+
+    Only needed when blank or duplicate pages were dropped, in which case the
+    model numbered the remaining pages 1..n. Output that is not a JSON object
+    is left unchanged.
+    """
+    page_numbers = request.preprocessing.get("page_mapping")
+    if not page_numbers:
+        return
+    for candidate in formatted_response["candidates"]:
+        for part in candidate["content"]["parts"]:
+            try:
+                parsed = safe_json_load(part.get("text", ""))
+            except (json.JSONDecodeError, TypeError):
+                continue
+            if isinstance(parsed, dict):
+                parsed = page_windows.remap_pages(parsed, page_numbers, request.total_pages)
+            elif isinstance(parsed, list):
+                parsed = [
+                    page_windows.remap_pages(item, page_numbers, request.total_pages) if isinstance(item, dict) else item
+                    for item in parsed
+                ]
+            else:
+                continue
+            part["text"] = json.dumps(parsed, ensure_ascii=False)
+
+
+def _apply_usage_metadata(formatted_response: Dict[str, Any], usage_metadata) -> None:
+    """Copy token counts from an SDK usage_metadata object into a formatted response."""
+    if hasattr(usage_metadata, 'prompt_token_count'):
+        formatted_response["usageMetadata"]["promptTokenCount"] = usage_metadata.prompt_token_count
+    if hasattr(usage_metadata, 'candidates_token_count'):
+        formatted_response["usageMetadata"]["candidatesTokenCount"] = usage_metadata.candidates_token_count
+    if hasattr(usage_metadata, 'total_token_count'):
+        formatted_response["usageMetadata"]["totalTokenCount"] = usage_metadata.total_token_count
+
+
+def _generation_params(
+    temperature: float,
+    top_p: float,
+    top_k: int,
+    max_output_tokens: int,
+    response_mime_type: Optional[str],
+    response_schema: Optional[Dict[str, Any]] = None
+) -> Dict[str, Any]:
+    params = {
+        "temperature": temperature,
+        "top_p": top_p,
+        "top_k": top_k,
+        "max_output_tokens": max_output_tokens,
+        "response_mime_type": response_mime_type,
+    }
+    # Only present when set, so requests without a schema keep their cache keys
+    if response_schema:
+        params["response_schema"] = response_schema
+    return params
+
+
+def _cacheable(formatted_response: Dict[str, Any], response_schema: Optional[Dict[str, Any]]) -> bool:
+    """False for output that does not match the request's schema, so a retry asks the model again."""
+    if not response_schema or not formatted_response["candidates"]:
+        return True
+    text = formatted_response["candidates"][0]["content"]["parts"][0].get("text", "")
+    if output_schema.conforms(text, response_schema):
+        return True
+    logger.warning("Model output does not match the response schema, not caching it")
+    return False
+
+
+def _finish_reason(response) -> Optional[str]:
+    """Name of the finish reason of a response or streamed chunk (e.g. "STOP", "MAX_TOKENS")."""
+    reason = getattr(response, "finish_reason", None)
+    for candidate in getattr(response, "candidates", None) or []:
+        reason = getattr(candidate, "finish_reason", None) or reason
+    if reason is None:
+        return None
+    return getattr(reason, "name", None) or str(reason)
+
+
+def _add_usage(formatted_response: Dict[str, Any], usage: Dict[str, Any]) -> None:
+    for name in ("promptTokenCount", "candidatesTokenCount", "totalTokenCount"):
+        formatted_response["usageMetadata"][name] = (
+            (formatted_response["usageMetadata"].get(name) or 0) + (usage.get(name) or 0)
+        )
+
+
+def _record_salvage(formatted_response: Dict[str, Any], name: str, value: int) -> None:
+    # Kept with the preprocessing statistics so it is stored in processing_metadata
+    if value:
+        salvage = formatted_response["preprocessing"].setdefault("salvage", {})
+        salvage[name] = salvage.get(name, 0) + value
+
+
+def _continue_output(
+    formatted_response: Dict[str, Any],
+    request,
+    backend,
+    update_progress: Callable[[str], None],
+    deadline: resilience.Deadline,
+    attempt_timeout: Optional[float],
+    requester: Optional[rate_limiter.Requester] = None
+) -> int:
+    """
+    Ask the model to continue an answer cut off by max_output_tokens.
+
+    Up to OUTPUT_CONTINUATION_MAX_ROUNDS follow-up calls are made; their text
+    is appended and their tokens added. A failing follow-up ends the
+    continuation and leaves the rest to repair and refill. Follow-up calls
+    take the rate limiter slots of ``requester``.
+
+    Returns:
+        int: Number of continuation calls made
+    """
+    if not formatted_response["candidates"]:
+        return 0
+    candidate = formatted_response["candidates"][0]
+    part = candidate["content"]["parts"][0]
+    max_rounds = int(getattr(settings, "OUTPUT_CONTINUATION_MAX_ROUNDS", 2))
+    rounds = 0
+    while output_salvage.is_truncated(candidate["finishReason"]) and rounds < max_rounds and not deadline.expired():
+        update_progress("Output was cut off, asking the model to continue...")
+        continued = request.continue_from(part["text"])
         try:
-            json_data = json.loads(input_data)
-            return Part.from_text(json.dumps(json_data, ensure_ascii=False)), actual_pages
-        except (json.JSONDecodeError, TypeError):
-            # If not JSON, treat as plain text
-            return Part.from_text(input_data), actual_pages
+            lease = rate_limiter.acquire(
+                _estimate_input_tokens(request.prompt_text, request.pages_processed),
+                on_wait=update_progress,
+                max_wait=deadline.cap(None),
+                cancel_token=deadline.cancel_token,
+                requester=requester
+            )
+        except rate_limiter.RateLimitTimeout as e:
+            logger.warning(f"Continuation of truncated output not sent: {e}")
+            break
+        try:
+            response = resilience.call_with_timeout(
+                lambda: backend.generate(continued, stream=False), deadline.cap(attempt_timeout), deadline.cancel_token
+            )
+        except resilience.CancelledError:
+            rate_limiter.release(lease, outcome="cancelled")
+            raise
+        except Exception as e:
+            error_class = resilience.classify_error(e)
+            rate_limiter.release(lease, outcome="quota" if error_class == resilience.QUOTA else "error")
+            metrics.increment("salvage.continuation_errors")
+            logger.warning(f"Continuation of truncated output failed: {e}")
+            break
+        rate_limiter.release(lease, outcome="success")
+
+        part["text"] += _chunk_text(response)
+        candidate["finishReason"] = _finish_reason(response)
+        usage = {"usageMetadata": {"promptTokenCount": 0, "candidatesTokenCount": 0, "totalTokenCount": 0}}
+        _apply_usage_metadata(usage, getattr(response, "usage_metadata", None))
+        _add_usage(formatted_response, usage["usageMetadata"])
+        rounds += 1
+        metrics.increment("salvage.continuations")
+
+    _record_salvage(formatted_response, "continuations", rounds)
+    return rounds
+
+
+def _repair_output(formatted_response: Dict[str, Any]) -> Optional[str]:
+    """
+    Replace output that does not parse with what output_salvage.repair recovers.
 
-    # For any other type, convert to string
-    return Part.from_text(str(input_data)), actual_pages
+    Returns:
+        str: How the output was repaired, or None if it needed no repair (or
+        nothing could be recovered)
+    """
+    for candidate in formatted_response["candidates"]:
+        for part in candidate["content"]["parts"]:
+            value, method = output_salvage.repair(part.get("text", ""))
+            if method and value is not None:
+                part["text"] = json.dumps(value, ensure_ascii=False)
+                metrics.increment(f"salvage.repaired.{method}")
+                _record_salvage(formatted_response, "repaired", 1)
+                return method
+    return None
+
+
+def _refill_missing_pages(
+    formatted_response: Dict[str, Any],
+    request,
+    update_progress: Callable[[str], None],
+    deadline: resilience.Deadline,
+    call_args: Dict[str, Any]
+) -> List[int]:
+    """
+    Extract the pages missing from page-wise output again and merge them in.
+
+    Only the missing pages of a PDF input are sent, as one new PDF, through
+    call_gemini_api_with_streaming with ``call_args``. Pages that already
+    succeeded are kept as they are.
+
+    Returns:
+        list: Page numbers that were recovered
+    """
+    input_data = request.input_data
+    if not isinstance(input_data, str) or mimetypes.guess_type(input_data)[0] != "application/pdf":
+        return []
+    if not formatted_response["candidates"] or deadline.expired() or not os.path.exists(input_data):
+        return []
+    part = formatted_response["candidates"][0]["content"]["parts"][0]
+    try:
+        parsed = safe_json_load(part.get("text", ""))
+    except (ValueError, TypeError):
+        return []
+    if not output_salvage.is_page_wise(parsed):
+        return []
+    pages = output_salvage.missing_pages(
+        parsed, output_salvage.expected_pages(request.pages_processed, request.preprocessing.get("pages_skipped"))
+    )
+    if not pages:
+        return []
+
+    update_progress(f"Re-extracting {len(pages)} pages missing from the output...")
+    try:
+        with tempfile.TemporaryDirectory(prefix="adp-refill-") as refill_dir:
+            path = os.path.join(refill_dir, "pages.pdf")
+            with pdf_slicing.PdfDocument(input_data) as document, open(path, "wb") as f:
+                f.write(document.select(page - 1 for page in pages))
+            response = call_gemini_api_with_streaming(
+                input_data=path,
+                max_pages=None,
+                progress_callback=lambda message: update_progress(f"[missing pages] {message}"),
+                deadline_seconds=deadline.cap(None),
+                cancel_token=deadline.cancel_token,
+                coalesce=False,
+                refill_pages=False,
+                **call_args
+            )
+        refill, _ = output_salvage.repair(response["candidates"][0]["content"]["parts"][0]["text"])
+    except resilience.CancelledError:
+        raise
+    except Exception as e:
+        metrics.increment("salvage.refill_errors")
+        logger.warning(f"Re-extracting pages {pages} failed: {e}")
+        return []
+    if not isinstance(refill, dict):
+        return []
+
+    # The refill PDF numbers its pages 1..n
+    refill = page_windows.remap_pages(refill, pages, request.total_pages)
+    parsed = output_salvage.fill_pages(parsed, refill, pages)
+    part["text"] = json.dumps(parsed, ensure_ascii=False)
+    _add_usage(formatted_response, response.get("usageMetadata", {}))
+
+    recovered = [page for page in pages if page not in output_salvage.missing_pages(parsed, pages)]
+    metrics.increment("salvage.pages_refilled", len(recovered))
+    _record_salvage(formatted_response, "pages_refilled", len(recovered))
+    return recovered
+
+
+def _salvage_output(
+    formatted_response: Dict[str, Any],
+    request,
+    backend,
+    update_progress: Callable[[str], None],
+    deadline: resilience.Deadline,
+    attempt_timeout: Optional[float],
+    call_args: Optional[Dict[str, Any]],
+    requester: Optional[rate_limiter.Requester] = None
+) -> None:
+    """
+    Recover truncated or malformed output (see output_salvage) and map its
+    pages to original numbers. ``call_args`` are the arguments for
+    re-extracting missing pages, None to skip that step.
+    """
+    if output_salvage.is_enabled():
+        _continue_output(formatted_response, request, backend, update_progress, deadline, attempt_timeout, requester)
+        _repair_output(formatted_response)
+    _remap_skipped_pages(formatted_response, request)
+    if output_salvage.is_enabled() and call_args is not None:
+        _refill_missing_pages(formatted_response, request, update_progress, deadline, call_args)
+
+
+class VertexBackend(extraction_backends.ExtractionBackend):
+    """Send extraction requests to Gemini through the Vertex AI SDK."""
+
+    name = "vertex"
+
+    def prepare(self, request, update_progress):
+        get_model(request.model)
+        request.contents, request.pages_processed, request.total_pages, request.preprocessing = _build_content_parts(
+            request.prompt_text, request.input_data, request.max_pages, update_progress
+        )
+        return request.pages_processed
+
+    def generate(self, request, stream=False):
+        contents = request.contents
+        if request.continuation is not None:
+            from vertexai.generative_models import Content, Part
+
+            # The partial answer goes back as the model's own turn, so it continues rather than restarts
+            contents = [
+                Content(role="user", parts=request.contents),
+                Content(role="model", parts=[Part.from_text(request.continuation)]),
+                Content(role="user", parts=[Part.from_text(output_salvage.CONTINUE_PROMPT)]),
+            ]
+        generation_config = _build_generation_config(**request.generation_params)
+
+        def call(endpoint):
+            pool = get_model_pool(request.model, endpoint)
+            if stream:
+                return _leased_stream(pool, request.pages_sent, contents, generation_config)
+            with pool.lease(request.pages_sent) as model:
+                return model.generate_content(contents=contents, generation_config=generation_config)
+
+        return endpoint_pool.call(call, request.pages_sent, stream)
+
+    def count_tokens(self, request):
+        return get_model(request.model).count_tokens(request.contents).total_tokens
+
+
+def _leased_stream(pool: client_pool.ClientPool, pages: int, contents, generation_config) -> Iterator:
+    # The client stays leased until the last chunk has been read
+    with pool.lease(pages) as model:
+        yield from model.generate_content(contents=contents, generation_config=generation_config, stream=True)
+
+
+def _request_key(
+    prompt_text: str,
+    input_data: Optional[Union[str, dict, list]],
+    max_pages: Optional[int],
+    temperature: float,
+    top_p: float,
+    top_k: int,
+    max_output_tokens: int,
+    response_mime_type: Optional[str],
+    route: model_routing.Route,
+    response_schema: Optional[Dict[str, Any]] = None
+) -> str:
+    """Identity of a request, shared by the result cache and request coalescing."""
+    return extraction_cache.make_key(
+        extraction_cache.fingerprint_input(input_data),
+        prompt_text,
+        route.key,
+        max_pages,
+        _generation_params(temperature, top_p, top_k, max_output_tokens, response_mime_type, response_schema),
+        preprocessing.fingerprint(),
+    )
 
 
 def call_gemini_api_with_streaming(
@@ -223,7 +707,18 @@ def call_gemini_api_with_streaming(
     top_k: int = 32,
     max_output_tokens: int = 65536,
     max_pages: int = None,
-    progress_callback: Optional[Callable[[str], None]] = None
+    progress_callback: Optional[Callable[[str], None]] = None,
+    use_cache: bool = True,
+    deadline_seconds: Optional[float] = None,
+    attempt_timeout: Optional[float] = None,
+    coalesce: bool = True,
+    doc_type: Optional[str] = None,
+    user_type: Optional[str] = None,
+    route: Optional[model_routing.Route] = None,
+    response_schema: Optional[Dict[str, Any]] = None,
+    refill_pages: bool = True,
+    cancel_token: Optional[resilience.CancelToken] = None,
+    user_id: Optional[int] = None
 ) -> Dict[str, Any]:
     """
     Call Gemini API with flexible input handling, page limitation, and streaming progress updates.
@@ -239,12 +734,31 @@ def call_gemini_api_with_streaming(
         max_output_tokens: Maximum number of tokens to generate
         max_pages: Maximum number of pages to process for PDFs
         progress_callback: Optional callback function for progress updates
+        use_cache: Serve identical requests from the extraction result cache
+        deadline_seconds: Time budget covering all attempts (VERTEX_REQUEST_DEADLINE_SECONDS)
+        attempt_timeout: Timeout of a single model call (VERTEX_ATTEMPT_TIMEOUT_SECONDS)
+        coalesce: Share the result of an identical request already in flight
+        doc_type: Document type, used to pick the model route
+        user_type: Tier of the requesting user, used to pick the model route and
+            the rate limiter slots (see rate_limiter.Requester)
+        route: Model route to use instead of selecting one from MODEL_ROUTES
+        response_schema: Optional output schema (see output_schema) constraining the response
+        refill_pages: Re-extract pages missing from truncated output (see output_salvage)
+        cancel_token: Cancels the model call in flight and any pending retry,
+            e.g. when the client disconnected
+        user_id: Id of the requesting user, for their share of the rate limiter
 
     Returns:
-        dict: API response with additional metadata about pages processed
+        dict: API response with additional metadata about pages processed and
+        the model used (``modelUsed``)
 
     Raises:
         APIRateLimitError: If rate limited and max retries exceeded
+        CircuitOpenError: If Vertex AI is failing and calls are being rejected
+        DeadlineExceededError: If the request deadline ran out before a success
+        CancelledError: If ``cancel_token`` was cancelled before a success
+        DocumentTooLargeError: If the document would need more memory than the worker's budget
+        MemoryBudgetTimeout: If memory to process the document did not free up in time
         Exception: For other API errors
     """
 
@@ -253,56 +767,160 @@ def call_gemini_api_with_streaming(
             progress_callback(message)
         logger.info(f"Progress: {message}")
 
-    for attempt in range(max_retries + 1):
-        try:
-            update_progress("Preparing document for processing...")
-
-            # Process the input data if provided
-            content_parts = []
-            actual_pages_processed = 1
-
-            if input_data is not None:
-                update_progress("Processing input data...")
-
-                # Handle multiple inputs (list/tuple)
-                if isinstance(input_data, (list, tuple)):
-                    for item in input_data:
-                        part, pages = process_input_with_page_limit(item, max_pages)
-                        content_parts.append(part)
-                        actual_pages_processed = max(actual_pages_processed, pages)
-                else:
-                    part, actual_pages_processed = process_input_with_page_limit(input_data, max_pages)
-                    content_parts.append(part)
-
-            # Add prompt text (required)
-            if not prompt_text and not content_parts:
-                raise ValueError("Either prompt_text or input_data must be provided")
+    route = route or model_routing.route_for(input_data, max_pages, doc_type, user_type, MODEL_ID)
+    request_key = _request_key(
+        prompt_text, input_data, max_pages, temperature, top_p, top_k,
+        max_output_tokens, response_mime_type, route, response_schema
+    )
 
-            if prompt_text:
-                content_parts.append(Part.from_text(prompt_text))
+    cache_key = None
+    if use_cache and extraction_cache.is_enabled():
+        cache_key = request_key
+        cached_response = extraction_cache.get(cache_key)
+        if cached_response is not None:
+            update_progress("Returning cached extraction result...")
+            return extraction_cache.as_cache_hit(cached_response)
 
-            update_progress("Configuring AI model...")
+    deadline = resilience.Deadline(
+        deadline_seconds or getattr(settings, "VERTEX_REQUEST_DEADLINE_SECONDS", 300), cancel_token
+    )
 
-            # Configure generation parameters
-            generation_config = GenerationConfig(
+    def generate():
+        # The document stays in memory until the model has answered
+        with memory_budget.admit(memory_budget.estimate(input_data, max_pages), deadline, update_progress) as reservation:
+            response = _generate_with_retries(
+                prompt_text=prompt_text,
+                input_data=input_data,
+                response_mime_type=response_mime_type,
+                max_retries=max_retries,
                 temperature=temperature,
                 top_p=top_p,
                 top_k=top_k,
                 max_output_tokens=max_output_tokens,
+                max_pages=max_pages,
+                update_progress=update_progress,
+                cache_key=cache_key,
+                deadline=deadline,
+                attempt_timeout=attempt_timeout or getattr(settings, "VERTEX_ATTEMPT_TIMEOUT_SECONDS", 120),
+                route=route,
+                response_schema=response_schema,
+                refill_pages=refill_pages,
+                requester=rate_limiter.Requester(user_type, user_id),
+                doc_type=doc_type,
             )
+        response.setdefault("preprocessing", {})["memory"] = reservation.report()
+        return response
+
+    if not coalesce:
+        return generate()
+
+    # Identical requests already running in this or another worker are awaited
+    # instead of being sent to Gemini a second time, within this request's deadline.
+    return singleflight.run(request_key, generate, on_wait=update_progress, deadline=deadline)
+
+
+def _generate_with_retries(
+    prompt_text: str,
+    input_data: Optional[Union[str, dict, list]],
+    response_mime_type: Optional[str],
+    max_retries: int,
+    temperature: float,
+    top_p: float,
+    top_k: int,
+    max_output_tokens: int,
+    max_pages: Optional[int],
+    update_progress: Callable[[str], None],
+    cache_key: Optional[str] = None,
+    deadline: Optional[resilience.Deadline] = None,
+    attempt_timeout: Optional[float] = None,
+    route: Optional[model_routing.Route] = None,
+    response_schema: Optional[Dict[str, Any]] = None,
+    refill_pages: bool = True,
+    requester: Optional[rate_limiter.Requester] = None,
+    doc_type: Optional[str] = None
+) -> Dict[str, Any]:
+    """
+    Send the request to Gemini, retrying on failure, and cache a successful response.
+
+    Arguments mirror call_gemini_api_with_streaming; ``cache_key`` is the extraction
+    cache entry to populate, or None when caching is disabled for this call.
+    Only quota and transient errors are retried, and never past ``deadline``.
+    A model of ``route`` that is rate limited or failing is replaced by the
+    next model of the chain for the following attempts. Output that does
+    not match ``response_schema`` is returned but not cached. Truncated or
+    malformed output is salvaged before it is returned. Cancelling the
+    deadline's cancel_token abandons the call in flight, frees its rate
+    limiter lease and ends any backoff. Every call queues for the rate
+    limiter slots of ``requester``.
+    """
+    deadline = deadline or resilience.Deadline(None)
+    requester = requester or rate_limiter.Requester()
+    route = route or model_routing.Route(model_routing.DEFAULT_ROUTE, [MODEL_ID])
+    backend = extraction_backends.get_backend()
+    request = None
+    failed_models = set()
+    refill_args = dict(
+        prompt_text=prompt_text, response_mime_type=response_mime_type, max_retries=max_retries,
+        temperature=temperature, top_p=top_p, top_k=top_k, max_output_tokens=max_output_tokens,
+        attempt_timeout=attempt_timeout, route=route, response_schema=response_schema,
+        user_type=None if requester.tier == rate_limiter.SYSTEM_TIER else requester.tier,
+        user_id=requester.user_key, doc_type=doc_type,
+    ) if refill_pages else None
+
+    for attempt in range(max_retries + 1):
+        model = None
+        circuit = None
+        try:
+            deadline.check()
+            model = model_routing.select_model(route, failed_models)
+            circuit = model_routing.circuit(model)
+
+            # The document is read and sliced once and reused by every retry
+            if request is None:
+                prepared = extraction_backends.ExtractionRequest(
+                    prompt_text, input_data, max_pages,
+                    _generation_params(temperature, top_p, top_k, max_output_tokens, response_mime_type, response_schema),
+                    doc_type
+                )
+                prepared.model = model
+                backend.prepare(prepared, update_progress)
+                request = prepared
+            request.model = model
+            actual_pages_processed = request.pages_processed
 
-            # Add response MIME type if specified
-            if response_mime_type:
-                generation_config.response_mime_type = response_mime_type
+            update_progress("Configuring AI model...")
 
             update_progress("Sending request to AI model...")
 
+            # Queue for the shared request/token budget instead of racing other workers
+            lease = rate_limiter.acquire(
+                _estimate_input_tokens(prompt_text, actual_pages_processed),
+                on_wait=update_progress,
+                max_wait=deadline.cap(None),
+                cancel_token=deadline.cancel_token,
+                requester=requester
+            )
+
             try:
-                response = model.generate_content(
-                    contents=content_parts,
-                    generation_config=generation_config,
-                    stream=False
-                )
+                try:
+                    # A call slower than recent ones may be raced by a second, identical call.
+                    # hedging releases the lease once the call it covers has finished.
+                    response = hedging.call(
+                        lambda: backend.generate(request, stream=False),
+                        request.pages_sent,
+                        deadline.cap(attempt_timeout),
+                        _estimate_input_tokens(prompt_text, actual_pages_processed),
+                        deadline.cancel_token,
+                        lease=lease,
+                        requester=requester,
+                        used_tokens=lambda result: getattr(getattr(result, 'usage_metadata', None), 'prompt_token_count', None)
+                    )
+                except resilience.CancelledError:
+                    raise
+                except Exception as e:
+                    circuit.record(resilience.classify_error(e))
+                    raise
+                circuit.record_success()
 
                 update_progress("Processing AI response...")
 
@@ -310,19 +928,11 @@ def call_gemini_api_with_streaming(
                     raise ValueError("API returned empty response")
 
                 # Format response to match the original API structure
-                formatted_response = {
-                    "candidates": [],
-                    "promptFeedback": {
-                        "blockReason": None,
-                        "safetyRatings": []
-                    },
-                    "usageMetadata": {
-                        "promptTokenCount": 0,
-                        "candidatesTokenCount": 0,
-                        "totalTokenCount": 0
-                    },
-                    "pagesProcessed": actual_pages_processed  # Add metadata about pages processed
-                }
+                formatted_response = _new_formatted_response(actual_pages_processed, request.total_pages, request.preprocessing)
+                formatted_response["modelUsed"] = model
+                formatted_response["route"] = route.name
+
+                finish_reason = _finish_reason(response)
 
                 # First try to get the response text directly
                 response_text = None
@@ -337,7 +947,7 @@ def call_gemini_api_with_streaming(
                             "parts": [{"text": response_text}],
                             "role": "model"
                         },
-                        "finishReason": None,
+                        "finishReason": finish_reason,
                         "safetyRatings": []
                     }
                     formatted_response["candidates"].append(candidate_data)
@@ -353,7 +963,7 @@ def call_gemini_api_with_streaming(
                                     "parts": [],
                                     "role": "model"
                                 },
-                                "finishReason": None,
+                                "finishReason": finish_reason,
                                 "safetyRatings": []
                             }
 
@@ -367,16 +977,21 @@ def call_gemini_api_with_streaming(
 
                 # Update usage metadata if available
                 if hasattr(response, 'usage_metadata'):
-                    if hasattr(response.usage_metadata, 'prompt_token_count'):
-                        formatted_response["usageMetadata"]["promptTokenCount"] = response.usage_metadata.prompt_token_count
-                    if hasattr(response.usage_metadata, 'candidates_token_count'):
-                        formatted_response["usageMetadata"]["candidatesTokenCount"] = response.usage_metadata.candidates_token_count
-                    if hasattr(response.usage_metadata, 'total_token_count'):
-                        formatted_response["usageMetadata"]["totalTokenCount"] = response.usage_metadata.total_token_count
+                    _apply_usage_metadata(formatted_response, response.usage_metadata)
+
+                _salvage_output(
+                    formatted_response, request, backend, update_progress, deadline, attempt_timeout, refill_args,
+                    requester
+                )
+
+                if cache_key and formatted_response["candidates"] and _cacheable(formatted_response, response_schema):
+                    extraction_cache.put(cache_key, formatted_response)
 
                 update_progress("Document processing completed successfully!")
                 return formatted_response
 
+            except resilience.CancelledError:
+                raise
             except Exception as e:
                 error_msg = str(e)
                 logger.error(f"Error processing Gemini API response: {error_msg}", exc_info=True)
@@ -384,14 +999,43 @@ def call_gemini_api_with_streaming(
                 raise Exception(f"Failed to process API response: {error_msg}") from e
 
         except Exception as e:
-            error_str = str(e).lower()
+            if isinstance(e, rate_limiter.RateLimitTimeout):
+                update_progress(f"Processing failed: {str(e)}")
+                raise APIRateLimitError(str(e)) from e
+
+            if isinstance(e, resilience.CancelledError):
+                update_progress("Processing cancelled.")
+                raise
+
+            if isinstance(e, (resilience.CircuitOpenError, resilience.DeadlineExceededError)):
+                update_progress(f"Processing failed: {str(e)}")
+                raise
+
+            error_class = resilience.classify_error(e)
+            metrics.increment(f"resilience.errors.{error_class}")
+
+            # Permanent errors (bad input, invalid arguments, unparsable output) are not retried
+            if error_class == resilience.FATAL:
+                metrics.increment("resilience.not_retried")
+                update_progress(f"Processing failed: {str(e)}")
+                raise Exception(f"API request failed with a non-retryable error: {str(e)}") from e
+
+            # A rate limited or failing model hands the request to the next one in its route
+            if _fall_back(route, model, failed_models, error_class) and attempt < max_retries:
+                update_progress(f"Model {model} unavailable, retrying with the next model... (Attempt {attempt + 1}/{max_retries})")
+                continue
 
             # Check for rate limiting or quota errors
-            if any(term in error_str for term in ['rate limit', 'quota', '429', 'resource exhausted']):
+            if error_class == resilience.QUOTA:
                 if attempt < max_retries:
+                    if rate_limiter.is_enabled():
+                        # The shared limiter has started a cooldown; the next
+                        # acquire() waits in the queue instead of sleeping here.
+                        update_progress(f"Rate limited. Re-queuing request... (Attempt {attempt + 1}/{max_retries})")
+                        continue
                     retry_delay = exponential_backoff(attempt)
                     update_progress(f"Rate limited. Retrying in {retry_delay:.2f} seconds... (Attempt {attempt + 1}/{max_retries})")
-                    time.sleep(retry_delay)
+                    deadline.sleep(retry_delay)
                     continue
                 else:
                     raise APIRateLimitError(
@@ -399,15 +1043,505 @@ def call_gemini_api_with_streaming(
                         f"Please wait before making more requests."
                     )
 
-            # For other errors, retry with exponential backoff
+            # For transient errors, retry with exponential backoff within the deadline
             if attempt < max_retries:
                 retry_delay = exponential_backoff(attempt)
+                if retry_delay >= deadline.remaining():
+                    metrics.increment("resilience.deadline_exceeded")
+                    update_progress(f"Processing failed: {str(e)}")
+                    raise resilience.DeadlineExceededError(
+                        f"Request deadline reached after {attempt + 1} attempts: {str(e)}"
+                    ) from e
+                metrics.increment("resilience.retries")
                 update_progress(f"Request failed: {str(e)}. Retrying in {retry_delay:.2f} seconds... (Attempt {attempt + 1}/{max_retries})")
-                time.sleep(retry_delay)
+                deadline.sleep(retry_delay)
                 continue
 
             update_progress(f"Processing failed: {str(e)}")
             raise Exception(f"API request failed after {max_retries} retries: {str(e)}")
+        finally:
+            # A half-open probe whose call never happened is given back
+            if circuit is not None:
+                circuit.release_probe()
+
+
+def _fall_back(route: model_routing.Route, model: Optional[str], failed_models: set, error_class: str) -> bool:
+    """
+    Record a quota or transient failure of ``model`` and return True if
+    another model of ``route`` can take the next attempt.
+    """
+    if error_class == resilience.QUOTA:
+        model_routing.record_quota_error(model)
+    if len(route.models) < 2:
+        return False
+    failed_models.add(model)
+    return model_routing.has_fallback(route, failed_models)
+
+
+def _chunk_text(chunk) -> str:
+    """Return the text carried by one streamed response chunk, if any."""
+    try:
+        return chunk.text or ""
+    except (ValueError, AttributeError):
+        # Chunks without text parts (e.g. the final usage-only chunk) raise here
+        return ""
+
+
+def stream_gemini_api(
+    prompt_text: str,
+    input_data: Optional[Union[str, dict, list]] = None,
+    response_mime_type: Optional[str] = None,
+    max_retries: int = MAX_RETRIES,
+    temperature: float = 0.9,
+    top_p: float = 1.0,
+    top_k: int = 32,
+    max_output_tokens: int = 65536,
+    max_pages: int = None,
+    use_cache: bool = True,
+    doc_type: Optional[str] = None,
+    user_type: Optional[str] = None,
+    response_schema: Optional[Dict[str, Any]] = None,
+    cancel_token: Optional[resilience.CancelToken] = None,
+    user_id: Optional[int] = None,
+    progress_callback: Optional[Callable[[str], None]] = None
+) -> Iterator[Dict[str, Any]]:
+    """
+    Call Gemini with stream=True and yield events while the response is generated.
+
+    Arguments match call_gemini_api_with_streaming. Retries only happen before the
+    first token arrives; once data has been emitted a failure is raised to the caller.
+    Cancelling ``cancel_token`` closes the stream at the next chunk and raises
+    CancelledError.
+
+    Progress reported while the generator is blocked (waiting for memory or a
+    rate limiter slot, preprocessing, re-extracting pages) goes to
+    ``progress_callback`` as it happens. Without a callback it is yielded as
+    progress events once the wait is over.
+
+    Yields:
+        dict: Events with a "type" of
+            - "progress": {"message": str}
+            - "member": {"key": str, "value": Any}, one per completed top-level
+              JSON member (each page_N object of the doc_extraction_prompt output)
+            - "complete": {"response": dict}, the formatted response as returned by
+              call_gemini_api_with_streaming
+    """
+    pending = []
+
+    def progress(message: str) -> Dict[str, Any]:
+        logger.info(f"Progress: {message}")
+        return {"type": "progress", "message": message}
+
+    def report(message: str):
+        if progress_callback is None:
+            pending.append(message)
+            return
+        logger.info(f"Progress: {message}")
+        progress_callback(message)
+
+    def drain():
+        while pending:
+            yield progress(pending.pop(0))
+
+    route = model_routing.route_for(input_data, max_pages, doc_type, user_type, MODEL_ID)
+    request_key = _request_key(
+        prompt_text, input_data, max_pages, temperature, top_p, top_k,
+        max_output_tokens, response_mime_type, route, response_schema
+    )
+
+    cache_key = None
+    if use_cache and extraction_cache.is_enabled():
+        cache_key = request_key
+        cached_response = extraction_cache.get(cache_key)
+        if cached_response is not None:
+            yield progress("Returning cached extraction result...")
+            served = extraction_cache.as_cache_hit(cached_response)
+            parser = IncrementalObjectParser()
+            for candidate in served["candidates"][:1]:
+                for key, value in parser.feed(candidate["content"]["parts"][0]["text"]):
+                    yield {"type": "member", "key": key, "value": value}
+            yield {"type": "complete", "response": served}
+            return
+
+    deadline = resilience.Deadline(getattr(settings, "VERTEX_REQUEST_DEADLINE_SECONDS", 300), cancel_token)
+    backend = extraction_backends.get_backend()
+    requester = rate_limiter.Requester(user_type, user_id)
+    request = None
+    failed_models = set()
+    refill_args = dict(
+        prompt_text=prompt_text, response_mime_type=response_mime_type, max_retries=max_retries,
+        temperature=temperature, top_p=top_p, top_k=top_k, max_output_tokens=max_output_tokens,
+        route=route, response_schema=response_schema, user_type=user_type, user_id=user_id, doc_type=doc_type,
+    )
+
+    # The document stays in memory until the stream has ended
+    with memory_budget.admit(memory_budget.estimate(input_data, max_pages), deadline, report) as reservation:
+        for attempt in range(max_retries + 1):
+            emitted = False
+            model = None
+            circuit = None
+            try:
+                deadline.check()
+                model = model_routing.select_model(route, failed_models)
+                circuit = model_routing.circuit(model)
+
+                if request is None:
+                    prepared = extraction_backends.ExtractionRequest(
+                        prompt_text, input_data, max_pages,
+                        _generation_params(temperature, top_p, top_k, max_output_tokens, response_mime_type, response_schema),
+                        doc_type
+                    )
+                    prepared.model = model
+                    backend.prepare(prepared, report)
+                    request = prepared
+                request.model = model
+                actual_pages_processed = request.pages_processed
+                yield from drain()
+
+                yield progress("Sending request to AI model...")
+                lease = rate_limiter.acquire(
+                    _estimate_input_tokens(prompt_text, actual_pages_processed),
+                    on_wait=report,
+                    max_wait=deadline.cap(None),
+                    cancel_token=cancel_token,
+                    requester=requester
+                )
+
+                formatted_response = _new_formatted_response(actual_pages_processed, request.total_pages, request.preprocessing)
+                formatted_response["modelUsed"] = model
+                formatted_response["route"] = route.name
+                parser = IncrementalObjectParser()
+                text_chunks = []
+                finish_reason = None
+
+                responses = None
+                try:
+                    yield from drain()
+                    request_start = time.time()
+                    responses = backend.generate(request, stream=True)
+
+                    for chunk in responses:
+                        if cancel_token is not None:
+                            cancel_token.check()
+                        chunk_text = _chunk_text(chunk)
+                        if chunk_text:
+                            if not emitted:
+                                emitted = True
+                                metrics.observe("gemini.stream.first_token_seconds", time.time() - request_start)
+                                yield progress("Receiving extracted data...")
+                            text_chunks.append(chunk_text)
+                            for key, value in parser.feed(chunk_text):
+                                if request.preprocessing.get("page_mapping"):
+                                    (key, value), = page_windows.remap_pages(
+                                        {key: value}, request.preprocessing["page_mapping"], request.total_pages
+                                    ).items()
+                                yield {"type": "member", "key": key, "value": value}
+                        if getattr(chunk, 'usage_metadata', None):
+                            _apply_usage_metadata(formatted_response, chunk.usage_metadata)
+                        finish_reason = _finish_reason(chunk) or finish_reason
+                except resilience.CancelledError:
+                    # Closing the stream ends the call instead of reading it to the end
+                    if hasattr(responses, "close"):
+                        responses.close()
+                    rate_limiter.release(lease, outcome="cancelled")
+                    raise
+                except Exception as e:
+                    error_class = resilience.classify_error(e)
+                    rate_limiter.release(lease, outcome="quota" if error_class == resilience.QUOTA else "error")
+                    circuit.record(error_class)
+                    raise
+                except BaseException:
+                    # The consumer closed the stream (GeneratorExit) or the process is stopping:
+                    # nothing is learned about the model
+                    if hasattr(responses, "close"):
+                        responses.close()
+                    rate_limiter.release(lease, outcome="cancelled")
+                    raise
+                circuit.record_success()
+                rate_limiter.release(
+                    lease,
+                    outcome="success",
+                    actual_tokens=formatted_response["usageMetadata"]["promptTokenCount"] or None
+                )
+
+                response_text = "".join(text_chunks)
+                if not response_text:
+                    raise ValueError("API returned empty response")
+
+                metrics.observe("gemini.stream.total_seconds", time.time() - request_start)
+                formatted_response["candidates"].append({
+                    "content": {
+                        "parts": [{"text": response_text}],
+                        "role": "model"
+                    },
+                    "finishReason": finish_reason,
+                    "safetyRatings": []
+                })
+                # Pages completed after a cut-off are in the complete event, not streamed as members
+                _salvage_output(
+                    formatted_response, request, backend, report, deadline,
+                    getattr(settings, "VERTEX_ATTEMPT_TIMEOUT_SECONDS", 120), refill_args, requester
+                )
+                yield from drain()
+
+                if cache_key and _cacheable(formatted_response, response_schema):
+                    extraction_cache.put(cache_key, formatted_response)
+
+                formatted_response["preprocessing"]["memory"] = reservation.report()
+                yield progress("Document processing completed successfully!")
+                yield {"type": "complete", "response": formatted_response}
+                return
+
+            except resilience.CancelledError:
+                yield progress("Processing cancelled.")
+                raise
+            except Exception as e:
+                logger.error(f"Error during streamed Gemini request: {e}", exc_info=True)
+                if isinstance(e, rate_limiter.RateLimitTimeout):
+                    raise APIRateLimitError(str(e)) from e
+                if isinstance(e, (resilience.CircuitOpenError, resilience.DeadlineExceededError)):
+                    raise
+                error_class = resilience.classify_error(e)
+                metrics.increment(f"resilience.errors.{error_class}")
+                if emitted or error_class == resilience.FATAL or attempt >= max_retries:
+                    raise Exception(f"Streaming API request failed: {str(e)}") from e
+
+                if _fall_back(route, model, failed_models, error_class):
+                    yield progress(f"Model {model} unavailable, retrying with the next model... (Attempt {attempt + 1}/{max_retries})")
+                    continue
+
+                if _is_rate_limit_error(e) and rate_limiter.is_enabled():
+                    yield progress(f"Rate limited. Re-queuing request... (Attempt {attempt + 1}/{max_retries})")
+                    continue
+
+                retry_delay = exponential_backoff(attempt)
+                if retry_delay >= deadline.remaining():
+                    metrics.increment("resilience.deadline_exceeded")
+                    raise resilience.DeadlineExceededError(
+                        f"Request deadline reached after {attempt + 1} attempts: {str(e)}"
+                    ) from e
+                metrics.increment("resilience.retries")
+                yield progress(f"Request failed: {str(e)}. Retrying in {retry_delay:.2f} seconds... (Attempt {attempt + 1}/{max_retries})")
+                deadline.sleep(retry_delay)
+            finally:
+                # A half-open probe whose call never happened is given back
+                if circuit is not None:
+                    circuit.release_probe()
+
+
+def call_gemini_api_windowed(
+    prompt_text: str,
+    input_data: str,
+    response_mime_type: Optional[str] = "application/json",
+    max_retries: int = MAX_RETRIES,
+    max_pages: int = None,
+    progress_callback: Optional[Callable[[str], None]] = None,
+    window_size: Optional[int] = None,
+    max_workers: Optional[int] = None,
+    doc_type: Optional[str] = None,
+    user_type: Optional[str] = None,
+    response_schema: Optional[Dict[str, Any]] = None,
+    cancel_token: Optional[resilience.CancelToken] = None,
+    user_id: Optional[int] = None
+) -> Dict[str, Any]:
+    """
+    Extract a large PDF by sending page windows to Gemini concurrently.
+
+    The PDF is split into windows of ``window_size`` pages (adapted from observed
+    latency when not given). Windows run on a bounded thread pool and their
+    page_N objects are merged back with global page numbers. The first window
+    that fails cancels the windows still running. Inputs that are not PDFs, or
+    that fit in one window, go through call_gemini_api_with_streaming.
+
+    Args:
+        prompt_text: The prompt text sent with every window
+        input_data: Path of the document to process
+        response_mime_type: MIME type for the response (JSON is required for merging)
+        max_retries: Maximum number of retry attempts per window
+        max_pages: Maximum number of pages to process, None for the whole document
+        progress_callback: Optional callback function for progress updates
+        window_size: Pages per window; defaults to the adaptive controller's choice
+        max_workers: Upper bound on concurrent windows; defaults to the controller's choice
+        doc_type: Document type, used to pick the model route
+        user_type: Tier of the requesting user, used to pick the model route and
+            the rate limiter slots every window queues for
+        response_schema: Optional output schema sent with every window
+        cancel_token: Cancels every window in flight and the windows not yet sent
+        user_id: Id of the requesting user, for their share of the rate limiter
+
+    Returns:
+        dict: Formatted response whose single candidate holds the merged JSON,
+        with summed usageMetadata and a ``windows`` list describing each window
+    """
+
+    def update_progress(message: str):
+        if progress_callback:
+            progress_callback(message)
+        logger.info(f"Progress: {message}")
+
+    # The route is chosen once for the whole document, not per window
+    route = model_routing.route_for(input_data, max_pages, doc_type, user_type, MODEL_ID)
+
+    def single_call():
+        return call_gemini_api_with_streaming(
+            prompt_text=prompt_text,
+            input_data=input_data,
+            response_mime_type=response_mime_type,
+            max_retries=max_retries,
+            max_pages=max_pages,
+            progress_callback=progress_callback,
+            doc_type=doc_type,
+            user_type=user_type,
+            route=route,
+            response_schema=response_schema,
+            cancel_token=cancel_token,
+            user_id=user_id
+        )
+
+    mime_type, _ = mimetypes.guess_type(input_data) if isinstance(input_data, str) else (None, None)
+    if mime_type != "application/pdf" or not os.path.exists(input_data):
+        return single_call()
+
+    try:
+        document = pdf_slicing.PdfDocument(input_data)
+        total_pages = document.page_count
+    except Exception as e:
+        logger.warning(f"Could not read PDF for page windows: {e}, processing as a single request")
+        return single_call()
+
+    if max_pages is not None:
+        total_pages = min(total_pages, max_pages)
+
+    window_size = window_size or page_windows.controller.window_size()
+    if total_pages <= window_size:
+        document.close()
+        return single_call()
+
+    ranges = page_windows.split_page_ranges(total_pages, window_size)
+    update_progress(f"Splitting {total_pages} pages into {len(ranges)} windows of up to {window_size} pages...")
+
+    with tempfile.TemporaryDirectory(prefix="adp-windows-") as window_dir:
+        window_paths = {}
+        with document:
+            for start, end in ranges:
+                path = os.path.join(window_dir, f"pages_{start + 1}_{end}.pdf")
+                with open(path, "wb") as f:
+                    f.write(document.slice(start, end))
+                window_paths[(start, end)] = path
+
+        def run_window(page_range, window_token):
+            start, end = page_range
+            window_start = time.time()
+
+            def window_progress(message):
+                update_progress(f"[pages {start + 1}-{end}] {message}")
+
+            try:
+                response = call_gemini_api_with_streaming(
+                    prompt_text=prompt_text,
+                    input_data=window_paths[page_range],
+                    response_mime_type=response_mime_type,
+                    max_retries=max_retries,
+                    progress_callback=window_progress,
+                    doc_type=doc_type,
+                    user_type=user_type,
+                    route=route,
+                    response_schema=response_schema,
+                    cancel_token=window_token,
+                    user_id=user_id
+                )
+            except resilience.CancelledError:
+                # Says nothing about the window size that was used
+                raise
+            except Exception:
+                page_windows.controller.record(end - start, time.time() - window_start, ok=False)
+                raise
+            latency = time.time() - window_start
+            # Cached and coalesced windows did not call the model at this window size
+            if not response.get("cacheHit") and not response.get("coalesced"):
+                page_windows.controller.record(end - start, latency, ok=True)
+            return response, latency
+
+        results = {}
+        pending = list(ranges)
+        pool_size = max_workers or int(getattr(settings, "PAGE_WINDOW_MAX_WORKERS", 4))
+        with ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="page-window") as executor:
+            running = {}
+            window_tokens = {}
+            while pending or running:
+                # Re-read the allowed fan-out each round so it adapts mid-document
+                allowed = min(pool_size, max_workers or page_windows.controller.concurrency())
+                while pending and len(running) < allowed:
+                    page_range = pending.pop(0)
+                    window_token = cancel_token.child() if cancel_token is not None else resilience.CancelToken()
+                    future = executor.submit(run_window, page_range, window_token)
+                    running[future] = page_range
+                    window_tokens[future] = window_token
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    page_range = running.pop(future)
+                    window_tokens.pop(future)
+                    try:
+                        results[page_range] = future.result()
+                    except Exception:
+                        # Stop the windows already calling Gemini; the executor waits for them on exit
+                        for other in running:
+                            other.cancel()
+                            window_tokens[other].cancel(resilience.CancelToken.SIBLING_FAILED)
+                        raise
+                    update_progress(f"Finished pages {page_range[0] + 1}-{page_range[1]} ({len(results)}/{len(ranges)} windows)")
+
+    window_results = []
+    window_info = []
+    pages_skipped = []
+    for (start, end), (response, latency) in sorted(results.items()):
+        # Skipped pages are reported with window-local numbers
+        for page in response.get("pagesSkipped", []):
+            shifted = {**page, "page": page["page"] + start}
+            if "duplicateOf" in page:
+                shifted["duplicateOf"] = page["duplicateOf"] + start
+            pages_skipped.append(shifted)
+        text = response['candidates'][0]['content']['parts'][0]['text']
+        parsed = safe_json_load(text)
+        if isinstance(parsed, list) and parsed:
+            parsed = parsed[0]
+        if not isinstance(parsed, dict):
+            raise ValueError(f"Window for pages {start + 1}-{end} did not return a JSON object")
+        window_results.append((start, parsed))
+        window_info.append({
+            "pages": [start + 1, end],
+            "latencySeconds": round(latency, 3),
+            "usageMetadata": response.get("usageMetadata", {}),
+            "cacheHit": response.get("cacheHit", False),
+            "modelUsed": response.get("modelUsed"),
+        })
+
+    merged = page_windows.merge_window_results(window_results, total_pages)
+
+    formatted_response = _new_formatted_response(
+        total_pages,
+        document.page_count,
+        preprocessing.merge_metadata([response.get("preprocessing") for response, _ in results.values()])
+    )
+    formatted_response["candidates"].append({
+        "content": {
+            "parts": [{"text": json.dumps(merged, ensure_ascii=False)}],
+            "role": "model"
+        },
+        "finishReason": None,
+        "safetyRatings": []
+    })
+    formatted_response["usageMetadata"] = page_windows.sum_usage_metadata([r for r, _ in results.values()])
+    if pages_skipped:
+        formatted_response["pagesSkipped"] = pages_skipped
+        formatted_response["preprocessing"]["pages_skipped"] = pages_skipped
+    formatted_response["windows"] = window_info
+    models_used = [info["modelUsed"] for info in window_info if info["modelUsed"]]
+    formatted_response["modelUsed"] = ",".join(dict.fromkeys(models_used)) or None
+    formatted_response["route"] = route.name
+
+    update_progress("Document processing completed successfully!")
+    return formatted_response
 
 
 # Legacy function for backward compatibility - now with page limitation
@@ -28,7 +28,12 @@ from cryptography.fernet import Fernet
 
 import logging
 from .logger import log_exception, log_exceptions
+from . import (
+    client_disconnect, estimation, memory_budget, model_routing, output_schema, receipt_batching, reimbursement, resilience,
+    singleflight,
+)
 import uuid
+import tempfile
 import time
 import threading
 import queue
@@ -37,15 +42,21 @@ import queue
 logger = logging.getLogger(__name__)
 
 # Updated import with new streaming function
-from .vertex_model import call_gemini_api_with_streaming, MODEL_ID
+from .vertex_model import (
+    call_gemini_api_with_streaming,
+    call_gemini_api_windowed,
+    stream_gemini_api,
+    MODEL_ID,
+)
 import yaml
 import configparser
 
 # ... (keep your existing APP_CONFIG loading code)
 
-# Initialize prompts
+# Prompts are loaded on first use (see get_app_config) to keep worker startup fast
 APP_CONFIG = {}
 CONFIG_FILE_PATH = os.path.join(settings.BASE_DIR, 'Prompts', 'prompts.yaml')
+_app_config_lock = threading.Lock()
 
 def load_prompts():
     """Load prompts from YAML file"""
@@ -64,7 +75,13 @@ def load_prompts():
         logger.critical(f"Error loading prompts from YAML at {CONFIG_FILE_PATH}: {e}", exc_info=True)
         raise
 
-load_prompts()
+def get_app_config():
+    """Return the parsed prompts.yaml, loading it on first use."""
+    if not APP_CONFIG:
+        with _app_config_lock:
+            if not APP_CONFIG:
+                load_prompts()
+    return APP_CONFIG
 
 # ... (keep your existing environment loading and helper functions)
 
@@ -74,21 +91,6 @@ if env_path and os.path.exists(env_path):
 else:
     load_dotenv()
 
-def safe_json_load(raw_string: str):
-    if not raw_string or not raw_string.strip():
-        raise json.JSONDecodeError("Empty or whitespace-only string", raw_string, 0)
-
-    cleaned = raw_string.strip()
-
-    if cleaned.startswith("```json"):
-        lines = cleaned.splitlines()
-        if len(lines) > 2 and lines[-1].strip() == "```":
-            cleaned = "\n".join(lines[1:-1])
-        else:
-            cleaned = "\n".join(lines[1:])
-
-    return json.loads(cleaned)
-
 def get_fernet_key():
     try:
         config = configparser.ConfigParser()
@@ -113,22 +115,192 @@ def get_fernet_key():
         logger.error(f"Error loading Fernet key: {str(e)}")
         return None
 
-FERNET_KEY = get_fernet_key()
+_fernet = None
 
-if not FERNET_KEY:
-    logger.error("Fernet key initialization failed")
+def get_fernet() -> Fernet:
+    """Return the Fernet instance for document ids, reading config.properties on first use."""
+    global _fernet
+    if _fernet is None:
+        key = get_fernet_key()
+        if not key:
+            logger.error("Fernet key initialization failed")
+        _fernet = Fernet(key)
+    return _fernet
 
 def encrypt_id(id: int) -> str:
-    fernet = Fernet(FERNET_KEY)
+    fernet = get_fernet()
     id_bytes = str(id).encode()
     encrypted = fernet.encrypt(id_bytes)
     return encrypted.decode()
 
 def decrypt_id(token: str) -> int:
-    fernet = Fernet(FERNET_KEY)
+    fernet = get_fernet()
     decrypted = fernet.decrypt(token.encode())
     return int(decrypted.decode())
 
+SUPPORTED_EXTENSIONS = [".jpg", ".jpeg", ".png", ".pdf"]
+REIMBURSEMENT_DOC_TYPE = reimbursement.DOC_TYPE
+# Document type whose prompt numbers several documents, so its receipts can be batched
+BATCH_DOC_TYPE = REIMBURSEMENT_DOC_TYPE
+
+def get_prompt_name_for_doc_type(doc_type):
+    """Return the name of the prompts.yaml prompt used for ``doc_type``."""
+    if doc_type == REIMBURSEMENT_DOC_TYPE:
+        return reimbursement.prompt_name()
+    return 'doc_extraction_prompt'
+
+def get_prompt_for_doc_type(doc_type):
+    """Return the prompts.yaml prompt text used for ``doc_type``."""
+    return get_app_config().get('prompts', {}).get(get_prompt_name_for_doc_type(doc_type), '')
+
+def get_schema_for_doc_type(doc_type, prompt_text_from_request=None):
+    """
+    Return the output schema declared for the prompt of ``doc_type``.
+
+    None when the request brings its own prompt, since the schema describes
+    the prompts.yaml prompt's answer.
+    """
+    if prompt_text_from_request:
+        return None
+    return output_schema.schema_for(get_app_config(), get_prompt_name_for_doc_type(doc_type))
+
+def save_uploaded_file(uploaded_file):
+    """
+    Save an uploaded file under a unique name in MEDIA_ROOT.
+
+    Returns:
+        tuple: (relative_path, absolute_path, extension)
+    """
+    custom_dir = "uploads/pdf_files"
+    save_dir = os.path.join(settings.MEDIA_ROOT, custom_dir)
+    os.makedirs(save_dir, exist_ok=True)
+
+    file_name = uploaded_file.name
+    name_without_ext, extension = os.path.splitext(file_name)
+    extension = extension.lower()
+    sanitized_name = name_without_ext.replace("/", "_").replace("\\", "_")
+    unique_name = f"{sanitized_name}_{uuid.uuid4()}{extension}"
+    relative_path = default_storage.save(
+        os.path.join(custom_dir, unique_name), uploaded_file
+    )
+    absolute_path = os.path.join(settings.MEDIA_ROOT, relative_path)
+    return relative_path, absolute_path, extension
+
+def budget_exceeded_response(user, estimate, budget, needs="this document needs"):
+    """The 403 returned for a request that does not fit in the user's input token budget."""
+    return Response({
+        "status": "error",
+        "message": (
+            f"Input token budget exceeded: {needs} about {estimate['estimated_input_tokens']} "
+            f"tokens and {budget['remaining']} of {budget['limit']} remain."
+        ),
+        "estimate": estimate,
+        "budget": budget,
+        "usage_info": user.get_usage_info()
+    }, status=status.HTTP_403_FORBIDDEN)
+
+def apply_token_budget(user, relative_path, absolute_path, prompt_text, max_pages):
+    """
+    Estimate an upload and check it against the user's input token budget.
+
+    Requests that do not fit are downgraded to fewer pages or rejected, in
+    which case the saved upload is deleted again. Users without a budget get
+    a page-count estimate, which does not preprocess the document.
+
+    Returns:
+        tuple: (max_pages to apply, estimate, error Response or None)
+    """
+    if estimation.input_token_budget(user) is None:
+        return max_pages, estimation.quick_estimate(absolute_path, prompt_text, max_pages), None
+
+    estimate = estimation.estimate(absolute_path, prompt_text, max_pages, method="local")
+    budget = estimation.check_budget(user, estimate)
+
+    if budget["decision"] == estimation.REJECT:
+        logger.warning(f"User {user.id} is over the input token budget: {budget}")
+        default_storage.delete(relative_path)
+        return max_pages, estimate, budget_exceeded_response(user, estimate, budget)
+
+    if budget["decision"] == estimation.DOWNGRADE:
+        logger.info(f"Downgrading user {user.id} request to {budget['page_limit']} pages to fit the token budget")
+        estimate = estimation.limit_estimate(estimate, budget["page_limit"])
+        return budget["page_limit"], estimate, None
+
+    return max_pages, estimate, None
+
+def parse_extraction_json(result_json, doc_type=None, response_schema=None, response=None, api_response_time=None):
+    """
+    Parse the model's text output into the dict stored as Document.json_data.
+
+    The outcome is counted per doc_type (see output_schema.parse_output).
+    Reimbursement totals are computed from the expenses, and the call
+    (``response`` and its latency) is measured (see reimbursement).
+
+    Raises:
+        json.JSONDecodeError: If the text is not valid JSON
+        ValueError: If the JSON is not an object (or a list starting with one)
+    """
+    parsed = output_schema.parse_output(result_json, doc_type, response_schema)
+    if doc_type == REIMBURSEMENT_DOC_TYPE:
+        parsed = reimbursement.complete(parsed, response=response, seconds=api_response_time)
+    return parsed
+
+def store_extraction_result(
+    user,
+    relative_path,
+    parsed_json,
+    doc_type,
+    response,
+    api_response_time,
+    pages_processed,
+    is_full_document,
+    estimate=None,
+):
+    """
+    Write the JSON next to the upload, create the Document and bill the user.
+
+    ``estimate`` is the pre-flight estimate of the request, recorded in
+    processing_metadata to calibrate future estimates.
+
+    Returns:
+        Document: The saved document
+    """
+    usage_metadata = response.get('usageMetadata', {})
+    input_tokens = usage_metadata.get('promptTokenCount', 0)
+    output_tokens = usage_metadata.get('candidatesTokenCount', 0)
+
+    json_filename = os.path.splitext(relative_path)[0] + ".json"
+    json_path = os.path.join(settings.MEDIA_ROOT, json_filename)
+    with open(json_path, "w", encoding="utf-8") as jf:
+        json.dump(parsed_json, jf, indent=2, ensure_ascii=False)
+
+    processing_metadata = dict(response.get('preprocessing') or {})
+    if estimate:
+        estimation.record_estimate(processing_metadata, estimate)
+
+    db_start = time.time()
+    doc = Document.objects.create(
+        file_path=relative_path,
+        file=relative_path,
+        json_data=parsed_json,
+        userid=user,
+        document_type=doc_type,
+        input_token=input_tokens,
+        output_token=output_tokens,
+        api_response_time=api_response_time,
+        llm_model_used=response.get('modelUsed') or MODEL_ID,
+        pages_processed=pages_processed,
+        is_full_document=is_full_document,
+        processing_metadata=processing_metadata
+    )
+    db_save_time = time.time() - db_start
+    doc.db_save_time = db_save_time
+    doc.save(update_fields=["db_save_time"])
+
+    # Update user usage counters
+    user.increment_usage(pages_processed)
+    return doc
+
 # Updated views with user restrictions and streaming
 
 class GetDocumentByIdView(APIView):
@@ -172,6 +344,7 @@ class GetDocumentByIdView(APIView):
                     "llm_model_used": doc.llm_model_used,
                     "pages_processed": getattr(doc, 'pages_processed', 1),
                     "is_full_document": getattr(doc, 'is_full_document', False),
+                    "processing_metadata": doc.processing_metadata,
                 }
 
             return Response(response_data, status=status.HTTP_200_OK)
@@ -329,8 +502,6 @@ class UploadAndProcessFileView(APIView):
         logger.info("Upload request received")
 
         user = request.user
-        input_tokens = 0
-        output_tokens = 0
 
         if not uploaded_file:
             logger.error("Upload failed: 'pdf_file' is missing in the request.", exc_info=True)
@@ -355,16 +526,8 @@ class UploadAndProcessFileView(APIView):
             max_pages = None
         
         # Determine prompt text
-        prompt_text = None
-        if prompt_text_from_request:
-            prompt_text = prompt_text_from_request
-        else:
-            if doc_type == 'docextraction':
-                prompt_text = APP_CONFIG.get('prompts', {}).get('doc_extraction_prompt', '')
-            elif doc_type == 'Bill Reimbursment':
-                prompt_text = APP_CONFIG.get('prompts', {}).get('reimbursement_extraction_prompt', '')
-            else:
-                prompt_text = APP_CONFIG.get('prompts', {}).get('doc_extraction_prompt', '')
+        prompt_text = prompt_text_from_request or get_prompt_for_doc_type(doc_type)
+        response_schema = get_schema_for_doc_type(doc_type, prompt_text_from_request)
 
         if not prompt_text:
             logger.error(f"Prompt text is empty or not found in prompts.yaml for doc_type: {doc_type}.")
@@ -374,29 +537,28 @@ class UploadAndProcessFileView(APIView):
             )
 
         try:
-            with log_exceptions(logger):
+            # Model calls are abandoned as soon as the client goes away
+            with log_exceptions(logger), client_disconnect.watch(request) as cancel_token:
                 # Save uploaded file
-                custom_dir = "uploads/pdf_files"
-                save_dir = os.path.join(settings.MEDIA_ROOT, custom_dir)
-                os.makedirs(save_dir, exist_ok=True)
-
-                file_name = uploaded_file.name
-                name_without_ext, extension = os.path.splitext(file_name)
-                extension = extension.lower()
-                sanitized_name = name_without_ext.replace("/", "_").replace("\\", "_")
-                unique_name = f"{sanitized_name}_{uuid.uuid4()}{extension}"
-                relative_path = default_storage.save(
-                    os.path.join(custom_dir, unique_name), uploaded_file
-                )
-                absolute_path = os.path.join(settings.MEDIA_ROOT, relative_path)
+                relative_path, absolute_path, extension = save_uploaded_file(uploaded_file)
 
-                if extension not in [".jpg", ".jpeg", ".png", ".pdf"]:
+                if extension not in SUPPORTED_EXTENSIONS:
                     logger.error("Unsupported file type provided.", exc_info=True)
                     return Response(
                         {"status": "error", "message": "Unsupported file type"},
                         status=status.HTTP_400_BAD_REQUEST,
                     )
 
+                # Reject or downgrade requests that would exceed the token budget
+                limited_pages, estimate, budget_error = apply_token_budget(
+                    user, relative_path, absolute_path, prompt_text, max_pages
+                )
+                if budget_error is not None:
+                    return budget_error
+                if limited_pages != max_pages:
+                    max_pages = limited_pages
+                    process_full_document = False
+
                 # Progress tracking for streaming updates
                 progress_messages = []
                 
@@ -408,13 +570,20 @@ class UploadAndProcessFileView(APIView):
 
                 # Extract structured JSON with streaming and page limitation
                 try:
+                    # Full documents are split into page windows extracted in parallel
+                    extract = call_gemini_api_windowed if max_pages is None else call_gemini_api_with_streaming
                     api_start = time.time()
-                    response = call_gemini_api_with_streaming(
+                    response = extract(
                         prompt_text=prompt_text,
                         input_data=absolute_path,
                         response_mime_type="application/json",
                         max_pages=max_pages,
-                        progress_callback=progress_callback
+                        progress_callback=progress_callback,
+                        doc_type=doc_type,
+                        user_type=user.user_type,
+                        user_id=user.id,
+                        response_schema=response_schema,
+                        cancel_token=cancel_token
                     )
                     api_response_time = time.time() - api_start
 
@@ -439,30 +608,21 @@ class UploadAndProcessFileView(APIView):
                                 status=status.HTTP_500_INTERNAL_SERVER_ERROR,
                             )
 
-                        parsed_json = safe_json_load(result_json)
-
-                        if parsed_json is None:
-                            logger.error(
-                                "Failed to parse JSON: Invalid JSON format",
-                                exc_info=True,
-                            )
-                            return Response(
-                                {"error": "Invalid JSON format received from API"},
-                                status=status.HTTP_400_BAD_REQUEST,
-                            )
-
-                        if isinstance(parsed_json, list) and parsed_json:
-                            parsed_json = parsed_json[0]
-
-                        if not isinstance(parsed_json, dict):
-                            logger.error("Parsed JSON is not a dictionary.", exc_info=True)
+                        try:
+                            parsed_json = parse_extraction_json(result_json, doc_type, response_schema, response, api_response_time)
+                        except ValueError as e:
+                            logger.error(f"Failed to parse JSON: {str(e)}", exc_info=True)
                             return Response(
                                 {"error": "Invalid JSON format received from API"},
                                 status=status.HTTP_400_BAD_REQUEST,
                             )
 
                         logger.debug("Successfully parsed JSON response")
+                        # A client that left during parsing is not charged for the result
+                        cancel_token.check()
 
+                    except resilience.CancelledError:
+                        raise
                     except KeyError as e:
                         logger.error(f"Missing key in API response: {str(e)}", exc_info=True)
                         return Response(
@@ -488,6 +648,38 @@ class UploadAndProcessFileView(APIView):
                         {"error": "Invalid JSON received from API"},
                         status=status.HTTP_400_BAD_REQUEST,
                     )
+                except resilience.CircuitOpenError as e:
+                    logger.warning(f"Extraction rejected, circuit open: {str(e)}")
+                    return Response(
+                        {"error": str(e)},
+                        status=status.HTTP_503_SERVICE_UNAVAILABLE,
+                    )
+                except resilience.DeadlineExceededError as e:
+                    logger.error(f"Extraction deadline exceeded: {str(e)}")
+                    return Response(
+                        {"error": "Document processing took too long. Please try again."},
+                        status=status.HTTP_504_GATEWAY_TIMEOUT,
+                    )
+                except memory_budget.DocumentTooLargeError as e:
+                    logger.warning(f"Extraction rejected, document too large for the memory budget: {str(e)}")
+                    default_storage.delete(relative_path)
+                    return Response(
+                        {"error": str(e)},
+                        status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                    )
+                except memory_budget.MemoryBudgetTimeout as e:
+                    logger.warning(f"Extraction rejected, no memory freed up: {str(e)}")
+                    return Response(
+                        {"error": str(e)},
+                        status=status.HTTP_503_SERVICE_UNAVAILABLE,
+                    )
+                except resilience.CancelledError as e:
+                    logger.info(f"Extraction cancelled: {str(e)}")
+                    default_storage.delete(relative_path)
+                    return Response(
+                        {"error": "Request cancelled"},
+                        status=client_disconnect.CLIENT_CLOSED_REQUEST,
+                    )
                 except Exception as e:
                     logger.error(
                         f"Error during JSON extraction API call: {str(e)}",
@@ -500,41 +692,26 @@ class UploadAndProcessFileView(APIView):
 
                 if 'usageMetadata' in response:
                     usage_metadata = response['usageMetadata']
-                    input_tokens = usage_metadata.get('promptTokenCount', 0)
-                    output_tokens = usage_metadata.get('candidatesTokenCount', 0)
                     logger.info(
-                        f"JSON Extraction - Input Tokens: {input_tokens}, Output Tokens: {output_tokens}"
+                        f"JSON Extraction - Input Tokens: {usage_metadata.get('promptTokenCount', 0)}, "
+                        f"Output Tokens: {usage_metadata.get('candidatesTokenCount', 0)}"
                     )
                 else:
                     logger.info(
                         "JSON Extraction - Usage metadata not available in the response."
                     )
 
-                json_filename = os.path.splitext(relative_path)[0] + ".json"
-                json_path = os.path.join(settings.MEDIA_ROOT, json_filename)
-                with open(json_path, "w", encoding="utf-8") as jf:
-                    json.dump(parsed_json, jf, indent=2, ensure_ascii=False)
-
-                db_start = time.time()
-                doc = Document.objects.create(
-                    file_path=relative_path,
-                    file=relative_path,
-                    json_data=parsed_json,
-                    userid=user,
-                    document_type=doc_type,
-                    input_token=input_tokens,
-                    output_token=output_tokens,
-                    api_response_time=api_response_time,
-                    llm_model_used=MODEL_ID,
-                    pages_processed=pages_processed,
-                    is_full_document=process_full_document and user.user_type in ['power', 'admin']
+                doc = store_extraction_result(
+                    user,
+                    relative_path,
+                    parsed_json,
+                    doc_type,
+                    response,
+                    api_response_time,
+                    pages_processed,
+                    is_full_document=process_full_document and user.user_type in ['power', 'admin'],
+                    estimate=estimate,
                 )
-                db_save_time = time.time() - db_start
-                doc.db_save_time = db_save_time
-                doc.save(update_fields=["db_save_time"])
-
-                # Update user usage counters
-                user.increment_usage(pages_processed)
 
                 encrypted_doc_id = encrypt_id(doc.id)
                 logger.info(
@@ -546,7 +723,10 @@ class UploadAndProcessFileView(APIView):
                     "status": "success", 
                     "document_id": encrypted_doc_id,
                     "pages_processed": pages_processed,
+                    "pages_skipped": response.get("pagesSkipped", []),
                     "is_full_document": doc.is_full_document,
+                    "cache_hit": response.get("cacheHit", False),
+                    "estimate": estimate,
                     "progress_messages": progress_messages,
                     "usage_info": user.get_usage_info()
                 }
@@ -566,6 +746,460 @@ class UploadAndProcessFileView(APIView):
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR,
             )
 
+class BatchUploadView(APIView):
+    """
+    Extract many Bill Reimbursment receipts in as few model calls as possible.
+
+    Files are packed into batches by receipt_batching, each file is saved as
+    its own Document holding its expenses, and the merged reimbursement
+    result is returned.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        uploaded_files = request.FILES.getlist("pdf_files")
+        doc_type = request.POST.get("doc_type") or BATCH_DOC_TYPE
+        process_full_document = request.POST.get("process_full_document", "false").lower() == "true"
+        user = request.user
+
+        logger.info(f"Batch upload request received with {len(uploaded_files)} files")
+
+        if not uploaded_files:
+            return Response(
+                {"status": "error", "message": "Missing 'pdf_files'"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if doc_type != BATCH_DOC_TYPE:
+            return Response(
+                {"status": "error", "message": f"Batch uploads are only supported for '{BATCH_DOC_TYPE}'"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        max_files = int(getattr(settings, "RECEIPT_BATCH_MAX_FILES", 50))
+        if len(uploaded_files) > max_files:
+            return Response(
+                {"status": "error", "message": f"At most {max_files} files can be uploaded at once"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if any(os.path.splitext(f.name)[1].lower() not in SUPPORTED_EXTENSIONS for f in uploaded_files):
+            return Response(
+                {"status": "error", "message": "Unsupported file type"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        can_process, limit_message = user.can_process_document(len(uploaded_files))
+        if not can_process:
+            logger.warning(f"User {user.id} hit document limit: {limit_message}")
+            return Response({
+                "status": "error",
+                "message": limit_message,
+                "usage_info": user.get_usage_info()
+            }, status=status.HTTP_403_FORBIDDEN)
+
+        max_pages = 3
+        if user.user_type in ['power', 'admin'] and process_full_document:
+            max_pages = None
+
+        prompt_text = request.POST.get("prompt_text") or get_prompt_for_doc_type(doc_type)
+        response_schema = get_schema_for_doc_type(doc_type, request.POST.get("prompt_text"))
+        if not prompt_text:
+            return Response(
+                {"status": "error", "message": "Prompt text could not be determined for the document type."},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
+
+        saved = [save_uploaded_file(uploaded_file) for uploaded_file in uploaded_files]
+        paths = [absolute_path for _, absolute_path, _ in saved]
+
+        def discard_uploads():
+            for relative_path, _, _ in saved:
+                default_storage.delete(relative_path)
+
+        # The whole batch must fit in the token budget; receipts are not dropped to make it fit
+        calls = len(receipt_batching.plan_batches([model_routing.describe_input(path, max_pages) for path in paths]))
+        if estimation.input_token_budget(user) is None:
+            estimate = estimation.combine(
+                [estimation.quick_estimate(path, prompt_text, max_pages) for path in paths], calls
+            )
+        else:
+            estimate = estimation.combine(
+                [estimation.estimate(path, prompt_text, max_pages, method="local") for path in paths], calls
+            )
+        budget = estimation.check_budget(user, estimate)
+        if budget["decision"] != estimation.ALLOW:
+            discard_uploads()
+            return budget_exceeded_response(user, estimate, budget, "these documents need")
+
+        progress_messages = []
+
+        def progress_callback(message):
+            progress_messages.append({"timestamp": time.time(), "message": message})
+
+        try:
+            try:
+                with client_disconnect.watch(request) as cancel_token:
+                    outcome = receipt_batching.extract_batches(
+                        paths, prompt_text, max_pages,
+                        doc_type=doc_type, user_type=user.user_type, user_id=user.id, progress_callback=progress_callback,
+                        response_schema=response_schema, cancel_token=cancel_token
+                    )
+            except Exception:
+                # No Document will point at the saved receipts, whatever the failure
+                discard_uploads()
+                raise
+        except resilience.CancelledError as e:
+            logger.info(f"Batch extraction cancelled: {str(e)}")
+            return Response({"error": "Request cancelled"}, status=client_disconnect.CLIENT_CLOSED_REQUEST)
+        except resilience.CircuitOpenError as e:
+            logger.warning(f"Batch extraction rejected, circuit open: {str(e)}")
+            return Response({"error": str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        except memory_budget.DocumentTooLargeError as e:
+            logger.warning(f"Batch extraction rejected, too large for the memory budget: {str(e)}")
+            return Response({"error": str(e)}, status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        except memory_budget.MemoryBudgetTimeout as e:
+            logger.warning(f"Batch extraction rejected, no memory freed up: {str(e)}")
+            return Response({"error": str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        except resilience.DeadlineExceededError as e:
+            logger.error(f"Batch extraction deadline exceeded: {str(e)}")
+            return Response(
+                {"error": "Document processing took too long. Please try again."},
+                status=status.HTTP_504_GATEWAY_TIMEOUT,
+            )
+        except Exception as e:
+            logger.error(f"Error during batch extraction: {str(e)}", exc_info=True)
+            return Response(
+                {"error": f"Error during JSON extraction: {str(e)}"},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            )
+
+        batch_id = str(uuid.uuid4())
+        documents = []
+        batches = []
+        for call, batch in enumerate(outcome["batches"], start=1):
+            indices = batch["indices"]
+            response = batch["response"]
+            per_document, unassigned = receipt_batching.split_expenses(batch["parsed"], len(indices))
+            if unassigned:
+                logger.warning(f"Batch {batch_id} call {call}: {len(unassigned)} expenses without a valid document number")
+            usage_shares = receipt_batching.split_usage(
+                response.get("usageMetadata", {}), [outcome["pages"][index] for index in indices]
+            )
+            for index, expenses, usage in zip(indices, per_document, usage_shares):
+                relative_path = saved[index][0]
+                document_response = {
+                    "usageMetadata": usage,
+                    "modelUsed": response.get("modelUsed"),
+                    "preprocessing": {"batch": {
+                        "id": batch_id,
+                        "document": index + 1,
+                        "documents": len(paths),
+                        "call": call,
+                        "documents_in_call": len(indices),
+                    }},
+                }
+                doc = store_extraction_result(
+                    user,
+                    relative_path,
+                    reimbursement.complete({"expenses": [{**expense, "document": 1} for expense in expenses]}, 1),
+                    doc_type,
+                    document_response,
+                    batch["latency"],
+                    outcome["pages"][index],
+                    is_full_document=max_pages is None,
+                )
+                documents.append({
+                    "document": index + 1,
+                    "document_id": encrypt_id(doc.id),
+                    "file_name": uploaded_files[index].name,
+                    "pages_processed": outcome["pages"][index],
+                    "expenses": expenses,
+                })
+            batches.append({
+                "documents": [index + 1 for index in indices],
+                "latencySeconds": round(batch["latency"], 3),
+                "usageMetadata": response.get("usageMetadata", {}),
+                "modelUsed": response.get("modelUsed"),
+                "cacheHit": response.get("cacheHit", False),
+            })
+
+        documents.sort(key=lambda item: item["document"])
+        logger.info(f"Batch {batch_id}: {len(paths)} documents extracted in {len(batches)} calls")
+        return Response({
+            "status": "success",
+            "batch_id": batch_id,
+            "documents": documents,
+            "missing_documents": [item["document"] for item in documents if not item["expenses"]],
+            "result": outcome["result"],
+            "batches": batches,
+            "estimate": estimate,
+            "progress_messages": progress_messages,
+            "usage_info": user.get_usage_info()
+        }, status=status.HTTP_200_OK)
+
+
+def sse_event(event, data):
+    """Format one Server-Sent Events message."""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+# Seconds of silence after which a keep-alive comment is sent on an SSE stream
+SSE_HEARTBEAT_SECONDS = 15
+
+class EstimateUploadView(APIView):
+    """
+    Dry run of upload/: estimate tokens, latency and the page limit that
+    would apply, without calling the model or keeping the file.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        uploaded_file = request.FILES.get("pdf_file")
+        doc_type = request.POST.get("doc_type")
+        process_full_document = request.POST.get("process_full_document", "false").lower() == "true"
+        user = request.user
+
+        if not uploaded_file:
+            return Response(
+                {"status": "error", "message": "Missing 'pdf_file"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        extension = os.path.splitext(uploaded_file.name)[1].lower()
+        if extension not in SUPPORTED_EXTENSIONS:
+            return Response(
+                {"status": "error", "message": "Unsupported file type"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        prompt_text = request.POST.get("prompt_text") or get_prompt_for_doc_type(doc_type)
+        if not prompt_text:
+            return Response(
+                {"status": "error", "message": "Prompt text could not be determined for the document type."},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
+
+        max_pages = 3
+        if user.user_type in ['power', 'admin'] and process_full_document:
+            max_pages = None
+
+        try:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                path = os.path.join(tmpdir, f"estimate{extension}")
+                with open(path, "wb") as f:
+                    for chunk in uploaded_file.chunks():
+                        f.write(chunk)
+                estimate = estimation.estimate(path, prompt_text, max_pages)
+        except Exception:
+            log_exception(logger)
+            return Response(
+                {"status": "error", "message": "Could not estimate the document"},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
+
+        budget = estimation.check_budget(user, estimate)
+        if budget["decision"] == estimation.DOWNGRADE:
+            estimate = estimation.limit_estimate(estimate, budget["page_limit"])
+
+        can_process, limit_message = user.can_process_document()
+        return Response({
+            "status": "success",
+            "can_process": can_process and budget["decision"] != estimation.REJECT,
+            "message": limit_message,
+            **estimate,
+            "budget": budget,
+            "usage_info": user.get_usage_info()
+        }, status=status.HTTP_200_OK)
+
+
+class StreamUploadAndProcessFileView(APIView):
+    """
+    Upload a document and stream the extraction back as Server-Sent Events.
+
+    Events: ``progress`` as processing advances, ``page`` for every page_N object
+    as soon as the model has finished generating it, ``field`` for other top-level
+    members, then ``complete`` with the saved document id, or ``error``.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        uploaded_file = request.FILES.get("pdf_file")
+        prompt_text_from_request = request.POST.get("prompt_text")
+        doc_type = request.POST.get("doc_type")
+        process_full_document = request.POST.get("process_full_document", "false").lower() == "true"
+
+        logger.info("Streaming upload request received")
+
+        user = request.user
+
+        if not uploaded_file:
+            logger.error("Streaming upload failed: 'pdf_file' is missing in the request.")
+            return Response(
+                {"status": "error", "message": "Missing 'pdf_file"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        can_process, limit_message = user.can_process_document()
+        if not can_process:
+            logger.warning(f"User {user.id} hit document limit: {limit_message}")
+            return Response({
+                "status": "error",
+                "message": limit_message,
+                "usage_info": user.get_usage_info()
+            }, status=status.HTTP_403_FORBIDDEN)
+
+        if os.path.splitext(uploaded_file.name)[1].lower() not in SUPPORTED_EXTENSIONS:
+            logger.error("Unsupported file type provided for streaming upload.")
+            return Response(
+                {"status": "error", "message": "Unsupported file type"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        max_pages = 3
+        is_full_document = user.user_type in ['power', 'admin'] and process_full_document
+        if is_full_document:
+            max_pages = None
+
+        prompt_text = prompt_text_from_request or get_prompt_for_doc_type(doc_type)
+        response_schema = get_schema_for_doc_type(doc_type, prompt_text_from_request)
+        if not prompt_text:
+            logger.error(f"Prompt text is empty or not found in prompts.yaml for doc_type: {doc_type}.")
+            return Response(
+                {"status": "error", "message": "Prompt text could not be determined for the document type."},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
+
+        relative_path, absolute_path, _ = save_uploaded_file(uploaded_file)
+
+        limited_pages, estimate, budget_error = apply_token_budget(
+            user, relative_path, absolute_path, prompt_text, max_pages
+        )
+        if budget_error is not None:
+            return budget_error
+        if limited_pages != max_pages:
+            max_pages = limited_pages
+            is_full_document = False
+
+        # The model call runs on a worker thread so the response generator can
+        # send keep-alives while waiting for the first tokens, and relay the
+        # progress of waits (memory, rate limiter queue) while they last.
+        events = queue.Queue()
+        # Cancelled when the client closes the event stream before the end
+        cancel_token = resilience.CancelToken()
+
+        def run_extraction():
+            try:
+                for event in stream_gemini_api(
+                    prompt_text=prompt_text,
+                    input_data=absolute_path,
+                    response_mime_type="application/json",
+                    max_pages=max_pages,
+                    doc_type=doc_type,
+                    user_type=user.user_type,
+                    user_id=user.id,
+                    response_schema=response_schema,
+                    cancel_token=cancel_token,
+                    progress_callback=lambda message: events.put({"type": "progress", "message": message}),
+                ):
+                    events.put(event)
+            except resilience.CancelledError as e:
+                logger.info(f"Streamed extraction cancelled: {str(e)}")
+            except Exception as e:
+                logger.error(f"Error during streamed extraction: {str(e)}", exc_info=True)
+                events.put({"type": "error", "message": str(e)})
+            finally:
+                events.put(None)
+
+        api_start = time.time()
+        threading.Thread(target=run_extraction, daemon=True).start()
+
+        # Set once a Document owns the upload
+        stored = []
+
+        def event_stream():
+            finished = False
+            try:
+                for chunk in relay_events():
+                    yield chunk
+                finished = True
+            finally:
+                if not finished:
+                    cancel_token.cancel(resilience.CancelToken.CLIENT_DISCONNECTED)
+                if not stored:
+                    # Failed, cancelled or unparsable extractions leave no upload behind
+                    default_storage.delete(relative_path)
+
+        def relay_events():
+            while True:
+                try:
+                    event = events.get(timeout=SSE_HEARTBEAT_SECONDS)
+                except queue.Empty:
+                    yield ": keep-alive\n\n"
+                    continue
+
+                if event is None:
+                    return
+
+                if event["type"] == "progress":
+                    yield sse_event("progress", {"timestamp": time.time(), "message": event["message"]})
+                elif event["type"] == "member":
+                    name = "page" if str(event["key"]).startswith("page_") else "field"
+                    yield sse_event(name, {"key": event["key"], "value": event["value"]})
+                elif event["type"] == "error":
+                    yield sse_event("error", {"status": "error", "message": f"Error during JSON extraction: {event['message']}"})
+                elif event["type"] == "complete":
+                    chunk, doc = self._complete(
+                        user, relative_path, doc_type, event["response"],
+                        time.time() - api_start, is_full_document, estimate, response_schema
+                    )
+                    if doc is not None:
+                        stored.append(doc)
+                    yield chunk
+
+        response = StreamingHttpResponse(event_stream(), content_type="text/event-stream")
+        response["Cache-Control"] = "no-cache"
+        response["X-Accel-Buffering"] = "no"
+        return response
+
+    def _complete(
+        self, user, relative_path, doc_type, response, api_response_time, is_full_document,
+        estimate=None, response_schema=None
+    ):
+        """
+        Persist the finished extraction and build the final ``complete`` event.
+
+        Returns:
+            tuple: (the SSE event, the stored Document or None when the output was invalid)
+        """
+        try:
+            result_json = response['candidates'][0]['content']['parts'][0]['text']
+            parsed_json = parse_extraction_json(result_json, doc_type, response_schema, response, api_response_time)
+        except (KeyError, IndexError, ValueError) as e:
+            logger.error(f"Invalid JSON received from streamed extraction: {str(e)}", exc_info=True)
+            return sse_event("error", {"status": "error", "message": "Invalid JSON format received from API"}), None
+
+        pages_processed = response.get('pagesProcessed', 1)
+        doc = store_extraction_result(
+            user,
+            relative_path,
+            parsed_json,
+            doc_type,
+            response,
+            api_response_time,
+            pages_processed,
+            is_full_document,
+            estimate=estimate,
+        )
+        encrypted_doc_id = encrypt_id(doc.id)
+        logger.info(f"Streamed document processed and saved successfully. Document ID: {encrypted_doc_id}")
+
+        return sse_event("complete", {
+            "status": "success",
+            "document_id": encrypted_doc_id,
+            "pages_processed": pages_processed,
+            "pages_skipped": response.get("pagesSkipped", []),
+            "is_full_document": doc.is_full_document,
+            "cache_hit": response.get("cacheHit", False),
+            "usage_info": user.get_usage_info(),
+        }), doc
+
 # New view for power users to process full documents
 class ProcessFullDocumentView(APIView):
     permission_classes = [IsAuthenticated]
@@ -600,96 +1234,155 @@ class ProcessFullDocumentView(APIView):
                     status=status.HTTP_403_FORBIDDEN,
                 )
             
-            # Check if already processed as full document
-            if doc.is_full_document:
-                return Response(
-                    {"status": "error", "message": "Document already processed as full document"},
-                    status=status.HTTP_400_BAD_REQUEST
-                )
+            # Only one full-document run per Document at a time, across workers
+            with singleflight.document_lock(doc.id):
+                # Re-read in case a concurrent request just finished processing it
+                doc.refresh_from_db()
+
+                # Check if already processed as full document
+                if doc.is_full_document:
+                    return Response(
+                        {"status": "error", "message": "Document already processed as full document"},
+                        status=status.HTTP_400_BAD_REQUEST
+                    )
             
-            # Get the original file path
-            absolute_path = os.path.join(settings.MEDIA_ROOT, doc.file_path)
+                # Get the original file path
+                absolute_path = os.path.join(settings.MEDIA_ROOT, doc.file_path)
             
-            if not os.path.exists(absolute_path):
-                return Response(
-                    {"status": "error", "message": "Original file not found"},
-                    status=status.HTTP_404_NOT_FOUND
-                )
-            
-            # Determine prompt text based on document type
-            prompt_text = None
-            if doc.document_type == 'docextraction':
-                prompt_text = APP_CONFIG.get('prompts', {}).get('doc_extraction_prompt', '')
-            elif doc.document_type == 'Bill Reimbursment':
-                prompt_text = APP_CONFIG.get('prompts', {}).get('reimbursement_extraction_prompt', '')
-            else:
-                prompt_text = APP_CONFIG.get('prompts', {}).get('doc_extraction_prompt', '')
+                if not os.path.exists(absolute_path):
+                    return Response(
+                        {"status": "error", "message": "Original file not found"},
+                        status=status.HTTP_404_NOT_FOUND
+                    )
             
-            if not prompt_text:
-                return Response(
-                    {"status": "error", "message": "Could not determine prompt for document type"},
-                    status=status.HTTP_500_INTERNAL_SERVER_ERROR
-                )
+                # Determine prompt text based on document type
+                prompt_text = get_prompt_for_doc_type(doc.document_type)
+                response_schema = get_schema_for_doc_type(doc.document_type)
             
-            # Progress tracking
-            progress_messages = []
+                if not prompt_text:
+                    return Response(
+                        {"status": "error", "message": "Could not determine prompt for document type"},
+                        status=status.HTTP_500_INTERNAL_SERVER_ERROR
+                    )
             
-            def progress_callback(message):
-                progress_messages.append({
-                    "timestamp": time.time(),
-                    "message": message
-                })
+                # The full run must fit in the budget too, or a downgraded upload could be re-run at full length.
+                # Its tokens replace those already billed for the document.
+                estimate = None
+                if estimation.input_token_budget(user) is not None:
+                    estimate = estimation.estimate(absolute_path, prompt_text, None, method="local")
+                    budget = estimation.check_budget(user, estimate, replaced_tokens=doc.input_token or 0)
+                    if budget["decision"] != estimation.ALLOW:
+                        logger.warning(f"User {user.id} is over the input token budget for full document {doc.id}: {budget}")
+                        return budget_exceeded_response(user, estimate, budget)
+
+                # Progress tracking
+                progress_messages = []
             
-            # Process full document (no page limit)
-            api_start = time.time()
-            response = call_gemini_api_with_streaming(
-                prompt_text=prompt_text,
-                input_data=absolute_path,
-                response_mime_type="application/json",
-                max_pages=None,  # No page limit
-                progress_callback=progress_callback
-            )
-            api_response_time = time.time() - api_start
+                def progress_callback(message):
+                    progress_messages.append({
+                        "timestamp": time.time(),
+                        "message": message
+                    })
             
-            # Process response
-            result_json = response['candidates'][0]['content']['parts'][0]['text']
-            pages_processed = response.get('pagesProcessed', 1)
-            parsed_json = safe_json_load(result_json)
+                # Process full document (no page limit), fanned out over page windows
+                api_start = time.time()
+                with client_disconnect.watch(request) as cancel_token:
+                    response = call_gemini_api_windowed(
+                        prompt_text=prompt_text,
+                        input_data=absolute_path,
+                        response_mime_type="application/json",
+                        max_pages=None,  # No page limit
+                        progress_callback=progress_callback,
+                        doc_type=doc.document_type,
+                        user_type=user.user_type,
+                        user_id=user.id,
+                        response_schema=response_schema,
+                        cancel_token=cancel_token
+                    )
+                api_response_time = time.time() - api_start
             
-            # Update token usage
-            if 'usageMetadata' in response:
-                usage_metadata = response['usageMetadata']
-                input_tokens = usage_metadata.get('promptTokenCount', 0)
-                output_tokens = usage_metadata.get('candidatesTokenCount', 0)
-            else:
-                input_tokens = doc.input_token or 0
-                output_tokens = doc.output_token or 0
+                # Process response
+                result_json = response['candidates'][0]['content']['parts'][0]['text']
+                pages_processed = response.get('pagesProcessed', 1)
+                parsed_json = parse_extraction_json(
+                    result_json, doc.document_type, response_schema, response, api_response_time
+                )
             
-            # Update document with full processing results
-            doc.json_data = parsed_json
-            doc.pages_processed = pages_processed
-            doc.is_full_document = True
-            doc.input_token = input_tokens
-            doc.output_token = output_tokens
-            doc.api_response_time = api_response_time
-            doc.save()
+                # Update token usage
+                if 'usageMetadata' in response:
+                    usage_metadata = response['usageMetadata']
+                    input_tokens = usage_metadata.get('promptTokenCount', 0)
+                    output_tokens = usage_metadata.get('candidatesTokenCount', 0)
+                else:
+                    input_tokens = doc.input_token or 0
+                    output_tokens = doc.output_token or 0
             
-            # Update user usage (difference in pages)
-            pages_difference = pages_processed - (doc.pages_processed or 1)
-            if pages_difference > 0:
-                user.total_pages_processed += pages_difference
-                user.save(update_fields=['total_pages_processed'])
+                # Update document with full processing results
+                doc.json_data = parsed_json
+                doc.pages_processed = pages_processed
+                doc.is_full_document = True
+                doc.input_token = input_tokens
+                doc.output_token = output_tokens
+                doc.api_response_time = api_response_time
+                doc.processing_metadata = response.get('preprocessing') or {}
+                if estimate:
+                    estimation.record_estimate(doc.processing_metadata, estimate)
+                doc.llm_model_used = response.get('modelUsed') or doc.llm_model_used
+                doc.save()
             
-            logger.info(f"Full document processing completed for document {doc.id}")
+                # Update user usage (difference in pages)
+                pages_difference = pages_processed - (doc.pages_processed or 1)
+                if pages_difference > 0:
+                    user.total_pages_processed += pages_difference
+                    user.save(update_fields=['total_pages_processed'])
             
-            return Response({
-                "status": "success",
-                "message": "Full document processed successfully",
-                "pages_processed": pages_processed,
-                "progress_messages": progress_messages,
-                "usage_info": user.get_usage_info()
-            }, status=status.HTTP_200_OK)
+                logger.info(f"Full document processing completed for document {doc.id}")
             
+                return Response({
+                    "status": "success",
+                    "message": "Full document processed successfully",
+                    "pages_processed": pages_processed,
+                    "pages_skipped": response.get("pagesSkipped", []),
+                    "progress_messages": progress_messages,
+                    "usage_info": user.get_usage_info()
+                }, status=status.HTTP_200_OK)
+
+        except singleflight.LockBusyError:
+            logger.warning(f"Full document processing already in progress for document {document_id}")
+            return Response(
+                {"status": "error", "message": "Full document processing is already in progress for this document"},
+                status=status.HTTP_409_CONFLICT
+            )
+        except resilience.CancelledError as e:
+            logger.info(f"Full document processing cancelled for document {document_id}: {str(e)}")
+            return Response(
+                {"status": "error", "message": "Request cancelled"},
+                status=client_disconnect.CLIENT_CLOSED_REQUEST
+            )
+        except resilience.CircuitOpenError as e:
+            logger.warning(f"Full document processing of document {document_id} rejected, circuit open: {str(e)}")
+            return Response(
+                {"status": "error", "message": str(e)},
+                status=status.HTTP_503_SERVICE_UNAVAILABLE
+            )
+        except resilience.DeadlineExceededError as e:
+            logger.error(f"Full document processing deadline exceeded for document {document_id}: {str(e)}")
+            return Response(
+                {"status": "error", "message": "Document processing took too long. Please try again."},
+                status=status.HTTP_504_GATEWAY_TIMEOUT
+            )
+        except memory_budget.DocumentTooLargeError as e:
+            logger.warning(f"Full document processing rejected for document {document_id}: {str(e)}")
+            return Response(
+                {"status": "error", "message": str(e)},
+                status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+            )
+        except memory_budget.MemoryBudgetTimeout as e:
+            logger.warning(f"Full document processing of document {document_id} waited too long for memory: {str(e)}")
+            return Response(
+                {"status": "error", "message": str(e)},
+                status=status.HTTP_503_SERVICE_UNAVAILABLE
+            )
         except Exception as e:
             logger.error(f"Error in ProcessFullDocumentView: {str(e)}", exc_info=True)
             return Response(